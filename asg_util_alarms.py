@@ -1,14 +1,29 @@
 #!/usr/bin/python3
+import asyncio
 import calendar
 import logging
+import math
 import signal
 import sys
+import threading
 import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import boto3
 
+from aws_clients import DEFAULT_REGION, BackoffClient, create_client
+from controller_metrics import ControllerMetrics, InstrumentedClient, start_metrics_server, time_phase
+from forecast import DEFAULT_HISTORY_SECONDS, MODELS, UtilizationForecaster
+from group_metrics import GroupUtilizationQuery
+from instance_readiness import ReadinessTracker
+from instance_sidecar import DEFAULT_PORT as DEFAULT_SIDECAR_PORT
+from instance_sidecar import DEFAULT_WINDOW_SECONDS as DEFAULT_SIDECAR_WINDOW_SECONDS
+from instance_sidecar import SidecarCollector
+from latency_slo import DEFAULT_POLL_SECONDS, DEFAULT_WINDOW_SECONDS, LatencySloMonitor
+from window_state import WINDOW_METRICS, InstanceWindowState, get_newest_timestamp
+
 FORMAT = '%(asctime)-15s %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 logger = logging.getLogger('asg_util_alarms')
@@ -16,6 +31,11 @@ logger = logging.getLogger('asg_util_alarms')
 LAUNCH_TIME_DELAY_SECONDS = 300
 PERIOD_SEC = 30
 WINDOW_MINUTES = 2
+TICK_SECONDS = 15
+DEFAULT_WORKERS = 16
+
+# Set once the script starts shutting down, so no tick overwrites the reset Target
+shutting_down = threading.Event()
 
 
 def get_mean_from_data_points(data_points):
@@ -33,8 +53,8 @@ def get_mean_from_data_points(data_points):
     return data_points_avg
 
 
-def get_metric_data_cpu_util(cw_client, instance_id: str, cpu: str, start_time: datetime, end_time: datetime,
-                             period_sec: int, asg_name: str):
+def get_cpu_idle_datapoints(cw_client, instance_id: str, cpu: str, start_time: datetime, end_time: datetime,
+                            period_sec: int, asg_name: str):
     cpu_response = cw_client.get_metric_statistics(
         Namespace='CWAgent',
         Dimensions=[
@@ -70,14 +90,25 @@ def get_metric_data_cpu_util(cw_client, instance_id: str, cpu: str, start_time:
     )
 
     if cpu_response:
+        return cpu_response['Datapoints']
+
+    return None
+
+
+def get_metric_data_cpu_util(cw_client, instance_id: str, cpu: str, start_time: datetime, end_time: datetime,
+                             period_sec: int, asg_name: str):
+    datapoints = get_cpu_idle_datapoints(cw_client, instance_id, cpu, start_time, end_time, period_sec, asg_name)
+
+    # No datapoints (e.g. the agent hasn't reported yet) means no utilization, not 0% idle
+    if datapoints:
         # 'Idle Percent' -> 'Utilization'
-        return (100 - get_mean_from_data_points(cpu_response['Datapoints'])) / 100
+        return (100 - get_mean_from_data_points(datapoints)) / 100
 
     return None
 
 
-def get_metric_data_disk_util(cw_client, instance_id: str, start_time: datetime, end_time: datetime, period_sec: int,
-                              asg_name: str):
+def get_disk_io_time_datapoints(cw_client, instance_id: str, start_time: datetime, end_time: datetime,
+                                period_sec: int, asg_name: str):
     disk_response = cw_client.get_metric_statistics(
         Namespace='CWAgent',
         Dimensions=[
@@ -113,8 +144,18 @@ def get_metric_data_disk_util(cw_client, instance_id: str, start_time: datetime,
     )
 
     if disk_response:
+        return disk_response['Datapoints']
+
+    return None
+
+
+def get_metric_data_disk_util(cw_client, instance_id: str, start_time: datetime, end_time: datetime, period_sec: int,
+                              asg_name: str):
+    datapoints = get_disk_io_time_datapoints(cw_client, instance_id, start_time, end_time, period_sec, asg_name)
+
+    if datapoints:
         # 'Milliseconds' -> 'Utilization'
-        return get_mean_from_data_points(disk_response['Datapoints']) / 1000 / period_sec
+        return get_mean_from_data_points(datapoints) / 1000 / period_sec
 
     return None
 
@@ -139,24 +180,57 @@ def put_metric_data_target(cw_client, target_value: float, asg_name: str):
     )
 
 
-def run_scaling_notifier(ec2, ec2_client, cw_client, cpu_upper: float, cpu_lower: float, disk_upper: float,
-                         disk_lower: float, period_sec: int, window_minutes: int, asg_name: str):
+def get_instance_utils(cw_client, instance_id: str, start_time: datetime, end_time: datetime, period_sec: int,
+                       asg_name: str):
+    """
+    Get the average utilization of each cpu and of the disk for a single instance.
     """
+    # Take average utilization for a single cpu for each instance.
+    cpu_utils = [get_metric_data_cpu_util(cw_client, instance_id, cpu, start_time, end_time, period_sec, asg_name)
+                 for cpu in ['cpu0', 'cpu1']]
+
+    # Take average utilization for the disk for each instance.
+    disk_util = get_metric_data_disk_util(cw_client, instance_id, start_time, end_time, period_sec, asg_name)
+
+    return cpu_utils, disk_util
+
 
+def update_instance_window(cw_client, state: InstanceWindowState, now: datetime, period_sec: int, asg_name: str):
     """
-    start_time = datetime.utcnow() - timedelta(minutes=window_minutes)
-    end_time = datetime.utcnow()
+    Fetch only the datapoints newer than what the instance's window state has already seen, then get the
+    window averages in the same form as get_instance_utils.
+    """
+    for metric in WINDOW_METRICS:
+        start_time = state.get_fetch_start(metric, now)
+        if metric == 'disk':
+            datapoints = get_disk_io_time_datapoints(cw_client, state.instance_id, start_time, now, period_sec,
+                                                     asg_name)
+        else:
+            datapoints = get_cpu_idle_datapoints(cw_client, state.instance_id, metric, start_time, now, period_sec,
+                                                 asg_name)
+        state.add_datapoints(metric, datapoints or [])
 
-    # Fetch running instances from asg_name auto scaling group
-    instances = ec2.instances.filter(
-        Filters=[
-            {'Name': 'instance-state-name', 'Values': ['running']},
-            {'Name': 'tag:aws:autoscaling:groupName', 'Values': [asg_name]}
-        ]
-    )
+    state.expire(now)
 
-    # Get ids from retrieved instances but exclude if not 'ok' status
-    current_epoch_seconds = calendar.timegm(time.gmtime())
+    # 'Idle Percent' -> 'Utilization'
+    cpu_utils = []
+    for cpu in ['cpu0', 'cpu1']:
+        cpu_idle = state.mean(cpu)
+        cpu_utils.append((100 - cpu_idle) / 100 if cpu_idle is not None else None)
+
+    # 'Milliseconds' -> 'Utilization'
+    disk_io_time = state.mean('disk')
+    disk_util = disk_io_time / 1000 / period_sec if disk_io_time is not None else None
+
+    return cpu_utils, disk_util
+
+
+def get_ready_instances(ec2_client, instances, current_epoch_seconds: float):
+    """
+    Check every instance with its own describe_instance_status call.
+
+    Returns the ready instance ids and the number of instances warming up.
+    """
     waiting_instances = 0
     instance_id_list = list()
     for instance in instances:
@@ -176,29 +250,56 @@ def run_scaling_notifier(ec2, ec2_client, cw_client, cpu_upper: float, cpu_lower
 
         instance_id_list.append(instance.id)
 
-    # Check if no ready instances found
-    if len(instance_id_list) == 0:
-        logger.warning("No ready instances found! (%s instance(s) warming up)", str(waiting_instances))
-        return
+    return instance_id_list, waiting_instances
 
-    logger.info('Ready instances: %s (%s instance(s) warming up)', str(instance_id_list), str(waiting_instances))
 
-    # Get average utilization for desired metrics
+def get_average_utils(cw_client, instance_id_list, start_time: datetime, end_time: datetime, period_sec: int,
+                      window_minutes: int, asg_name: str, workers: int = 1, window_states=None, executor=None,
+                      metrics: ControllerMetrics = None, sidecar: SidecarCollector = None):
+    """
+    Fetch the metrics of each ready instance and average their utilizations.
+
+    Instances with recent samples in `sidecar` use those instead of CloudWatch.
+    """
     count_cpu_util = 0
     count_disk_util = 0
     sum_cpu_util = 0
     sum_disk_util = 0
 
-    for instance_id in instance_id_list:
-        # Take average utilization for a single cpu for each instance.
-        for cpu in ['cpu0', 'cpu1']:
-            cpu_util = get_metric_data_cpu_util(cw_client, instance_id, cpu, start_time, end_time, period_sec, asg_name)
+    if window_states is not None:
+        # Forget instances that are no longer ready
+        for instance_id in list(window_states.keys()):
+            if instance_id not in instance_id_list:
+                del window_states[instance_id]
+        for instance_id in instance_id_list:
+            if instance_id not in window_states:
+                window_states[instance_id] = InstanceWindowState(instance_id, window_minutes, period_sec)
+
+    def fetch(instance_id):
+        if sidecar is not None:
+            instance_utils = sidecar.get_instance_utils(instance_id, time.time())
+            if instance_utils is not None:
+                return instance_utils
+        if window_states is not None:
+            return update_instance_window(cw_client, window_states[instance_id], end_time, period_sec, asg_name)
+        return get_instance_utils(cw_client, instance_id, start_time, end_time, period_sec, asg_name)
+
+    with time_phase(metrics, 'metric_fetch'):
+        if executor is not None:
+            instance_utils = list(executor.map(fetch, instance_id_list))
+        elif workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                instance_utils = list(executor.map(fetch, instance_id_list))
+        else:
+            instance_utils = [fetch(instance_id) for instance_id in instance_id_list]
+
+    # Sum in instance order so the result doesn't depend on which thread finished first
+    for cpu_utils, disk_util in instance_utils:
+        for cpu_util in cpu_utils:
             if cpu_util:
                 sum_cpu_util = sum_cpu_util + cpu_util
                 count_cpu_util = count_cpu_util + 1
 
-        # Take average utilization for the disk for each instance.
-        disk_util = get_metric_data_disk_util(cw_client, instance_id, start_time, end_time, period_sec, asg_name)
         if disk_util:
             sum_disk_util = sum_disk_util + disk_util
             count_disk_util = count_disk_util + 1
@@ -206,28 +307,228 @@ def run_scaling_notifier(ec2, ec2_client, cw_client, cpu_upper: float, cpu_lower
     avg_cpu_util = sum_cpu_util / count_cpu_util if count_cpu_util > 0 else None
     avg_disk_util = sum_disk_util / count_disk_util if count_disk_util > 0 else None
 
+    return avg_cpu_util, avg_disk_util
+
+
+def decide_target(avg_cpu_util, avg_disk_util, cpu_upper: float, cpu_lower: float, disk_upper: float,
+                  disk_lower: float, ready_instances: int, waiting_instances: int, projected_cpu_util=None,
+                  projected_disk_util=None, latency_breached: bool = False, latency_high: bool = False):
+    """
+    The Target rule: returns 1 (scale up), 0.5 (no action) or 0 (scale down), and what it means.
+    """
+    if avg_cpu_util and avg_cpu_util >= cpu_upper or avg_disk_util and avg_disk_util >= disk_upper:
+        return 1, "Scale up"
+    if latency_breached:
+        return 1, "Scale up (latency SLO)"
+    if projected_cpu_util and projected_cpu_util >= cpu_upper or \
+            projected_disk_util and projected_disk_util >= disk_upper:
+        return 1, "Scale up (forecast)"
+    if (ready_instances <= 1 and waiting_instances == 0) or avg_cpu_util and avg_cpu_util > cpu_lower \
+            or avg_disk_util and avg_disk_util > disk_lower or latency_high:
+        return 0.5, "No action"
+    return 0, "Scale down"
+
+
+def run_scaling_notifier(ec2, ec2_client, cw_client, cpu_upper: float, cpu_lower: float, disk_upper: float,
+                         disk_lower: float, period_sec: int, window_minutes: int, asg_name: str, workers: int = 1,
+                         window_states=None, readiness_tracker: ReadinessTracker = None, executor=None,
+                         deadline: float = None, metrics: ControllerMetrics = None,
+                         forecaster: UtilizationForecaster = None, group_query: GroupUtilizationQuery = None,
+                         latency_monitor: LatencySloMonitor = None, sidecar: SidecarCollector = None):
+    """
+    Compute the average utilization of the ready instances and publish the resulting Target value.
+
+    If a window_states dict is passed, it keeps an InstanceWindowState per instance across calls so that only
+    new datapoints are fetched on each tick. If a readiness_tracker is passed, instances that were already ready
+    are not checked again and the rest are checked in one batched call.
+
+    Per-instance metrics are fetched from `executor` if given, otherwise from a new pool of `workers` threads.
+    If `deadline` (a time.monotonic() value) has passed by the time Target is known, it is not published.
+    If `metrics` is given, the time spent in each phase and the decision latency are recorded in it.
+    If a `forecaster` is given, Target is also 1 when utilization is projected to reach an upper bound within
+    its lead time. If a `group_query` is given, the group averages come from one GetMetricData call instead of
+    per-instance queries. If a `latency_monitor` is given, Target is 1 while the rolling latency breaches its SLO,
+    and not 0 while latency is close to it. If a `sidecar` collector is given, the instances sending it samples
+    use those instead of CloudWatch, and count as past the launch time delay once they have sent a whole window.
+    """
+    start_time = datetime.utcnow() - timedelta(minutes=window_minutes)
+    end_time = datetime.utcnow()
+
+    # Fetch running instances from asg_name auto scaling group
+    with time_phase(metrics, 'ec2_list'):
+        instances = list(ec2.instances.filter(
+            Filters=[
+                {'Name': 'instance-state-name', 'Values': ['running']},
+                {'Name': 'tag:aws:autoscaling:groupName', 'Values': [asg_name]}
+            ]
+        ))
+        if metrics is not None:
+            metrics.record_api_call('ec2', 'describe_instances')
+
+    # Get ids from retrieved instances but exclude if not 'ok' status
+    current_epoch_seconds = calendar.timegm(time.gmtime())
+    with time_phase(metrics, 'status_check'):
+        if readiness_tracker is not None:
+            reporting_ids = sidecar.get_reporting_ids(time.time()) if sidecar is not None else None
+            instance_id_list, waiting_instances = readiness_tracker.update(ec2_client, instances,
+                                                                           current_epoch_seconds, reporting_ids)
+        else:
+            instance_id_list, waiting_instances = get_ready_instances(ec2_client, instances, current_epoch_seconds)
+
+    # Check if no ready instances found
+    if len(instance_id_list) == 0:
+        logger.warning("No ready instances found! (%s instance(s) warming up)", str(waiting_instances))
+        return
+
+    logger.info('Ready instances: %s (%s instance(s) warming up)', str(instance_id_list), str(waiting_instances))
+
+    # Get average utilization for desired metrics; with every instance in the sidecar, CloudWatch isn't needed
+    sidecar_covers = sidecar is not None and sidecar.covers(instance_id_list, time.time())
+    if group_query is not None and not sidecar_covers:
+        with time_phase(metrics, 'metric_fetch'):
+            avg_cpu_util, avg_disk_util = group_query.get_utils(cw_client, asg_name,
+                                                                [instance.id for instance in instances],
+                                                                instance_id_list, start_time, end_time, period_sec)
+    else:
+        avg_cpu_util, avg_disk_util = get_average_utils(cw_client, instance_id_list, start_time, end_time,
+                                                        period_sec, window_minutes, asg_name, workers,
+                                                        window_states, executor, metrics, sidecar)
+
     logger.info("Avg CPU Utilization: %s", str(avg_cpu_util))
     logger.info("Avg Disk Utilization: %s", str(avg_disk_util))
 
-    # Calculate target based on upper and lower bounds
-    if avg_cpu_util and avg_cpu_util >= cpu_upper or avg_disk_util and avg_disk_util >= disk_upper:
-        target = 1
-        target_msg = "Scale up"
-    elif (len(instance_id_list) <= 1 and waiting_instances == 0) or avg_cpu_util and avg_cpu_util > cpu_lower \
-            or avg_disk_util and avg_disk_util > disk_lower:
-        target = 0.5
-        target_msg = "No action"
+    if sidecar_covers:
+        # sidecar samples are stamped with the end of their interval
+        newest_datapoint_end = sidecar.get_newest_timestamp(instance_id_list)
     else:
-        target = 0
-        target_msg = "Scale down"
+        if group_query is not None:
+            newest_timestamp = group_query.newest_timestamp
+        else:
+            newest_timestamp = get_newest_timestamp(window_states) if window_states is not None else None
+        newest_datapoint_end = newest_timestamp + period_sec if newest_timestamp is not None else None
+    projected_cpu_util = None
+    projected_disk_util = None
+    if forecaster is not None:
+        data_end = newest_datapoint_end if newest_datapoint_end is not None else current_epoch_seconds
+        # the averages cover the whole window, so they describe its middle
+        window_seconds = sidecar.window_seconds if sidecar_covers else window_minutes * 60
+        forecaster.update(data_end - window_seconds / 2, avg_cpu_util, avg_disk_util)
+        projected_cpu_util, projected_disk_util = forecaster.predict(current_epoch_seconds)
+        # instances warming up now will be sharing the load by then
+        ready_share = len(instance_id_list) / (len(instance_id_list) + waiting_instances)
+        if projected_cpu_util is not None:
+            projected_cpu_util = projected_cpu_util * ready_share
+        if projected_disk_util is not None:
+            projected_disk_util = projected_disk_util * ready_share
+        logger.info("Projected CPU/Disk Utilization in %s s: %s/%s", str(forecaster.lead_seconds),
+                    str(projected_cpu_util), str(projected_disk_util))
+
+    latency_p95_ms = None
+    latency_p99_ms = None
+    latency_breached = False
+    latency_high = False
+    if latency_monitor is not None:
+        latency_monitor.poll()
+        latency_p95_ms, latency_p99_ms, latency_samples, _ = latency_monitor.get_latency()
+        latency_breached = latency_monitor.is_breached(latency_p95_ms, latency_p99_ms)
+        latency_high = latency_monitor.is_high(latency_p95_ms, latency_p99_ms)
+        logger.info("Latency p95/p99: %s/%s ms (%s sample(s))", str(latency_p95_ms), str(latency_p99_ms),
+                    str(latency_samples))
+
+    # Calculate target based on upper and lower bounds
+    target, target_msg = decide_target(avg_cpu_util, avg_disk_util, cpu_upper, cpu_lower, disk_upper, disk_lower,
+                                       len(instance_id_list), waiting_instances, projected_cpu_util,
+                                       projected_disk_util, latency_breached, latency_high)
 
     logger.info("Target: %s (%s)", str(target), str(target_msg))
 
+    if deadline is not None and time.monotonic() > deadline:
+        logger.warning("Tick missed its deadline, not sending stale target value")
+        return
+
+    # Don't overwrite the reset value sent by signal_handler
+    if shutting_down.is_set():
+        return
+
     # Send target value
-    put_metric_data_target(cw_client, target, asg_name)
+    with time_phase(metrics, 'put_target'):
+        put_metric_data_target(cw_client, target, asg_name)
+
+    if metrics is not None:
+        metrics.record_decision(target, newest_datapoint_end,
+                                ready_instances=len(instance_id_list), waiting_instances=waiting_instances,
+                                avg_cpu_util=avg_cpu_util, avg_disk_util=avg_disk_util,
+                                projected_cpu_util=projected_cpu_util, projected_disk_util=projected_disk_util,
+                                latency_p95_ms=latency_p95_ms, latency_p99_ms=latency_p99_ms,
+                                sidecar=sidecar_covers)
+
+
+def run_latency_watcher(latency_monitor: LatencySloMonitor, cw_client, asg_name: str, poll_seconds: float,
+                        repeat_seconds: float):
+    """
+    Poll the jtl every poll_seconds and publish Target 1 as soon as the latency SLO is breached, instead of waiting
+    for the next tick. While the breach lasts it is published again every repeat_seconds.
+    """
+    last_published = None
+    while not shutting_down.is_set():
+        try:
+            latency_monitor.poll()
+            latency_p95_ms, latency_p99_ms, _, _ = latency_monitor.get_latency()
+            if not latency_monitor.is_breached(latency_p95_ms, latency_p99_ms):
+                last_published = None
+            elif last_published is None or time.monotonic() - last_published >= repeat_seconds:
+                logger.info("Latency p95/p99 %s/%s ms breaches the SLO, Target: 1 (Scale up (latency SLO))",
+                            str(latency_p95_ms), str(latency_p99_ms))
+                if not shutting_down.is_set():
+                    put_metric_data_target(cw_client, 1, asg_name)
+                last_published = time.monotonic()
+        except Exception as error:
+            logger.error("Latency watcher poll failed: %r", error)
+        shutting_down.wait(poll_seconds)
+
+
+def log_tick_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Scaling notifier tick failed: %r", future.exception())
+
+
+async def run_notifier_loop(tick, tick_seconds: float, deadline_seconds: float, metrics: ControllerMetrics = None):
+    """
+    Call tick(deadline) every tick_seconds at a fixed rate, without drifting by however long each tick takes.
+
+    Ticks run on a single background thread. If the previous tick is still running when the next one is due,
+    that tick is skipped with a warning instead of being queued.
+    """
+    loop = asyncio.get_event_loop()
+    tick_executor = ThreadPoolExecutor(max_workers=1)
+    next_tick_time = loop.time()
+    in_flight = None
+
+    while True:
+        if in_flight is not None and not in_flight.done():
+            logger.warning("Previous tick still running, skipping this tick")
+            if metrics is not None:
+                metrics.record_skipped_tick()
+        else:
+            in_flight = loop.run_in_executor(tick_executor, tick, time.monotonic() + deadline_seconds)
+            in_flight.add_done_callback(log_tick_error)
+
+        next_tick_time = next_tick_time + tick_seconds
+        now = loop.time()
+        if now > next_tick_time:
+            # The loop itself fell behind (e.g. the host was suspended)
+            missed_ticks = math.floor((now - next_tick_time) / tick_seconds) + 1
+            logger.warning("Scheduler fell behind, skipping %s tick(s)", str(missed_ticks))
+            if metrics is not None:
+                for _ in range(missed_ticks):
+                    metrics.record_skipped_tick()
+            next_tick_time = next_tick_time + missed_ticks * tick_seconds
+        await asyncio.sleep(next_tick_time - now)
 
 
 def signal_handler(cw_client, asg_name):
+    shutting_down.set()
+
     # Reset Target metric
     print("ASG Util Alarms script exiting, sending target value 0.5 to Cloudwatch ...")
     put_metric_data_target(cw_client, 0.5, asg_name)
@@ -242,7 +543,49 @@ def main():
                         help="Supply the auto scaling group name")
     parser.add_argument('boundaries', metavar=('cpu_upper', 'disk_upper'), type=int, nargs=2,
                         help="Supply 'cpu_upper' and 'disk_upper' bounds (0-100)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="Fetch per-instance metrics from a thread pool of this size")
+    parser.add_argument('--tick-seconds', type=float, default=TICK_SECONDS,
+                        help="Time between the start of two ticks")
+    parser.add_argument('--tick-deadline', type=float,
+                        help="Don't publish a Target computed later than this many seconds after its tick "
+                             "started (default: --tick-seconds)")
+    parser.add_argument('--no-incremental', action='store_true',
+                        help="Re-query the whole window for every instance on every tick")
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve controller metrics in Prometheus text format at http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--metrics-file',
+                        help="Append one JSON line per tick with phase timings and the Target decision")
+    parser.add_argument('--query-mode', choices=['instance', 'group'], default='instance',
+                        help="Query each ready instance's metrics (default), or have CloudWatch average the whole "
+                             "group in one GetMetricData call per tick")
+    parser.add_argument('--forecast', choices=sorted(MODELS),
+                        help="Also scale up when this model projects utilization to reach an upper bound within "
+                             "--forecast-lead seconds (see forecast.py)")
+    parser.add_argument('--forecast-lead', type=float, default=LAUNCH_TIME_DELAY_SECONDS,
+                        help="How far ahead to project, i.e. how long a new instance takes to count "
+                             "(default: %(default)s)")
+    parser.add_argument('--forecast-history', type=float, default=DEFAULT_HISTORY_SECONDS,
+                        help="Seconds of history the linear model fits (default: %(default)s)")
+    parser.add_argument('--latency-jtl',
+                        help="Follow the jtl JMeter is writing and scale up within seconds of a latency SLO breach "
+                             "(needs --slo-p95-ms and/or --slo-p99-ms, see latency_slo.py)")
+    parser.add_argument('--slo-p95-ms', type=float, help="p95 latency target in milliseconds")
+    parser.add_argument('--slo-p99-ms', type=float, help="p99 latency target in milliseconds")
+    parser.add_argument('--slo-window', type=float, default=DEFAULT_WINDOW_SECONDS,
+                        help="Seconds of samples the rolling percentiles cover (default: %(default)s)")
+    parser.add_argument('--slo-poll-seconds', type=float, default=DEFAULT_POLL_SECONDS,
+                        help="How often the jtl is checked between ticks (default: %(default)s)")
+    parser.add_argument('--sidecar-port', type=int, nargs='?', const=DEFAULT_SIDECAR_PORT,
+                        help="Receive 1 s samples from instance_sidecar.py on this UDP port (default: %(const)s) "
+                             "and use them instead of CloudWatch for the instances sending them")
+    parser.add_argument('--sidecar-window', type=float, default=DEFAULT_SIDECAR_WINDOW_SECONDS,
+                        help="Seconds of sidecar samples averaged per tick (default: %(default)s)")
+    parser.add_argument('--sidecar-record',
+                        help="Append every sidecar sample to this csv, for get_logs.py --source sidecar")
     args = parser.parse_args()
+    if args.latency_jtl and args.slo_p95_ms is None and args.slo_p99_ms is None:
+        parser.error("--latency-jtl needs --slo-p95-ms and/or --slo-p99-ms")
 
     asg_name = args.asg_name
     cpu_upper = float(args.boundaries[0] / 100)
@@ -257,10 +600,22 @@ def main():
     window_minutes = WINDOW_MINUTES
 
     # Setup AWS resources
-    region = "us-west-1"
+    region = DEFAULT_REGION
     ec2 = boto3.resource('ec2', region_name=region)
-    cw_client = boto3.client('cloudwatch', region_name=region)
-    ec2_client = boto3.client('ec2', region_name=region)
+    cw_client = create_client('cloudwatch', region, max_pool_connections=max(args.workers, 10))
+    ec2_client = create_client('ec2', region)
+
+    metrics = None
+    if args.metrics_port is not None or args.metrics_file:
+        metrics = ControllerMetrics(jsonl_path=args.metrics_file)
+        # Count every attempt, including throttled ones that get retried
+        cw_client = InstrumentedClient(cw_client, metrics, 'cloudwatch')
+        ec2_client = InstrumentedClient(ec2_client, metrics, 'ec2')
+        if args.metrics_port is not None:
+            start_metrics_server(metrics, args.metrics_port)
+
+    cw_client = BackoffClient(cw_client)
+    ec2_client = BackoffClient(ec2_client)
 
     # Catch SIGINT & SIGINT
     def signal_handler_wrapper(_sig, _frame):
@@ -269,12 +624,51 @@ def main():
     signal.signal(signal.SIGINT, signal_handler_wrapper)
     signal.signal(signal.SIGTERM, signal_handler_wrapper)
 
+    # Per-instance sliding windows and readiness, kept across ticks
+    window_states = None if args.no_incremental else {}
+    readiness_tracker = ReadinessTracker(LAUNCH_TIME_DELAY_SECONDS)
+
+    fetch_executor = ThreadPoolExecutor(max_workers=max(args.workers, 1))
+
+    group_query = GroupUtilizationQuery(window_minutes) if args.query_mode == 'group' else None
+
+    forecaster = None
+    if args.forecast:
+        forecaster = UtilizationForecaster(args.forecast, args.forecast_lead, args.forecast_history)
+
+    latency_monitor = None
+    if args.latency_jtl:
+        latency_monitor = LatencySloMonitor(args.latency_jtl, args.slo_p95_ms, args.slo_p99_ms, args.slo_window)
+        threading.Thread(target=run_latency_watcher, daemon=True,
+                         args=(latency_monitor, cw_client, asg_name, args.slo_poll_seconds,
+                               args.tick_seconds)).start()
+
+    sidecar = None
+    if args.sidecar_port is not None:
+        sidecar = SidecarCollector(args.sidecar_port, window_seconds=args.sidecar_window,
+                                   record_path=args.sidecar_record).start()
+        logger.info("Receiving sidecar samples on UDP port %s", str(args.sidecar_port))
+
+    def tick(deadline):
+        if metrics is not None:
+            metrics.start_tick()
+        try:
+            with time_phase(metrics, 'tick'):
+                run_scaling_notifier(ec2, ec2_client, cw_client, cpu_upper, cpu_lower, disk_upper, disk_lower,
+                                     period_sec, window_minutes, asg_name, window_states=window_states,
+                                     readiness_tracker=readiness_tracker, executor=fetch_executor,
+                                     deadline=deadline, metrics=metrics, forecaster=forecaster,
+                                     group_query=group_query, latency_monitor=latency_monitor, sidecar=sidecar)
+        finally:
+            if metrics is not None:
+                metrics.finish_tick()
+
+    tick_deadline = args.tick_deadline if args.tick_deadline is not None else args.tick_seconds
+
     # Run infinite-loop
     logging.info("Starting ASG Util Alarms script ...")
-    while True:
-        run_scaling_notifier(ec2, ec2_client, cw_client, cpu_upper, cpu_lower, disk_upper, disk_lower, period_sec,
-                             window_minutes, asg_name)
-        time.sleep(15)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run_notifier_loop(tick, args.tick_seconds, tick_deadline, metrics=metrics))
 
 
 if __name__ == "__main__":
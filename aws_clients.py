@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+"""
+Shared boto3 client setup for the collection scripts.
+
+A single client is created per service with a connection pool large enough for
+the thread pool using it, and every call goes through an adaptive backoff that
+slows all threads down together when AWS starts throttling.
+"""
+import random
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+DEFAULT_REGION = "us-west-1"
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'TooManyRequestsException',
+}
+
+
+def create_client(service: str, region: str = DEFAULT_REGION, max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS):
+    config = Config(max_pool_connections=max_pool_connections)
+    return boto3.client(service, region_name=region, config=config)
+
+
+def is_throttling_error(error):
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+class AdaptiveBackoff:
+    """
+    Delay shared by all threads calling the same API.
+
+    Every throttled call doubles the delay (up to max_delay) and every successful call halves it again,
+    so the combined request rate settles just below what AWS allows.
+    """
+
+    def __init__(self, base_delay: float = 0.1, max_delay: float = 10.0, max_attempts: int = 8):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.delay = 0.0
+        self.throttle_count = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay > 0:
+            # jitter so threads don't retry in lock step
+            time.sleep(random.uniform(delay / 2, delay))
+
+    def on_success(self):
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.base_delay else 0.0
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttle_count = self.throttle_count + 1
+            self.delay = min(max(self.delay * 2, self.base_delay), self.max_delay)
+
+    def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.wait()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as error:
+                if not is_throttling_error(error) or attempt + 1 >= self.max_attempts:
+                    raise
+                attempt = attempt + 1
+                self.on_throttle()
+                continue
+            self.on_success()
+            return result
+
+
+class BackoffClient:
+    """
+    Wrap a boto3 client so every API method goes through an AdaptiveBackoff.
+    """
+
+    def __init__(self, client, backoff: AdaptiveBackoff = None):
+        self.client = client
+        self.backoff = backoff if backoff is not None else AdaptiveBackoff()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.backoff.call(attr, *args, **kwargs)
+
+        return call
+
+
+class ApiBudget:
+    """
+    Calls per second shared by every client wrapped with it, e.g. all the groups a controller manages.
+
+    A token bucket allowing bursts of up to `burst` calls: a call over the budget waits for its turn instead of
+    failing, in the order the calls were made.
+    """
+
+    def __init__(self, calls_per_second: float, burst: float = None):
+        self.rate = calls_per_second
+        self.burst = burst if burst is not None else max(calls_per_second, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.calls = 0
+        self.waited_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # take the token now, even if it is only there in the future, so later callers queue behind this one
+            self.tokens = self.tokens - 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.calls = self.calls + 1
+            self.waited_seconds = self.waited_seconds + wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+class BudgetClient:
+    """
+    Wrap a boto3 client so every API method call first takes a token from an ApiBudget.
+
+    Wrap it in a BackoffClient, not the other way round, so retries are paid for too.
+    """
+
+    def __init__(self, client, budget: ApiBudget):
+        self.client = client
+        self.budget = budget
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.budget.acquire()
+            return attr(*args, **kwargs)
+
+        return call
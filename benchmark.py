@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the metric collection and scaling control paths, run against
+fake_aws.FakeAws instead of AWS.
+
+- get_logs: get_logs.get_logs over a window of --window-hours for every
+  --fetch-modes and --instances combination.
+- notifier: --ticks back-to-back asg_util_alarms.run_scaling_notifier ticks,
+  set up as asg_util_alarms.py does, for every --query-modes and --instances
+  combination.
+- multi_group: --ticks multi_group_alarms.py ticks controlling every
+  --groups count of groups with --instances instances each, to show what a
+  tick costs as groups are added.
+
+Each case runs in a fresh process so its peak RSS is its own. Wall time, the
+time spent in each phase, API calls (including throttled attempts) and peak
+RSS are saved to a JSON file; --compare prints the change against a file
+saved by an earlier version.
+
+    ./benchmark.py --instances 1 10 100 1000 --window-hours 1 6 --latency-ms 20
+    ./benchmark.py --compare benchmark_<old commit>.json
+"""
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+
+import asg_util_alarms
+import get_logs
+import multi_group_alarms
+from aws_clients import BackoffClient
+from controller_metrics import ControllerMetrics, time_phase
+from fake_aws import FakeAws
+from group_metrics import GroupUtilizationQuery
+from instance_readiness import ReadinessTracker
+from metrics_output import TEST_PARAM_FIELDS, get_metrics_filename
+from timepoint_matrix import DEFAULT_FILL_POLICY
+
+FORMAT = '%(asctime)-15s %(message)s'
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger('benchmark')
+
+ASG_NAME = 'benchmark-asg'
+PERIOD_SEC = 30
+DEFAULT_INSTANCES = [1, 10, 100, 1000]
+DEFAULT_WINDOW_HOURS = [1, 6]
+DEFAULT_FETCH_MODES = ['batched', 'concurrent']
+DEFAULT_TICKS = 5
+DEFAULT_LATENCY_MS = 20
+DEFAULT_GROUPS = [1, 10]
+# Keys identifying the same case across results files
+CASE_KEYS = ['benchmark', 'fetch_mode', 'query_mode', 'instances', 'window_hours', 'ticks', 'groups']
+
+
+def get_version_label():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def parse_throttle_rates(throttles):
+    rates = {}
+    for throttle in throttles or []:
+        operation, _, rate = throttle.partition('=')
+        rates[operation] = float(rate)
+    return rates
+
+
+def get_peak_rss_kb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark_get_logs(case, aws, start_time: int, end_time: int):
+    with tempfile.TemporaryDirectory() as results_dir:
+        boundaries = [1, start_time, end_time, PERIOD_SEC, 1, 50, 50, 1800, 5, 1, 1, 1]
+        args = Namespace(results_dir=results_dir, asg_name=ASG_NAME, boundaries=boundaries,
+                         fetch_mode=case['fetch_mode'], workers=case['workers'], fill_policy=DEFAULT_FILL_POLICY,
+                         columnar_format=None, source='cloudwatch', sidecar_file=[],
+                         loadgen_monitor=None)
+        timings = {}
+        start = time.perf_counter()
+        get_logs.get_logs(aws.resource, BackoffClient(aws.cw_client), args, timings=timings)
+        wall_seconds = time.perf_counter() - start
+        csv_path = os.path.join(results_dir, get_metrics_filename(dict(zip(TEST_PARAM_FIELDS, boundaries))))
+        return {'wall_seconds': wall_seconds, 'phases': timings, 'csv_bytes': os.path.getsize(csv_path)}
+
+
+def benchmark_notifier(case, aws):
+    # one line per instance per tick would swamp the output
+    logging.getLogger('asg_util_alarms').setLevel(logging.WARNING)
+
+    cw_client = BackoffClient(aws.cw_client)
+    ec2_client = BackoffClient(aws.ec2_client)
+    metrics = ControllerMetrics()
+    window_states = {}
+    readiness_tracker = ReadinessTracker(asg_util_alarms.LAUNCH_TIME_DELAY_SECONDS)
+    group_query = GroupUtilizationQuery(asg_util_alarms.WINDOW_MINUTES) if case['query_mode'] == 'group' else None
+    tick_seconds = []
+    with ThreadPoolExecutor(max_workers=case['workers']) as executor:
+        for _ in range(case['ticks']):
+            start = time.perf_counter()
+            metrics.start_tick()
+            with time_phase(metrics, 'tick'):
+                asg_util_alarms.run_scaling_notifier(
+                    aws.resource, ec2_client, cw_client, 0.7, 0.35, 0.7, 0.35, asg_util_alarms.PERIOD_SEC,
+                    asg_util_alarms.WINDOW_MINUTES, ASG_NAME, window_states=window_states,
+                    readiness_tracker=readiness_tracker, executor=executor, metrics=metrics,
+                    group_query=group_query)
+            metrics.finish_tick()
+            tick_seconds.append(time.perf_counter() - start)
+
+    steady_ticks = tick_seconds[1:] or tick_seconds
+    return {
+        'wall_seconds': sum(tick_seconds),
+        'first_tick_seconds': tick_seconds[0],
+        'steady_tick_seconds': sum(steady_ticks) / len(steady_ticks),
+        # mean seconds per tick
+        'phases': {phase: histogram.sum / histogram.count for phase, histogram in metrics.phases.items()
+                   if histogram.count > 0},
+        'targets_published': len(aws.put_values)
+    }
+
+
+def benchmark_multi_group(case, aws):
+    logging.getLogger('multi_group_alarms').setLevel(logging.WARNING)
+
+    cw_client = BackoffClient(aws.cw_client)
+    ec2_client = BackoffClient(aws.ec2_client)
+    metrics = ControllerMetrics()
+    groups = [{'asg_name': get_group_name(i), 'cpu_upper': 70, 'disk_upper': 70} for i in range(case['groups'])]
+    controller = multi_group_alarms.MultiGroupController(aws.resource, ec2_client, cw_client, groups,
+                                                         query_mode=case['query_mode'], metrics=metrics)
+    tick_seconds = []
+    tick_api_calls = []
+    for _ in range(case['ticks']):
+        start = time.perf_counter()
+        api_calls = sum(aws.calls.values())
+        metrics.start_tick()
+        with time_phase(metrics, 'tick'):
+            controller.run_tick()
+        metrics.finish_tick()
+        tick_seconds.append(time.perf_counter() - start)
+        tick_api_calls.append(sum(aws.calls.values()) - api_calls)
+
+    steady_ticks = tick_seconds[1:] or tick_seconds
+    steady_api_calls = tick_api_calls[1:] or tick_api_calls
+    return {
+        'wall_seconds': sum(tick_seconds),
+        'first_tick_seconds': tick_seconds[0],
+        'steady_tick_seconds': sum(steady_ticks) / len(steady_ticks),
+        # the first tick also publishes every group's Target and checks every instance's status
+        'steady_tick_api_calls': sum(steady_api_calls) / len(steady_api_calls),
+        'phases': {phase: histogram.sum / histogram.count for phase, histogram in metrics.phases.items()
+                   if histogram.count > 0},
+        'targets_published': len(aws.put_values)
+    }
+
+
+def get_group_name(index: int):
+    return ASG_NAME if index == 0 else '{}-{}'.format(ASG_NAME, index)
+
+
+def run_case(case):
+    """
+    Run one case (in its own process) and return its result record.
+    """
+    now = int(time.time())
+    window_seconds = int(case.get('window_hours') or 1) * 3600
+    start_time = now - window_seconds
+    # launched just before the window, so every instance has data for all of it
+    aws = FakeAws(case['instances'], ASG_NAME, start_time - 600, latency=case['latency_ms'] / 1000,
+                  throttle_rates=case['throttle_rates'])
+    for index in range(1, case.get('groups') or 1):
+        aws.add_group(get_group_name(index), case['instances'])
+
+    result = dict(case)
+    baseline_rss_kb = get_peak_rss_kb()
+    try:
+        if case['benchmark'] == 'get_logs':
+            result.update(benchmark_get_logs(case, aws, start_time, now))
+        elif case['benchmark'] == 'multi_group':
+            result.update(benchmark_multi_group(case, aws))
+        else:
+            result.update(benchmark_notifier(case, aws))
+        result['error'] = None
+    except Exception as error:
+        result['error'] = repr(error)
+    result['api_calls'] = dict(aws.calls)
+    result['api_calls_total'] = sum(aws.calls.values())
+    result['throttled'] = dict(aws.throttled)
+    result['baseline_rss_kb'] = baseline_rss_kb
+    result['peak_rss_kb'] = get_peak_rss_kb()
+    return result
+
+
+def build_cases(args):
+    common = {'latency_ms': args.latency_ms, 'throttle_rates': parse_throttle_rates(args.throttle),
+              'workers': args.workers}
+    cases = []
+    if 'get_logs' in args.benchmarks:
+        for fetch_mode in args.fetch_modes:
+            for window_hours in args.window_hours:
+                for instances in args.instances:
+                    cases.append(dict(common, benchmark='get_logs', fetch_mode=fetch_mode, query_mode=None,
+                                      instances=instances, window_hours=window_hours, ticks=None, groups=None))
+    if 'notifier' in args.benchmarks:
+        for query_mode in args.query_modes:
+            for instances in args.instances:
+                cases.append(dict(common, benchmark='notifier', fetch_mode=None, query_mode=query_mode,
+                                  instances=instances, window_hours=None, ticks=args.ticks, groups=None))
+    if 'multi_group' in args.benchmarks:
+        for query_mode in args.query_modes:
+            for groups in args.groups:
+                for instances in args.instances:
+                    cases.append(dict(common, benchmark='multi_group', fetch_mode=None, query_mode=query_mode,
+                                      instances=instances, window_hours=None, ticks=args.ticks, groups=groups))
+    return cases
+
+
+def describe_case(case):
+    if case['benchmark'] == 'get_logs':
+        return 'get_logs {} {} instance(s) {}h'.format(case['fetch_mode'], case['instances'], case['window_hours'])
+    if case['benchmark'] == 'multi_group':
+        return 'multi_group {} {} group(s) x {} instance(s) {} tick(s)'.format(
+            case['query_mode'], case['groups'], case['instances'], case['ticks'])
+    return 'notifier {} {} instance(s) {} tick(s)'.format(case['query_mode'], case['instances'], case['ticks'])
+
+
+def get_case_key(result):
+    return tuple(result.get(key) for key in CASE_KEYS)
+
+
+def format_change(old, new):
+    if old is None or new is None:
+        return '-'
+    if old == 0:
+        return '{:.4g} -> {:.4g}'.format(old, new)
+    return '{:.4g} -> {:.4g} ({:+.1f}%)'.format(old, new, (new - old) / old * 100)
+
+
+def print_comparison(old_results, new_results):
+    old_by_key = {get_case_key(result): result for result in old_results['results']}
+    print("{} -> {}".format(old_results['version'], new_results['version']))
+    for result in new_results['results']:
+        old = old_by_key.get(get_case_key(result))
+        if old is None:
+            continue
+        print("{}: wall seconds {}, API calls {}, peak RSS KB {}".format(
+            describe_case(result), format_change(old.get('wall_seconds'), result.get('wall_seconds')),
+            format_change(old.get('api_calls_total'), result.get('api_calls_total')),
+            format_change(old.get('peak_rss_kb'), result.get('peak_rss_kb'))))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark get_logs.py and asg_util_alarms.py against a fake AWS")
+    parser.add_argument('--benchmarks', nargs='+', choices=['get_logs', 'notifier', 'multi_group'],
+                        default=['get_logs', 'notifier'])
+    parser.add_argument('--instances', type=int, nargs='+', default=DEFAULT_INSTANCES)
+    parser.add_argument('--window-hours', type=int, nargs='+', default=DEFAULT_WINDOW_HOURS,
+                        help="Test lengths for the get_logs benchmark")
+    parser.add_argument('--fetch-modes', nargs='+', choices=['batched', 'concurrent', 'serial'],
+                        default=DEFAULT_FETCH_MODES)
+    parser.add_argument('--query-modes', nargs='+', choices=['instance', 'group'], default=['instance', 'group'],
+                        help="--query-mode values for the notifier and multi_group benchmarks")
+    parser.add_argument('--groups', type=int, nargs='+', default=DEFAULT_GROUPS,
+                        help="Numbers of groups for the multi_group benchmark")
+    parser.add_argument('--workers', type=int, default=16, help="Thread pool size, as the scripts' --workers")
+    parser.add_argument('--ticks', type=int, default=DEFAULT_TICKS, help="Ticks per notifier case")
+    parser.add_argument('--latency-ms', type=float, default=DEFAULT_LATENCY_MS,
+                        help="Added to every fake API call")
+    parser.add_argument('--throttle', action='append', metavar='OPERATION=CALLS_PER_SEC',
+                        help="Throttle an operation, e.g. get_metric_data=50 (repeatable)")
+    parser.add_argument('--label', default=None, help="Version label stored in the results (default: git commit)")
+    parser.add_argument('--output', help="Results file (default: benchmark_<label>.json)")
+    parser.add_argument('--compare', metavar='RESULTS_JSON', help="Print the change from an earlier results file")
+    args = parser.parse_args()
+
+    label = args.label or get_version_label()
+    output_path = args.output or 'benchmark_{}.json'.format(label)
+
+    results = []
+    for case in build_cases(args):
+        logger.info("Running %s", describe_case(case))
+        # a fresh process per case, so peak RSS isn't carried over from bigger cases
+        with multiprocessing.Pool(processes=1) as pool:
+            result = pool.apply(run_case, (case,))
+        if result['error']:
+            logger.warning("%s failed: %s", describe_case(case), result['error'])
+        else:
+            logger.info("%s: %.3fs, %s API call(s), peak RSS %s KB", describe_case(case), result['wall_seconds'],
+                        result['api_calls_total'], result['peak_rss_kb'])
+        results.append(result)
+
+    benchmark_results = {
+        'version': label,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results
+    }
+    with open(output_path, 'w') as output_file:
+        json.dump(benchmark_results, output_file, indent=2)
+    logger.info("Results saved to %s", output_path)
+
+    if args.compare:
+        with open(args.compare) as compare_file:
+            print_comparison(json.load(compare_file), benchmark_results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,473 @@
+#!/usr/bin/python3
+"""
+Run every test in a test_list.json, several at a time.
+
+Each test slot owns one auto scaling group / load balancer pair, named with an
+asg suffix as in run-tests.sh (PicSiteASG<suffix>, PicSiteAppLB<suffix>).
+Tests are handed to a thread pool with one worker per slot; a worker scales
+its group, waits for the instances, starts asg_util_alarms.py and JMeter,
+collects the logs with get_logs.py and scales the group back down. Every slot
+is torn down when the campaign ends, also after a failure or ctrl + c.
+
+The AWS and JMeter steps go through backend objects, so `--dry-run` runs the
+whole campaign against fake backends that only sleep and write placeholder
+results.
+"""
+import json
+import logging
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from aws_clients import DEFAULT_REGION, BackoffClient, create_client
+
+FORMAT = '%(asctime)-15s [%(threadName)s] %(message)s'
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger('campaign')
+
+DEFAULT_MIN_INSTANCES = 1
+DEFAULT_MAX_INSTANCES = 5
+PERIOD_SEC = 30  # used by get_logs.py
+WAIT_POLL_SECONDS = 15
+# JMeter gets this long past test_duration before it is stopped (as stop_jmeter_threads_after_delay.sh does)
+JMETER_STOP_DELAY_SECONDS = 60
+JMETER_PATH = '/home/ubuntu/apache-jmeter-5.1/bin/jmeter'
+TEST_PLAN = 'jmeter_tests/Project_Test_Plan.jmx'
+
+# Optional test_list.json fields and their defaults
+TEST_DEFAULTS = {
+    'num_instances': 1,
+    'scale_down_size': -1,
+    'scale_up_size': 1
+}
+# Optional test fields -> asg_util_alarms.py flags
+LATENCY_SLO_FLAGS = {
+    'latency_slo_p95_ms': '--slo-p95-ms',
+    'latency_slo_p99_ms': '--slo-p99-ms'
+}
+REQUIRED_FIELDS = ['autoscaling_value', 'cpu_utilization_param', 'disk_utilization_param', 'test_duration',
+                   'image_size', 'num_users_a', 'num_users_b', 'num_users_c']
+
+# Set on ctrl + c so waiting workers give up
+stopping = threading.Event()
+
+
+class CampaignInterrupted(Exception):
+    pass
+
+
+def load_tests(config_file: str):
+    """
+    Read the test list once, filling in defaults. The test id is the position in the list.
+    """
+    with open(config_file) as f:
+        tests = json.load(f)
+    loaded = []
+    for test_id, test in enumerate(tests):
+        missing = [field for field in REQUIRED_FIELDS if test.get(field) is None]
+        if missing:
+            raise ValueError("Test {} in {} is missing {}".format(test_id, config_file, missing))
+        test = dict(TEST_DEFAULTS, **{key: value for key, value in test.items() if value is not None})
+        test['test_id'] = test_id
+        loaded.append(test)
+    return loaded
+
+
+def has_latency_slo(test):
+    return any(test.get(field) is not None for field in LATENCY_SLO_FLAGS)
+
+
+def get_latency_slo_args(test, jtl_path: str):
+    """
+    asg_util_alarms.py arguments for the test's optional latency SLO.
+    """
+    if not has_latency_slo(test):
+        return []
+    args = ['--latency-jtl', jtl_path]
+    for field, flag in LATENCY_SLO_FLAGS.items():
+        if test.get(field) is not None:
+            args.extend([flag, str(test[field])])
+    return args
+
+
+def get_jtl_path(results_dir: str, test):
+    return os.path.join(results_dir, 'testresults_{}.jtl'.format(test['test_id']))
+
+
+def get_loadgen_monitor_path(results_dir: str, test):
+    return os.path.join(results_dir, 'loadgen_{}.csv'.format(test['test_id']))
+
+
+def get_asg_name(asg_suffix: str):
+    return "PicSiteASG{}".format(asg_suffix)
+
+
+def sleep_unless_stopping(seconds: float):
+    if stopping.wait(seconds):
+        raise CampaignInterrupted()
+
+
+class AwsBackend:
+    """
+    Runs the existing shell scripts for infrastructure changes, and talks to AWS directly for the waits.
+    """
+
+    def __init__(self, region: str = DEFAULT_REGION):
+        self.autoscaling = BackoffClient(create_client('autoscaling', region))
+        self.ec2 = BackoffClient(create_client('ec2', region))
+        self.cloudwatch = BackoffClient(create_client('cloudwatch', region))
+        self.elbv2 = BackoffClient(create_client('elbv2', region))
+
+    def run_script(self, *args):
+        subprocess.run([str(arg) for arg in args], check=True)
+
+    def setup_load_balancing(self, asg_suffix: str):
+        """
+        Create the load balancer for a slot if needed, and return its DNS name.
+        """
+        self.run_script('./init_load_balancing.sh', asg_suffix)
+        response = self.elbv2.describe_load_balancers(Names=['PicSiteAppLB{}'.format(asg_suffix)])
+        return response['LoadBalancers'][0]['DNSName']
+
+    def prepare_group(self, asg_name: str, asg_suffix: str, test):
+        # set scale down and scale up step sizes
+        self.autoscaling.put_scaling_policy(AutoScalingGroupName=asg_name,
+                                            PolicyName="Target Utilization Scale Down",
+                                            AdjustmentType='ChangeInCapacity',
+                                            ScalingAdjustment=test['scale_down_size'])
+        self.autoscaling.put_scaling_policy(AutoScalingGroupName=asg_name,
+                                            PolicyName="Target Utilization Scale Up",
+                                            AdjustmentType='ChangeInCapacity',
+                                            ScalingAdjustment=test['scale_up_size'])
+
+        num_instances = test['num_instances']
+        if test['autoscaling_value'] == 0:
+            # no auto-scaling
+            self.run_script('./init_auto_scaling_group.sh', num_instances, num_instances, num_instances, asg_suffix)
+        else:
+            self.run_script('./init_auto_scaling_group.sh', DEFAULT_MIN_INSTANCES, DEFAULT_MAX_INSTANCES,
+                            num_instances, asg_suffix)
+
+    def reset_target(self, asg_name: str):
+        self.cloudwatch.put_metric_data(
+            Namespace=asg_name,
+            MetricData=[{
+                'MetricName': 'Target',
+                'Dimensions': [{'Name': 'AutoScalingGroupName', 'Value': asg_name}],
+                'Value': 0.5
+            }]
+        )
+
+    def wait_for_desired_instances(self, asg_name: str, desired_instances: int):
+        """
+        Wait until the group has the desired number of instances, all with status 'ok'. Target is held at 0.5
+        meanwhile.
+        """
+        while True:
+            self.reset_target(asg_name)
+
+            group = self.autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
+            instance_ids = [instance['InstanceId'] for instance in group['AutoScalingGroups'][0]['Instances']]
+            if len(instance_ids) != desired_instances:
+                logger.info("%s: waiting for num_instances = %s. Currently num_instances = %s",
+                            asg_name, desired_instances, len(instance_ids))
+            elif not instance_ids:
+                return
+            else:
+                statuses = self.ec2.describe_instance_status(InstanceIds=instance_ids)['InstanceStatuses']
+                ok_ids = [status['InstanceId'] for status in statuses if status['InstanceStatus']['Status'] == 'ok']
+                if len(ok_ids) == len(instance_ids):
+                    return
+                logger.info("%s: waiting for status = ok for %s", asg_name,
+                            [instance_id for instance_id in instance_ids if instance_id not in ok_ids])
+            sleep_unless_stopping(WAIT_POLL_SECONDS)
+
+    def start_alarm_monitor(self, asg_name: str, test, log_path: str, jtl_path: str):
+        log_file = open(log_path, 'w')
+        process = subprocess.Popen([sys.executable, 'asg_util_alarms.py', asg_name,
+                                    str(test['cpu_utilization_param']), str(test['disk_utilization_param'])] +
+                                   get_latency_slo_args(test, jtl_path),
+                                   stdout=log_file, stderr=subprocess.STDOUT)
+        log_file.close()
+        return process
+
+    def stop_alarm_monitor(self, process):
+        # SIGINT makes asg_util_alarms.py reset Target before exiting
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    def collect_logs(self, results_dir: str, asg_name: str, test, start_time: int, end_time: int):
+        extra_args = []
+        monitor_path = get_loadgen_monitor_path(results_dir, test)
+        if os.path.exists(monitor_path):
+            extra_args = ['--loadgen-monitor', monitor_path]
+        self.run_script(sys.executable, 'get_logs.py', results_dir, asg_name,
+                        test['test_id'], start_time, end_time, PERIOD_SEC, test['autoscaling_value'],
+                        test['cpu_utilization_param'], test['disk_utilization_param'], test['test_duration'],
+                        test['image_size'], test['num_users_a'], test['num_users_b'], test['num_users_c'],
+                        *extra_args)
+
+    def shutdown_group(self, asg_suffix: str):
+        self.run_script('./shutdown_auto_scaling_group.sh', asg_suffix)
+
+    def teardown(self, asg_suffix: str):
+        self.shutdown_group(asg_suffix)
+        self.run_script('./shutdown_load_balancing.sh', asg_suffix)
+
+
+class JMeterRunner:
+
+    def __init__(self, jmeter_path: str = JMETER_PATH, test_plan: str = TEST_PLAN):
+        self.jmeter_path = jmeter_path
+        self.test_plan = test_plan
+
+    def run(self, test, load_balancer_dns_name: str, results_dir: str):
+        """
+        Run JMeter for one test and wait for it. It is stopped if it runs JMETER_STOP_DELAY_SECONDS past the test
+        duration; unlike stoptest.sh, this only stops this test's JMeter.
+
+        loadgen_monitor.py watches this host and the JMeter process meanwhile, and afterwards flags the jtl samples
+        taken while either was saturated.
+        """
+        test_id = test['test_id']
+        jtl_path = get_jtl_path(results_dir, test)
+        monitor_path = get_loadgen_monitor_path(results_dir, test)
+        command = [self.jmeter_path, '-n',
+                   '-t', self.test_plan,
+                   '-JusersA={}'.format(test['num_users_a']),
+                   '-JusersB={}'.format(test['num_users_b']),
+                   '-JusersC={}'.format(test['num_users_c']),
+                   '-Jduration={}'.format(test['test_duration']),
+                   '-JLoadBalancerDNS={}'.format(load_balancer_dns_name),
+                   '-JImageSize={}'.format(test['image_size']),
+                   '-JTestID={}'.format(test_id),
+                   '-JResultsDir={}'.format(results_dir),
+                   '-l', jtl_path,
+                   '-j', os.path.join(results_dir, 'jmeter_{}.log'.format(test_id))]
+        if has_latency_slo(test):
+            # asg_util_alarms.py follows the jtl, so every sample has to reach it right away
+            command.append('-Jjmeter.save.saveservice.autoflush=true')
+        monitor = subprocess.Popen([sys.executable, 'loadgen_monitor.py', 'record', monitor_path,
+                                    '--match', 'ApacheJMeter.jar', '--match', jtl_path])
+        with open(os.path.join(results_dir, 'jmeter_{}.out'.format(test_id)), 'w') as out_file:
+            process = subprocess.Popen(command, stdout=out_file, stderr=subprocess.STDOUT)
+            deadline = time.monotonic() + test['test_duration'] + JMETER_STOP_DELAY_SECONDS
+            try:
+                while process.poll() is None:
+                    if time.monotonic() > deadline:
+                        logger.warning("Test %s: forcing JMeter to stop", test_id)
+                        process.terminate()
+                        process.wait(timeout=60)
+                        break
+                    sleep_unless_stopping(1)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                monitor.terminate()
+                monitor.wait()
+        if os.path.exists(jtl_path):
+            subprocess.run([sys.executable, 'loadgen_monitor.py', 'flag', monitor_path, '--jtl', jtl_path])
+        return process.returncode
+
+
+class FakeAwsBackend:
+    """
+    Stand-in for AwsBackend that only sleeps, with every AWS wait scaled by time_scale.
+    """
+
+    def __init__(self, time_scale: float = 0.001):
+        self.time_scale = time_scale
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def record(self, *call):
+        with self._lock:
+            self.calls.append(call)
+        logger.info("fake aws: %s", call)
+
+    def setup_load_balancing(self, asg_suffix):
+        self.record('setup_load_balancing', asg_suffix)
+        return 'fake-lb{}.example.com'.format(asg_suffix)
+
+    def prepare_group(self, asg_name, asg_suffix, test):
+        self.record('prepare_group', asg_name, test['test_id'])
+
+    def wait_for_desired_instances(self, asg_name, desired_instances):
+        self.record('wait_for_desired_instances', asg_name, desired_instances)
+        sleep_unless_stopping(300 * self.time_scale)
+
+    def start_alarm_monitor(self, asg_name, test, log_path, jtl_path):
+        self.record('start_alarm_monitor', asg_name, test['test_id'])
+        return subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(3600)'])
+
+    def stop_alarm_monitor(self, process):
+        self.record('stop_alarm_monitor')
+        process.terminate()
+        process.wait()
+
+    def collect_logs(self, results_dir, asg_name, test, start_time, end_time):
+        self.record('collect_logs', asg_name, test['test_id'])
+        path = os.path.join(results_dir, 'aws_metrics_{}_fake.csv'.format(test['test_id']))
+        with open(path, 'w') as f:
+            f.write('timepoint,instance_id,timestamp\n')
+
+    def shutdown_group(self, asg_suffix):
+        self.record('shutdown_group', asg_suffix)
+
+    def teardown(self, asg_suffix):
+        self.record('teardown', asg_suffix)
+
+
+class FakeJMeterRunner:
+
+    def __init__(self, time_scale: float = 0.001, fail_test_ids=()):
+        self.time_scale = time_scale
+        self.fail_test_ids = set(fail_test_ids)
+
+    def run(self, test, load_balancer_dns_name, results_dir):
+        sleep_unless_stopping(test['test_duration'] * self.time_scale)
+        if test['test_id'] in self.fail_test_ids:
+            raise RuntimeError("fake JMeter failure for test {}".format(test['test_id']))
+        with open(get_jtl_path(results_dir, test), 'w') as f:
+            f.write('timeStamp,elapsed,label,responseCode,threadName,success\n')
+        return 0
+
+
+def run_test(backend, jmeter, test, asg_suffix: str, load_balancer_dns_name: str, results_dir: str):
+    """
+    Run one test on the group of a slot. The group is always scaled back down afterwards.
+    """
+    asg_name = get_asg_name(asg_suffix)
+    test_id = test['test_id']
+    monitor = None
+    try:
+        backend.prepare_group(asg_name, asg_suffix, test)
+
+        logger.info("Test %s: waiting for desired starting instances (%s) on %s", test_id, test['num_instances'],
+                    asg_name)
+        backend.wait_for_desired_instances(asg_name, test['num_instances'])
+
+        monitor = backend.start_alarm_monitor(asg_name, test,
+                                              os.path.join(results_dir, 'asg_util_alarms_{}.log'.format(test_id)),
+                                              get_jtl_path(results_dir, test))
+
+        logger.info("Test %s: running JMeter against %s", test_id, load_balancer_dns_name)
+        start_time = int(time.time())  # seconds since epoch utc
+        jmeter.run(test, load_balancer_dns_name, results_dir)
+        end_time = int(time.time())
+        logger.info("Test %s: finished running JMeter", test_id)
+
+        # stop the monitor before collecting, it needs new params for the next test anyway
+        backend.stop_alarm_monitor(monitor)
+        monitor = None
+
+        backend.collect_logs(results_dir, asg_name, test, start_time, end_time)
+    finally:
+        if monitor is not None:
+            backend.stop_alarm_monitor(monitor)
+        logger.info("Test %s: cleaning up instances of %s", test_id, asg_name)
+        backend.shutdown_group(asg_suffix)
+        if not stopping.is_set():
+            backend.wait_for_desired_instances(asg_name, 0)
+
+
+def run_campaign(backend, jmeter, tests, asg_suffixes, results_dir: str):
+    """
+    Run tests on as many groups in parallel as there are asg suffixes. Returns {test_id: error or None}.
+    """
+    slots = queue.Queue()
+    load_balancer_dns_names = {}
+    results = {}
+
+    def run_in_slot(test):
+        asg_suffix = slots.get()
+        try:
+            if stopping.is_set():
+                raise CampaignInterrupted()
+            run_test(backend, jmeter, test, asg_suffix, load_balancer_dns_names[asg_suffix], results_dir)
+        finally:
+            slots.put(asg_suffix)
+
+    try:
+        for asg_suffix in asg_suffixes:
+            load_balancer_dns_names[asg_suffix] = backend.setup_load_balancing(asg_suffix)
+            slots.put(asg_suffix)
+
+        with ThreadPoolExecutor(max_workers=len(asg_suffixes), thread_name_prefix='slot') as executor:
+            futures = {test['test_id']: executor.submit(run_in_slot, test) for test in tests}
+            for test_id, future in futures.items():
+                try:
+                    future.result()
+                    results[test_id] = None
+                except Exception as error:
+                    logger.error("Test %s failed: %r", test_id, error)
+                    results[test_id] = error
+    finally:
+        # scale down & disable auto-scaling, shut down load balancing, for every slot
+        for asg_suffix in asg_suffixes:
+            try:
+                backend.teardown(asg_suffix)
+            except Exception as error:
+                logger.error("Teardown of %s failed: %r. Please run 'shutdown_load_balancing.sh %s' and "
+                             "'shutdown_auto_scaling_group.sh %s'", get_asg_name(asg_suffix), error, asg_suffix,
+                             asg_suffix)
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Run the tests in a test list in parallel on separate auto scaling groups")
+    parser.add_argument('config_file', nargs='?', default='test_list.json')
+    parser.add_argument('--asg-suffixes', nargs='+', default=[''],
+                        help="One test slot per suffix; each uses PicSiteASG<suffix> and PicSiteAppLB<suffix> "
+                             "(e.g. --asg-suffixes 1 2 3)")
+    parser.add_argument('--results-dir', help="Default: results/<date>")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Use fake AWS and JMeter backends that only sleep")
+    parser.add_argument('--time-scale', type=float, default=0.001,
+                        help="With --dry-run, how much faster than real time the fake backends run")
+    args = parser.parse_args()
+
+    tests = load_tests(args.config_file)
+
+    # setup results directory based on current run session
+    results_dir = args.results_dir or os.path.join('results', datetime.now().strftime('%Y_%m_%d_%H%M%S'))
+    os.makedirs(results_dir, exist_ok=True)
+
+    if args.dry_run:
+        backend = FakeAwsBackend(args.time_scale)
+        jmeter = FakeJMeterRunner(args.time_scale)
+    else:
+        backend = AwsBackend()
+        jmeter = JMeterRunner()
+
+    def signal_handler(_sig, _frame):
+        logger.warning("Campaign interrupted, stopping tests and tearing down ...")
+        stopping.set()
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    start = time.monotonic()
+    results = run_campaign(backend, jmeter, tests, args.asg_suffixes, results_dir)
+    failed = [test_id for test_id, error in results.items() if error is not None]
+
+    logger.info("Ran %s test(s) on %s group(s) in %.0f s, results in %s", len(tests), len(args.asg_suffixes),
+                time.monotonic() - start, results_dir)
+    if failed:
+        logger.error("Failed test(s): %s", failed)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+"""
+Join JMeter results with the aws_metrics files written by get_logs.py.
+
+JTL samples are put on the same `sample_period` grid as the aws_metrics
+timestamps, and every bucket gets the request rate, error rate and latency
+percentiles next to the number of active instances and their mean cpu, disk
+and memory utilization. The jtl is read in chunks of rows and each chunk is
+bucketed with numpy; latencies are counted into a (bucket x histogram bucket)
+array with the same log buckets as jtl_analysis.LatencyHistogram, so memory
+does not grow with the number of samples.
+
+Writes one capacity_<...>.csv per test next to its aws_metrics file.
+"""
+import csv
+import glob
+import itertools
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from jtl_analysis import HISTOGRAM_RELATIVE_ERROR, PERCENTILES
+from jtl_binary import BINARY_JTL_EXTENSION, JtlBinaryReader, get_jtl_path
+from metrics_output import COLUMNAR_FORMATS, read_metrics_params, read_metrics_table
+
+DEFAULT_PERIOD_SEC = 30
+JTL_CHUNK_ROWS = 100000
+
+# Latencies above this many ms all land in the last histogram bucket
+MAX_LATENCY_MS = 10 * 60 * 1000
+
+METRICS_FILE_PATTERN = re.compile(r'^aws_metrics_(\d+)_.*\.(csv|parquet|arrow)$')
+
+CAPACITY_FIELDNAMES = ['timestamp', 'timepoint', 'requests_per_sec', 'error_rate'] + \
+                      ['p{}_ms'.format(percentile) for percentile in PERCENTILES] + \
+                      ['active_instances', 'mean_cpu_util', 'mean_disk_util', 'mean_mem_util']
+
+
+class LatencyBuckets:
+    """
+    Vectorized version of the jtl_analysis.LatencyHistogram bucketing, with a fixed number of buckets.
+    """
+
+    def __init__(self, relative_error: float = HISTOGRAM_RELATIVE_ERROR, max_value: float = MAX_LATENCY_MS):
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = np.log(self.gamma)
+        # bucket 0 holds values <= 1 (and zeros)
+        self.num_buckets = int(np.ceil(np.log(max_value) / self.log_gamma)) + 1
+
+    def get_indices(self, values):
+        values = np.maximum(np.asarray(values, dtype=np.float64), 1.0)
+        indices = np.ceil(np.log(values) / self.log_gamma).astype(np.int64)
+        return np.minimum(indices, self.num_buckets - 1)
+
+    def get_values(self, indices):
+        return 2 * self.gamma ** np.asarray(indices, dtype=np.float64) / (self.gamma + 1)
+
+    def percentiles(self, counts, percentiles):
+        """
+        Get percentiles for every row of a (rows x buckets) count array, NaN for rows with no samples.
+        """
+        cumulative = np.cumsum(counts, axis=1)
+        totals = cumulative[:, -1]
+        result = np.full((counts.shape[0], len(percentiles)), np.nan)
+        for p, percentile in enumerate(percentiles):
+            rank = np.maximum(np.ceil(percentile / 100 * totals), 1)
+            indices = np.argmax(cumulative >= rank[:, None], axis=1)
+            result[:, p] = np.where(totals > 0, self.get_values(indices), np.nan)
+        return result
+
+
+def load_metrics(path: str):
+    """
+    Load the columns of an aws_metrics csv, parquet or arrow file as numpy arrays, and the sample period if the
+    file records it.
+    """
+    columns = ['timestamp', 'instance_id', 'cpu0_util', 'cpu1_util', 'disk_util', 'mem_util']
+    if path.endswith(COLUMNAR_FORMATS['parquet']) or path.endswith(COLUMNAR_FORMATS['arrow']):
+        table = read_metrics_table(path, columns=columns)
+        metrics = {column: table.column(column).to_numpy(zero_copy_only=False) for column in columns}
+        for column in columns:
+            if column != 'instance_id':
+                metrics[column] = np.asarray(metrics[column], dtype=np.float64)
+        return metrics, read_metrics_params(path)['sample_period']
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        if 'timestamp' not in header:
+            raise ValueError("{} has no timestamp column, re-run get_logs.py to regenerate it".format(path))
+        rows = list(reader)
+    indices = [header.index(column) for column in columns]
+    metrics = {}
+    for column, index in zip(columns, indices):
+        values = [row[index] for row in rows]
+        if column == 'instance_id':
+            metrics[column] = np.asarray(values, dtype=object)
+        else:
+            # empty fields are gaps (--fill-policy nan)
+            metrics[column] = np.asarray([float(value) if value != '' else np.nan for value in values])
+    return metrics, None
+
+
+def get_period(timestamps, default: int = DEFAULT_PERIOD_SEC):
+    unique_timestamps = np.unique(timestamps)
+    if len(unique_timestamps) < 2:
+        return default
+    return int(np.min(np.diff(unique_timestamps)))
+
+
+def iter_jtl_chunks(path: str, chunk_rows: int = JTL_CHUNK_ROWS):
+    """
+    Yield (timestamp_ms, elapsed_ms, success, unparsable) for chunks of a csv jtl, or for the blocks of a .jtlb.
+    The arrays only hold rows with integer timeStamp and elapsed fields; unparsable counts the other ones.
+    """
+    if path.endswith(BINARY_JTL_EXTENSION):
+        with JtlBinaryReader(path) as reader:
+            for values in reader.iter_blocks(['timeStamp', 'elapsed', 'success']):
+                yield values['timeStamp'], values['elapsed'], values['success'] == 'true', 0
+        return
+
+    with open(path, newline='') as jtl_file:
+        reader = csv.reader(jtl_file)
+        header = next(reader, None)
+        if header is None:
+            return
+        timestamp_col = header.index('timeStamp')
+        elapsed_col = header.index('elapsed')
+        success_col = header.index('success')
+        num_columns = len(header)
+        while True:
+            chunk = list(itertools.islice(reader, chunk_rows))
+            if not chunk:
+                break
+            timestamps = []
+            elapsed = []
+            success = []
+            unparsable = 0
+            for row in chunk:
+                if len(row) < num_columns:
+                    # e.g. a truncated last row from an interrupted test
+                    continue
+                try:
+                    timestamp_ms = int(row[timestamp_col])
+                    elapsed_ms = int(row[elapsed_col])
+                except ValueError:
+                    # e.g. a garbled row; loadgen_monitor.py flag keeps these as they are
+                    unparsable = unparsable + 1
+                    continue
+                timestamps.append(timestamp_ms)
+                elapsed.append(elapsed_ms)
+                success.append(row[success_col] == 'true')
+            yield (np.array(timestamps, dtype=np.int64), np.array(elapsed, dtype=np.int64),
+                   np.array(success, dtype=bool), unparsable)
+
+
+def bucket_jtl(path: str, grid_start: float, period_sec: int, num_buckets: int,
+               relative_error: float = HISTOGRAM_RELATIVE_ERROR):
+    """
+    Count samples, errors and latency histogram buckets per time bucket. Samples outside the grid and rows that
+    can't be parsed are dropped.
+
+    Returns (samples, errors, latency_counts, dropped).
+    """
+    latency_buckets = LatencyBuckets(relative_error)
+    samples = np.zeros(num_buckets, dtype=np.int64)
+    errors = np.zeros(num_buckets, dtype=np.int64)
+    latency_counts = np.zeros((num_buckets, latency_buckets.num_buckets), dtype=np.int64)
+    dropped = 0
+
+    for timestamp_ms, elapsed_ms, success, unparsable in iter_jtl_chunks(path):
+        buckets = np.floor((timestamp_ms / 1000 - grid_start) / period_sec).astype(np.int64)
+        keep = (buckets >= 0) & (buckets < num_buckets)
+        dropped = dropped + int(np.count_nonzero(~keep)) + unparsable
+        buckets = buckets[keep]
+
+        samples = samples + np.bincount(buckets, minlength=num_buckets)
+        errors = errors + np.bincount(buckets, weights=~success[keep], minlength=num_buckets).astype(np.int64)
+        np.add.at(latency_counts, (buckets, latency_buckets.get_indices(elapsed_ms[keep])), 1)
+
+    return samples, errors, latency_counts, dropped
+
+
+def aggregate_metrics(metrics, bucket_timestamps):
+    """
+    Get the active instance count and mean cpu, disk and memory utilization of active instances per bucket.
+
+    An instance is active in a bucket if it reported a cpu sample there; zero-filled gaps (from
+    --fill-policy zero/pad before launch) have 0 for both cpus and don't count.
+    """
+    num_buckets = len(bucket_timestamps)
+    period_sec = bucket_timestamps[1] - bucket_timestamps[0] if num_buckets > 1 else 1
+    buckets = np.rint((metrics['timestamp'] - bucket_timestamps[0]) / period_sec).astype(np.int64)
+    cpu0 = metrics['cpu0_util']
+    cpu1 = metrics['cpu1_util']
+    active = ~np.isnan(cpu0) & ((cpu0 != 0) | (cpu1 != 0))
+
+    active_instances = np.bincount(buckets[active], minlength=num_buckets)
+
+    def mean(values):
+        values = values[active]
+        valid = ~np.isnan(values)
+        total = np.bincount(buckets[active][valid], weights=values[valid], minlength=num_buckets)
+        count = np.bincount(buckets[active][valid], minlength=num_buckets)
+        return np.divide(total, count, out=np.full(num_buckets, np.nan), where=count > 0)
+
+    cpu = np.where(np.isnan(cpu1), cpu0, (cpu0 + cpu1) / 2)
+    return active_instances, mean(cpu), mean(metrics['disk_util']), mean(metrics['mem_util'])
+
+
+def join_test(metrics_path: str, jtl_path: str, output_path: str, period_sec: int = None,
+              relative_error: float = HISTOGRAM_RELATIVE_ERROR):
+    """
+    Write the per-bucket capacity table for one test. Returns the number of jtl samples dropped by bucket_jtl, or None
+    without writing anything if the metrics file has no rows (get_logs.py found no instance data).
+    """
+    metrics, file_period = load_metrics(metrics_path)
+    if len(metrics['timestamp']) == 0:
+        return None
+    period_sec = period_sec or file_period or get_period(metrics['timestamp'])
+
+    grid_start = float(np.min(metrics['timestamp']))
+    num_buckets = int(round((np.max(metrics['timestamp']) - grid_start) / period_sec)) + 1
+    bucket_timestamps = grid_start + period_sec * np.arange(num_buckets, dtype=np.float64)
+
+    samples, errors, latency_counts, dropped = bucket_jtl(jtl_path, grid_start, period_sec, num_buckets,
+                                                          relative_error)
+    latency_percentiles = LatencyBuckets(relative_error).percentiles(latency_counts, PERCENTILES)
+    active_instances, mean_cpu, mean_disk, mean_mem = aggregate_metrics(metrics, bucket_timestamps)
+
+    error_rate = np.divide(errors, samples, out=np.full(num_buckets, np.nan), where=samples > 0)
+
+    with open(output_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(CAPACITY_FIELDNAMES)
+        for b in range(num_buckets):
+            row = [int(bucket_timestamps[b]), b, samples[b] / period_sec, error_rate[b]] + \
+                  list(latency_percentiles[b]) + [active_instances[b], mean_cpu[b], mean_disk[b], mean_mem[b]]
+            writer.writerow(['' if isinstance(value, float) and np.isnan(value) else value for value in row])
+    return dropped
+
+
+def find_tests(results_dir: str):
+    """
+    Pair every aws_metrics file in a results directory with its testresults_<test_id>.jtl.
+
+    Returns (metrics_path, jtl_path, output_path) tuples; a csv is preferred over its columnar copies.
+    """
+    tests = {}
+    for path in sorted(glob.glob(os.path.join(results_dir, 'aws_metrics_*'))):
+        match = METRICS_FILE_PATTERN.match(os.path.basename(path))
+        if match is None:
+            continue
+        test_id = match.group(1)
+        if test_id in tests and not path.endswith('.csv'):
+            continue
+        tests[test_id] = path
+
+    joins = []
+    for test_id, metrics_path in sorted(tests.items(), key=lambda item: int(item[0])):
+        jtl_path = get_jtl_path(results_dir, test_id)
+        if jtl_path is None:
+            print("No testresults_{}.jtl for {}, skipping".format(test_id, metrics_path), file=sys.stderr)
+            continue
+        name = os.path.splitext(os.path.basename(metrics_path))[0].replace('aws_metrics_', 'capacity_', 1)
+        joins.append((metrics_path, jtl_path, os.path.join(results_dir, name + '.csv')))
+    return joins
+
+
+def main():
+    parser = ArgumentParser(description="Join JMeter results with aws_metrics utilization on the sample "
+                                        "period grid, writing capacity_<...>.csv per test")
+    parser.add_argument('results_dir', help="Results directory written by run-tests.sh")
+    parser.add_argument('--period', type=int, default=None,
+                        help="Bucket size in seconds (default: the sample period of the aws_metrics file)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Processes used to join tests in parallel (default: number of cpus)")
+    args = parser.parse_args()
+
+    joins = find_tests(args.results_dir)
+    if not joins:
+        print("No aws_metrics / testresults pairs found in {}".format(args.results_dir))
+        return
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(join_test, metrics_path, jtl_path, output_path, args.period)
+                   for metrics_path, jtl_path, output_path in joins]
+        for (metrics_path, jtl_path, output_path), future in zip(joins, futures):
+            dropped = future.result()
+            if dropped is None:
+                print("No instance data in {}, skipping".format(metrics_path), file=sys.stderr)
+                continue
+            print("Wrote {}".format(output_path))
+            if dropped:
+                print("  {} sample(s) of {} fell outside the metrics time range or couldn't be parsed".format(dropped, jtl_path))
+
+
+if __name__ == '__main__':
+    main()
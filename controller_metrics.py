@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+"""
+Hot-path instrumentation for asg_util_alarms.py.
+
+ControllerMetrics keeps per-phase timing histograms, API call and error
+counters and a decision latency histogram (from the end of the newest
+datapoint's period to the moment Target is published). They can be scraped
+in Prometheus text format from a local HTTP endpoint, and each tick is also
+appended to a JSON-lines file.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Histogram bucket upper bounds, in seconds
+PHASE_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30]
+DECISION_LATENCY_BUCKETS = [15, 30, 45, 60, 90, 120, 180, 240, 300, 600]
+
+# Phases of a single run_scaling_notifier tick
+PHASES = ['ec2_list', 'status_check', 'metric_fetch', 'put_target', 'tick']
+
+METRIC_PREFIX = 'asg_controller'
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[i] = self.counts[i] + 1
+                break
+        else:
+            self.counts[-1] = self.counts[-1] + 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def cumulative_counts(self):
+        total = 0
+        cumulative = []
+        for count in self.counts:
+            total = total + count
+            cumulative.append(total)
+        return cumulative
+
+
+def format_labels(labels):
+    return ','.join('{}="{}"'.format(name, value) for name, value in labels)
+
+
+class ControllerMetrics:
+
+    def __init__(self, jsonl_path: str = None):
+        self.phases = {phase: Histogram(PHASE_BUCKETS) for phase in PHASES}
+        self.decision_latency = Histogram(DECISION_LATENCY_BUCKETS)
+        self.api_calls = {}
+        self.api_errors = {}
+        self.ticks_skipped = 0
+        self.last_target = None
+        self._lock = threading.Lock()
+        self._tick = threading.local()
+        self.jsonl_path = jsonl_path
+
+    @contextmanager
+    def time_phase(self, phase: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            with self._lock:
+                self.phases[phase].observe(duration)
+            record = getattr(self._tick, 'record', None)
+            if record is not None:
+                record['phases'][phase] = duration
+
+    def record_api_call(self, service: str, operation: str, error: str = None):
+        key = (service, operation)
+        with self._lock:
+            self.api_calls[key] = self.api_calls.get(key, 0) + 1
+            if error is not None:
+                error_key = (service, operation, error)
+                self.api_errors[error_key] = self.api_errors.get(error_key, 0) + 1
+
+    def record_skipped_tick(self):
+        with self._lock:
+            self.ticks_skipped = self.ticks_skipped + 1
+
+    def start_tick(self):
+        self._tick.record = {'time': time.time(), 'phases': {}}
+
+    def record_decision(self, target, newest_datapoint_end: float = None, **fields):
+        """
+        Record the Target published by the current tick.
+
+        newest_datapoint_end is the epoch time the newest datapoint's period ended; the decision latency is the
+        time from then until now, right after Target has been published.
+        """
+        with self._lock:
+            self.last_target = target
+            if newest_datapoint_end is not None:
+                latency = time.time() - newest_datapoint_end
+                self.decision_latency.observe(latency)
+            else:
+                latency = None
+
+        record = getattr(self._tick, 'record', None)
+        if record is not None:
+            record['target'] = target
+            record['decision_latency'] = latency
+            record.update(fields)
+
+    def finish_tick(self):
+        """
+        Append the current tick's record to the JSON-lines file.
+        """
+        record = getattr(self._tick, 'record', None)
+        if record is None:
+            return
+        self._tick.record = None
+
+        if self.jsonl_path:
+            with self._lock:
+                with open(self.jsonl_path, 'a') as jsonl_file:
+                    jsonl_file.write(json.dumps(record) + '\n')
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            name = METRIC_PREFIX + '_phase_seconds'
+            lines.append('# HELP {} Time spent in each phase of a scaling notifier tick.'.format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+            for phase, histogram in self.phases.items():
+                lines.extend(render_histogram(name, histogram, [('phase', phase)]))
+
+            name = METRIC_PREFIX + '_decision_latency_seconds'
+            lines.append('# HELP {} Time from the end of the newest datapoint period to Target being published.'
+                         .format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+            lines.extend(render_histogram(name, self.decision_latency, []))
+
+            name = METRIC_PREFIX + '_api_calls_total'
+            lines.append('# HELP {} AWS API calls made, including retries.'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for (service, operation), count in sorted(self.api_calls.items()):
+                lines.append('{}{{{}}} {}'.format(name, format_labels([('service', service),
+                                                                        ('operation', operation)]), count))
+
+            name = METRIC_PREFIX + '_api_errors_total'
+            lines.append('# HELP {} AWS API calls that raised an error.'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for (service, operation, error), count in sorted(self.api_errors.items()):
+                lines.append('{}{{{}}} {}'.format(name, format_labels([('service', service),
+                                                                        ('operation', operation),
+                                                                        ('error', error)]), count))
+
+            name = METRIC_PREFIX + '_ticks_skipped_total'
+            lines.append('# HELP {} Ticks skipped because the previous one was still running.'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            lines.append('{} {}'.format(name, self.ticks_skipped))
+
+            if self.last_target is not None:
+                name = METRIC_PREFIX + '_target'
+                lines.append('# HELP {} Last published Target value.'.format(name))
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, self.last_target))
+        return '\n'.join(lines) + '\n'
+
+
+def render_histogram(name: str, histogram: Histogram, labels):
+    lines = []
+    cumulative = histogram.cumulative_counts()
+    for upper_bound, count in zip(histogram.buckets + ['+Inf'], cumulative):
+        lines.append('{}_bucket{{{}}} {}'.format(name, format_labels(labels + [('le', upper_bound)]), count))
+    label_text = '{{{}}}'.format(format_labels(labels)) if labels else ''
+    lines.append('{}_sum{} {}'.format(name, label_text, histogram.sum))
+    lines.append('{}_count{} {}'.format(name, label_text, histogram.count))
+    return lines
+
+
+@contextmanager
+def time_phase(metrics: ControllerMetrics, phase: str):
+    """
+    Time a phase if metrics are enabled, otherwise do nothing.
+    """
+    if metrics is None:
+        yield
+        return
+    with metrics.time_phase(phase):
+        yield
+
+
+class InstrumentedClient:
+    """
+    Wrap a boto3 client to count every API call and error in a ControllerMetrics.
+    """
+
+    def __init__(self, client, metrics: ControllerMetrics, service: str):
+        self.client = client
+        self.metrics = metrics
+        self.service = service
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as error:
+                response = getattr(error, 'response', None)
+                code = response.get('Error', {}).get('Code') if isinstance(response, dict) else None
+                self.metrics.record_api_call(self.service, name, code or type(error).__name__)
+                raise
+            self.metrics.record_api_call(self.service, name)
+            return result
+
+        return call
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(metrics: ControllerMetrics, port: int, host: str = '127.0.0.1'):
+    """
+    Serve metrics in Prometheus text format at http://host:port/metrics from a daemon thread.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,395 @@
+#!/usr/bin/python3
+"""
+In-process fakes of the EC2 resource and the EC2 and CloudWatch clients.
+
+FakeAws generates auto scaling groups of synthetic instances and a
+deterministic series for every metric get_logs.py and asg_util_alarms.py
+read, computed on demand for whatever time range is asked for. Every call
+sleeps for a configurable API latency and can be throttled by a token bucket
+per operation, which raises the same ClientError boto3 would so that
+BackoffClient retries as it does against AWS. The request limits CloudWatch
+and EC2 enforce are enforced too.
+
+GetMetricData also evaluates AVG/SUM/MIN/MAX(SEARCH(...)) metric math
+expressions, with the SEARCH syntax group_metrics.py uses: a {namespace,
+dimensions} schema, Name="value" terms, AND, OR, NOT and parentheses.
+"""
+import math
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+from metric_data import IMAGE_ID, INSTANCE_TYPE, to_epoch_seconds
+
+# Limits AWS enforces on a single request
+MAX_STATISTICS_DATAPOINTS = 1440
+MAX_METRIC_DATA_QUERIES = 500
+MAX_METRIC_DATA_DATAPOINTS = 100800
+MAX_STATUS_IDS_PER_REQUEST = 100
+DESCRIBE_INSTANCES_PAGE_SIZE = 1000
+
+# How long after its period ends a datapoint becomes visible
+DEFAULT_PUBLISH_DELAY_SECONDS = 60
+
+AGGREGATE_EXPRESSION = re.compile(
+    r"^\s*(AVG|SUM|MIN|MAX)\(\s*SEARCH\(\s*'((?:[^']|'')*)'\s*,\s*'(\w+)'\s*,\s*(\d+)\s*\)\s*\)\s*$")
+SEARCH_TOKEN = re.compile(r'\s*(\{[^}]*\}|\(|\)|[A-Za-z_][\w.-]*="(?:[^"\\]|\\.)*"|AND\b|OR\b|NOT\b)')
+AGGREGATE_FUNCTIONS = {'AVG': np.mean, 'SUM': np.sum, 'MIN': np.min, 'MAX': np.max}
+
+
+def get_client_error(code: str, message: str, operation: str):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average and bursts of up to `burst` calls.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens = self.tokens - 1
+            return True
+
+
+def tokenize_search(search: str):
+    tokens = []
+    position = 0
+    search = search.strip()
+    while position < len(search):
+        match = SEARCH_TOKEN.match(search, position)
+        if match is None:
+            raise get_client_error('ValidationError', 'Unsupported search syntax at: ' + search[position:],
+                                   'GetMetricData')
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def parse_search(tokens):
+    """
+    Parse SEARCH tokens into a predicate on a metric's {'Namespace', 'MetricName', <dimension>: value} dict.
+    """
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+
+    def take():
+        position[0] = position[0] + 1
+        return tokens[position[0] - 1]
+
+    def parse_or():
+        predicates = [parse_and()]
+        while peek() == 'OR':
+            take()
+            predicates.append(parse_and())
+        return lambda metric: any(predicate(metric) for predicate in predicates)
+
+    def parse_and():
+        predicates = [parse_not()]
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                take()
+            predicates.append(parse_not())
+        return lambda metric: all(predicate(metric) for predicate in predicates)
+
+    def parse_not():
+        token = take()
+        if token == 'NOT':
+            predicate = parse_not()
+            return lambda metric: not predicate(metric)
+        if token == '(':
+            predicate = parse_or()
+            take()
+            return predicate
+        if token.startswith('{'):
+            names = [name.strip() for name in token[1:-1].split(',')]
+            namespace, dimension_names = names[0], set(names[1:])
+            return lambda metric: metric['Namespace'] == namespace and \
+                set(metric) - {'Namespace', 'MetricName'} == dimension_names
+        name, value = token.split('=', 1)
+        value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        return lambda metric: metric.get(name) == value
+
+    return parse_or()
+
+
+class FakeInstance:
+
+    def __init__(self, instance_id: str, launch_time: float, asg_name: str):
+        self.id = instance_id
+        self.launch_epoch = launch_time
+        self.launch_time = datetime.fromtimestamp(launch_time, timezone.utc)
+        self.asg_name = asg_name
+        self.state = {'Name': 'running'}
+        self.tags = [{'Key': 'aws:autoscaling:groupName', 'Value': asg_name}]
+
+
+class FakeInstanceCollection:
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def filter(self, Filters=None):
+        instances = self.aws.instances
+        for instance_filter in Filters or []:
+            values = instance_filter['Values']
+            if instance_filter['Name'] == 'instance-state-name':
+                instances = [instance for instance in instances if instance.state['Name'] in values]
+            elif instance_filter['Name'] == 'tag:aws:autoscaling:groupName':
+                instances = [instance for instance in instances if instance.tags[0]['Value'] in values]
+            elif instance_filter['Name'] == 'instance-id':
+                instances = [instance for instance in instances if instance.id in values]
+
+        # the real collection pages through describe_instances
+        for _ in range(max(1, math.ceil(len(self.aws.instances) / DESCRIBE_INSTANCES_PAGE_SIZE))):
+            self.aws.api_call('ec2', 'describe_instances')
+        return instances
+
+
+class FakeEc2Resource:
+
+    def __init__(self, aws):
+        self.instances = FakeInstanceCollection(aws)
+
+
+class FakeEc2Client:
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def describe_instance_status(self, InstanceIds=None, IncludeAllInstances=False):
+        self.aws.api_call('ec2', 'describe_instance_status')
+        if InstanceIds is not None and len(InstanceIds) > MAX_STATUS_IDS_PER_REQUEST:
+            raise get_client_error('InvalidParameterValue', 'Too many instance ids', 'DescribeInstanceStatus')
+        instance_ids = set(InstanceIds) if InstanceIds is not None else None
+        return {'InstanceStatuses': [
+            {'InstanceId': instance.id, 'InstanceState': {'Name': 'running'}, 'InstanceStatus': {'Status': 'ok'}}
+            for instance in self.aws.instances if instance_ids is None or instance.id in instance_ids
+        ]}
+
+
+class FakeCloudWatchClient:
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def get_metric_statistics(self, Namespace, MetricName, Dimensions, StartTime, EndTime, Period, Statistics,
+                              Unit=None):
+        self.aws.api_call('cloudwatch', 'get_metric_statistics')
+        timestamps, values = self.aws.get_series(Namespace, MetricName, Dimensions, to_epoch_seconds(StartTime),
+                                                 to_epoch_seconds(EndTime), Period)
+        if len(timestamps) > MAX_STATISTICS_DATAPOINTS:
+            raise get_client_error('InvalidParameterCombination',
+                                   'You have requested up to {} datapoints, which exceeds the limit of {}'.format(
+                                       len(timestamps), MAX_STATISTICS_DATAPOINTS), 'GetMetricStatistics')
+        return {'Label': MetricName, 'Datapoints': [
+            {'Timestamp': datetime.fromtimestamp(timestamp, timezone.utc), 'Average': value, 'Unit': Unit or 'None'}
+            for timestamp, value in zip(timestamps.tolist(), values.tolist())
+        ]}
+
+    def get_query_series(self, query, start: float, end: float):
+        if 'Expression' in query:
+            return self.aws.evaluate_expression(query['Expression'], start, end)
+        metric_stat = query['MetricStat']
+        metric = metric_stat['Metric']
+        return self.aws.get_series(metric['Namespace'], metric['MetricName'], metric['Dimensions'], start, end,
+                                   metric_stat['Period'])
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, NextToken=None,
+                        ScanBy='TimestampDescending'):
+        self.aws.api_call('cloudwatch', 'get_metric_data')
+        if len(MetricDataQueries) > MAX_METRIC_DATA_QUERIES:
+            raise get_client_error('ValidationError', 'Too many queries', 'GetMetricData')
+        start = to_epoch_seconds(StartTime)
+        end = to_epoch_seconds(EndTime)
+
+        # the token is where the previous page stopped: query index and datapoint offset
+        query_index, offset = [int(part) for part in NextToken.split(':')] if NextToken else (0, 0)
+        budget = MAX_METRIC_DATA_DATAPOINTS
+        results = []
+        next_token = None
+        while query_index < len(MetricDataQueries):
+            query = MetricDataQueries[query_index]
+            timestamps, values = self.get_query_series(query, start, end)
+            if ScanBy == 'TimestampDescending':
+                timestamps = timestamps[::-1]
+                values = values[::-1]
+            page_end = min(len(timestamps), offset + budget)
+            results.append({
+                'Id': query['Id'],
+                'Label': query.get('Label', query['Id']),
+                'Timestamps': [datetime.fromtimestamp(timestamp, timezone.utc)
+                               for timestamp in timestamps[offset:page_end].tolist()],
+                'Values': values[offset:page_end].tolist(),
+                'StatusCode': 'Complete' if page_end == len(timestamps) else 'PartialData'
+            })
+            budget = budget - (page_end - offset)
+            if page_end < len(timestamps):
+                next_token = '{}:{}'.format(query_index, page_end)
+                break
+            query_index = query_index + 1
+            offset = 0
+            if budget == 0 and query_index < len(MetricDataQueries):
+                next_token = '{}:0'.format(query_index)
+                break
+
+        response = {'MetricDataResults': results, 'Messages': []}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.aws.api_call('cloudwatch', 'put_metric_data')
+        with self.aws.lock:
+            self.aws.put_values.extend((Namespace, datum['MetricName'], datum['Value']) for datum in MetricData)
+
+
+class FakeAws:
+    """
+    A fake account with `num_instances` running instances in `asg_name`, all launched at `launch_time`. More
+    groups can be added with add_group.
+
+    `latency` seconds are slept on every call. `throttle_rates` maps operation names (the boto3 method names, e.g.
+    'get_metric_data') to the calls per second allowed before calls fail with a Throttling error.
+    """
+
+    def __init__(self, num_instances: int, asg_name: str, launch_time: float, latency: float = 0.0,
+                 throttle_rates=None, publish_delay: float = DEFAULT_PUBLISH_DELAY_SECONDS):
+        self.asg_name = asg_name
+        self.launch_time = launch_time
+        self.latency = latency
+        self.publish_delay = publish_delay
+        self.instances = []
+        self.instance_numbers = {}
+        self.add_group(asg_name, num_instances, launch_time)
+        self.buckets = {operation: TokenBucket(rate) for operation, rate in (throttle_rates or {}).items()}
+        self.calls = {}
+        self.throttled = {}
+        self.put_values = []
+        self.lock = threading.Lock()
+
+        self.resource = FakeEc2Resource(self)
+        self.ec2_client = FakeEc2Client(self)
+        self.cw_client = FakeCloudWatchClient(self)
+
+    def add_group(self, asg_name: str, num_instances: int, launch_time: float = None):
+        """
+        Add `num_instances` running instances in `asg_name`, launched at `launch_time` (default: the first group's).
+        """
+        launch_time = launch_time if launch_time is not None else self.launch_time
+        first = len(self.instances)
+        for i in range(first, first + num_instances):
+            instance = FakeInstance('i-{:017x}'.format(i), launch_time, asg_name)
+            self.instances.append(instance)
+            self.instance_numbers[instance.id] = i
+
+    def api_call(self, service: str, operation: str):
+        """
+        Count the call, wait out the latency and fail it if the operation's rate is exceeded.
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        bucket = self.buckets.get(operation)
+        throttled = bucket is not None and not bucket.take()
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            if throttled:
+                self.throttled[operation] = self.throttled.get(operation, 0) + 1
+        if throttled:
+            raise get_client_error('Throttling', 'Rate exceeded', operation)
+
+    def get_series(self, namespace: str, metric_name: str, dimensions, start: float, end: float, period_sec: int):
+        """
+        Datapoints of one metric in [start, end), as arrays of epoch seconds and values.
+        """
+        dimension_values = {dimension['Name']: dimension['Value'] for dimension in dimensions}
+        instance_number = self.instance_numbers.get(dimension_values.get('InstanceId'))
+        if instance_number is None:
+            return np.zeros(0), np.zeros(0)
+
+        # nothing before the launch, nor for periods that haven't been published yet
+        start = max(start, self.instances[instance_number].launch_epoch)
+        end = min(end, time.time() - self.publish_delay + period_sec)
+        first = math.ceil(start / period_sec) * period_sec
+        timestamps = np.arange(first, end, period_sec, dtype=float)
+
+        # a slow daily-ish wave plus a faster one, shifted per instance
+        utilization = 0.45 + 0.3 * np.sin(timestamps / 3600 + instance_number) + \
+            0.1 * np.sin(timestamps / 300 + 2 * instance_number)
+        if metric_name == 'cpu_usage_idle':
+            if dimension_values.get('cpu') == 'cpu1':
+                utilization = utilization * 0.9
+            values = 100 - utilization * 100
+        elif metric_name == 'diskio_io_time':
+            values = utilization * 0.2 * period_sec * 1000
+        elif metric_name == 'mem_used_percent':
+            values = 30 + utilization * 40
+        elif metric_name == 'NetworkOut' and namespace == 'AWS/EC2':
+            values = utilization * 5e7
+        else:
+            return np.zeros(0), np.zeros(0)
+        return timestamps, values
+
+    def list_metrics(self):
+        """
+        Every metric the instances publish, as {'Namespace', 'MetricName', <dimension>: value} dicts.
+        """
+        metrics = []
+        for instance in self.instances:
+            agent_dimensions = {'AutoScalingGroupName': instance.asg_name, 'ImageId': IMAGE_ID,
+                                'InstanceId': instance.id, 'InstanceType': INSTANCE_TYPE}
+            for cpu in ['cpu0', 'cpu1']:
+                metrics.append(dict(agent_dimensions, Namespace='CWAgent', MetricName='cpu_usage_idle', cpu=cpu))
+            metrics.append(dict(agent_dimensions, Namespace='CWAgent', MetricName='diskio_io_time', name='xvda1'))
+            metrics.append(dict(agent_dimensions, Namespace='CWAgent', MetricName='mem_used_percent'))
+            metrics.append({'Namespace': 'AWS/EC2', 'MetricName': 'NetworkOut', 'InstanceId': instance.id})
+        return metrics
+
+    def evaluate_expression(self, expression: str, start: float, end: float):
+        """
+        Evaluate an AGGREGATE(SEARCH('...', 'Average', period)) expression over the matching series.
+        """
+        match = AGGREGATE_EXPRESSION.match(expression)
+        if match is None:
+            raise get_client_error('ValidationError', 'Unsupported expression: ' + expression, 'GetMetricData')
+        function, search, _, period_sec = match.groups()
+        predicate = parse_search(tokenize_search(search.replace("''", "'")))
+
+        all_timestamps = []
+        all_values = []
+        for metric in self.list_metrics():
+            if not predicate(metric):
+                continue
+            dimensions = [{'Name': name, 'Value': value} for name, value in metric.items()
+                          if name not in ('Namespace', 'MetricName')]
+            timestamps, values = self.get_series(metric['Namespace'], metric['MetricName'], dimensions, start, end,
+                                                 int(period_sec))
+            all_timestamps.append(timestamps)
+            all_values.append(values)
+        if not all_timestamps:
+            return np.zeros(0), np.zeros(0)
+
+        # aggregate across series, per timestamp
+        timestamps = np.concatenate(all_timestamps)
+        values = np.concatenate(all_values)
+        unique_timestamps, inverse = np.unique(timestamps, return_inverse=True)
+        aggregate = AGGREGATE_FUNCTIONS[function]
+        return unique_timestamps, np.array([aggregate(values[inverse == i]) for i in range(len(unique_timestamps))])
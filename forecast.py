@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+"""
+Utilization forecasting for asg_util_alarms.py.
+
+The reactive rule only sees window averages of metrics that are already
+minutes old, and new instances take LAUNCH_TIME_DELAY_SECONDS to be counted,
+so on a steady ramp capacity always arrives late. A UtilizationForecaster is
+fed the group's average utilization every tick and projects it to the time
+an instance launched now would be ready, so Target can go to 1 before the
+upper bound is actually crossed.
+
+Models (all take irregularly spaced observations, time in epoch seconds):
+- ewma: exponentially weighted level, no trend
+- holt: Holt's linear trend (double exponential smoothing)
+- linear: least squares line over the last history_seconds
+"""
+
+DEFAULT_MODEL = 'holt'
+# Smoothing factors per observation, for observations a tick (15 s) apart
+DEFAULT_ALPHA = 0.5
+DEFAULT_BETA = 0.3
+DEFAULT_HISTORY_SECONDS = 600
+
+
+class EwmaModel:
+
+    def __init__(self, alpha: float = DEFAULT_ALPHA, **_kwargs):
+        self.alpha = alpha
+        self.level = None
+
+    def add(self, timestamp: float, value: float):
+        if self.level is None:
+            self.level = value
+        else:
+            self.level = self.alpha * value + (1 - self.alpha) * self.level
+
+    def predict(self, timestamp: float):
+        return self.level
+
+
+class HoltModel:
+    """
+    Level and trend (per second) smoothed separately, so the projection follows a ramp.
+    """
+
+    def __init__(self, alpha: float = DEFAULT_ALPHA, beta: float = DEFAULT_BETA, **_kwargs):
+        self.alpha = alpha
+        self.beta = beta
+        self.level = None
+        self.trend = 0.0
+        self.timestamp = None
+
+    def add(self, timestamp: float, value: float):
+        if self.level is None:
+            self.level = value
+            self.timestamp = timestamp
+            return
+        elapsed = timestamp - self.timestamp
+        if elapsed <= 0:
+            # same datapoints as last tick, only refresh the level
+            self.level = self.alpha * value + (1 - self.alpha) * self.level
+            return
+        previous_level = self.level
+        self.level = self.alpha * value + (1 - self.alpha) * (self.level + self.trend * elapsed)
+        self.trend = self.beta * (self.level - previous_level) / elapsed + (1 - self.beta) * self.trend
+        self.timestamp = timestamp
+
+    def predict(self, timestamp: float):
+        if self.level is None:
+            return None
+        return self.level + self.trend * (timestamp - self.timestamp)
+
+
+class LinearModel:
+    """
+    Ordinary least squares over the observations of the last history_seconds.
+    """
+
+    def __init__(self, history_seconds: float = DEFAULT_HISTORY_SECONDS, **_kwargs):
+        self.history_seconds = history_seconds
+        self.observations = []
+
+    def add(self, timestamp: float, value: float):
+        self.observations.append((timestamp, value))
+        oldest = timestamp - self.history_seconds
+        while self.observations and self.observations[0][0] < oldest:
+            self.observations.pop(0)
+
+    def predict(self, timestamp: float):
+        if not self.observations:
+            return None
+        count = len(self.observations)
+        mean_t = sum(t for t, _ in self.observations) / count
+        mean_v = sum(v for _, v in self.observations) / count
+        variance = sum((t - mean_t) ** 2 for t, _ in self.observations)
+        if variance == 0:
+            return mean_v
+        slope = sum((t - mean_t) * (v - mean_v) for t, v in self.observations) / variance
+        return mean_v + slope * (timestamp - mean_t)
+
+
+MODELS = {
+    'ewma': EwmaModel,
+    'holt': HoltModel,
+    'linear': LinearModel,
+}
+
+
+class UtilizationForecaster:
+    """
+    One model per metric (cpu, disk), kept across ticks.
+    """
+
+    def __init__(self, model: str = DEFAULT_MODEL, lead_seconds: float = 300,
+                 history_seconds: float = DEFAULT_HISTORY_SECONDS, alpha: float = DEFAULT_ALPHA,
+                 beta: float = DEFAULT_BETA):
+        if model not in MODELS:
+            raise ValueError("Unknown forecast model '{}', expected one of {}".format(model, sorted(MODELS)))
+        self.model = model
+        self.lead_seconds = lead_seconds
+        self.models = {metric: MODELS[model](alpha=alpha, beta=beta, history_seconds=history_seconds)
+                       for metric in ['cpu', 'disk']}
+
+    def update(self, timestamp: float, avg_cpu_util: float, avg_disk_util: float):
+        """
+        Add the group's average utilization, as measured at `timestamp`. Missing (None) values are skipped.
+        """
+        for metric, value in [('cpu', avg_cpu_util), ('disk', avg_disk_util)]:
+            if value is not None:
+                self.models[metric].add(timestamp, value)
+
+    def predict(self, now: float):
+        """
+        Projected (cpu, disk) utilization lead_seconds from now, None for a metric with no data yet.
+        """
+        return self.models['cpu'].predict(now + self.lead_seconds), \
+            self.models['disk'].predict(now + self.lead_seconds)
@@ -1,337 +1,377 @@
 #!/usr/bin/python3
-import csv
 import os
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import boto3
 
-LOGS_DIR = "aws_logs"
+from aws_clients import DEFAULT_REGION, BackoffClient, create_client
+from instance_sidecar import read_sidecar_logs
+from metric_cache import DEFAULT_MAX_CACHE_BYTES, CachingClient, MetricCache
+from metric_data import get_datapoint_timestamps, get_logs_by_instance_batched, sort_datapoints
+from loadgen_monitor import get_bucket_flags
+from metrics_output import (COLUMNAR_FORMATS, LOADGEN_SATURATED_FIELD, TEST_PARAM_FIELDS, build_metrics_table,
+                            check_columnar_support, get_metrics_filename, iter_metric_rows, write_metrics_columnar,
+                            write_metrics_csv)
+from timepoint_matrix import DEFAULT_FILL_POLICY, FILL_POLICIES, build_timepoint_matrix, fill_gaps, matrix_to_columns
 
+LOGS_DIR = "aws_logs"
+DEFAULT_WORKERS = 16
 
-def left_pad_logs_by_instance(logs_by_instance):
-    '''
-    Since the tests only involve scaling up, we assume missing values are
-    due to late scalings and left-fill with zeroes.
-
-    This could be wrong if for example logs in the middle are missing for
-    some reason...
-    '''
-
-    # find total timepoints from oldest instance
-    num_timepoints = 0
-    for log in logs_by_instance:
-        for key, val in log.items():
-            if key == 'instance_id':
-                continue
-            if key == 'launch_time':
-                continue
-            if len(log[key]) > num_timepoints:
-                num_timepoints = len(log[key])
-
-    # perform the padding on items with less timepoints
-    for log in logs_by_instance:
-        for key, val in log.items():
-            if key == 'instance_id' or key == 'launch_time' or len(log[key]) == num_timepoints:
-                continue
-            num_missing = num_timepoints - len(log[key])
-            left_pad = [0 for _ in range(0, num_missing)]
-            log[key] = left_pad + log[key]
-    return logs_by_instance
-
-
-def convert_logs_by_instance_to_per_timepoint(logs_by_instance):
-
-    padded_logs = left_pad_logs_by_instance(logs_by_instance)
-
-    num_instances = len(padded_logs)
-    num_timepoints = len(padded_logs[0]['cpu0_utils']) if num_instances > 0 else 0
-
-    logs_by_timepoint = []
-    for i in range(0, num_instances):
-        for j in range(0, num_timepoints):
-            logs_by_timepoint.append({
-                'instance_id': padded_logs[i]['instance_id'],
-                'cpu0_util': padded_logs[i]['cpu0_utils'][j],
-                'cpu1_util': padded_logs[i]['cpu1_utils'][j],
-                'disk_util': padded_logs[i]['disk_utils'][j],
-                'mem_util': padded_logs[i]['mem_utils'][j],
-                'network_out': padded_logs[i]['network_out_values'][j],
-                'launch_time': padded_logs[i]['launch_time'],
-                'timepoint': j
-            })
-    return logs_by_timepoint
-
-
-def get_logs(ec2, cw_client, args):
+@contextmanager
+def timed(timings, name):
     """
-    Between the start and end times,
-    - gets a list of running instances in the autoscaling group
-    - obtains logs for each
-    - converts these per-instance logs into per-timepoint logs
-    - outputs to csv
-
+    Add the time spent in the block to timings[name], if a timings dict is given.
     """
-    # get params from args
-    results_dir = args.results_dir
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
 
-    asg_name = args.asg_name
 
-    test_id = args.boundaries[0]
-    test_start_time = args.boundaries[1]
-    test_end_time = args.boundaries[2]
-    sample_period = args.boundaries[3]
-    asg_policy_type = args.boundaries[4]
-    asg_cpu_max = args.boundaries[5]
-    asg_disk_max = args.boundaries[6]
-    asg_scaleup_duration = args.boundaries[7]
-    image_size = args.boundaries[8]
-    num_users_a = args.boundaries[9]
-    num_users_b = args.boundaries[10]
-    num_users_c = args.boundaries[11]
-
-    # Fetch running instances from asg_name autoscaling group
+def get_instances(ec2, asg_name):
+    """
+    Get (instance_id, launch_time) for every instance tagged with the auto scaling group.
+    """
     instances = ec2.instances.filter(
             Filters=[
                 {'Name': 'tag:aws:autoscaling:groupName', 'Values': [asg_name]}
             ]
     )
-    instance_id_list = [instance.id for instance in instances]
-    instance_launch_times = [instance.launch_time.timestamp() for instance in instances]
-
-    logs_by_instance = []
-
-    launch_time_index = 0
-
-    for instance_id in instance_id_list:
-        cpu0_response = cw_client.get_metric_statistics(
-            Namespace='CWAgent',
-            Dimensions=[
-                {
-                    'Name': 'AutoScalingGroupName',
-                    'Value': asg_name
-                },
-                {
-                    'Name': 'ImageId',
-                    'Value': 'ami-0bdd1b937142e6961'
-                },
-                {
-                    'Name': 'InstanceId',
-                    'Value': '{}'.format(instance_id)
-                },
-                {
-                    'Name': 'InstanceType',
-                    'Value': 'm4.large'
-                },
-                {
-                    'Name': 'cpu',
-                    'Value': 'cpu0'
-                }
-            ],
-            MetricName='cpu_usage_idle',
-            StartTime=test_start_time,
-            EndTime=test_end_time,
-            Period=sample_period,
-            Statistics=[
-                'Average'
-            ],
-            Unit='Percent'
-        )
-
-        # exclude instances with no activity during the timespan of interest
-        if (not cpu0_response) or (len(cpu0_response['Datapoints']) < 1):
-            continue
-
-        if cpu0_response:
-            # 'Idle Percent * 100' -> 'Util Percent'
-            cpu0_utils = [(100 - idle_percent['Average']) / 100 for
-                    idle_percent in cpu0_response['Datapoints']]
-        else:
-            cpu0_utils = None
-
-        # Take maximum utilization for a single cpu for each instance.
-        cpu1_response = cw_client.get_metric_statistics(
-            Namespace='CWAgent',
-            Dimensions=[
-                {
-                    'Name': 'AutoScalingGroupName',
-                    'Value': asg_name
-                },
-                {
-                    'Name': 'ImageId',
-                    'Value': 'ami-0bdd1b937142e6961'
-                },
-                {
-                    'Name': 'InstanceId',
-                    'Value': instance_id
-                },
-                {
-                    'Name': 'InstanceType',
-                    'Value': 'm4.large'
-                },
-                {
-                    'Name': 'cpu',
-                    'Value': 'cpu1'
-                }
-            ],
-            MetricName='cpu_usage_idle',
-            StartTime=test_start_time,
-            EndTime=test_end_time,
-            Period=sample_period,
-            Statistics=[
-                'Average'
-            ],
-            Unit='Percent'
-        )
-        if cpu1_response:
-            # 'Idle Percent * 100' -> 'Util Percent'
-            cpu1_utils = [(100 - util_val['Average']) / 100 for
-                    util_val in cpu1_response['Datapoints']]
-        else:
-            cpu1_utils = None
-
-        # Take maximum utilization for the disk for each instance.
-        disk_response = cw_client.get_metric_statistics(
-            Namespace='CWAgent',
-            Dimensions=[
-                {
-                    'Name': 'AutoScalingGroupName',
-                    'Value': asg_name
-                },
-                {
-                    'Name': 'ImageId',
-                    'Value': 'ami-0bdd1b937142e6961'
-                },
-                {
-                    'Name': 'InstanceId',
-                    'Value': instance_id
-                },
-                {
-                    'Name': 'InstanceType',
-                    'Value': 'm4.large'
-                },
-                {
-                    'Name': 'name',
-                    'Value': 'xvda1'
-                }
-            ],
-            MetricName='diskio_io_time',
-            StartTime=test_start_time,
-            EndTime=test_end_time,
-            Period=sample_period,
-            Statistics=[
-                'Average'
-            ],
-            Unit='Milliseconds'
-        )
-
-        if disk_response:
-            # 'Milliseconds' -> 'Util Percent'
-            disk_utils = [response['Average'] / 1000 / sample_period for response in disk_response['Datapoints']]
-        else:
-            disk_utils = None
-
-        mem_response = cw_client.get_metric_statistics(
-            Namespace='CWAgent',
-            Dimensions=[
-                {
-                    'Name': 'AutoScalingGroupName',
-                    'Value': asg_name
-                },
-                {
-                    'Name': 'ImageId',
-                    'Value': 'ami-0bdd1b937142e6961'
-                },
-                {
-                    'Name': 'InstanceId',
-                    'Value': instance_id
-                },
-                {
-                    'Name': 'InstanceType',
-                    'Value': 'm4.large'
-                }
-            ],
-            MetricName='mem_used_percent',
-            StartTime=test_start_time,
-            EndTime=test_end_time,
-            Period=sample_period,
-            Statistics=[
-                'Average'
-            ],
-            Unit='Percent'
-        )
-
-        if mem_response:
-            mem_utils = [response['Average'] for response in mem_response['Datapoints']]
-        else:
-            mem_utils = None
-
-        # unlike above, this doesnt seem to work unless very few dimensions are
-        # passed in
-        network_response = cw_client.get_metric_statistics(
-            Namespace='AWS/EC2',
-            Dimensions=[
-                {
-                    'Name': 'InstanceId',
-                    'Value': '{}'.format(instance_id)
-                }
-            ],
-            MetricName='NetworkOut',
-            StartTime=test_start_time,
-            EndTime=test_end_time,
-            Period=sample_period,
-            Statistics=[
-                'Average'
-            ]
-        )
+    return [(instance.id, instance.launch_time.timestamp()) for instance in instances]
 
-        if network_response:
-            network_out_values = [response['Average'] for response in network_response['Datapoints']]
-        else:
-            network_out_values = None
 
-        logs_by_instance.append({
-            'instance_id': instance_id,
-            'cpu0_utils': cpu0_utils,
-            'cpu1_utils': cpu1_utils,
-            'disk_utils': disk_utils,
-            'mem_utils': mem_utils,
-            'network_out_values': network_out_values,
-            'launch_time': instance_launch_times[launch_time_index]
-        })
+def get_instance_logs(cw_client, instance_id, launch_time, asg_name, start_time, end_time, period_sec):
+    """
+    Fetch logs for a single instance one metric at a time (5 get_metric_statistics calls).
 
-        launch_time_index = launch_time_index + 1
+    Returns None if the instance had no activity during the timespan of interest.
+    """
+    cpu0_response = cw_client.get_metric_statistics(
+        Namespace='CWAgent',
+        Dimensions=[
+            {
+                'Name': 'AutoScalingGroupName',
+                'Value': asg_name
+            },
+            {
+                'Name': 'ImageId',
+                'Value': 'ami-0bdd1b937142e6961'
+            },
+            {
+                'Name': 'InstanceId',
+                'Value': '{}'.format(instance_id)
+            },
+            {
+                'Name': 'InstanceType',
+                'Value': 'm4.large'
+            },
+            {
+                'Name': 'cpu',
+                'Value': 'cpu0'
+            }
+        ],
+        MetricName='cpu_usage_idle',
+        StartTime=start_time,
+        EndTime=end_time,
+        Period=period_sec,
+        Statistics=[
+            'Average'
+        ],
+        Unit='Percent'
+    )
 
-    logs_by_timepoint = convert_logs_by_instance_to_per_timepoint(logs_by_instance)
+    # exclude instances with no activity during the timespan of interest
+    if (not cpu0_response) or (len(cpu0_response['Datapoints']) < 1):
+        return None
+
+    timestamps = {}
+
+    if cpu0_response:
+        # 'Idle Percent * 100' -> 'Util Percent'
+        cpu0_datapoints = sort_datapoints(cpu0_response['Datapoints'])
+        cpu0_utils = [(100 - idle_percent['Average']) / 100 for
+                idle_percent in cpu0_datapoints]
+        timestamps['cpu0_utils'] = get_datapoint_timestamps(cpu0_datapoints)
+    else:
+        cpu0_utils = None
+
+    # Take maximum utilization for a single cpu for each instance.
+    cpu1_response = cw_client.get_metric_statistics(
+        Namespace='CWAgent',
+        Dimensions=[
+            {
+                'Name': 'AutoScalingGroupName',
+                'Value': asg_name
+            },
+            {
+                'Name': 'ImageId',
+                'Value': 'ami-0bdd1b937142e6961'
+            },
+            {
+                'Name': 'InstanceId',
+                'Value': instance_id
+            },
+            {
+                'Name': 'InstanceType',
+                'Value': 'm4.large'
+            },
+            {
+                'Name': 'cpu',
+                'Value': 'cpu1'
+            }
+        ],
+        MetricName='cpu_usage_idle',
+        StartTime=start_time,
+        EndTime=end_time,
+        Period=period_sec,
+        Statistics=[
+            'Average'
+        ],
+        Unit='Percent'
+    )
+    if cpu1_response:
+        # 'Idle Percent * 100' -> 'Util Percent'
+        cpu1_datapoints = sort_datapoints(cpu1_response['Datapoints'])
+        cpu1_utils = [(100 - util_val['Average']) / 100 for
+                util_val in cpu1_datapoints]
+        timestamps['cpu1_utils'] = get_datapoint_timestamps(cpu1_datapoints)
+    else:
+        cpu1_utils = None
+
+    # Take maximum utilization for the disk for each instance.
+    disk_response = cw_client.get_metric_statistics(
+        Namespace='CWAgent',
+        Dimensions=[
+            {
+                'Name': 'AutoScalingGroupName',
+                'Value': asg_name
+            },
+            {
+                'Name': 'ImageId',
+                'Value': 'ami-0bdd1b937142e6961'
+            },
+            {
+                'Name': 'InstanceId',
+                'Value': instance_id
+            },
+            {
+                'Name': 'InstanceType',
+                'Value': 'm4.large'
+            },
+            {
+                'Name': 'name',
+                'Value': 'xvda1'
+            }
+        ],
+        MetricName='diskio_io_time',
+        StartTime=start_time,
+        EndTime=end_time,
+        Period=period_sec,
+        Statistics=[
+            'Average'
+        ],
+        Unit='Milliseconds'
+    )
 
-    filename = 'aws_metrics_{}_{}_{}_{}_{}_{}_{}_{}_{}_{}_{}.csv'.format(
-        test_id, test_start_time, test_end_time, asg_policy_type, asg_cpu_max, asg_disk_max, asg_scaleup_duration,
-        image_size, num_users_a, num_users_b, num_users_c
+    if disk_response:
+        # 'Milliseconds' -> 'Util Percent'
+        disk_datapoints = sort_datapoints(disk_response['Datapoints'])
+        disk_utils = [response['Average'] / 1000 / period_sec for response in disk_datapoints]
+        timestamps['disk_utils'] = get_datapoint_timestamps(disk_datapoints)
+    else:
+        disk_utils = None
+
+    mem_response = cw_client.get_metric_statistics(
+        Namespace='CWAgent',
+        Dimensions=[
+            {
+                'Name': 'AutoScalingGroupName',
+                'Value': asg_name
+            },
+            {
+                'Name': 'ImageId',
+                'Value': 'ami-0bdd1b937142e6961'
+            },
+            {
+                'Name': 'InstanceId',
+                'Value': instance_id
+            },
+            {
+                'Name': 'InstanceType',
+                'Value': 'm4.large'
+            }
+        ],
+        MetricName='mem_used_percent',
+        StartTime=start_time,
+        EndTime=end_time,
+        Period=period_sec,
+        Statistics=[
+            'Average'
+        ],
+        Unit='Percent'
     )
-    with open(os.path.join(results_dir, filename), 'w') as csv_file:
-        fieldnames = ['timepoint',
-                      'cpu0_util',
-                      'cpu1_util',
-                      'mem_util',
-                      'disk_util',
-                      'network_out',
-                      'instance_id',
-                      'running_time_ms']
-
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-
-        writer.writeheader()
-        for i in range(0, len(logs_by_timepoint)):
-            data = {
-                fieldnames[0]: logs_by_timepoint[i]['timepoint'],
-                fieldnames[1]: logs_by_timepoint[i]['cpu0_util'],
-                fieldnames[2]: logs_by_timepoint[i]['cpu1_util'],
-                fieldnames[3]: logs_by_timepoint[i]['mem_util'],
-                fieldnames[4]: logs_by_timepoint[i]['disk_util'],
-                fieldnames[5]: logs_by_timepoint[i]['network_out'],
-                fieldnames[6]: logs_by_timepoint[i]['instance_id'],
-                fieldnames[7]: test_end_time - logs_by_timepoint[i]['launch_time']
+
+    if mem_response:
+        mem_datapoints = sort_datapoints(mem_response['Datapoints'])
+        mem_utils = [response['Average'] for response in mem_datapoints]
+        timestamps['mem_utils'] = get_datapoint_timestamps(mem_datapoints)
+    else:
+        mem_utils = None
+
+    # unlike above, this doesnt seem to work unless very few dimensions are
+    # passed in
+    network_response = cw_client.get_metric_statistics(
+        Namespace='AWS/EC2',
+        Dimensions=[
+            {
+                'Name': 'InstanceId',
+                'Value': '{}'.format(instance_id)
             }
-            writer.writerow(data)
+        ],
+        MetricName='NetworkOut',
+        StartTime=start_time,
+        EndTime=end_time,
+        Period=period_sec,
+        Statistics=[
+            'Average'
+        ]
+    )
+
+    if network_response:
+        network_datapoints = sort_datapoints(network_response['Datapoints'])
+        network_out_values = [response['Average'] for response in network_datapoints]
+        timestamps['network_out_values'] = get_datapoint_timestamps(network_datapoints)
+    else:
+        network_out_values = None
+
+    return {
+        'instance_id': instance_id,
+        'cpu0_utils': cpu0_utils,
+        'cpu1_utils': cpu1_utils,
+        'disk_utils': disk_utils,
+        'mem_utils': mem_utils,
+        'network_out_values': network_out_values,
+        'launch_time': launch_time,
+        'timestamps': timestamps
+    }
+
+
+def get_logs_by_instance(cw_client, instances, asg_name, start_time, end_time, period_sec, workers=1):
+    """
+    Fetch logs for each instance with get_metric_statistics.
+
+    With workers > 1 the instances are fetched from a bounded thread pool sharing cw_client. Results keep
+    the order of `instances` either way.
+    """
+    def fetch(instance):
+        instance_id, launch_time = instance
+        return get_instance_logs(cw_client, instance_id, launch_time, asg_name, start_time, end_time, period_sec)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            instance_logs = list(executor.map(fetch, instances))
+    else:
+        instance_logs = [fetch(instance) for instance in instances]
+
+    return [logs for logs in instance_logs if logs is not None]
+
+
+def get_logs(ec2, cw_client, args, cache=None, timings=None):
+    """
+    Between the start and end times,
+    - gets a list of running instances in the autoscaling group
+    - obtains logs for each
+    - aligns these per-instance logs on a shared timestamp grid
+    - outputs to csv, and optionally to a columnar (parquet/arrow) file
+
+    If a timings dict is given, the seconds spent in each of these steps are added to it.
+    """
+    # get params from args
+    results_dir = args.results_dir
+
+    asg_name = args.asg_name
+
+    test_params = dict(zip(TEST_PARAM_FIELDS, args.boundaries))
+    test_start_time = test_params['test_start_time']
+    test_end_time = test_params['test_end_time']
+    sample_period = test_params['sample_period']
+
+    # Fetch running instances from asg_name autoscaling group. The listing is cached too, since it can't be
+    # redone once the instances have been terminated.
+    with timed(timings, 'list_instances'):
+        if cache is not None:
+            instances_key = {'api': 'instances', 'asg_name': asg_name, 'start': test_start_time,
+                             'end': test_end_time}
+            instances = cache.get_instances(instances_key, lambda: get_instances(ec2, asg_name))
+        else:
+            instances = get_instances(ec2, asg_name)
+
+    # Instances with recorded sidecar samples don't need CloudWatch
+    sidecar_logs = []
+    cloudwatch_instances = instances
+    if args.source == 'sidecar':
+        with timed(timings, 'read_sidecar'):
+            sidecar_logs = read_sidecar_logs(args.sidecar_file, instances, test_start_time, test_end_time,
+                                             sample_period)
+        sidecar_ids = {log['instance_id'] for log in sidecar_logs}
+        cloudwatch_instances = [instance for instance in instances if instance[0] not in sidecar_ids]
+        print("Read sidecar samples for {} of {} instance(s)".format(len(sidecar_logs), len(instances)))
+
+    with timed(timings, 'fetch'):
+        if not cloudwatch_instances:
+            logs_by_instance = []
+        elif args.fetch_mode == 'batched':
+            logs_by_instance, api_stats = get_logs_by_instance_batched(
+                cw_client, cloudwatch_instances, asg_name, test_start_time, test_end_time, sample_period)
+            print("Fetched metrics for {} instance(s) in {} GetMetricData call(s), saving {} API call(s)".format(
+                len(cloudwatch_instances), api_stats['api_calls'], api_stats['api_calls_saved']))
+        elif args.fetch_mode == 'concurrent':
+            logs_by_instance = get_logs_by_instance(
+                cw_client, cloudwatch_instances, asg_name, test_start_time, test_end_time, sample_period,
+                workers=args.workers)
+        else:
+            logs_by_instance = get_logs_by_instance(
+                cw_client, cloudwatch_instances, asg_name, test_start_time, test_end_time, sample_period)
+
+    if sidecar_logs:
+        # back in the order of the instance listing
+        logs_by_id = {log['instance_id']: log for log in sidecar_logs + logs_by_instance}
+        logs_by_instance = [logs_by_id[instance_id] for instance_id, _ in instances if instance_id in logs_by_id]
+
+    # Align every series on a shared timestamp grid
+    with timed(timings, 'align'):
+        bucket_timestamps, matrix = build_timepoint_matrix(logs_by_instance, sample_period)
+        matrix = fill_gaps(matrix, args.fill_policy)
+
+    instance_ids = [log['instance_id'] for log in logs_by_instance]
+    launch_times = [log['launch_time'] for log in logs_by_instance]
+
+    # Timepoints during which the load generator was saturated, so their metrics can be told apart
+    extra_columns = {}
+    if args.loadgen_monitor:
+        extra_columns[LOADGEN_SATURATED_FIELD] = get_bucket_flags(args.loadgen_monitor, bucket_timestamps,
+                                                                  sample_period)
+        print("Load generator saturated in {} of {} timepoint(s)".format(
+            sum(extra_columns[LOADGEN_SATURATED_FIELD]), len(bucket_timestamps)))
+
+    # Rows are written as they are generated from the matrix
+    with timed(timings, 'write_csv'):
+        write_metrics_csv(os.path.join(results_dir, get_metrics_filename(test_params)),
+                          iter_metric_rows(instance_ids, launch_times, bucket_timestamps, matrix, test_end_time,
+                                           extra_columns),
+                          extra_columns.keys())
+
+    if args.columnar_format:
+        with timed(timings, 'write_columnar'):
+            columns = matrix_to_columns(instance_ids, launch_times, bucket_timestamps, matrix, test_end_time)
+            table = build_metrics_table(columns, test_params, extra_columns)
+            filename = get_metrics_filename(test_params, COLUMNAR_FORMATS[args.columnar_format])
+            write_metrics_columnar(os.path.join(results_dir, filename), table, args.columnar_format)
 
 
 def main():
@@ -355,16 +395,54 @@ def main():
                                  'num_users_c'),
                         type=int, nargs=12,
                         help="So many arguments, look at the source ")
+    parser.add_argument('--fetch-mode', choices=['batched', 'concurrent', 'serial'], default='batched',
+                        help="Fetch metrics with batched GetMetricData calls (default), or one "
+                             "get_metric_statistics call per instance and metric, either from a thread pool "
+                             "(concurrent) or one after another (serial)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="Thread pool size for --fetch-mode concurrent")
+    parser.add_argument('--fill-policy', choices=FILL_POLICIES, default=DEFAULT_FILL_POLICY,
+                        help="How to fill timepoints with no sample (see timepoint_matrix.py)")
+    parser.add_argument('--columnar-format', choices=list(COLUMNAR_FORMATS.keys()),
+                        help="Also write the metrics in this columnar format (requires pyarrow)")
+    parser.add_argument('--cache-dir', default=LOGS_DIR,
+                        help="Directory for cached CloudWatch responses (default: %(default)s)")
+    parser.add_argument('--cache-max-mb', type=int, default=DEFAULT_MAX_CACHE_BYTES // (1024 * 1024),
+                        help="Evict least recently used cache entries above this size")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Always fetch from CloudWatch")
+    parser.add_argument('--source', choices=['cloudwatch', 'sidecar'], default='cloudwatch',
+                        help="Take the metrics of the instances in --sidecar-file from their recorded 1 s sidecar "
+                             "samples, and only the rest from CloudWatch (default: %(default)s)")
+    parser.add_argument('--sidecar-file', nargs='+', default=[],
+                        help="csv(s) written by asg_util_alarms.py --sidecar-record or instance_sidecar.py collect")
+    parser.add_argument('--loadgen-monitor',
+                        help="csv written by loadgen_monitor.py record: adds a {} column, 1 for the timepoints "
+                             "during which the load generator was saturated".format(LOADGEN_SATURATED_FIELD))
     args = parser.parse_args()  # hint - this crashes if you provide 0 args
+    if args.source == 'sidecar' and not args.sidecar_file:
+        parser.error("--source sidecar needs --sidecar-file")
+
+    # Fail before fetching anything if the columnar output can't be written
+    if args.columnar_format:
+        check_columnar_support()
 
     # Setup AWS resources
-    region = "us-west-1"
+    region = DEFAULT_REGION
     ec2 = boto3.resource('ec2', region_name=region)
-    cw_client = boto3.client('cloudwatch', region_name=region)
+    cw_client = BackoffClient(create_client('cloudwatch', region, max_pool_connections=max(args.workers, 10)))
+
+    cache = None
+    if not args.no_cache:
+        cache = MetricCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024)
+        cw_client = CachingClient(cw_client, cache)
 
     # Get logs
     print("Getting logs...")
-    get_logs(ec2, cw_client, args)
+    get_logs(ec2, cw_client, args, cache=cache)
+    if cache is not None:
+        print("Cache: {} hit(s), {} miss(es), {} CloudWatch API call(s)".format(
+            cache.hits, cache.misses, cw_client.api_calls))
     print("Logs retrieved.")
 
 
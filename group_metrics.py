@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+"""
+Group-wide utilization for asg_util_alarms.py from a single GetMetricData call.
+
+Instead of fetching every ready instance's cpu and disk metrics and averaging
+them in Python, CloudWatch averages them itself: one AVG(SEARCH(...))
+metric math expression per metric over the AutoScalingGroupName dimension.
+The number of API calls per tick doesn't depend on the group size.
+
+SEARCH finds every instance of the group that has reported, so the ones
+run_scaling_notifier would leave out are excluded in the expression: running
+instances that aren't ready yet, and instances that have stopped running
+but still have datapoints in the window. That list stays short (instances
+launching or just terminated), unlike a list of the ready ones.
+"""
+from metric_data import IMAGE_ID, INSTANCE_TYPE, get_metric_data_batched, to_epoch_seconds
+
+# Dimensions the CloudWatch agent publishes each metric with
+AGENT_DIMENSIONS = ['AutoScalingGroupName', 'ImageId', 'InstanceId', 'InstanceType']
+GROUP_METRICS = [
+    {
+        'id': 'cpu',
+        'metric_name': 'cpu_usage_idle',
+        'extra_dimension': 'cpu',
+        'extra_values': ['cpu0', 'cpu1'],
+    },
+    {
+        'id': 'disk',
+        'metric_name': 'diskio_io_time',
+        'extra_dimension': 'name',
+        'extra_values': ['xvda1'],
+    },
+]
+
+
+def quote(value: str):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def any_of(name: str, values):
+    return '(' + ' OR '.join('{}={}'.format(name, quote(value)) for value in values) + ')'
+
+
+def build_search_expression(metric, asg_name: str, excluded_instance_ids, period_sec: int):
+    """
+    AVG(SEARCH(...)) over every instance of the group, except excluded_instance_ids.
+    """
+    schema = '{' + ','.join(['CWAgent'] + AGENT_DIMENSIONS + [metric['extra_dimension']]) + '}'
+    terms = [
+        schema,
+        'MetricName={}'.format(quote(metric['metric_name'])),
+        'AutoScalingGroupName={}'.format(quote(asg_name)),
+        'ImageId={}'.format(quote(IMAGE_ID)),
+        'InstanceType={}'.format(quote(INSTANCE_TYPE)),
+        any_of(metric['extra_dimension'], metric['extra_values'])
+    ]
+    if excluded_instance_ids:
+        terms.append('NOT ' + any_of('InstanceId', sorted(excluded_instance_ids)))
+    search = ' '.join(terms)
+    # inside the single quoted SEARCH string, single quotes are escaped by doubling them
+    return "AVG(SEARCH('{}', 'Average', {}))".format(search.replace("'", "''"), period_sec)
+
+
+class GroupUtilizationQuery:
+    """
+    Kept across ticks, to remember instances that have stopped running recently.
+    """
+
+    def __init__(self, window_minutes: int):
+        self.window_seconds = window_minutes * 60
+        # instance id -> epoch seconds it was last seen running
+        self.last_seen = {}
+        self.newest_timestamp = None
+        self.api_calls = 0
+
+    def get_excluded_instance_ids(self, running_ids, ready_ids, now: float):
+        for instance_id in running_ids:
+            self.last_seen[instance_id] = now
+        # gone for longer than the window: its datapoints can't be in it any more
+        for instance_id, last_seen in list(self.last_seen.items()):
+            if now - last_seen > self.window_seconds:
+                del self.last_seen[instance_id]
+        return set(self.last_seen) - set(ready_ids)
+
+    def build_queries(self, asg_name: str, running_ids, ready_ids, end_time, period_sec: int, id_prefix: str = ''):
+        """
+        The GetMetricData queries for one tick. id_prefix keeps the ids unique when several groups share a request.
+        """
+        excluded_ids = self.get_excluded_instance_ids(running_ids, ready_ids, to_epoch_seconds(end_time))
+        return [{'Id': id_prefix + metric['id'],
+                 'Expression': build_search_expression(metric, asg_name, excluded_ids, period_sec),
+                 'Period': period_sec,
+                 'ReturnData': True}
+                for metric in GROUP_METRICS]
+
+    def get_utils_from_results(self, results, period_sec: int, id_prefix: str = ''):
+        """
+        Average cpu and disk utilization from get_metric_data_batched results for build_queries.
+        """
+        values = {metric['id']: results[id_prefix + metric['id']]['Values'] for metric in GROUP_METRICS}
+        timestamps = [to_epoch_seconds(timestamp) for metric in GROUP_METRICS
+                      for timestamp in results[id_prefix + metric['id']]['Timestamps']]
+        self.newest_timestamp = max(timestamps) if timestamps else None
+
+        # 'Idle Percent' -> 'Utilization'
+        cpu_idle = values['cpu']
+        avg_cpu_util = (100 - sum(cpu_idle) / len(cpu_idle)) / 100 if cpu_idle else None
+        # 'Milliseconds' -> 'Utilization'
+        disk_io_time = values['disk']
+        avg_disk_util = sum(disk_io_time) / len(disk_io_time) / 1000 / period_sec if disk_io_time else None
+        return avg_cpu_util, avg_disk_util
+
+    def get_utils(self, cw_client, asg_name: str, running_ids, ready_ids, start_time, end_time, period_sec: int):
+        """
+        Average cpu and disk utilization over the window of the ready instances, in the same units as
+        run_scaling_notifier's per-instance path (None for a metric with no datapoints).
+        """
+        queries = self.build_queries(asg_name, running_ids, ready_ids, end_time, period_sec)
+        results, api_calls = get_metric_data_batched(cw_client, queries, start_time, end_time)
+        self.api_calls = self.api_calls + api_calls
+        return self.get_utils_from_results(results, period_sec)
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+"""
+Instance readiness tracking for asg_util_alarms.py.
+
+An instance counts as ready once it is older than the launch time delay and
+its status check is 'ok'. Instances that have become ready are remembered, so
+each tick only the pending ones are checked, all in one batched
+describe_instance_status call.
+"""
+
+# describe_instance_status accepts at most this many InstanceIds per call
+MAX_STATUS_IDS_PER_REQUEST = 100
+
+
+class ReadinessTracker:
+
+    def __init__(self, launch_time_delay_seconds: int):
+        self.launch_time_delay_seconds = launch_time_delay_seconds
+        self.ready = set()
+        self.status_calls = 0
+
+    def get_ok_instance_ids(self, ec2_client, instance_ids):
+        ok_instance_ids = set()
+        for i in range(0, len(instance_ids), MAX_STATUS_IDS_PER_REQUEST):
+            response = ec2_client.describe_instance_status(
+                InstanceIds=instance_ids[i:i + MAX_STATUS_IDS_PER_REQUEST])
+            self.status_calls = self.status_calls + 1
+            for instance_status in response['InstanceStatuses']:
+                if instance_status['InstanceStatus']['Status'] == 'ok':
+                    ok_instance_ids.add(instance_status['InstanceId'])
+        return ok_instance_ids
+
+    def update(self, ec2_client, instances, current_epoch_seconds: float, reporting_ids=None):
+        """
+        Split the running instances into ready ones and ones still warming up.
+
+        Instances in `reporting_ids` already send their own metrics (see instance_sidecar.py), so they don't
+        have to wait out the launch time delay; their status check still has to be 'ok'.
+
+        Returns the ready instance ids, in the order of `instances`, and the number of instances warming up.
+        """
+        running_ids = [instance.id for instance in instances]
+
+        # Forget instances that have been terminated or stopped
+        self.ready.intersection_update(running_ids)
+
+        waiting_instances = 0
+        pending_ids = []
+        for instance in instances:
+            if instance.id in self.ready:
+                continue
+            # Check if instance is older than the launch time delay
+            if current_epoch_seconds - instance.launch_time.timestamp() < self.launch_time_delay_seconds and \
+                    (reporting_ids is None or instance.id not in reporting_ids):
+                waiting_instances = waiting_instances + 1
+                continue
+            pending_ids.append(instance.id)
+
+        if pending_ids:
+            ok_instance_ids = self.get_ok_instance_ids(ec2_client, pending_ids)
+            self.ready.update(ok_instance_ids)
+            waiting_instances = waiting_instances + len(pending_ids) - len(ok_instance_ids)
+
+        return [instance_id for instance_id in running_ids if instance_id in self.ready], waiting_instances
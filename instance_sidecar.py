@@ -0,0 +1,519 @@
+#!/usr/bin/python3
+"""
+Per-instance utilization at 1 s resolution, without CloudWatch.
+
+The CloudWatch agent's datapoints come every PERIOD_SEC (30 s) and show up
+a minute or more later, so asg_util_alarms.py has to average over minutes and
+wait out LAUNCH_TIME_DELAY_SECONDS. The sidecar runs on each instance,
+samples /proc every --interval seconds and sends --batch samples at a time in
+one small UDP datagram to the collector that asg_util_alarms.py runs with
+--sidecar-port (or to `instance_sidecar.py collect`):
+
+    ./instance_sidecar.py send --collector <controller host>:8126
+    ./instance_sidecar.py collect --port 8126 --record sidecar_samples.csv
+
+A sample holds the same metrics the agent publishes: cpu_usage_idle of cpu0
+and cpu1, diskio_io_time of --disk (milliseconds spent doing I/O),
+mem_used_percent and the bytes sent on every interface but lo. The collector
+can record every sample to a csv that get_logs.py --source sidecar reads.
+
+Only the standard library is used, so the sidecar runs on a bare instance.
+"""
+import csv
+import logging
+import math
+import os
+import socket
+import struct
+import threading
+import time
+import urllib.request
+from argparse import ArgumentParser
+from collections import deque
+
+FORMAT = '%(asctime)-15s %(message)s'
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger('instance_sidecar')
+
+DEFAULT_PORT = 8126
+DEFAULT_INTERVAL_SECONDS = 1.0
+DEFAULT_BATCH = 5
+DEFAULT_DISK = 'xvda1'
+# Averaging window of the collector, and how long without a datagram before an instance counts as silent
+DEFAULT_WINDOW_SECONDS = 30
+DEFAULT_STALE_SECONDS = 15
+# EC2 detailed monitoring reports NetworkOut as bytes per minute
+NETWORK_OUT_PERIOD_SECONDS = 60
+
+MAGIC = b'SCR1'
+# magic, instance id length
+HEADER = struct.Struct('<4sB')
+# end timestamp, interval, cpu0 idle %, cpu1 idle %, disk io ms, mem used %, network out bytes
+SAMPLE = struct.Struct('<dffffff')
+SAMPLE_FIELDS = ['timestamp', 'interval', 'cpu0_idle', 'cpu1_idle', 'disk_io_ms', 'mem_used_percent',
+                 'network_out_bytes']
+RECORD_COLUMNS = ['instance_id'] + SAMPLE_FIELDS
+MAX_DATAGRAM_BYTES = 65507
+
+INSTANCE_ID_URL = 'http://169.254.169.254/latest/meta-data/instance-id'
+TOKEN_URL = 'http://169.254.169.254/latest/api/token'
+
+
+def encode_datagram(instance_id: str, samples):
+    """
+    One datagram for a batch of samples (tuples in SAMPLE_FIELDS order).
+    """
+    instance_id_bytes = instance_id.encode('utf-8')
+    parts = [HEADER.pack(MAGIC, len(instance_id_bytes)), instance_id_bytes]
+    parts.extend(SAMPLE.pack(*sample) for sample in samples)
+    return b''.join(parts)
+
+
+def decode_datagram(data: bytes):
+    """
+    (instance id, samples) of a datagram. Raises ValueError if it isn't one.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Datagram too short")
+    magic, id_length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a sidecar datagram")
+    samples_start = HEADER.size + id_length
+    if samples_start > len(data) or (len(data) - samples_start) % SAMPLE.size != 0:
+        raise ValueError("Truncated datagram")
+    instance_id = data[HEADER.size:samples_start].decode('utf-8')
+    samples = [SAMPLE.unpack_from(data, offset) for offset in range(samples_start, len(data), SAMPLE.size)]
+    return instance_id, samples
+
+
+class ProcReader:
+    """
+    A /proc file kept open and re-read from the start, which is cheaper than opening it every time.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def read(self):
+        if self.file is None:
+            try:
+                self.file = open(self.path, 'rb', buffering=0)
+            except FileNotFoundError:
+                return ''
+        self.file.seek(0)
+        chunks = []
+        while True:
+            chunk = self.file.read(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks).decode('ascii', errors='replace')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def parse_cpu_times(stat_text: str):
+    """
+    cpu name -> (idle jiffies, total jiffies) for every 'cpuN' line of /proc/stat.
+    """
+    cpu_times = {}
+    for line in stat_text.splitlines():
+        if not line.startswith('cpu') or line.startswith('cpu '):
+            continue
+        fields = line.split()
+        # user nice system idle iowait irq softirq steal; guest time is already counted in user and nice
+        jiffies = [int(field) for field in fields[1:9]]
+        cpu_times[fields[0]] = (jiffies[3], sum(jiffies))
+    return cpu_times
+
+
+def parse_disk_io_ms(diskstats_text: str, disk: str):
+    """
+    Milliseconds `disk` has spent doing I/O, from /proc/diskstats (None if there is no such device).
+    """
+    for line in diskstats_text.splitlines():
+        fields = line.split()
+        if len(fields) > 12 and fields[2] == disk:
+            return int(fields[12])
+    return None
+
+
+def parse_mem_used_percent(meminfo_text: str):
+    """
+    (MemTotal - MemAvailable) / MemTotal, in percent like the agent's mem_used_percent.
+    """
+    values = {}
+    for line in meminfo_text.splitlines():
+        name, _, rest = line.partition(':')
+        if name in ('MemTotal', 'MemAvailable'):
+            values[name] = int(rest.split()[0])
+    if not values.get('MemTotal') or 'MemAvailable' not in values:
+        return None
+    return (values['MemTotal'] - values['MemAvailable']) / values['MemTotal'] * 100
+
+
+def parse_network_out_bytes(net_dev_text: str):
+    """
+    Bytes sent on every interface but lo, from /proc/net/dev.
+    """
+    total = 0
+    for line in net_dev_text.splitlines()[2:]:
+        name, _, counters = line.partition(':')
+        if name.strip() == 'lo':
+            continue
+        fields = counters.split()
+        if len(fields) > 8:
+            total = total + int(fields[8])
+    return total
+
+
+class ProcSampler:
+    """
+    Samples the /proc counters; each sample covers the time since the previous one.
+    """
+
+    def __init__(self, disk: str = DEFAULT_DISK, proc_root: str = '/proc'):
+        self.disk = disk
+        self.stat = ProcReader(os.path.join(proc_root, 'stat'))
+        self.diskstats = ProcReader(os.path.join(proc_root, 'diskstats'))
+        self.meminfo = ProcReader(os.path.join(proc_root, 'meminfo'))
+        self.net_dev = ProcReader(os.path.join(proc_root, 'net', 'dev'))
+        self.previous = None
+
+    def read_counters(self):
+        return (time.time(), parse_cpu_times(self.stat.read()), parse_disk_io_ms(self.diskstats.read(), self.disk),
+                parse_network_out_bytes(self.net_dev.read()))
+
+    def sample(self):
+        """
+        A tuple in SAMPLE_FIELDS order, or None on the first call. Missing metrics are NaN.
+        """
+        counters = self.read_counters()
+        mem_used_percent = parse_mem_used_percent(self.meminfo.read())
+        previous = self.previous
+        self.previous = counters
+        if previous is None:
+            return None
+
+        now, cpu_times, disk_io_ms, network_out_bytes = counters
+        previous_now, previous_cpu_times, previous_disk_io_ms, previous_network_out_bytes = previous
+        cpu_idle = []
+        for cpu in ['cpu0', 'cpu1']:
+            if cpu in cpu_times and cpu in previous_cpu_times and \
+                    cpu_times[cpu][1] > previous_cpu_times[cpu][1]:
+                idle = cpu_times[cpu][0] - previous_cpu_times[cpu][0]
+                total = cpu_times[cpu][1] - previous_cpu_times[cpu][1]
+                cpu_idle.append(idle / total * 100)
+            else:
+                cpu_idle.append(math.nan)
+        disk_delta = disk_io_ms - previous_disk_io_ms \
+            if disk_io_ms is not None and previous_disk_io_ms is not None else math.nan
+        return (now, now - previous_now, cpu_idle[0], cpu_idle[1], disk_delta,
+                mem_used_percent if mem_used_percent is not None else math.nan,
+                network_out_bytes - previous_network_out_bytes)
+
+    def close(self):
+        for reader in (self.stat, self.diskstats, self.meminfo, self.net_dev):
+            reader.close()
+
+
+def get_instance_id():
+    """
+    The EC2 instance id from the instance metadata service (IMDSv2), or the host name off EC2.
+    """
+    try:
+        token_request = urllib.request.Request(TOKEN_URL, method='PUT',
+                                               headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+        token = urllib.request.urlopen(token_request, timeout=1).read().decode()
+        id_request = urllib.request.Request(INSTANCE_ID_URL, headers={'X-aws-ec2-metadata-token': token})
+        return urllib.request.urlopen(id_request, timeout=1).read().decode()
+    except OSError:
+        return socket.gethostname()
+
+
+def parse_address(address: str, default_port: int = DEFAULT_PORT):
+    host, _, port = address.rpartition(':')
+    if not host:
+        return address, default_port
+    return host, int(port)
+
+
+def run_sidecar(collector, instance_id: str, interval: float = DEFAULT_INTERVAL_SECONDS,
+                batch: int = DEFAULT_BATCH, disk: str = DEFAULT_DISK, stop_event: threading.Event = None):
+    """
+    Sample every `interval` seconds and send every `batch` samples to the (host, port) collector.
+    """
+    sampler = ProcSampler(disk)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stop_event = stop_event or threading.Event()
+    # one datagram has to fit the id and the whole batch
+    batch = max(1, min(batch, (MAX_DATAGRAM_BYTES - HEADER.size - 255) // SAMPLE.size))
+    samples = []
+    next_sample_time = time.monotonic()
+    try:
+        while not stop_event.is_set():
+            sample = sampler.sample()
+            if sample is not None:
+                samples.append(sample)
+            if len(samples) >= batch:
+                try:
+                    sock.sendto(encode_datagram(instance_id, samples), collector)
+                except OSError as error:
+                    # the collector may not be up yet; the samples are dropped, not queued
+                    logger.warning("Sending to %s failed: %r", collector, error)
+                samples = []
+            # at a fixed rate, without drifting by however long sampling takes
+            next_sample_time = next_sample_time + interval
+            stop_event.wait(max(0.0, next_sample_time - time.monotonic()))
+    finally:
+        sock.close()
+        sampler.close()
+
+
+class SidecarCollector:
+    """
+    Receives sidecar datagrams on a background thread and keeps each instance's samples of the last
+    retention_seconds. Thread-safe.
+
+    If record_path is given, every sample is also appended to that csv (RECORD_COLUMNS).
+    """
+
+    def __init__(self, port: int = DEFAULT_PORT, host: str = '0.0.0.0',
+                 window_seconds: float = DEFAULT_WINDOW_SECONDS, stale_seconds: float = DEFAULT_STALE_SECONDS,
+                 record_path: str = None):
+        self.address = (host, port)
+        self.window_seconds = window_seconds
+        self.stale_seconds = stale_seconds
+        self.retention_seconds = window_seconds * 2
+        self.record_path = record_path
+        # instance id -> deque of samples, oldest first
+        self.samples = {}
+        # instance id -> time.time() the last datagram was received
+        self.last_received = {}
+        self.datagrams = 0
+        self.bad_datagrams = 0
+        self.socket = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(self.address)
+        self.socket.settimeout(1)
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def get_port(self):
+        return self.socket.getsockname()[1]
+
+    def run(self):
+        record_file = open(self.record_path, 'a', newline='') if self.record_path else None
+        try:
+            writer = csv.writer(record_file) if record_file is not None else None
+            if record_file is not None and record_file.tell() == 0:
+                writer.writerow(RECORD_COLUMNS)
+            while not self._stop.is_set():
+                try:
+                    data, _ = self.socket.recvfrom(MAX_DATAGRAM_BYTES)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                decoded = self.add_datagram(data, time.time())
+                if writer is not None and decoded is not None:
+                    instance_id, samples = decoded
+                    writer.writerows([instance_id] + list(sample) for sample in samples)
+                    record_file.flush()
+        finally:
+            if record_file is not None:
+                record_file.close()
+
+    def add_datagram(self, data: bytes, received: float):
+        """
+        Store a datagram's samples. Returns (instance id, samples), or None if it isn't a sidecar datagram.
+        """
+        try:
+            instance_id, samples = decode_datagram(data)
+        except ValueError:
+            with self._lock:
+                self.bad_datagrams = self.bad_datagrams + 1
+            return None
+        with self._lock:
+            self.datagrams = self.datagrams + 1
+            instance_samples = self.samples.get(instance_id)
+            if instance_samples is None:
+                instance_samples = deque()
+                self.samples[instance_id] = instance_samples
+            instance_samples.extend(samples)
+            self.last_received[instance_id] = received
+            oldest = samples[-1][0] - self.retention_seconds if samples else None
+            while instance_samples and oldest is not None and instance_samples[0][0] < oldest:
+                instance_samples.popleft()
+        return instance_id, samples
+
+    def is_fresh(self, instance_id: str, now: float):
+        last_received = self.last_received.get(instance_id)
+        return last_received is not None and now - last_received <= self.stale_seconds
+
+    def get_window_samples(self, instance_id: str, now: float):
+        """
+        The samples of the last window_seconds, or None if the instance has gone silent.
+        """
+        with self._lock:
+            if not self.is_fresh(instance_id, now):
+                return None
+            samples = self.samples.get(instance_id, ())
+            newest = samples[-1][0] if samples else None
+            if newest is None:
+                return None
+            # the window ends at the instance's newest sample, so clock skew between hosts doesn't matter
+            return [sample for sample in samples if sample[0] > newest - self.window_seconds]
+
+    def get_instance_utils(self, instance_id: str, now: float):
+        """
+        (cpu_utils, disk_util) of the instance over the window, in the form of asg_util_alarms.get_instance_utils,
+        or None if there are no recent samples.
+        """
+        samples = self.get_window_samples(instance_id, now)
+        if not samples:
+            return None
+
+        # 'Idle Percent' -> 'Utilization'
+        cpu_utils = []
+        for column in (2, 3):
+            cpu_idle = [sample[column] for sample in samples if not math.isnan(sample[column])]
+            cpu_utils.append((100 - sum(cpu_idle) / len(cpu_idle)) / 100 if cpu_idle else None)
+
+        # 'Milliseconds' -> 'Utilization'
+        disk_utils = [sample[4] / 1000 / sample[1] for sample in samples if not math.isnan(sample[4]) and sample[1]]
+        disk_util = sum(disk_utils) / len(disk_utils) if disk_utils else None
+        return cpu_utils, disk_util
+
+    def covers(self, instance_ids, now: float):
+        return all(self.get_window_samples(instance_id, now) for instance_id in instance_ids)
+
+    def get_reporting_ids(self, now: float):
+        """
+        Instances that have been reporting for a whole window and still are.
+        """
+        with self._lock:
+            return {instance_id for instance_id, samples in self.samples.items()
+                    if samples and self.is_fresh(instance_id, now) and
+                    samples[-1][0] - samples[0][0] >= self.window_seconds}
+
+    def get_newest_timestamp(self, instance_ids):
+        """
+        The end of the newest sample of any of the instances.
+        """
+        with self._lock:
+            timestamps = [self.samples[instance_id][-1][0] for instance_id in instance_ids
+                          if self.samples.get(instance_id)]
+        return max(timestamps) if timestamps else None
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.socket is not None:
+            self.socket.close()
+
+
+def read_sidecar_logs(record_paths, instances, start_time: float, end_time: float, period_sec: int):
+    """
+    Per-instance log dicts, like metric_data.get_logs_by_instance_batched's, from recorded sidecar samples
+    averaged into period_sec buckets.
+
+    `instances` is a list of (instance_id, launch_time) tuples; instances with no samples are left out.
+    """
+    launch_times = dict(instances)
+    # instance id -> metric key -> bucket start -> [sum, count]
+    buckets = {}
+    for record_path in record_paths:
+        with open(record_path, newline='') as record_file:
+            for row in csv.DictReader(record_file):
+                instance_id = row['instance_id']
+                if instance_id not in launch_times:
+                    continue
+                interval = float(row['interval'])
+                # a sample covers the interval before its timestamp
+                sample_start = float(row['timestamp']) - interval
+                if sample_start < start_time or sample_start >= end_time:
+                    continue
+                bucket = math.floor(sample_start / period_sec) * period_sec
+                values = {
+                    'cpu0_utils': (100 - float(row['cpu0_idle'])) / 100,
+                    'cpu1_utils': (100 - float(row['cpu1_idle'])) / 100,
+                    'disk_utils': float(row['disk_io_ms']) / 1000 / interval if interval else math.nan,
+                    'mem_utils': float(row['mem_used_percent']),
+                    'network_out_values': float(row['network_out_bytes']) / interval * NETWORK_OUT_PERIOD_SECONDS
+                    if interval else math.nan,
+                }
+                instance_buckets = buckets.setdefault(instance_id, {})
+                for key, value in values.items():
+                    if math.isnan(value):
+                        continue
+                    total = instance_buckets.setdefault(key, {}).setdefault(bucket, [0.0, 0])
+                    total[0] = total[0] + value
+                    total[1] = total[1] + 1
+
+    logs_by_instance = []
+    for instance_id, launch_time in instances:
+        instance_buckets = buckets.get(instance_id, {})
+        if not instance_buckets.get('cpu0_utils'):
+            continue
+        log = {'instance_id': instance_id, 'launch_time': launch_time, 'timestamps': {}}
+        for key in ['cpu0_utils', 'cpu1_utils', 'disk_utils', 'mem_utils', 'network_out_values']:
+            key_buckets = sorted(instance_buckets.get(key, {}).items())
+            log[key] = [total / count for _, (total, count) in key_buckets]
+            log['timestamps'][key] = [float(bucket) for bucket, _ in key_buckets]
+        logs_by_instance.append(log)
+    return logs_by_instance
+
+
+def main():
+    parser = ArgumentParser(description="Send 1 s /proc samples to a collector, or collect them")
+    subparsers = parser.add_subparsers(dest='command')
+    send_parser = subparsers.add_parser('send', help="Run on an instance")
+    send_parser.add_argument('--collector', required=True, metavar='HOST[:PORT]',
+                             help="Where asg_util_alarms.py --sidecar-port or 'collect' listens")
+    send_parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL_SECONDS,
+                             help="Seconds between samples (default: %(default)s)")
+    send_parser.add_argument('--batch', type=int, default=DEFAULT_BATCH,
+                             help="Samples per datagram (default: %(default)s)")
+    send_parser.add_argument('--disk', default=DEFAULT_DISK, help="Block device to sample (default: %(default)s)")
+    send_parser.add_argument('--instance-id', help="Default: from the instance metadata service")
+    collect_parser = subparsers.add_parser('collect', help="Receive and record samples without asg_util_alarms.py")
+    collect_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    collect_parser.add_argument('--record', required=True, help="Append every sample to this csv")
+    args = parser.parse_args()
+
+    if args.command == 'send':
+        instance_id = args.instance_id or get_instance_id()
+        collector = parse_address(args.collector)
+        logger.info("Sending samples of %s every %s s to %s:%s", instance_id, str(args.interval), *collector)
+        try:
+            run_sidecar(collector, instance_id, args.interval, args.batch, args.disk)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'collect':
+        collector = SidecarCollector(args.port, record_path=args.record).start()
+        logger.info("Collecting samples on port %s into %s", str(args.port), args.record)
+        try:
+            while True:
+                time.sleep(60)
+                logger.info("%s datagram(s) from %s instance(s), %s bad", str(collector.datagrams),
+                            str(len(collector.samples)), str(collector.bad_datagrams))
+        except KeyboardInterrupt:
+            collector.stop()
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
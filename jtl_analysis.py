@@ -0,0 +1,374 @@
+#!/usr/bin/python3
+"""
+Streaming analysis of the testresults_<test_id>.jtl files written by JMeter.
+
+A jtl is read one row at a time and folded into a SamplerStats per
+(thread group, sampler label), so memory only depends on the number of
+labels, not on the number of rows. Latencies go into a LatencyHistogram with
+logarithmic buckets (every percentile is within HISTOGRAM_RELATIVE_ERROR of
+the exact value), and histograms from different labels, thread groups or
+files can be merged by adding bucket counts. Several jtl files are analyzed
+in parallel, one process per file.
+
+Closed-loop results (JMeter thread groups) under-report tail latency: while
+a user waits on a slow response it sends nothing, so the requests it would
+have sent are never measured. Given the interval at which a user normally
+sends requests, --expected-interval-ms back-fills those missed samples into
+the histograms the way HdrHistogram's recordValueWithExpectedInterval does.
+Results from loadgen.py --arrival-rate are measured from the scheduled send
+time and need no correction.
+"""
+import csv
+import math
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from jtl_binary import BINARY_JTL_EXTENSION, JtlBinaryReader
+
+HISTOGRAM_RELATIVE_ERROR = 0.01
+PERCENTILES = [50, 95, 99, 99.9]
+
+# Label used for the rows that roll up every thread group or every sampler label
+ALL_LABEL = 'ALL'
+
+# JMeter names threads '<thread group> <group number>-<thread number>'
+THREAD_NAME_PATTERN = re.compile(r'^(.*) \d+-\d+$')
+
+SUMMARY_FIELDNAMES = ['file', 'thread_group', 'label', 'samples', 'errors', 'error_rate', 'throughput_per_sec',
+                      'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'p99.9_ms', 'max_ms']
+
+
+class LatencyHistogram:
+    """
+    Mergeable histogram of non-negative values with logarithmically sized buckets.
+
+    Bucket i holds values in (gamma^(i-1), gamma^i], so the reported value for a bucket is within relative_error
+    of every value in it. The number of buckets only grows with log(max value).
+    """
+
+    def __init__(self, relative_error: float = HISTOGRAM_RELATIVE_ERROR):
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def add(self, value: float, count: int = 1):
+        if value <= 0:
+            self.zero_count = self.zero_count + count
+        else:
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count = self.count + count
+        self.sum = self.sum + value * count
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.relative_error != self.relative_error:
+            raise ValueError("Can't merge histograms with different relative errors ({} and {})".format(
+                self.relative_error, other.relative_error))
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count = self.zero_count + other.zero_count
+        self.count = self.count + other.count
+        self.sum = self.sum + other.sum
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
+
+    def to_dict(self):
+        """
+        Compact json-able form, for sending histograms between processes or hosts.
+        """
+        return {'relative_error': self.relative_error, 'buckets': [[index, count] for index, count in
+                                                                    self.buckets.items()],
+                'zero_count': self.zero_count, 'count': self.count, 'sum': self.sum, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['relative_error'])
+        histogram.buckets = {index: count for index, count in data['buckets']}
+        histogram.zero_count = data['zero_count']
+        histogram.count = data['count']
+        histogram.sum = data['sum']
+        histogram.max = data['max']
+        return histogram
+
+    def add_corrected(self, value: float, expected_interval: float):
+        """
+        Add a value, plus the values the requests that should have been sent every expected_interval during it
+        would have seen (coordinated omission correction).
+        """
+        self.add(value)
+        if expected_interval is None or expected_interval <= 0:
+            return
+        missed_value = value - expected_interval
+        while missed_value >= expected_interval:
+            self.add(missed_value)
+            missed_value = missed_value - expected_interval
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.sum / self.count
+
+    def percentile(self, percentile: float):
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(percentile / 100 * self.count)))
+        seen = self.zero_count
+        if seen >= rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen = seen + self.buckets[index]
+            if seen >= rank:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(value, self.max)
+        return self.max
+
+
+class SamplerStats:
+    """
+    Sample and error counts, time span and latency histogram of one sampler label (or a merge of several).
+    """
+
+    def __init__(self, relative_error: float = HISTOGRAM_RELATIVE_ERROR):
+        self.samples = 0
+        self.errors = 0
+        self.first_start_ms = None
+        self.last_end_ms = None
+        self.elapsed = LatencyHistogram(relative_error)
+
+    def add(self, timestamp_ms: int, elapsed_ms: int, success: bool, expected_interval_ms: float = None):
+        self.samples = self.samples + 1
+        if not success:
+            self.errors = self.errors + 1
+        end_ms = timestamp_ms + elapsed_ms
+        if self.first_start_ms is None or timestamp_ms < self.first_start_ms:
+            self.first_start_ms = timestamp_ms
+        if self.last_end_ms is None or end_ms > self.last_end_ms:
+            self.last_end_ms = end_ms
+        if expected_interval_ms is None:
+            self.elapsed.add(elapsed_ms)
+        else:
+            self.elapsed.add_corrected(elapsed_ms, expected_interval_ms)
+
+    def merge(self, other):
+        self.samples = self.samples + other.samples
+        self.errors = self.errors + other.errors
+        if other.first_start_ms is not None:
+            if self.first_start_ms is None or other.first_start_ms < self.first_start_ms:
+                self.first_start_ms = other.first_start_ms
+            if self.last_end_ms is None or other.last_end_ms > self.last_end_ms:
+                self.last_end_ms = other.last_end_ms
+        self.elapsed.merge(other.elapsed)
+        return self
+
+    def to_dict(self):
+        return {'samples': self.samples, 'errors': self.errors, 'first_start_ms': self.first_start_ms,
+                'last_end_ms': self.last_end_ms, 'elapsed': self.elapsed.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        sampler_stats = cls(data['elapsed']['relative_error'])
+        sampler_stats.samples = data['samples']
+        sampler_stats.errors = data['errors']
+        sampler_stats.first_start_ms = data['first_start_ms']
+        sampler_stats.last_end_ms = data['last_end_ms']
+        sampler_stats.elapsed = LatencyHistogram.from_dict(data['elapsed'])
+        return sampler_stats
+
+    def error_rate(self):
+        if self.samples == 0:
+            return None
+        return self.errors / self.samples
+
+    def throughput(self):
+        """
+        Samples per second over the span from the first sample's start to the last sample's end.
+        """
+        if self.samples == 0:
+            return None
+        duration_ms = self.last_end_ms - self.first_start_ms
+        if duration_ms <= 0:
+            return None
+        return self.samples / (duration_ms / 1000)
+
+
+def get_thread_group(thread_name: str):
+    match = THREAD_NAME_PATTERN.match(thread_name)
+    return match.group(1) if match else thread_name
+
+
+def analyze_jtl(path: str, relative_error: float = HISTOGRAM_RELATIVE_ERROR, expected_interval_ms: float = None):
+    """
+    Stream a csv jtl (or a jtl_binary.py .jtlb) file and return {(thread_group, label): SamplerStats}.
+
+    With expected_interval_ms, latency histograms are corrected for coordinated omission.
+    """
+    if path.endswith(BINARY_JTL_EXTENSION):
+        with JtlBinaryReader(path) as reader:
+            return analyze_rows(path, reader.header, reader.iter_rows(), relative_error, expected_interval_ms)
+    with open(path, newline='') as jtl_file:
+        reader = csv.reader(jtl_file)
+        header = next(reader, None)
+        if header is None:
+            return {}
+        return analyze_rows(path, header, reader, relative_error, expected_interval_ms)
+
+
+def analyze_rows(path: str, header, rows, relative_error: float = HISTOGRAM_RELATIVE_ERROR,
+                 expected_interval_ms: float = None):
+    stats = {}
+    try:
+        timestamp_col = header.index('timeStamp')
+        elapsed_col = header.index('elapsed')
+        label_col = header.index('label')
+        thread_col = header.index('threadName')
+        success_col = header.index('success')
+    except ValueError:
+        raise ValueError("{} is not a csv jtl with a header row (expected timeStamp, elapsed, label, "
+                         "threadName and success columns)".format(path))
+
+    # Thread names repeat a lot, so only parse each one once
+    thread_groups = {}
+    for row in rows:
+        if len(row) < len(header):
+            # e.g. a truncated last row from an interrupted test
+            continue
+        try:
+            timestamp_ms = int(row[timestamp_col])
+            elapsed_ms = int(row[elapsed_col])
+        except ValueError:
+            # e.g. a garbled row; loadgen_monitor.py flag keeps these as they are
+            continue
+        thread_name = row[thread_col]
+        thread_group = thread_groups.get(thread_name)
+        if thread_group is None:
+            thread_group = get_thread_group(thread_name)
+            thread_groups[thread_name] = thread_group
+
+        key = (thread_group, row[label_col])
+        sampler_stats = stats.get(key)
+        if sampler_stats is None:
+            sampler_stats = SamplerStats(relative_error)
+            stats[key] = sampler_stats
+        sampler_stats.add(timestamp_ms, elapsed_ms, row[success_col] == 'true', expected_interval_ms)
+    return stats
+
+
+def merge_stats(stats_list, relative_error: float = HISTOGRAM_RELATIVE_ERROR):
+    """
+    Merge several {(thread_group, label): SamplerStats} into one.
+    """
+    merged = {}
+    for stats in stats_list:
+        for key, sampler_stats in stats.items():
+            merged.setdefault(key, SamplerStats(relative_error)).merge(sampler_stats)
+    return merged
+
+
+def add_rollups(stats, relative_error: float = HISTOGRAM_RELATIVE_ERROR):
+    """
+    Add ALL_LABEL rows for every thread group, every label, and overall.
+    """
+    rollups = {}
+    for (thread_group, label), sampler_stats in stats.items():
+        for key in [(thread_group, ALL_LABEL), (ALL_LABEL, label), (ALL_LABEL, ALL_LABEL)]:
+            rollups.setdefault(key, SamplerStats(relative_error)).merge(sampler_stats)
+    with_rollups = dict(stats)
+    for key, sampler_stats in rollups.items():
+        with_rollups.setdefault(key, sampler_stats)
+    return with_rollups
+
+
+def analyze_jtl_files(paths, workers: int = None, relative_error: float = HISTOGRAM_RELATIVE_ERROR,
+                      expected_interval_ms: float = None):
+    """
+    Analyze jtl files in parallel, one process per file. Returns a list of stats dicts in the order of `paths`.
+    """
+    if len(paths) == 1 or workers == 1:
+        return [analyze_jtl(path, relative_error, expected_interval_ms) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(analyze_jtl, paths, [relative_error] * len(paths),
+                                 [expected_interval_ms] * len(paths)))
+
+
+def sort_key(key):
+    # ALL rows go after the groups / labels they roll up
+    thread_group, label = key
+    return (thread_group == ALL_LABEL, thread_group, label == ALL_LABEL, label)
+
+
+def iter_summary_rows(file_label: str, stats):
+    """
+    Yield summary rows (in SUMMARY_FIELDNAMES order), times in milliseconds.
+    """
+    for key in sorted(stats, key=sort_key):
+        sampler_stats = stats[key]
+        histogram = sampler_stats.elapsed
+        yield [file_label, key[0], key[1], sampler_stats.samples, sampler_stats.errors,
+               sampler_stats.error_rate(), sampler_stats.throughput(), histogram.mean()] + \
+              [histogram.percentile(percentile) for percentile in PERCENTILES] + [histogram.max]
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{:.4g}'.format(value)
+    return str(value)
+
+
+def print_summary(rows):
+    table = [SUMMARY_FIELDNAMES] + [[format_value(value) for value in row] for row in rows]
+    widths = [max(len(row[i]) for row in table) for i in range(len(SUMMARY_FIELDNAMES))]
+    for row in table:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    parser = ArgumentParser(description="Summarize JMeter jtl results: throughput, error rate and latency "
+                                        "percentiles per thread group and sampler label")
+    parser.add_argument('jtl_files', nargs='+', help="testresults_<test_id>.jtl files (csv format, or .jtlb)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Processes used to analyze files in parallel (default: number of cpus)")
+    parser.add_argument('--merge', action='store_true', help="Report all files together instead of one by one")
+    parser.add_argument('--relative-error', type=float, default=HISTOGRAM_RELATIVE_ERROR,
+                        help="Relative error of the reported percentiles")
+    parser.add_argument('--expected-interval-ms', type=float,
+                        help="Correct closed-loop latencies for coordinated omission, assuming each user normally "
+                             "sends a request this often")
+    parser.add_argument('--output', help="Also write the summary to this csv file")
+    args = parser.parse_args()
+
+    stats_list = analyze_jtl_files(args.jtl_files, args.workers, args.relative_error, args.expected_interval_ms)
+
+    if args.merge:
+        reports = [(ALL_LABEL, merge_stats(stats_list, args.relative_error))]
+    else:
+        reports = [(os.path.basename(path), stats) for path, stats in zip(args.jtl_files, stats_list)]
+
+    rows = []
+    for file_label, stats in reports:
+        rows.extend(iter_summary_rows(file_label, add_rollups(stats, args.relative_error)))
+
+    print_summary(rows)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(SUMMARY_FIELDNAMES)
+            writer.writerows(['' if value is None else value for value in row] for row in rows)
+        print("Wrote {}".format(args.output), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
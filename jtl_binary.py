@@ -0,0 +1,394 @@
+#!/usr/bin/python3
+"""
+Compact binary format for JMeter csv jtl files (.jtlb).
+
+Rows are stored in blocks of --block-rows. Within a block every column is a
+fixed-width array, compressed on its own with zlib:
+- a column whose values in the block are all plain integers (timeStamp,
+  elapsed, bytes, ...) is stored as int64
+- any other column (label, threadName, success, ...) is stored as uint32
+  codes into a dictionary of that column's distinct values
+
+After the blocks come the time index (file offset, row count and min / max
+timeStamp of every block), the segment lengths and kinds, and a json footer
+with the csv header and the dictionaries. The reader memory-maps the file,
+reads only the footer and index up front and only decompresses the blocks
+(and columns) a query needs.
+
+Converting a csv jtl and back gives the same rows and the same line endings;
+rows cut short (the last row of an interrupted test) are left out, as
+jtl_analysis.py and capacity_join.py skip them too.
+
+    ./jtl_binary.py encode results/<run>/testresults_*.jtl
+    ./jtl_binary.py decode results/<run>/testresults_0.jtlb --start-ms 1554000000000 --end-ms 1554000600000
+"""
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from argparse import ArgumentParser
+
+import numpy as np
+
+BINARY_JTL_EXTENSION = '.jtlb'
+MAGIC = b'JTLB'
+VERSION = 1
+DEFAULT_BLOCK_ROWS = 65536
+COMPRESSION_LEVEL = 6
+TIMESTAMP_COLUMN = 'timeStamp'
+
+# Segment kinds
+INT_SEGMENT = 0
+CODE_SEGMENT = 1
+
+HEADER = struct.Struct('<4sI')
+# index offset, footer json offset, footer json length
+TRAILER = struct.Struct('<QQQ4s')
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('rows', '<u4'), ('min_timestamp', '<i8'), ('max_timestamp', '<i8')])
+INT64_MIN = np.iinfo(np.int64).min
+INT64_MAX = np.iinfo(np.int64).max
+
+
+def to_field(value):
+    # what csv.writer writes for a value
+    return '' if value is None else str(value)
+
+
+def parse_ints(values):
+    """
+    int64 array of the values if every one is an integer written the way str(int) writes it, else None.
+    """
+    try:
+        ints = [int(value) for value in values]
+    except ValueError:
+        return None
+    # '007', '+7', ' 7' or '1_000' wouldn't come back the same
+    if any(str(i) != value for i, value in zip(ints, values)):
+        return None
+    try:
+        return np.array(ints, dtype='<i8')
+    except OverflowError:
+        return None
+
+
+def is_in_range(timestamp: str, start_ms: int = None, end_ms: int = None):
+    try:
+        timestamp = int(timestamp)
+    except ValueError:
+        return False
+    return (start_ms is None or timestamp >= start_ms) and (end_ms is None or timestamp < end_ms)
+
+
+class JtlBinaryWriter:
+    """
+    Writes rows like a csv.writer: the first row written is the header.
+    """
+
+    def __init__(self, path: str, block_rows: int = DEFAULT_BLOCK_ROWS, lineterminator: str = '\r\n'):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.block_rows = block_rows
+        self.lineterminator = lineterminator
+        self.header = None
+        self.rows = []
+        self.dictionaries = []
+        self.index = []
+        self.segment_lengths = []
+        self.segment_kinds = []
+        self.num_rows = 0
+        self.skipped_rows = 0
+
+    def writerow(self, row):
+        row = [to_field(value) for value in row]
+        if self.header is None:
+            self.header = row
+            self.dictionaries = [{} for _ in row]
+            return
+        if len(row) != len(self.header):
+            self.skipped_rows = self.skipped_rows + 1
+            return
+        self.rows.append(row)
+        if len(self.rows) >= self.block_rows:
+            self.write_block()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def encode_segment(self, column: int, values):
+        ints = parse_ints(values)
+        if ints is not None:
+            return INT_SEGMENT, ints
+        dictionary = self.dictionaries[column]
+        codes = np.fromiter((dictionary.setdefault(value, len(dictionary)) for value in values), dtype='<u4',
+                            count=len(values))
+        return CODE_SEGMENT, codes
+
+    def write_block(self):
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        offset = self.file.tell()
+        min_timestamp, max_timestamp = INT64_MIN, INT64_MAX
+        lengths = []
+        kinds = []
+        for c, values in enumerate(columns):
+            kind, array = self.encode_segment(c, values)
+            if self.header[c] == TIMESTAMP_COLUMN and kind == INT_SEGMENT:
+                min_timestamp, max_timestamp = int(array.min()), int(array.max())
+            data = zlib.compress(array.tobytes(), COMPRESSION_LEVEL)
+            self.file.write(data)
+            lengths.append(len(data))
+            kinds.append(kind)
+        self.index.append((offset, len(self.rows), min_timestamp, max_timestamp))
+        self.segment_lengths.append(lengths)
+        self.segment_kinds.append(kinds)
+        self.num_rows = self.num_rows + len(self.rows)
+        self.rows = []
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.write_block()
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+        self.file.write(np.array(self.segment_lengths, dtype='<u8').tobytes())
+        self.file.write(np.array(self.segment_kinds, dtype='u1').tobytes())
+        footer = {
+            'version': VERSION,
+            'header': self.header or [],
+            'num_rows': self.num_rows,
+            'num_blocks': len(self.index),
+            'lineterminator': self.lineterminator,
+            # values in code order
+            'dictionaries': [sorted(dictionary, key=dictionary.get) for dictionary in self.dictionaries]
+        }
+        footer_data = json.dumps(footer).encode('utf-8')
+        footer_offset = self.file.tell()
+        self.file.write(footer_data)
+        self.file.write(TRAILER.pack(index_offset, footer_offset, len(footer_data), MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class JtlBinaryReader:
+    """
+    Memory-mapped reader of a .jtlb file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = HEADER.unpack_from(self.buffer, 0)
+        index_offset, footer_offset, footer_length, end_magic = TRAILER.unpack_from(
+            self.buffer, len(self.buffer) - TRAILER.size)
+        if magic != MAGIC or end_magic != MAGIC:
+            raise ValueError("{} is not a binary jtl (or was not closed properly)".format(path))
+        if version != VERSION:
+            raise ValueError("{} has format version {}, expected {}".format(path, version, VERSION))
+
+        footer = json.loads(self.buffer[footer_offset:footer_offset + footer_length].decode('utf-8'))
+        self.header = footer['header']
+        self.num_rows = footer['num_rows']
+        self.lineterminator = footer['lineterminator']
+        self.dictionaries = [np.array(values, dtype=object) for values in footer['dictionaries']]
+        num_blocks = footer['num_blocks']
+        num_columns = len(self.header)
+
+        # copied, so the mmap can be closed without waiting for these to be garbage collected
+        self.index = np.frombuffer(self.buffer, INDEX_DTYPE, num_blocks, index_offset).copy()
+        offset = index_offset + self.index.nbytes
+        self.segment_lengths = np.frombuffer(self.buffer, '<u8', num_blocks * num_columns, offset).reshape(
+            num_blocks, num_columns).copy()
+        offset = offset + self.segment_lengths.nbytes
+        self.segment_kinds = np.frombuffer(self.buffer, 'u1', num_blocks * num_columns, offset).reshape(
+            num_blocks, num_columns).copy()
+
+    def get_blocks(self, start_ms: int = None, end_ms: int = None):
+        """
+        Indices of the blocks that can have rows with start_ms <= timeStamp < end_ms.
+        """
+        keep = np.ones(len(self.index), dtype=bool)
+        if start_ms is not None:
+            keep = keep & (self.index['max_timestamp'] >= start_ms)
+        if end_ms is not None:
+            keep = keep & (self.index['min_timestamp'] < end_ms)
+        return np.flatnonzero(keep)
+
+    def read_segment(self, block: int, column: int):
+        """
+        (kind, array) of one column of one block: int64 values or dictionary codes.
+        """
+        start = int(self.index['offset'][block] + self.segment_lengths[block, :column].sum())
+        data = zlib.decompress(self.buffer[start:start + int(self.segment_lengths[block, column])])
+        kind = int(self.segment_kinds[block, column])
+        return kind, np.frombuffer(data, '<i8' if kind == INT_SEGMENT else '<u4')
+
+    def decode(self, column: int, kind: int, array, as_strings: bool = False):
+        if kind == CODE_SEGMENT:
+            return self.dictionaries[column][array]
+        if as_strings:
+            return np.array([str(value) for value in array.tolist()], dtype=object)
+        return array
+
+    def iter_blocks(self, columns=None, start_ms: int = None, end_ms: int = None, as_strings: bool = False):
+        """
+        Yield {column: array} per block, with only the rows with start_ms <= timeStamp < end_ms.
+
+        Integer segments are int64 arrays (strings with as_strings), others object arrays of strings.
+        """
+        columns = columns or self.header
+        column_indices = [self.header.index(column) for column in columns]
+        timestamp_column = self.header.index(TIMESTAMP_COLUMN) if TIMESTAMP_COLUMN in self.header else None
+        for block in self.get_blocks(start_ms, end_ms):
+            rows = None
+            if timestamp_column is not None and (start_ms is not None or end_ms is not None):
+                kind, timestamps = self.read_segment(block, timestamp_column)
+                if kind == CODE_SEGMENT:
+                    # a garbled timeStamp in the block: its row has no time and is never in range
+                    rows = np.array([is_in_range(timestamp, start_ms, end_ms) for timestamp in
+                                     self.decode(timestamp_column, kind, timestamps).tolist()], dtype=bool)
+                else:
+                    rows = np.ones(len(timestamps), dtype=bool)
+                    if start_ms is not None:
+                        rows = rows & (timestamps >= start_ms)
+                    if end_ms is not None:
+                        rows = rows & (timestamps < end_ms)
+            values = {}
+            for column, c in zip(columns, column_indices):
+                kind, array = self.read_segment(block, c)
+                if rows is not None:
+                    array = array[rows]
+                values[column] = self.decode(c, kind, array, as_strings)
+            yield values
+
+    def read(self, columns=None, start_ms: int = None, end_ms: int = None):
+        """
+        {column: array} of the rows with start_ms <= timeStamp < end_ms, in file order.
+        """
+        columns = columns or self.header
+        blocks = list(self.iter_blocks(columns, start_ms, end_ms))
+        result = {}
+        for column in columns:
+            arrays = [values[column] for values in blocks]
+            if any(array.dtype == object for array in arrays):
+                # strings in some block: the whole column as strings
+                arrays = [array if array.dtype == object else np.array([str(value) for value in array.tolist()],
+                                                                       dtype=object) for array in arrays]
+            result[column] = np.concatenate(arrays) if arrays else np.array([], dtype=np.int64)
+        return result
+
+    def iter_rows(self, start_ms: int = None, end_ms: int = None):
+        """
+        Yield csv rows (lists of strings, in header order) as they were written.
+        """
+        for values in self.iter_blocks(None, start_ms, end_ms, as_strings=True):
+            for row in zip(*[values[column].tolist() for column in self.header]):
+                yield list(row)
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_lineterminator(path: str):
+    with open(path, 'rb') as jtl_file:
+        first_line = jtl_file.readline()
+    return '\r\n' if first_line.endswith(b'\r\n') else '\n'
+
+
+def encode_jtl(jtl_path: str, output_path: str, block_rows: int = DEFAULT_BLOCK_ROWS):
+    """
+    Convert a csv jtl. Returns the number of rows skipped for having the wrong number of fields.
+    """
+    with open(jtl_path, newline='') as jtl_file, \
+            JtlBinaryWriter(output_path, block_rows, get_lineterminator(jtl_path)) as writer:
+        writer.writerows(csv.reader(jtl_file))
+    return writer.skipped_rows
+
+
+def decode_jtl(binary_path: str, output_path: str, start_ms: int = None, end_ms: int = None):
+    """
+    Convert a .jtlb back to a csv jtl, optionally only the rows with start_ms <= timeStamp < end_ms.
+    """
+    with JtlBinaryReader(binary_path) as reader, open(output_path, 'w', newline='') as jtl_file:
+        writer = csv.writer(jtl_file, lineterminator=reader.lineterminator)
+        writer.writerow(reader.header)
+        writer.writerows(reader.iter_rows(start_ms, end_ms))
+
+
+def get_jtl_path(results_dir: str, test_id):
+    """
+    testresults_<test_id>.jtl, or its .jtlb if only that one exists. None if there is neither.
+    """
+    for extension in ['.jtl', BINARY_JTL_EXTENSION]:
+        path = os.path.join(results_dir, 'testresults_{}{}'.format(test_id, extension))
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def main():
+    parser = ArgumentParser(description="Convert JMeter csv jtl files to and from the binary .jtlb format")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    encode_parser = subparsers.add_parser('encode', help="csv jtl -> .jtlb (written next to it)")
+    encode_parser.add_argument('jtl_files', nargs='+')
+    encode_parser.add_argument('--block-rows', type=int, default=DEFAULT_BLOCK_ROWS,
+                               help="Rows per compressed block (default: %(default)s)")
+    encode_parser.add_argument('--skip-existing', action='store_true',
+                               help="Skip files whose .jtlb is newer than the jtl")
+
+    decode_parser = subparsers.add_parser('decode', help=".jtlb -> csv jtl")
+    decode_parser.add_argument('binary_file')
+    decode_parser.add_argument('-o', '--output', help="Output csv jtl (default: the .jtlb path with .jtl)")
+    decode_parser.add_argument('--start-ms', type=int, default=None, help="Only rows with timeStamp >= this")
+    decode_parser.add_argument('--end-ms', type=int, default=None, help="Only rows with timeStamp < this")
+
+    info_parser = subparsers.add_parser('info', help="Print the rows, blocks and time range of .jtlb files")
+    info_parser.add_argument('binary_files', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'encode':
+        for jtl_path in args.jtl_files:
+            output_path = os.path.splitext(jtl_path)[0] + BINARY_JTL_EXTENSION
+            if args.skip_existing and os.path.exists(output_path) and \
+                    os.path.getmtime(output_path) >= os.path.getmtime(jtl_path):
+                continue
+            skipped_rows = encode_jtl(jtl_path, output_path, args.block_rows)
+            print("Wrote {} ({:.1f}% of {})".format(output_path, os.path.getsize(output_path) /
+                                                    max(os.path.getsize(jtl_path), 1) * 100, jtl_path))
+            if skipped_rows:
+                print("  {} row(s) with the wrong number of fields left out".format(skipped_rows), file=sys.stderr)
+    elif args.command == 'decode':
+        output_path = args.output or os.path.splitext(args.binary_file)[0] + '.jtl'
+        decode_jtl(args.binary_file, output_path, args.start_ms, args.end_ms)
+        print("Wrote {}".format(output_path))
+    else:
+        for binary_path in args.binary_files:
+            with JtlBinaryReader(binary_path) as reader:
+                timestamps = reader.index[reader.index['min_timestamp'] != INT64_MIN]
+                time_range = '{} - {}'.format(timestamps['min_timestamp'].min(), timestamps['max_timestamp'].max()) \
+                    if len(timestamps) else '-'
+                print("{}: {} row(s) in {} block(s), timeStamp {}".format(binary_path, reader.num_rows,
+                                                                         len(reader.index), time_range))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+"""
+Latency SLO signal for asg_util_alarms.py, from the jtl JMeter is writing.
+
+JtlFollower only reads what was appended to the jtl since the last poll, so
+a poll costs the same however long the test has been running. Every sample
+is counted in the second its response arrived (timeStamp + elapsed) in a
+jtl_analysis.LatencyHistogram; the rolling p95 / p99 merges the per-second
+histograms of the last window_seconds.
+
+JMeter buffers its jtl writes unless it runs with
+-Jjmeter.save.saveservice.autoflush=true, which run-tests.sh sets when a
+latency SLO is configured.
+"""
+import csv
+import io
+import os
+import threading
+import time
+
+from jtl_analysis import HISTOGRAM_RELATIVE_ERROR, LatencyHistogram
+
+DEFAULT_WINDOW_SECONDS = 60
+DEFAULT_POLL_SECONDS = 1
+# Fewer samples than this in the window are too few to act on
+DEFAULT_MIN_SAMPLES = 20
+# Latency above this fraction of the SLO keeps the group from scaling down, as the utilization lower bounds do
+LOWER_FRACTION = 0.5
+
+
+def split_records(data: bytes):
+    """
+    Split csv data into (complete records, rest): records end at a newline that isn't inside a quoted field.
+    """
+    end = 0
+    in_quotes = False
+    start = 0
+    while True:
+        newline = data.find(b'\n', start)
+        if newline == -1:
+            break
+        if data.count(b'"', start, newline) % 2 == 1:
+            in_quotes = not in_quotes
+        if not in_quotes:
+            end = newline + 1
+        start = newline + 1
+    return data[:end], data[end:]
+
+
+class JtlFollower:
+    """
+    Follows a csv jtl as it grows. The file may not exist yet; if it is replaced or truncated, it is read again
+    from the start.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.offset = 0
+        self.pending = b''
+        self.header = None
+
+    def reopen_if_replaced(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if self.file is not None and stat.st_ino == self.inode and stat.st_size >= self.offset:
+            return
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'rb')
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.offset = 0
+        self.pending = b''
+        self.header = None
+
+    def read_rows(self):
+        """
+        Rows (lists of strings) completed since the last call, without the header.
+        """
+        self.reopen_if_replaced()
+        if self.file is None:
+            return []
+        data = self.file.read()
+        if not data:
+            return []
+        self.offset = self.offset + len(data)
+        records, self.pending = split_records(self.pending + data)
+        rows = list(csv.reader(io.StringIO(records.decode('utf-8', errors='replace'), newline='')))
+        if self.header is None and rows:
+            self.header = rows.pop(0)
+        return rows
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RollingLatency:
+    """
+    Per-second latency histograms and error counts over the last window_seconds.
+    """
+
+    def __init__(self, window_seconds: float = DEFAULT_WINDOW_SECONDS,
+                 relative_error: float = HISTOGRAM_RELATIVE_ERROR):
+        self.window_seconds = window_seconds
+        self.relative_error = relative_error
+        # epoch second -> [LatencyHistogram, errors]
+        self.seconds = {}
+
+    def add(self, end_ms: int, elapsed_ms: int, success: bool):
+        second = end_ms // 1000
+        entry = self.seconds.get(second)
+        if entry is None:
+            entry = [LatencyHistogram(self.relative_error), 0]
+            self.seconds[second] = entry
+        entry[0].add(elapsed_ms)
+        if not success:
+            entry[1] = entry[1] + 1
+
+    def expire(self, now: float):
+        oldest = now - self.window_seconds
+        for second in [second for second in self.seconds if second + 1 <= oldest]:
+            del self.seconds[second]
+
+    def get_window(self, now: float):
+        """
+        (merged LatencyHistogram, errors) of the samples that arrived in the window ending at `now`.
+        """
+        self.expire(now)
+        histogram = LatencyHistogram(self.relative_error)
+        errors = 0
+        for second_histogram, second_errors in self.seconds.values():
+            histogram.merge(second_histogram)
+            errors = errors + second_errors
+        return histogram, errors
+
+
+class LatencySloMonitor:
+    """
+    Rolling p95 / p99 of a live jtl against p95_ms / p99_ms targets (either may be None). Thread-safe.
+    """
+
+    def __init__(self, jtl_path: str, p95_ms: float = None, p99_ms: float = None,
+                 window_seconds: float = DEFAULT_WINDOW_SECONDS, min_samples: int = DEFAULT_MIN_SAMPLES):
+        if p95_ms is None and p99_ms is None:
+            raise ValueError("A latency SLO needs a p95 and/or a p99 target")
+        self.follower = JtlFollower(jtl_path)
+        self.latency = RollingLatency(window_seconds)
+        self.p95_ms = p95_ms
+        self.p99_ms = p99_ms
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def poll(self):
+        """
+        Read the samples appended to the jtl since the last poll.
+        """
+        with self._lock:
+            rows = self.follower.read_rows()
+            header = self.follower.header
+            if not rows or header is None:
+                return
+            timestamp_col = header.index('timeStamp')
+            elapsed_col = header.index('elapsed')
+            success_col = header.index('success')
+            for row in rows:
+                if len(row) < len(header):
+                    continue
+                try:
+                    elapsed_ms = int(row[elapsed_col])
+                    timestamp_ms = int(row[timestamp_col])
+                except ValueError:
+                    # one bad row mustn't cost the rest of the batch, or the tick
+                    continue
+                self.latency.add(timestamp_ms + elapsed_ms, elapsed_ms, row[success_col] == 'true')
+
+    def get_latency(self, now: float = None):
+        """
+        (p95 ms, p99 ms, samples, errors) over the window; the percentiles are None with too few samples.
+        """
+        with self._lock:
+            histogram, errors = self.latency.get_window(now if now is not None else time.time())
+        if histogram.count < self.min_samples:
+            return None, None, histogram.count, errors
+        return histogram.percentile(95), histogram.percentile(99), histogram.count, errors
+
+    def is_breached(self, p95_ms: float, p99_ms: float):
+        return (self.p95_ms is not None and p95_ms is not None and p95_ms >= self.p95_ms) or \
+               (self.p99_ms is not None and p99_ms is not None and p99_ms >= self.p99_ms)
+
+    def is_high(self, p95_ms: float, p99_ms: float):
+        """
+        Above LOWER_FRACTION of a target, i.e. too close to the SLO to scale down.
+        """
+        return (self.p95_ms is not None and p95_ms is not None and p95_ms > self.p95_ms * LOWER_FRACTION) or \
+               (self.p99_ms is not None and p99_ms is not None and p99_ms > self.p99_ms * LOWER_FRACTION)
+
+    def close(self):
+        with self._lock:
+            self.follower.close()
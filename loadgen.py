@@ -0,0 +1,693 @@
+#!/usr/bin/python3
+"""
+asyncio load generator reproducing jmeter_tests/Project_Test_Plan.jmx.
+
+Every JMeter thread is a coroutine, so thousands of users fit in one process.
+The plan's three thread groups are modelled by USER_CLASSES:
+- User A loops over 2 random image fetches, pausing 50 ms after each
+- User B logs in (POST /login) then fetches 6 images, pausing 50 ms after each
+- User C logs in then fetches 20 images, pausing 50 ms after each
+In B and C the 'Login Think Time' uniform random timer (1000 ms + up to 100 ms)
+sits at thread group level, so as in JMeter it delays every sampler of the
+group. Each group ramps its users up linearly over `duration` and every user
+stops at `duration`.
+
+Connections are HTTP/1.1 keep-alive connections from a shared pool, and
+response bodies are read in chunks and discarded. Samples are written as
+JMeter csv jtl rows (same columns as the plan's saveConfig), so the results
+can go through jtl_analysis.py and capacity_join.py unchanged.
+
+Takes the same -J properties as the plan, e.g.
+    ./loadgen.py -JusersA=96 -JusersB=240 -JusersC=48 -Jduration=1800 -JImageSize=5 \
+        -JLoadBalancerDNS=<dns> -l results/testresults_0.jtl
+`./loadgen.py --stub-server 8080` serves fake images and /login locally to
+check it against.
+
+With --arrival-rate the thread groups are replaced by an open-loop schedule:
+requests are started at a target rate (constant, stepped or ramped) whether
+or not earlier ones have completed, drawn from the same request mix as the
+closed-loop users. timeStamp, elapsed and Latency are then measured from each
+request's scheduled send time rather than from when it was actually sent, so
+when the server (or --max-in-flight) holds requests back the wait counts as
+latency instead of silently lowering the load (coordinated omission).
+"""
+import asyncio
+import csv
+import logging
+import random
+import sys
+import time
+import uuid
+from argparse import ArgumentParser
+from urllib.parse import urlsplit
+
+from jtl_binary import BINARY_JTL_EXTENSION, JtlBinaryWriter
+
+FORMAT = '%(asctime)-15s %(message)s'
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger('loadgen')
+
+# Defaults of the plan's __P() properties
+PLAN_DEFAULTS = {
+    'usersA': 64,
+    'usersB': 160,
+    'usersC': 32,
+    'duration': 600,
+    'LoadBalancerDNS': 'PicSiteAppLB-372930899.us-west-1.elb.amazonaws.com',
+    'ImageSize': 10,
+    'TestID': 1,
+    'ResultsDir': 'results'
+}
+
+IMAGE_PATH = '/static/images/random_image_{}mb_{}.bmp'
+IMAGE_NUMBER_MIN = 1
+IMAGE_NUMBER_MAX = 599
+IMAGE_THINK_TIME_SECONDS = 0.05
+LOGIN_THINK_TIME_SECONDS = 1.0
+LOGIN_THINK_TIME_RANGE_SECONDS = 0.1
+LOGIN_PASSWORD = 'my_password'
+IMAGE_TIMEOUT_SECONDS = 50
+
+REQUEST_HEADERS = {'Cache-Control': 'no-cache'}
+MAX_REDIRECTS = 5
+READ_CHUNK_BYTES = 64 * 1024
+
+USER_CLASSES = [
+    {'name': 'User A', 'users': 'usersA', 'login_email': None, 'images_per_loop': 2, 'login_think_time': False},
+    {'name': 'User B', 'users': 'usersB', 'login_email': 'my_email@69.com', 'images_per_loop': 6,
+     'login_think_time': True},
+    {'name': 'User C', 'users': 'usersC', 'login_email': 'my_email@70.com', 'images_per_loop': 20,
+     'login_think_time': True},
+]
+
+# Columns of a JMeter 5.1 csv jtl with the plan's saveConfig
+JTL_FIELDNAMES = ['timeStamp', 'elapsed', 'label', 'responseCode', 'responseMessage', 'threadName', 'dataType',
+                  'success', 'failureMessage', 'bytes', 'sentBytes', 'grpThreads', 'allThreads', 'URL', 'Latency',
+                  'IdleTime', 'Connect']
+
+
+class HttpError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Idle keep-alive connections to one host, reused by whichever user needs one next.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.opened = 0
+
+    async def acquire(self, timeout: float = None):
+        """
+        Returns (reader, writer, connect_seconds), connect_seconds being 0 for a reused connection.
+        """
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not reader.at_eof() and not writer.transport.is_closing():
+                return reader, writer, 0.0
+            writer.close()
+        start = time.monotonic()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout)
+        self.opened = self.opened + 1
+        return reader, writer, time.monotonic() - start
+
+    def release(self, reader, writer, reusable: bool):
+        if reusable:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+def encode_multipart(fields):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields:
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(boundary, name, value))
+    parts.append('--{}--\r\n'.format(boundary))
+    return ''.join(parts).encode(), 'multipart/form-data; boundary={}'.format(boundary)
+
+
+async def read_body(reader, headers, timeout):
+    """
+    Read and discard a response body. Returns (bytes read, whether the connection can be reused).
+    """
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        total = 0
+        while True:
+            size_line = await asyncio.wait_for(reader.readuntil(b'\r\n'), timeout)
+            total = total + len(size_line)
+            size = int(size_line.split(b';')[0].strip(), 16)
+            # chunk data plus its trailing CRLF (or the final CRLF after the last chunk)
+            remaining = size + 2 if size > 0 else 0
+            while remaining > 0:
+                data = await asyncio.wait_for(reader.read(min(remaining, READ_CHUNK_BYTES)), timeout)
+                if not data:
+                    raise HttpError("Connection closed mid-chunk")
+                remaining = remaining - len(data)
+                total = total + len(data)
+            if size == 0:
+                trailer = await asyncio.wait_for(reader.readuntil(b'\r\n'), timeout)
+                total = total + len(trailer)
+                return total, True
+
+    if 'content-length' in headers:
+        remaining = int(headers['content-length'])
+        total = remaining
+        while remaining > 0:
+            data = await asyncio.wait_for(reader.read(min(remaining, READ_CHUNK_BYTES)), timeout)
+            if not data:
+                raise HttpError("Connection closed with {} body byte(s) left".format(remaining))
+            remaining = remaining - len(data)
+        return total, headers.get('connection', '').lower() != 'close'
+
+    # no length: the body runs until the server closes the connection
+    total = 0
+    while True:
+        data = await asyncio.wait_for(reader.read(READ_CHUNK_BYTES), timeout)
+        if not data:
+            return total, False
+        total = total + len(data)
+
+
+async def send_request(pool: ConnectionPool, method: str, path: str, headers, body: bytes, timeout: float):
+    """
+    Send one request and read the response, returning a dict with the JTL sample fields.
+    """
+    reader, writer, connect_seconds = await pool.acquire(timeout)
+    reusable = False
+    try:
+        lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: {}'.format(pool.host)]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers.items())
+        if body is not None:
+            lines.append('Content-Length: {}'.format(len(body)))
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode() + (body or b'')
+        writer.write(request)
+        await writer.drain()
+
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        first_byte = time.monotonic()
+        status_line, *header_lines = head.decode('latin-1').split('\r\n')
+        _, code, *message = status_line.split(' ', 2)
+        response_headers = {}
+        for line in header_lines:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                response_headers[name.strip().lower()] = value.strip()
+
+        if method == 'HEAD' or code in ('204', '304'):
+            body_bytes, reusable = 0, True
+        else:
+            body_bytes, reusable = await read_body(reader, response_headers, timeout)
+        return {
+            'code': code,
+            'message': message[0] if message else '',
+            'headers': response_headers,
+            'bytes': len(head) + body_bytes,
+            'sent_bytes': len(request),
+            'first_byte': first_byte,
+            'connect': connect_seconds
+        }
+    finally:
+        pool.release(reader, writer, reusable)
+
+
+class LoadGenerator:
+
+    def __init__(self, host: str, port: int, params, jtl_writer=None, on_sample=None):
+        """
+        Samples are written to jtl_writer (a csv writer or JtlBinaryWriter) and/or passed to
+        on_sample(thread_group, label, timestamp_ms, elapsed_ms, success).
+        """
+        self.pool = ConnectionPool(host, port)
+        self.params = params
+        self.duration = float(params['duration'])
+        self.jtl_writer = jtl_writer
+        self.on_sample = on_sample
+        self.base_url = 'http://{}{}'.format(host, '' if port == 80 else ':{}'.format(port))
+        self.group_threads = {user_class['name']: 0 for user_class in USER_CLASSES}
+        self.all_threads = 0
+        self.start = None
+        self.end_time = None
+        self.tasks = set()
+        self.samples = 0
+        self.errors = 0
+
+    def remaining(self):
+        return self.end_time - time.monotonic()
+
+    async def sleep(self, seconds: float):
+        """
+        Sleep, but never past the end of the test. Returns False once the test is over.
+        """
+        await asyncio.sleep(max(0.0, min(seconds, self.remaining())))
+        return self.remaining() > 0
+
+    async def sample(self, label: str, thread_group: str, thread_name: str, method: str, path: str, body=None,
+                     content_type=None, timeout: float = None, scheduled=None):
+        """
+        Run one sampler (following redirects like the plan's follow_redirects) and record it in the jtl.
+
+        `scheduled` is an optional (epoch time, time.monotonic()) pair the sample is measured from instead of now.
+        """
+        headers = dict(REQUEST_HEADERS)
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+
+        timestamp, start = scheduled if scheduled is not None else (time.time(), time.monotonic())
+        url = self.base_url + path
+        latency = None
+        connect = 0.0
+        total_bytes = 0
+        sent_bytes = 0
+        failure = ''
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                response = await send_request(self.pool, method, path, headers, body, timeout)
+                if latency is None:
+                    latency = response['first_byte'] - start
+                    connect = response['connect']
+                total_bytes = total_bytes + response['bytes']
+                sent_bytes = sent_bytes + response['sent_bytes']
+                location = response['headers'].get('location')
+                if not (response['code'] in ('301', '302', '303', '307', '308') and location):
+                    break
+                # redirects are followed with GET, as browsers (and JMeter) do for 302/303
+                split = urlsplit(location)
+                path = (split.path or '/') + ('?' + split.query if split.query else '')
+                if response['code'] in ('301', '302', '303'):
+                    method, body = 'GET', None
+                    headers.pop('Content-Type', None)
+            code = response['code']
+            message = response['message']
+            success = code.startswith('2') or code.startswith('3')
+            if not success:
+                failure = 'Response code {}'.format(code)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            code = 'Non HTTP response code: {}'.format(type(error).__name__)
+            message = 'Non HTTP response message: {}'.format(error)
+            success = False
+
+        self.record(timestamp, time.monotonic() - start, label, code, message, thread_group, thread_name, success,
+                    failure, total_bytes, sent_bytes, url, latency, connect)
+
+    def record(self, timestamp: float, elapsed: float, label: str, code: str, message: str, thread_group: str,
+               thread_name: str, success: bool, failure: str = '', total_bytes: int = 0, sent_bytes: int = 0,
+               url: str = '', latency: float = None, connect: float = 0.0):
+        self.samples = self.samples + 1
+        if not success:
+            self.errors = self.errors + 1
+        if self.jtl_writer is not None:
+            self.jtl_writer.writerow([
+                int(timestamp * 1000), int(elapsed * 1000), label, code, message, thread_name, 'bin',
+                'true' if success else 'false', failure, total_bytes, sent_bytes, self.group_threads[thread_group],
+                self.all_threads, url, int((latency if latency is not None else elapsed) * 1000), 0,
+                int(connect * 1000)])
+        if self.on_sample is not None:
+            self.on_sample(thread_group, label, int(timestamp * 1000), int(elapsed * 1000), success)
+
+    async def login_think_time(self, user_class):
+        if not user_class['login_think_time']:
+            return True
+        return await self.sleep(LOGIN_THINK_TIME_SECONDS + random.random() * LOGIN_THINK_TIME_RANGE_SECONDS)
+
+    async def run_user(self, user_class, group_number: int, thread_number: int, start_delay: float):
+        thread_group = user_class['name']
+        thread_name = '{} {}-{}'.format(thread_group, group_number, thread_number)
+        if not await self.sleep(start_delay):
+            return
+
+        self.group_threads[thread_group] = self.group_threads[thread_group] + 1
+        self.all_threads = self.all_threads + 1
+        try:
+            while self.remaining() > 0:
+                if user_class['login_email'] is not None:
+                    if not await self.login_think_time(user_class):
+                        return
+                    body, content_type = encode_multipart([('email', user_class['login_email']),
+                                                           ('password', LOGIN_PASSWORD)])
+                    await self.sample('Login', thread_group, thread_name, 'POST', '/login', body, content_type)
+
+                for _ in range(user_class['images_per_loop']):
+                    if not await self.login_think_time(user_class):
+                        return
+                    path = IMAGE_PATH.format(self.params['ImageSize'],
+                                             random.randint(IMAGE_NUMBER_MIN, IMAGE_NUMBER_MAX))
+                    await self.sample('Get Image', thread_group, thread_name, 'GET', path,
+                                      timeout=IMAGE_TIMEOUT_SECONDS)
+                    if not await self.sleep(IMAGE_THINK_TIME_SECONDS):
+                        return
+        finally:
+            self.group_threads[thread_group] = self.group_threads[thread_group] - 1
+            self.all_threads = self.all_threads - 1
+
+    def add_task(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def start_shard(self, shard: int = 0, shards: int = 1):
+        """
+        Start every shards-th user of each group, beginning at `shard`, on the same ramp schedule as the whole
+        population. Users whose start time has already passed (a shard taken over mid-test) start now.
+        """
+        elapsed = time.monotonic() - self.start
+        for group_number, user_class in enumerate(USER_CLASSES, start=1):
+            num_users = int(self.params[user_class['users']])
+            for i in range(shard, num_users, shards):
+                # JMeter starts thread i of a group ramp_time / num_threads * i after the test starts
+                start_delay = self.duration / num_users * i - elapsed
+                self.add_task(self.run_user(user_class, group_number, i + 1, start_delay))
+
+    async def wait_until(self, start_at: float):
+        """
+        Sleep until the epoch time start_at (when several generators start together).
+        """
+        delay = start_at - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def run(self, start_at: float = None, shard: int = 0, shards: int = 1):
+        if start_at is not None:
+            await self.wait_until(start_at)
+        self.start = time.monotonic()
+        self.end_time = self.start + self.duration
+        self.start_shard(shard, shards)
+
+        try:
+            # users stop by themselves at the end; samples still in flight then are cut off, as in JMeter
+            while self.tasks:
+                done, pending = await asyncio.wait(set(self.tasks), timeout=max(0.0, self.remaining() + 1))
+                for task in done:
+                    if not task.cancelled() and task.exception() is not None:
+                        logger.error("User failed: %r", task.exception())
+                if self.remaining() + 1 <= 0:
+                    for task in pending:
+                        task.cancel()
+                    if pending:
+                        await asyncio.wait(pending)
+                    break
+        finally:
+            self.pool.close()
+
+
+class ArrivalSchedule:
+    """
+    Target arrival rate (requests per second) over the test, from a profile string:
+    - 'constant:RATE'
+    - 'step:RATE1,RATE2,...:STEP_SECONDS', each rate held for STEP_SECONDS and the last one until the end
+    - 'ramp:START_RATE:END_RATE', linear over the test duration
+    """
+
+    def __init__(self, profile: str, duration: float, poisson: bool = False):
+        self.duration = duration
+        self.poisson = poisson
+        kind, _, spec = profile.partition(':')
+        try:
+            if kind == 'constant':
+                rate = float(spec)
+                self.rate_at = lambda t: rate
+            elif kind == 'step':
+                rates_spec, step_seconds = spec.rsplit(':', 1)
+                rates = [float(rate) for rate in rates_spec.split(',')]
+                step_seconds = float(step_seconds)
+                self.rate_at = lambda t: rates[min(int(t // step_seconds), len(rates) - 1)]
+            elif kind == 'ramp':
+                start_rate, end_rate = [float(rate) for rate in spec.split(':')]
+                self.rate_at = lambda t: start_rate + (end_rate - start_rate) * min(t / duration, 1.0)
+            else:
+                raise ValueError()
+        except ValueError:
+            raise ValueError("Bad arrival rate profile '{}', expected constant:RATE, step:RATE1,RATE2,...:SECONDS "
+                             "or ramp:START:END".format(profile))
+
+    def next_offset(self, offset: float, share: float = 1.0):
+        """
+        Get the scheduled offset (seconds from the test start) of the arrival after the one at `offset`, for a
+        generator sending `share` of the total rate.
+        """
+        rate = self.rate_at(offset) * share
+        if rate <= 0:
+            # nothing scheduled now, check again shortly
+            return offset + 0.1
+        if self.poisson:
+            return offset + random.expovariate(rate)
+        return offset + 1 / rate
+
+
+class OpenLoopGenerator(LoadGenerator):
+    """
+    Starts requests on an ArrivalSchedule instead of running closed-loop users.
+
+    Each arrival is one request from the plan's mix: a user class is picked in proportion to usersA/B/C, then a
+    login with the probability that class logs in per request, otherwise an image fetch. Think times don't
+    apply, since the schedule decides when requests are sent.
+    """
+
+    def __init__(self, host: str, port: int, params, jtl_writer, schedule: ArrivalSchedule,
+                 max_in_flight: int = None, on_sample=None):
+        super().__init__(host, port, params, jtl_writer, on_sample)
+        self.schedule = schedule
+        self.max_in_flight = max_in_flight
+        self.late_starts = 0
+        self.max_start_delay = 0.0
+        # share of the schedule's rate this generator sends
+        self.rate_share = 0.0
+
+    def pick_request(self):
+        weights = [int(self.params[user_class['users']]) for user_class in USER_CLASSES]
+        if sum(weights) == 0:
+            weights = [1] * len(USER_CLASSES)
+        group_number = random.choices(range(len(USER_CLASSES)), weights=weights)[0] + 1
+        user_class = USER_CLASSES[group_number - 1]
+        login = user_class['login_email'] is not None and \
+            random.random() < 1 / (1 + user_class['images_per_loop'])
+        return group_number, user_class, login
+
+    async def run_arrival(self, scheduled, semaphore):
+        group_number, user_class, login = self.pick_request()
+        thread_group = user_class['name']
+        # a single name per group, so analysis sees the usual groups
+        thread_name = '{} {}-1'.format(thread_group, group_number)
+        label = 'Login' if login else 'Get Image'
+
+        self.group_threads[thread_group] = self.group_threads[thread_group] + 1
+        self.all_threads = self.all_threads + 1
+        try:
+            if semaphore is not None:
+                await semaphore.acquire()
+            try:
+                start_delay = time.monotonic() - scheduled[1]
+                self.max_start_delay = max(self.max_start_delay, start_delay)
+                if login:
+                    body, content_type = encode_multipart([('email', user_class['login_email']),
+                                                           ('password', LOGIN_PASSWORD)])
+                    await self.sample(label, thread_group, thread_name, 'POST', '/login', body, content_type,
+                                      scheduled=scheduled)
+                else:
+                    path = IMAGE_PATH.format(self.params['ImageSize'],
+                                             random.randint(IMAGE_NUMBER_MIN, IMAGE_NUMBER_MAX))
+                    await self.sample(label, thread_group, thread_name, 'GET', path, timeout=IMAGE_TIMEOUT_SECONDS,
+                                      scheduled=scheduled)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+        except asyncio.CancelledError:
+            # still outstanding at the end of the test: leaving it out would hide the worst latencies
+            self.record(scheduled[0], time.monotonic() - scheduled[1], label,
+                        'Non HTTP response code: Cancelled', 'Non HTTP response message: still running at the end '
+                        'of the test', thread_group, thread_name, False)
+            raise
+        finally:
+            self.group_threads[thread_group] = self.group_threads[thread_group] - 1
+            self.all_threads = self.all_threads - 1
+
+    def start_shard(self, shard: int = 0, shards: int = 1):
+        """
+        Take on 1 / shards of the arrival rate (more than once if this generator takes over other shards).
+        """
+        self.rate_share = self.rate_share + 1 / shards
+
+    async def run(self, start_at: float = None, shard: int = 0, shards: int = 1):
+        if start_at is not None:
+            await self.wait_until(start_at)
+        start_time = time.time()
+        self.start = time.monotonic()
+        self.end_time = self.start + self.duration
+        self.start_shard(shard, shards)
+        semaphore = asyncio.Semaphore(self.max_in_flight) if self.max_in_flight else None
+
+        # spread the shards' arrivals out rather than having every generator send at the same instants
+        offset = self.schedule.next_offset(0.0, self.rate_share) * shard / shards if shards > 1 else 0.0
+        try:
+            # (the tolerance stops float error adding an arrival right at the end)
+            while offset < self.duration - 1e-9:
+                delay = self.start + offset - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif delay < -0.001:
+                    # the event loop is behind: start it now, but still measure from when it was due
+                    self.late_starts = self.late_starts + 1
+                self.add_task(self.run_arrival((start_time + offset, self.start + offset), semaphore))
+                offset = self.schedule.next_offset(offset, self.rate_share)
+
+            # give outstanding requests as long as a response may take, then cut them off
+            if self.tasks:
+                _, pending = await asyncio.wait(set(self.tasks), timeout=IMAGE_TIMEOUT_SECONDS)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.wait(pending)
+        finally:
+            self.pool.close()
+
+
+def parse_properties(properties):
+    params = dict(PLAN_DEFAULTS)
+    for prop in properties or []:
+        if '=' not in prop:
+            raise ValueError("Expected -Jname=value, got -J{}".format(prop))
+        name, value = prop.split('=', 1)
+        params[name] = value
+    return params
+
+
+def open_jtl(jtl_path: str):
+    """
+    Create a jtl and write its header: a csv jtl, or jtl_binary.py's format for a .jtlb path.
+
+    Returns (file to close, writer).
+    """
+    if jtl_path.endswith(BINARY_JTL_EXTENSION):
+        jtl_file = JtlBinaryWriter(jtl_path)
+        jtl_writer = jtl_file
+    else:
+        jtl_file = open(jtl_path, 'w', newline='')
+        jtl_writer = csv.writer(jtl_file)
+    jtl_writer.writerow(JTL_FIELDNAMES)
+    return jtl_file, jtl_writer
+
+
+def run_load(params, jtl_path: str, schedule: ArrivalSchedule = None, max_in_flight: int = None):
+    dns = params['LoadBalancerDNS'].strip()
+    host, _, port = dns.partition(':')
+    port = int(port) if port else 80
+    jtl_file, jtl_writer = open_jtl(jtl_path)
+    with jtl_file:
+        if schedule is not None:
+            generator = OpenLoopGenerator(host, port, params, jtl_writer, schedule, max_in_flight)
+            logger.info("Running open loop arrivals against %s for %s s", dns, params['duration'])
+        else:
+            generator = LoadGenerator(host, port, params, jtl_writer)
+            logger.info("Running %s/%s/%s users (A/B/C) against %s for %s s", params['usersA'], params['usersB'],
+                        params['usersC'], dns, params['duration'])
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(generator.run())
+        logger.info("%s sample(s), %s error(s), %s connection(s) opened, results in %s", generator.samples,
+                    generator.errors, generator.pool.opened, jtl_path)
+        if schedule is not None:
+            logger.info("%s arrival(s) started late, longest wait before sending %.3f s", generator.late_starts,
+                        generator.max_start_delay)
+    return generator
+
+
+async def handle_stub_client(reader, writer, image_bytes: int):
+    """
+    Minimal keep-alive HTTP/1.1 server: images are image_bytes of zeros, POST /login redirects to /.
+    """
+    chunk = bytes(READ_CHUNK_BYTES)
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            request_line, *header_lines = head.decode('latin-1').split('\r\n')
+            method, path, _ = request_line.split(' ', 2)
+            headers = {line.split(':', 1)[0].strip().lower(): line.split(':', 1)[1].strip()
+                       for line in header_lines if ':' in line}
+            if 'content-length' in headers:
+                await reader.readexactly(int(headers['content-length']))
+
+            if method == 'POST' and path == '/login':
+                writer.write(b'HTTP/1.1 302 Found\r\nLocation: /\r\nContent-Length: 0\r\n\r\n')
+            elif path.startswith('/static/images/'):
+                writer.write('HTTP/1.1 200 OK\r\nContent-Type: image/bmp\r\nContent-Length: {}\r\n\r\n'
+                             .format(image_bytes).encode())
+                remaining = image_bytes
+                while remaining > 0:
+                    writer.write(chunk[:min(remaining, len(chunk))])
+                    remaining = remaining - min(remaining, len(chunk))
+                    await writer.drain()
+            elif path == '/':
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+            else:
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+def run_stub_server(port: int, image_bytes: int):
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(
+        lambda reader, writer: handle_stub_client(reader, writer, image_bytes), '127.0.0.1', port))
+    logger.info("Stub server listening on 127.0.0.1:%s (images of %s bytes)", port, image_bytes)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def main():
+    parser = ArgumentParser(description="asyncio load generator for Project_Test_Plan.jmx")
+    parser.add_argument('-J', dest='properties', action='append', metavar='NAME=VALUE',
+                        help="Plan property, as for jmeter (usersA, usersB, usersC, duration, LoadBalancerDNS, "
+                             "ImageSize)")
+    parser.add_argument('-l', dest='jtl_path', default='testresults.jtl',
+                        help="Results file (csv jtl, or binary for a .jtlb path)")
+    parser.add_argument('--arrival-rate', metavar='PROFILE',
+                        help="Open loop: start requests at this rate instead of running closed-loop users. "
+                             "constant:RATE, step:RATE1,RATE2,...:STEP_SECONDS or ramp:START:END (requests/s)")
+    parser.add_argument('--poisson', action='store_true',
+                        help="With --arrival-rate, use exponentially distributed gaps instead of even spacing")
+    parser.add_argument('--max-in-flight', type=int,
+                        help="With --arrival-rate, cap concurrent requests; held back requests still count their "
+                             "wait as latency")
+    parser.add_argument('--stub-server', type=int, metavar='PORT',
+                        help="Instead of generating load, serve fake images and /login on 127.0.0.1:PORT")
+    parser.add_argument('--stub-image-bytes', type=int, default=1024 * 1024,
+                        help="Size of the stub server's images")
+    args = parser.parse_args()
+
+    if args.stub_server is not None:
+        run_stub_server(args.stub_server, args.stub_image_bytes)
+        return
+
+    try:
+        params = parse_properties(args.properties)
+        schedule = None
+        if args.arrival_rate:
+            schedule = ArrivalSchedule(args.arrival_rate, float(params['duration']), args.poisson)
+    except ValueError as error:
+        parser.error(str(error))
+    generator = run_load(params, args.jtl_path, schedule, args.max_in_flight)
+    sys.exit(1 if generator.samples == 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
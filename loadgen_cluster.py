@@ -0,0 +1,389 @@
+#!/usr/bin/python3
+"""
+Distributed load generation: one controller, many loadgen.py workers.
+
+Workers (one per core or host) connect to the controller, which waits for the
+expected number of them and gives each a shard of the test: worker k of n runs
+users k, k + n, k + 2n, ... of every thread group on the same ramp schedule as
+the whole population (or 1/n of the --arrival-rate), so together they offer
+exactly the load one generator would. Every worker starts at the same epoch
+time chosen by the controller (hosts are expected to be NTP-synced).
+
+Instead of raw samples, workers send one compact message per interval with a
+jtl_analysis.SamplerStats (counts plus log-bucketed latency histogram) per
+thread group and label, which the controller merges. If a worker disconnects,
+what it already sent is kept, the interval it was in the middle of is lost
+rather than half-counted, and its shards are handed to the remaining workers
+so the offered load stays the same. Workers stop if they lose the controller.
+
+    ./loadgen_cluster.py controller --workers 4 -JusersA=96 ... -JLoadBalancerDNS=<dns> --output-prefix results/cluster_0
+    ./loadgen_cluster.py worker --controller <controller host>:7000
+
+`--local-workers N` makes the controller start N workers on this host itself.
+"""
+import asyncio
+import csv
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+from jtl_analysis import PERCENTILES, SUMMARY_FIELDNAMES, SamplerStats, add_rollups, iter_summary_rows, merge_stats
+from loadgen import (ArrivalSchedule, LoadGenerator, OpenLoopGenerator, open_jtl, parse_properties)
+
+FORMAT = '%(asctime)-15s %(message)s'
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger('loadgen_cluster')
+
+DEFAULT_PORT = 7000
+DEFAULT_INTERVAL_SECONDS = 5
+# Time between the last worker connecting and the synchronized start
+START_LEAD_SECONDS = 3
+# How long workers may take to report their last interval after the test ends
+FINISH_GRACE_SECONDS = 60
+
+INTERVAL_FIELDNAMES = ['interval_start', 'thread_group', 'label', 'samples', 'errors', 'throughput_per_sec'] + \
+                      ['p{}_ms'.format(percentile) for percentile in PERCENTILES] + ['workers']
+
+
+async def send_message(writer, message):
+    writer.write((json.dumps(message) + '\n').encode())
+    await writer.drain()
+
+
+async def read_message(reader):
+    """
+    Read one json line, or None when the connection is closed (a cut-off last line counts as closed).
+    """
+    try:
+        line = await reader.readline()
+    except ConnectionError:
+        return None
+    if not line.endswith(b'\n'):
+        return None
+    return json.loads(line.decode())
+
+
+def encode_stats(stats):
+    return [[thread_group, label, sampler_stats.to_dict()] for (thread_group, label), sampler_stats in stats.items()]
+
+
+def decode_stats(encoded):
+    return {(thread_group, label): SamplerStats.from_dict(data) for thread_group, label, data in encoded}
+
+
+class Controller:
+
+    def __init__(self, params, num_workers: int, interval_seconds: float, arrival_rate: str = None,
+                 poisson: bool = False, max_in_flight: int = None):
+        self.params = params
+        self.num_workers = num_workers
+        self.interval_seconds = interval_seconds
+        self.arrival_rate = arrival_rate
+        self.poisson = poisson
+        self.max_in_flight = max_in_flight
+
+        # worker name -> {'writer', 'shards', 'done'}
+        self.workers = {}
+        self.all_connected = asyncio.Event()
+        self.start_at = None
+        # interval index -> merged stats, and the workers that reported it
+        self.intervals = {}
+        self.interval_workers = {}
+        self.disconnected = []
+
+    def start_message(self, shard: int):
+        return {'type': 'start', 'shard': shard, 'shards': self.num_workers, 'start_at': self.start_at,
+                'params': self.params, 'interval': self.interval_seconds, 'arrival_rate': self.arrival_rate,
+                'poisson': self.poisson, 'max_in_flight': self.max_in_flight}
+
+    async def handle_worker(self, reader, writer):
+        hello = await read_message(reader)
+        if hello is None or hello.get('type') != 'hello':
+            writer.close()
+            return
+        name = hello['name']
+        if len(self.workers) >= self.num_workers:
+            logger.warning("Worker %s connected but all %s shard(s) are taken, ignoring it", name, self.num_workers)
+            writer.close()
+            return
+
+        shard = len(self.workers)
+        worker = {'writer': writer, 'shards': [shard], 'done': False}
+        self.workers[name] = worker
+        logger.info("Worker %s connected (%s/%s)", name, len(self.workers), self.num_workers)
+        if len(self.workers) == self.num_workers:
+            self.start_at = time.time() + START_LEAD_SECONDS
+            self.all_connected.set()
+
+        await self.all_connected.wait()
+        try:
+            await send_message(writer, self.start_message(shard))
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                if message['type'] == 'interval':
+                    self.merge_interval(name, message['index'], decode_stats(message['stats']))
+                elif message['type'] == 'done':
+                    worker['done'] = True
+                    logger.info("Worker %s finished: %s sample(s), %s error(s)", name, message['samples'],
+                                message['errors'])
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            if not worker['done']:
+                await self.handle_disconnect(name)
+
+    def merge_interval(self, name: str, index: int, stats):
+        merged = self.intervals.setdefault(index, {})
+        for key, sampler_stats in stats.items():
+            if key in merged:
+                merged[key].merge(sampler_stats)
+            else:
+                merged[key] = sampler_stats
+        self.interval_workers.setdefault(index, set()).add(name)
+
+    async def handle_disconnect(self, name: str):
+        worker = self.workers[name]
+        self.disconnected.append(name)
+        shards = worker['shards']
+        worker['shards'] = []
+        remaining = [(other_name, other) for other_name, other in self.workers.items()
+                     if other_name not in self.disconnected and not other['done']]
+        if time.time() >= self.start_at + float(self.params['duration']):
+            logger.warning("Worker %s disconnected after the end of the test", name)
+            return
+        if not remaining:
+            logger.error("Worker %s disconnected and no worker is left to take over shard(s) %s", name, shards)
+            return
+
+        # hand the shards to the least loaded workers, one at a time
+        for shard in shards:
+            other_name, other = min(remaining, key=lambda item: len(item[1]['shards']))
+            other['shards'].append(shard)
+            logger.warning("Worker %s disconnected, worker %s takes over shard %s", name, other_name, shard)
+            try:
+                await send_message(other['writer'], {'type': 'adopt', 'shard': shard, 'shards': self.num_workers})
+            except ConnectionError:
+                pass
+
+    def finished(self):
+        return all(worker['done'] or name in self.disconnected for name, worker in self.workers.items())
+
+    async def run(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle_worker, host, port)
+        logger.info("Controller listening on %s:%s, waiting for %s worker(s)", host, port, self.num_workers)
+        try:
+            await self.all_connected.wait()
+            logger.info("Starting in %s s", START_LEAD_SECONDS)
+            deadline = self.start_at + float(self.params['duration']) + FINISH_GRACE_SECONDS
+            while not self.finished() and time.time() < deadline:
+                await asyncio.sleep(0.5)
+        finally:
+            server.close()
+
+    def iter_interval_rows(self):
+        for index in sorted(self.intervals):
+            stats = add_rollups(self.intervals[index])
+            interval_start = int(self.start_at + index * self.interval_seconds)
+            workers = len(self.interval_workers[index])
+            for row in iter_summary_rows(interval_start, stats):
+                # summary row: file, group, label, samples, errors, error rate, throughput, mean, percentiles, max
+                samples = row[3]
+                yield [interval_start, row[1], row[2], samples, row[4], samples / self.interval_seconds] + \
+                      row[8:8 + len(PERCENTILES)] + [workers]
+
+    def write_results(self, output_prefix: str):
+        total = merge_stats(self.intervals.values())
+        with open(output_prefix + '_summary.csv', 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(SUMMARY_FIELDNAMES)
+            writer.writerows(['' if value is None else value for value in row]
+                             for row in iter_summary_rows(os.path.basename(output_prefix), add_rollups(total)))
+        with open(output_prefix + '_intervals.csv', 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(INTERVAL_FIELDNAMES)
+            writer.writerows(['' if value is None else value for value in row] for row in self.iter_interval_rows())
+        return total
+
+
+class IntervalStats:
+    """
+    Samples completed since the last flush, per (thread group, label).
+    """
+
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, thread_group: str, label: str, timestamp_ms: int, elapsed_ms: int, success: bool):
+        key = (thread_group, label)
+        sampler_stats = self.stats.get(key)
+        if sampler_stats is None:
+            sampler_stats = SamplerStats()
+            self.stats[key] = sampler_stats
+        sampler_stats.add(timestamp_ms, elapsed_ms, success)
+
+    def take(self):
+        stats = self.stats
+        self.stats = {}
+        return stats
+
+
+async def run_worker(controller_host: str, controller_port: int, name: str, jtl_path: str = None):
+    reader, writer = await asyncio.open_connection(controller_host, controller_port)
+    await send_message(writer, {'type': 'hello', 'name': name})
+    start = await read_message(reader)
+    if start is None:
+        logger.error("Controller closed the connection before the start")
+        return None
+
+    params = start['params']
+    host, _, port = params['LoadBalancerDNS'].strip().partition(':')
+    port = int(port) if port else 80
+    interval_stats = IntervalStats()
+
+    jtl_file, jtl_writer = open_jtl(jtl_path) if jtl_path else (None, None)
+
+    if start['arrival_rate']:
+        schedule = ArrivalSchedule(start['arrival_rate'], float(params['duration']), start['poisson'])
+        generator = OpenLoopGenerator(host, port, params, jtl_writer, schedule, start['max_in_flight'],
+                                      on_sample=interval_stats.add)
+    else:
+        generator = LoadGenerator(host, port, params, jtl_writer, on_sample=interval_stats.add)
+
+    start_at = start['start_at']
+    interval_seconds = start['interval']
+    logger.info("Worker %s running shard %s/%s from %s", name, start['shard'], start['shards'], start_at)
+    run_task = asyncio.ensure_future(generator.run(start_at, start['shard'], start['shards']))
+
+    async def flush(index: int):
+        # sent even when empty, so the controller knows which workers covered the interval
+        stats = interval_stats.take()
+        await send_message(writer, {'type': 'interval', 'index': index, 'stats': encode_stats(stats)})
+
+    async def flush_intervals():
+        index = 0
+        while True:
+            delay = start_at + (index + 1) * interval_seconds - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await flush(index)
+            index = index + 1
+
+    async def listen():
+        while True:
+            message = await read_message(reader)
+            if message is None:
+                logger.error("Lost the controller, stopping")
+                run_task.cancel()
+                return
+            if message['type'] == 'adopt':
+                while generator.start is None:
+                    await asyncio.sleep(0.1)
+                logger.info("Taking over shard %s", message['shard'])
+                generator.start_shard(message['shard'], message['shards'])
+
+    flush_task = asyncio.ensure_future(flush_intervals())
+    listen_task = asyncio.ensure_future(listen())
+    try:
+        await run_task
+        flush_task.cancel()
+        # the rest goes in the interval the test ended in
+        await flush(max(0, int((time.time() - start_at) // interval_seconds)))
+        await send_message(writer, {'type': 'done', 'samples': generator.samples, 'errors': generator.errors})
+    except asyncio.CancelledError:
+        pass
+    finally:
+        flush_task.cancel()
+        listen_task.cancel()
+        writer.close()
+        if jtl_file is not None:
+            jtl_file.close()
+    return generator
+
+
+def start_local_workers(count: int, port: int, jtl_prefix: str = None):
+    processes = []
+    for i in range(count):
+        command = [sys.executable, os.path.abspath(__file__), 'worker', '--controller', '127.0.0.1:{}'.format(port),
+                   '--name', '{}-{}'.format(socket.gethostname(), i)]
+        if jtl_prefix:
+            command.extend(['-l', '{}_worker{}.jtl'.format(jtl_prefix, i)])
+        processes.append(subprocess.Popen(command))
+    return processes
+
+
+def main():
+    parser = ArgumentParser(description="Distributed loadgen.py: a controller and its workers")
+    subparsers = parser.add_subparsers(dest='role')
+    subparsers.required = True
+
+    controller_parser = subparsers.add_parser('controller')
+    controller_parser.add_argument('-J', dest='properties', action='append', metavar='NAME=VALUE',
+                                   help="Plan property, as for loadgen.py")
+    controller_parser.add_argument('--workers', type=int, required=True, help="Number of workers to wait for")
+    controller_parser.add_argument('--local-workers', type=int, default=0,
+                                   help="Start this many of the workers on this host")
+    controller_parser.add_argument('--bind', default='0.0.0.0')
+    controller_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    controller_parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL_SECONDS,
+                                   help="Seconds covered by each histogram workers send")
+    controller_parser.add_argument('--arrival-rate', metavar='PROFILE', help="Open loop, as for loadgen.py")
+    controller_parser.add_argument('--poisson', action='store_true')
+    controller_parser.add_argument('--max-in-flight', type=int, help="Per worker")
+    controller_parser.add_argument('--output-prefix', default='loadgen_cluster',
+                                   help="Writes <prefix>_summary.csv and <prefix>_intervals.csv")
+    controller_parser.add_argument('--local-jtl', action='store_true',
+                                   help="Have local workers also write <prefix>_worker<i>.jtl")
+
+    worker_parser = subparsers.add_parser('worker')
+    worker_parser.add_argument('--controller', required=True, metavar='HOST:PORT')
+    worker_parser.add_argument('--name', default='{}-{}'.format(socket.gethostname(), os.getpid()))
+    worker_parser.add_argument('-l', dest='jtl_path', help="Also write this worker's samples to a jtl (csv, or binary for a .jtlb path)")
+
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+
+    if args.role == 'worker':
+        host, _, port = args.controller.rpartition(':')
+        generator = loop.run_until_complete(run_worker(host, int(port), args.name, args.jtl_path))
+        sys.exit(0 if generator is not None else 1)
+
+    try:
+        params = parse_properties(args.properties)
+        if args.arrival_rate:
+            ArrivalSchedule(args.arrival_rate, float(params['duration']))
+    except ValueError as error:
+        parser.error(str(error))
+
+    controller = Controller(params, args.workers, args.interval, args.arrival_rate, args.poisson,
+                            args.max_in_flight)
+    processes = []
+    try:
+        if args.local_workers:
+            processes = start_local_workers(args.local_workers, args.port,
+                                            args.output_prefix if args.local_jtl else None)
+        loop.run_until_complete(controller.run(args.bind, args.port))
+    finally:
+        for process in processes:
+            try:
+                process.wait(timeout=FINISH_GRACE_SECONDS)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    total = controller.write_results(args.output_prefix)
+    samples = sum(sampler_stats.samples for sampler_stats in total.values())
+    logger.info("%s sample(s) from %s worker(s)%s, results in %s_summary.csv and %s_intervals.csv", samples,
+                len(controller.workers), ' ({} disconnected)'.format(len(controller.disconnected))
+                if controller.disconnected else '', args.output_prefix, args.output_prefix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,564 @@
+#!/usr/bin/python3
+"""
+Tells when the load generator, not the PicSite group, was the bottleneck.
+
+`record` samples the generator host every --interval seconds while JMeter
+runs and writes one csv row per sample next to the jtl:
+- host cpu utilization (steal counts as busy) and the load generator
+  process's own cpu, in cores
+- NIC throughput, against --nic-mbps (or the link speed the kernel reports)
+- TCP sockets in use and in TIME_WAIT, against the ephemeral port range,
+  and TCP retransmits
+- the process's open file descriptors against its limit
+- how late the monitor's own timer fired, and the JVM's GC time (read with
+  jstat, if it is on the PATH)
+A sample is saturated when any of them is past its threshold; its `reasons`
+says which.
+
+`flag` then adds a loadgenSaturated column to the jtl (true for every sample
+that was in flight during a saturated interval) and writes a json report; a
+run with more than --max-flagged-fraction of its samples flagged is reported
+as suspect. get_logs.py --loadgen-monitor adds the same flag to the
+aws_metrics rows.
+
+    ./loadgen_monitor.py record results/loadgen_0.csv --match ApacheJMeter.jar --match testresults_0.jtl
+    ./loadgen_monitor.py flag results/loadgen_0.csv --jtl results/testresults_0.jtl
+"""
+import bisect
+import csv
+import json
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from argparse import ArgumentParser
+
+from instance_sidecar import ProcReader
+from jtl_binary import BINARY_JTL_EXTENSION, JtlBinaryReader, JtlBinaryWriter, get_lineterminator
+
+FORMAT = '%(asctime)-15s %(message)s'
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger('loadgen_monitor')
+
+DEFAULT_INTERVAL_SECONDS = 1.0
+CPU_THRESHOLD = 0.9
+NIC_THRESHOLD = 0.8
+PORTS_THRESHOLD = 0.9
+FD_THRESHOLD = 0.9
+LAG_THRESHOLD_MS = 100
+GC_THRESHOLD = 0.2
+DEFAULT_MAX_FLAGGED_FRACTION = 0.01
+
+MONITOR_COLUMNS = ['timestamp', 'interval', 'cpu_util', 'steal', 'runnable', 'process_cpu_cores',
+                   'process_threads', 'net_rx_bytes_per_sec', 'net_tx_bytes_per_sec', 'nic_util', 'tcp_inuse',
+                   'tcp_tw', 'tcp_retrans_per_sec', 'ports_util', 'open_fds', 'fd_limit', 'fd_util',
+                   'sched_lag_ms', 'gc_fraction', 'saturated', 'reasons']
+JTL_FLAG_COLUMN = 'loadgenSaturated'
+
+
+def read_file(path: str):
+    try:
+        with open(path) as proc_file:
+            return proc_file.read()
+    except OSError:
+        return None
+
+
+def parse_host_cpu(stat_text: str):
+    """
+    (busy jiffies, steal jiffies, total jiffies) of the 'cpu' line of /proc/stat.
+    """
+    for line in stat_text.splitlines():
+        if line.startswith('cpu '):
+            # user nice system idle iowait irq softirq steal
+            jiffies = [int(field) for field in line.split()[1:9]]
+            total = sum(jiffies)
+            return total - jiffies[3] - jiffies[4], jiffies[7], total
+    return 0, 0, 0
+
+
+def parse_net_bytes(net_dev_text: str):
+    """
+    (received, sent) bytes on every interface but lo, from /proc/net/dev.
+    """
+    received = 0
+    sent = 0
+    for line in net_dev_text.splitlines()[2:]:
+        name, _, counters = line.partition(':')
+        fields = counters.split()
+        if name.strip() == 'lo' or len(fields) < 9:
+            continue
+        received = received + int(fields[0])
+        sent = sent + int(fields[8])
+    return received, sent
+
+
+def parse_tcp_sockets(*sockstat_texts):
+    """
+    (in use, TIME_WAIT) TCP sockets from /proc/net/sockstat and sockstat6.
+    """
+    inuse = 0
+    time_wait = 0
+    for text in sockstat_texts:
+        for line in (text or '').splitlines():
+            name, _, rest = line.partition(':')
+            if name not in ('TCP', 'TCP6'):
+                continue
+            fields = rest.split()
+            values = dict(zip(fields[::2], fields[1::2]))
+            inuse = inuse + int(values.get('inuse', 0))
+            time_wait = time_wait + int(values.get('tw', 0))
+    return inuse, time_wait
+
+
+def parse_retransmits(snmp_text: str):
+    lines = [line.split() for line in snmp_text.splitlines() if line.startswith('Tcp:')]
+    if len(lines) < 2:
+        return 0
+    return int(dict(zip(lines[0], lines[1])).get('RetransSegs', 0))
+
+
+def get_port_range_size():
+    text = read_file('/proc/sys/net/ipv4/ip_local_port_range')
+    if not text:
+        return None
+    low, high = [int(value) for value in text.split()]
+    return high - low + 1
+
+
+def get_link_mbps():
+    """
+    Sum of the link speeds the kernel reports for the interfaces, or None (EC2's ENA usually reports none).
+    """
+    total = 0
+    for name in os.listdir('/sys/class/net'):
+        if name == 'lo':
+            continue
+        speed = read_file(os.path.join('/sys/class/net', name, 'speed'))
+        try:
+            if speed and int(speed) > 0:
+                total = total + int(speed)
+        except ValueError:
+            continue
+    return total or None
+
+
+def read_process_stat(pid: int):
+    """
+    (cpu seconds, threads) of a process, or None if it is gone.
+    """
+    text = read_file('/proc/{}/stat'.format(pid))
+    if not text:
+        return None
+    # the command name may contain spaces, the fields after it don't
+    fields = text[text.rindex(')') + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), int(fields[17])
+
+
+def find_process(match):
+    """
+    The pid of the process whose command line contains every string in `match` (not this one), or None. If
+    several do, e.g. a launcher script and the JVM it started, the one that has used the most cpu.
+    """
+    best_pid = None
+    best_cpu = -1.0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            with open(os.path.join('/proc', entry, 'cmdline'), 'rb') as cmdline_file:
+                cmdline = cmdline_file.read().replace(b'\0', b' ').decode('utf-8', errors='replace')
+        except OSError:
+            continue
+        if not cmdline or not all(part in cmdline for part in match):
+            continue
+        process_stat = read_process_stat(int(entry))
+        if process_stat is not None and process_stat[0] > best_cpu:
+            best_pid = int(entry)
+            best_cpu = process_stat[0]
+    return best_pid
+
+
+def get_fd_usage(pid: int = None):
+    """
+    (open file descriptors, limit) of a process, or of the whole host without a pid.
+    """
+    if pid is None:
+        text = read_file('/proc/sys/fs/file-nr')
+        if not text:
+            return None, None
+        allocated, _, maximum = [int(value) for value in text.split()]
+        return allocated, maximum
+    try:
+        open_fds = len(os.listdir('/proc/{}/fd'.format(pid)))
+    except OSError:
+        return None, None
+    limit = None
+    for line in (read_file('/proc/{}/limits'.format(pid)) or '').splitlines():
+        if line.startswith('Max open files'):
+            soft = line.split()[3]
+            limit = int(soft) if soft.isdigit() else None
+    return open_fds, limit
+
+
+class JstatReader:
+    """
+    Follows `jstat -gcutil <pid> <interval>` on a background thread and keeps the JVM's total GC seconds.
+    """
+
+    def __init__(self, pid: int, interval_ms: int):
+        self.gc_seconds = None
+        self.process = subprocess.Popen(['jstat', '-gcutil', str(pid), str(interval_ms)], stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, universal_newlines=True)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        gct_column = None
+        for line in self.process.stdout:
+            fields = line.split()
+            if 'GCT' in fields:
+                gct_column = fields.index('GCT')
+            elif gct_column is not None and len(fields) > gct_column:
+                try:
+                    self.gc_seconds = float(fields[gct_column])
+                except ValueError:
+                    continue
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def get_ratio(value, limit):
+    return value / limit if value is not None and limit else None
+
+
+class LoadgenSampler:
+    """
+    Samples the host, and the process matching `match` once it has started, every call to sample().
+    """
+
+    def __init__(self, match=(), nic_mbps: float = None, interval: float = DEFAULT_INTERVAL_SECONDS):
+        self.match = list(match)
+        self.interval = interval
+        self.stat = ProcReader('/proc/stat')
+        self.net_dev = ProcReader('/proc/net/dev')
+        self.snmp = ProcReader('/proc/net/snmp')
+        self.nic_bytes_per_sec = (nic_mbps or get_link_mbps() or 0) * 1e6 / 8 or None
+        self.port_range_size = get_port_range_size()
+        self.cpu_count = os.cpu_count() or 1
+        self.pid = None
+        self.jstat = None
+        self.previous = None
+
+    def find_process(self):
+        if self.pid is not None and os.path.exists('/proc/{}'.format(self.pid)):
+            return
+        if self.jstat is not None:
+            self.jstat.close()
+            self.jstat = None
+        self.pid = find_process(self.match) if self.match else None
+        if self.pid is not None:
+            logger.info("Monitoring process %s", str(self.pid))
+            try:
+                self.jstat = JstatReader(self.pid, int(self.interval * 1000))
+            except OSError:
+                # no JDK tools: no GC time
+                self.jstat = None
+
+    def read_counters(self):
+        process_stat = read_process_stat(self.pid) if self.pid is not None else None
+        return {
+            'time': time.time(),
+            'cpu': parse_host_cpu(self.stat.read()),
+            'net': parse_net_bytes(self.net_dev.read()),
+            'retransmits': parse_retransmits(self.snmp.read()),
+            'process_cpu': process_stat[0] if process_stat else None,
+            'process_threads': process_stat[1] if process_stat else None,
+            'gc_seconds': self.jstat.gc_seconds if self.jstat is not None else None,
+        }
+
+    def sample(self, sched_lag_ms: float):
+        """
+        A row in MONITOR_COLUMNS order, or None on the first call.
+        """
+        self.find_process()
+        counters = self.read_counters()
+        previous = self.previous
+        self.previous = counters
+        if previous is None:
+            return None
+
+        interval = counters['time'] - previous['time']
+        busy, steal, total = [now - before for now, before in zip(counters['cpu'], previous['cpu'])]
+        cpu_util = busy / total if total > 0 else None
+        steal_util = steal / total if total > 0 else None
+        loadavg = (read_file('/proc/loadavg') or '0 0 0 0/0').split()
+        runnable = int(loadavg[3].split('/')[0])
+
+        process_cpu_cores = None
+        if counters['process_cpu'] is not None and previous['process_cpu'] is not None and interval > 0:
+            process_cpu_cores = (counters['process_cpu'] - previous['process_cpu']) / interval
+        process_threads = counters['process_threads']
+
+        rx_rate, tx_rate = [(now - before) / interval
+                            for now, before in zip(counters['net'], previous['net'])] if interval > 0 else (0, 0)
+        nic_util = get_ratio(max(rx_rate, tx_rate), self.nic_bytes_per_sec)
+        tcp_inuse, tcp_tw = parse_tcp_sockets(read_file('/proc/net/sockstat'), read_file('/proc/net/sockstat6'))
+        ports_util = get_ratio(tcp_inuse + tcp_tw, self.port_range_size)
+        retrans_rate = (counters['retransmits'] - previous['retransmits']) / interval if interval > 0 else 0
+        open_fds, fd_limit = get_fd_usage(self.pid)
+        fd_util = get_ratio(open_fds, fd_limit)
+
+        gc_fraction = None
+        if counters['gc_seconds'] is not None and previous['gc_seconds'] is not None and interval > 0:
+            gc_fraction = max(0.0, counters['gc_seconds'] - previous['gc_seconds']) / interval
+
+        reasons = []
+        if cpu_util is not None and cpu_util >= CPU_THRESHOLD:
+            reasons.append('cpu')
+        # a process can't use more cores than it has threads, e.g. an event loop saturates a single core
+        if process_cpu_cores is not None and \
+                process_cpu_cores >= CPU_THRESHOLD * min(process_threads or 1, self.cpu_count):
+            reasons.append('process_cpu')
+        if nic_util is not None and nic_util >= NIC_THRESHOLD:
+            reasons.append('nic')
+        if ports_util is not None and ports_util >= PORTS_THRESHOLD:
+            reasons.append('ports')
+        if fd_util is not None and fd_util >= FD_THRESHOLD:
+            reasons.append('fds')
+        if sched_lag_ms >= LAG_THRESHOLD_MS:
+            reasons.append('lag')
+        if gc_fraction is not None and gc_fraction >= GC_THRESHOLD:
+            reasons.append('gc')
+
+        return [round(counters['time'], 3), round(interval, 3), cpu_util, steal_util, runnable, process_cpu_cores,
+                process_threads, rx_rate, tx_rate, nic_util, tcp_inuse, tcp_tw, retrans_rate, ports_util, open_fds,
+                fd_limit, fd_util, round(sched_lag_ms, 1), gc_fraction, 1 if reasons else 0, ';'.join(reasons)]
+
+    def close(self):
+        if self.jstat is not None:
+            self.jstat.close()
+        for reader in (self.stat, self.net_dev, self.snmp):
+            reader.close()
+
+
+def record(output_path: str, sampler: LoadgenSampler, stop_event: threading.Event):
+    """
+    Write a row every sampler.interval seconds until stop_event is set.
+    """
+    interval = sampler.interval
+    with open(output_path, 'w', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(MONITOR_COLUMNS)
+        next_sample_time = time.monotonic()
+        sched_lag_ms = 0.0
+        while not stop_event.is_set():
+            row = sampler.sample(sched_lag_ms)
+            if row is not None:
+                writer.writerow('' if value is None else value for value in row)
+                # flushed every row, so the file is complete whenever the monitor gets killed
+                output_file.flush()
+                if row[-2]:
+                    logger.warning("Load generator saturated: %s", row[-1])
+            next_sample_time = next_sample_time + interval
+            stop_event.wait(max(0.0, next_sample_time - time.monotonic()))
+            # how late this wake-up is: a busy host delays every thread, including JMeter's
+            sched_lag_ms = max(0.0, time.monotonic() - next_sample_time) * 1000
+
+
+def load_saturated_intervals(monitor_path: str):
+    """
+    (start, end, reasons) epoch seconds of every saturated sample.
+    """
+    intervals = []
+    with open(monitor_path, newline='') as monitor_file:
+        for row in csv.DictReader(monitor_file):
+            if row['saturated'] == '1':
+                end = float(row['timestamp'])
+                intervals.append((end - float(row['interval']), end, row['reasons']))
+    return intervals
+
+
+def merge_intervals(intervals):
+    """
+    The saturated intervals as sorted, non-overlapping (starts, ends) lists of epoch ms.
+    """
+    starts = []
+    ends = []
+    for start, end, _ in sorted(intervals):
+        start_ms = start * 1000
+        end_ms = end * 1000
+        if ends and start_ms <= ends[-1]:
+            ends[-1] = max(ends[-1], end_ms)
+        else:
+            starts.append(start_ms)
+            ends.append(end_ms)
+    return starts, ends
+
+
+def is_saturated(starts, ends, start_ms: float, end_ms: float):
+    """
+    Whether [start_ms, end_ms] overlaps one of the merge_intervals() intervals.
+    """
+    # the last interval starting before end_ms is the only one that can reach back past start_ms
+    i = bisect.bisect_left(starts, max(end_ms, start_ms + 1)) - 1
+    return i >= 0 and ends[i] > start_ms
+
+
+def get_bucket_flags(monitor_path: str, bucket_timestamps, period_sec: int):
+    """
+    1 for every bucket (epoch seconds at its start) that overlaps a saturated interval, else 0.
+    """
+    starts, ends = merge_intervals(load_saturated_intervals(monitor_path))
+    return [1 if is_saturated(starts, ends, bucket * 1000, (bucket + period_sec) * 1000) else 0
+            for bucket in bucket_timestamps]
+
+
+def flag_rows(header, rows, intervals):
+    """
+    The header and rows with JTL_FLAG_COLUMN set (added if missing); counts samples and flagged samples in `stats`.
+
+    A sample is flagged when [timeStamp, timeStamp + elapsed] overlaps a saturated interval. Rows without an
+    integer timeStamp and elapsed are passed through with an empty flag, and not counted.
+    """
+    header = list(header)
+    flag_column = header.index(JTL_FLAG_COLUMN) if JTL_FLAG_COLUMN in header else None
+    if flag_column is None:
+        header.append(JTL_FLAG_COLUMN)
+    timestamp_column = header.index('timeStamp')
+    elapsed_column = header.index('elapsed')
+    starts, ends = merge_intervals(intervals)
+    stats = {'samples': 0, 'flagged': 0}
+
+    def iter_flagged():
+        for row in rows:
+            row = list(row)
+            try:
+                start_ms = int(row[timestamp_column])
+                end_ms = start_ms + int(row[elapsed_column])
+            except (IndexError, ValueError):
+                # e.g. a row cut short by an interrupted test: kept as it is
+                value = ''
+            else:
+                flagged = is_saturated(starts, ends, start_ms, end_ms)
+                stats['samples'] = stats['samples'] + 1
+                if flagged:
+                    stats['flagged'] = stats['flagged'] + 1
+                value = 'true' if flagged else 'false'
+            if flag_column is None:
+                row.append(value)
+            elif flag_column < len(row):
+                row[flag_column] = value
+            yield row
+
+    return header, iter_flagged(), stats
+
+
+def flag_jtl(jtl_path: str, intervals):
+    """
+    Rewrite a csv or binary jtl with JTL_FLAG_COLUMN. Returns (samples, flagged samples).
+    """
+    temp_path = jtl_path + '.flagging'
+    if jtl_path.endswith(BINARY_JTL_EXTENSION):
+        with JtlBinaryReader(jtl_path) as reader, JtlBinaryWriter(temp_path,
+                                                                   lineterminator=reader.lineterminator) as writer:
+            header, rows, stats = flag_rows(reader.header, reader.iter_rows(), intervals)
+            writer.writerow(header)
+            writer.writerows(rows)
+    else:
+        with open(jtl_path, newline='') as jtl_file, open(temp_path, 'w', newline='') as output_file:
+            reader = csv.reader(jtl_file)
+            writer = csv.writer(output_file, lineterminator=get_lineterminator(jtl_path))
+            header, rows, stats = flag_rows(next(reader), reader, intervals)
+            writer.writerow(header)
+            writer.writerows(rows)
+    os.replace(temp_path, jtl_path)
+    return stats['samples'], stats['flagged']
+
+
+def build_report(monitor_path: str, jtl_samples: int = None, jtl_flagged: int = None,
+                 max_flagged_fraction: float = DEFAULT_MAX_FLAGGED_FRACTION):
+    intervals = load_saturated_intervals(monitor_path)
+    reason_seconds = {}
+    for start, end, reasons in intervals:
+        for reason in reasons.split(';'):
+            reason_seconds[reason] = reason_seconds.get(reason, 0) + end - start
+    report = {
+        'monitor': os.path.basename(monitor_path),
+        'saturated_seconds': round(sum(end - start for start, end, _ in intervals), 3),
+        'seconds_by_reason': {reason: round(seconds, 3) for reason, seconds in reason_seconds.items()},
+        'jtl_samples': jtl_samples,
+        'jtl_flagged_samples': jtl_flagged,
+    }
+    if jtl_samples:
+        report['flagged_fraction'] = jtl_flagged / jtl_samples
+        report['suspect'] = report['flagged_fraction'] > max_flagged_fraction
+    else:
+        report['suspect'] = bool(intervals)
+    return report
+
+
+def get_report_path(monitor_path: str):
+    return os.path.splitext(monitor_path)[0] + '_report.json'
+
+
+def main():
+    parser = ArgumentParser(description="Detect and flag load generator saturation")
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record', help="Sample the load generator host until interrupted")
+    record_parser.add_argument('output', help="Monitor csv to write")
+    record_parser.add_argument('--match', action='append', default=[],
+                               help="Also watch the process whose command line contains this (repeatable, all "
+                                    "have to match), e.g. ApacheJMeter.jar")
+    record_parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL_SECONDS,
+                               help="Seconds between samples (default: %(default)s)")
+    record_parser.add_argument('--nic-mbps', type=float,
+                               help="NIC bandwidth in Mbit/s (default: the link speed, if the kernel reports one)")
+    flag_parser = subparsers.add_parser('flag', help="Flag the jtl samples taken while the generator was saturated")
+    flag_parser.add_argument('monitor', help="Monitor csv written by 'record'")
+    flag_parser.add_argument('--jtl', help="csv or binary jtl to add the %s column to" % JTL_FLAG_COLUMN)
+    flag_parser.add_argument('--max-flagged-fraction', type=float, default=DEFAULT_MAX_FLAGGED_FRACTION,
+                             help="Report the run as suspect above this fraction of flagged samples "
+                                  "(default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        stop_event = threading.Event()
+
+        # SIGTERM (kill) stops the monitor as cleanly as ctrl + c
+        def stop(_sig, _frame):
+            stop_event.set()
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        sampler = LoadgenSampler(args.match, args.nic_mbps, args.interval)
+        try:
+            record(args.output, sampler, stop_event)
+        finally:
+            sampler.close()
+    elif args.command == 'flag':
+        jtl_samples = None
+        jtl_flagged = None
+        if args.jtl:
+            jtl_samples, jtl_flagged = flag_jtl(args.jtl, load_saturated_intervals(args.monitor))
+        report = build_report(args.monitor, jtl_samples, jtl_flagged, args.max_flagged_fraction)
+        with open(get_report_path(args.monitor), 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        if report['suspect']:
+            logger.warning("SUSPECT RESULTS: the load generator was saturated for %.0f s (%s), %s of %s jtl "
+                           "sample(s) flagged", report['saturated_seconds'],
+                           ', '.join('{} {:.0f} s'.format(reason, seconds)
+                                     for reason, seconds in sorted(report['seconds_by_reason'].items())),
+                           str(jtl_flagged), str(jtl_samples))
+        else:
+            logger.info("Load generator not saturated beyond %s of the samples", str(args.max_flagged_fraction))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
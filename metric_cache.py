@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+"""
+On-disk cache for CloudWatch metric responses.
+
+Each series is stored in its own json file keyed by namespace, metric name,
+dimensions, period and statistic, together with the time ranges that have
+already been fetched for it. When a request only partly overlaps what is
+cached, just the missing sub-ranges are fetched. Data younger than
+CACHE_SETTLE_SECONDS is never marked as fetched, since CloudWatch may still be
+ingesting it.
+
+CachingClient wraps a CloudWatch client so get_logs.py can use the cache
+without changing its call sites. asg_util_alarms.py doesn't use it: its
+window is younger than CACHE_SETTLE_SECONDS, so it would never be served
+from the cache.
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from metric_data import to_epoch_seconds
+
+DEFAULT_MAX_CACHE_BYTES = 256 * 1024 * 1024
+CACHE_SETTLE_SECONDS = 300
+
+
+def get_series_key(api: str, namespace: str, metric_name: str, dimensions, period_sec: int, stat, unit=None):
+    """
+    Build a key that doesn't depend on dimension order.
+    """
+    return {
+        'api': api,
+        'namespace': namespace,
+        'metric_name': metric_name,
+        'dimensions': sorted([[dimension['Name'], dimension['Value']] for dimension in dimensions]),
+        'period': period_sec,
+        'stat': stat,
+        'unit': unit
+    }
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def get_missing_ranges(covered, start: float, end: float, period_sec: int):
+    """
+    Get the parts of [start, end) not in the covered ranges, widened to period boundaries so CloudWatch returns
+    the same buckets it would for the whole range.
+    """
+    missing = []
+    cursor = start
+    for covered_start, covered_end in covered:
+        if covered_end <= cursor:
+            continue
+        if covered_start >= end:
+            break
+        if covered_start > cursor:
+            missing.append([cursor, covered_start])
+        cursor = max(cursor, covered_end)
+    if cursor < end:
+        missing.append([cursor, end])
+
+    return [[math.floor(range_start / period_sec) * period_sec, math.ceil(range_end / period_sec) * period_sec]
+            for range_start, range_end in missing]
+
+
+def to_datetime(epoch_seconds: float):
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc)
+
+
+class MetricCache:
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_CACHE_BYTES,
+                 settle_seconds: int = CACHE_SETTLE_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.settle_seconds = settle_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._list_files())
+
+    def _list_files(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((path, stat.st_mtime, stat.st_size))
+        return files
+
+    def _path(self, key):
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.json')
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as cache_file:
+                entry = json.load(cache_file)
+        except (FileNotFoundError, ValueError):
+            return {'key': key, 'covered': [], 'points': {}}
+        # mark as recently used for eviction
+        os.utime(path)
+        return entry
+
+    def save(self, entry):
+        path = self._path(entry['key'])
+        data = json.dumps(entry, sort_keys=True)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+            with open(tmp_path, 'w') as cache_file:
+                cache_file.write(data)
+            os.replace(tmp_path, path)
+            self.total_bytes = self.total_bytes + len(data) - old_size
+            if self.total_bytes > self.max_bytes:
+                self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        """
+        Delete least recently used entries until the cache is below 90% of max_bytes.
+        """
+        files = sorted(self._list_files(), key=lambda f: f[1])
+        self.total_bytes = sum(size for _, _, size in files)
+        for path, _, size in files:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            self.total_bytes = self.total_bytes - size
+
+    def count(self, hits: int = 0, misses: int = 0):
+        """
+        Add to the hit and miss counters, which CachingClient updates from every worker thread.
+        """
+        with self._lock:
+            self.hits = self.hits + hits
+            self.misses = self.misses + misses
+
+    def get_missing_ranges(self, entry, start: float, end: float, period_sec: int):
+        return get_missing_ranges(entry['covered'], start, end, period_sec)
+
+    def update(self, entry, fetched_ranges, points):
+        """
+        Add fetched points to an entry and mark the settled part of the fetched ranges as covered.
+        """
+        settled_until = time.time() - self.settle_seconds
+        for timestamp, value in points:
+            entry['points'][repr(float(timestamp))] = value
+
+        covered = [[range_start, min(range_end, settled_until)] for range_start, range_end in fetched_ranges
+                   if range_start < settled_until]
+        if covered:
+            entry['covered'] = merge_ranges(entry['covered'] + covered)
+        self.save(entry)
+
+    def get_points(self, entry, start: float, end: float):
+        """
+        Get (timestamp, value) pairs in [start, end), in ascending time order.
+        """
+        points = [(float(timestamp), value) for timestamp, value in entry['points'].items()]
+        return sorted([point for point in points if start <= point[0] < end], key=lambda point: point[0])
+
+    def get_instances(self, key, fetch):
+        """
+        Cache the result of an instance listing, which can't be redone once the instances are terminated.
+        """
+        entry = self.load(key)
+        if 'instances' in entry:
+            self.count(hits=1)
+            return [tuple(instance) for instance in entry['instances']]
+        self.count(misses=1)
+        instances = fetch()
+        if instances:
+            entry['instances'] = [list(instance) for instance in instances]
+            self.save(entry)
+        return instances
+
+
+class CachingClient:
+    """
+    Wrap a CloudWatch client so get_metric_statistics and get_metric_data are served from a MetricCache.
+
+    get_metric_data pages are merged internally, so responses never carry a NextToken. Calls that can't be
+    cached (e.g. metric math expressions) and every other method go straight to the wrapped client.
+    """
+
+    def __init__(self, client, cache: MetricCache):
+        self.client = client
+        self.cache = cache
+        self.api_calls = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def count_api_call(self):
+        with self._lock:
+            self.api_calls = self.api_calls + 1
+
+    def get_metric_statistics(self, **kwargs):
+        statistics = kwargs.get('Statistics') or kwargs.get('ExtendedStatistics')
+        key = get_series_key('get_metric_statistics', kwargs['Namespace'], kwargs['MetricName'],
+                             kwargs.get('Dimensions', []), kwargs['Period'], sorted(statistics), kwargs.get('Unit'))
+        start = to_epoch_seconds(kwargs['StartTime'])
+        end = to_epoch_seconds(kwargs['EndTime'])
+
+        entry = self.cache.load(key)
+        missing = self.cache.get_missing_ranges(entry, start, end, kwargs['Period'])
+        if missing:
+            self.cache.count(misses=1)
+            points = []
+            for range_start, range_end in missing:
+                response = self.client.get_metric_statistics(**dict(kwargs, StartTime=to_datetime(range_start),
+                                                                    EndTime=to_datetime(range_end)))
+                self.count_api_call()
+                for data_point in response['Datapoints']:
+                    data_point = dict(data_point)
+                    timestamp = to_epoch_seconds(data_point.pop('Timestamp'))
+                    points.append((timestamp, data_point))
+            self.cache.update(entry, missing, points)
+        else:
+            self.cache.count(hits=1)
+
+        datapoints = []
+        for timestamp, data_point in self.cache.get_points(entry, start, end):
+            datapoints.append(dict(data_point, Timestamp=to_datetime(timestamp)))
+        return {'Label': kwargs['MetricName'], 'Datapoints': datapoints}
+
+    def get_metric_data(self, **kwargs):
+        queries = kwargs['MetricDataQueries']
+        start = to_epoch_seconds(kwargs['StartTime'])
+        end = to_epoch_seconds(kwargs['EndTime'])
+
+        if any('MetricStat' not in query for query in queries):
+            self.count_api_call()
+            return self.client.get_metric_data(**kwargs)
+
+        # Group queries by the ranges they are missing, so queries with the same gaps share requests
+        entries = {}
+        missing_groups = {}
+        for query in queries:
+            metric_stat = query['MetricStat']
+            metric = metric_stat['Metric']
+            key = get_series_key('get_metric_data', metric['Namespace'], metric['MetricName'],
+                                 metric.get('Dimensions', []), metric_stat['Period'], metric_stat['Stat'],
+                                 metric_stat.get('Unit'))
+            entry = self.cache.load(key)
+            entries[query['Id']] = entry
+            missing = self.cache.get_missing_ranges(entry, start, end, metric_stat['Period'])
+            if missing:
+                missing_groups.setdefault(json.dumps(missing), []).append(query)
+
+        num_missing = sum(len(group) for group in missing_groups.values())
+        self.cache.count(hits=len(queries) - num_missing, misses=num_missing)
+
+        for missing_json, group in missing_groups.items():
+            missing = json.loads(missing_json)
+            points = {query['Id']: [] for query in group}
+            for range_start, range_end in missing:
+                next_token = None
+                while True:
+                    request = dict(kwargs, MetricDataQueries=group, StartTime=to_datetime(range_start),
+                                   EndTime=to_datetime(range_end))
+                    request.pop('NextToken', None)
+                    if next_token:
+                        request['NextToken'] = next_token
+                    response = self.client.get_metric_data(**request)
+                    self.count_api_call()
+                    for result in response.get('MetricDataResults', []):
+                        points[result['Id']].extend(
+                            (to_epoch_seconds(timestamp), value) for timestamp, value in
+                            zip(result.get('Timestamps', []), result.get('Values', [])))
+                    next_token = response.get('NextToken')
+                    if not next_token:
+                        break
+            for query in group:
+                self.cache.update(entries[query['Id']], missing, points[query['Id']])
+
+        # GetMetricData defaults to newest first
+        descending = kwargs.get('ScanBy', 'TimestampDescending') == 'TimestampDescending'
+        results = []
+        for query in queries:
+            series = self.cache.get_points(entries[query['Id']], start, end)
+            if descending:
+                series = series[::-1]
+            results.append({
+                'Id': query['Id'],
+                'Label': query.get('Label', query['MetricStat']['Metric']['MetricName']),
+                'Timestamps': [to_datetime(timestamp) for timestamp, _ in series],
+                'Values': [value for _, value in series],
+                'StatusCode': 'Complete'
+            })
+        return {'MetricDataResults': results}
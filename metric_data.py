@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+"""
+Batched CloudWatch GetMetricData helpers.
+
+Instead of issuing one get_metric_statistics call per instance and metric,
+every instance x metric pair is turned into a MetricDataQuery and packed into
+as few GetMetricData requests as possible.
+"""
+from datetime import datetime, timezone
+
+IMAGE_ID = 'ami-0bdd1b937142e6961'
+INSTANCE_TYPE = 'm4.large'
+
+# Hard limit imposed by CloudWatch on a single GetMetricData request
+MAX_QUERIES_PER_REQUEST = 500
+
+# Metrics collected for every instance by get_logs.py, keyed by the same names
+# used in the per-instance log dicts.
+INSTANCE_METRICS = [
+    {
+        'key': 'cpu0_utils',
+        'namespace': 'CWAgent',
+        'metric_name': 'cpu_usage_idle',
+        'unit': 'Percent',
+        'extra_dimensions': [{'Name': 'cpu', 'Value': 'cpu0'}],
+    },
+    {
+        'key': 'cpu1_utils',
+        'namespace': 'CWAgent',
+        'metric_name': 'cpu_usage_idle',
+        'unit': 'Percent',
+        'extra_dimensions': [{'Name': 'cpu', 'Value': 'cpu1'}],
+    },
+    {
+        'key': 'disk_utils',
+        'namespace': 'CWAgent',
+        'metric_name': 'diskio_io_time',
+        'unit': 'Milliseconds',
+        'extra_dimensions': [{'Name': 'name', 'Value': 'xvda1'}],
+    },
+    {
+        'key': 'mem_utils',
+        'namespace': 'CWAgent',
+        'metric_name': 'mem_used_percent',
+        'unit': 'Percent',
+        'extra_dimensions': [],
+    },
+    {
+        # unlike the agent metrics, this only works with very few dimensions
+        'key': 'network_out_values',
+        'namespace': 'AWS/EC2',
+        'metric_name': 'NetworkOut',
+        'unit': None,
+        'extra_dimensions': None,
+    },
+]
+
+
+def get_agent_dimensions(asg_name: str, instance_id: str, extra_dimensions=None):
+    """
+    Build the dimension list the CloudWatch agent attaches to every metric of an instance.
+    """
+    dimensions = [
+        {
+            'Name': 'AutoScalingGroupName',
+            'Value': asg_name
+        },
+        {
+            'Name': 'ImageId',
+            'Value': IMAGE_ID
+        },
+        {
+            'Name': 'InstanceId',
+            'Value': instance_id
+        },
+        {
+            'Name': 'InstanceType',
+            'Value': INSTANCE_TYPE
+        }
+    ]
+    if extra_dimensions:
+        dimensions = dimensions + extra_dimensions
+    return dimensions
+
+
+def get_metric_dimensions(metric, asg_name: str, instance_id: str):
+    if metric['extra_dimensions'] is None:
+        return [{'Name': 'InstanceId', 'Value': instance_id}]
+    return get_agent_dimensions(asg_name, instance_id, metric['extra_dimensions'])
+
+
+def convert_metric_values(key: str, values, period_sec: int):
+    """
+    Convert raw CloudWatch averages to the units written by get_logs.py.
+    """
+    if key in ('cpu0_utils', 'cpu1_utils'):
+        # 'Idle Percent * 100' -> 'Util Percent'
+        return [(100 - value) / 100 for value in values]
+    if key == 'disk_utils':
+        # 'Milliseconds' -> 'Util Percent'
+        return [value / 1000 / period_sec for value in values]
+    return list(values)
+
+
+def to_epoch_seconds(timestamp):
+    """
+    Convert a datetime or epoch number to epoch seconds. Naive datetimes are taken as UTC, like boto3 does.
+    """
+    if isinstance(timestamp, datetime):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return timestamp.timestamp()
+    return float(timestamp)
+
+
+def sort_datapoints(datapoints):
+    """
+    get_metric_statistics returns Datapoints in no particular order.
+    """
+    return sorted(datapoints, key=lambda data_point: to_epoch_seconds(data_point['Timestamp']))
+
+
+def get_datapoint_timestamps(datapoints):
+    return [to_epoch_seconds(data_point['Timestamp']) for data_point in datapoints]
+
+
+def build_metric_data_query(query_id: str, namespace: str, metric_name: str, dimensions, period_sec: int,
+                            unit=None, stat='Average'):
+    metric_stat = {
+        'Metric': {
+            'Namespace': namespace,
+            'MetricName': metric_name,
+            'Dimensions': dimensions
+        },
+        'Period': period_sec,
+        'Stat': stat
+    }
+    if unit:
+        metric_stat['Unit'] = unit
+
+    return {
+        'Id': query_id,
+        'MetricStat': metric_stat,
+        'ReturnData': True
+    }
+
+
+def build_instance_queries(asg_name: str, instance_ids, period_sec: int, metrics=None, id_prefix: str = 'm'):
+    """
+    Build one query per instance x metric. id_prefix (starting with a lowercase letter) keeps the ids unique when
+    the queries of several groups share a request.
+
+    Returns the list of queries and a dict mapping each query id back to its (instance_id, metric key).
+    """
+    if metrics is None:
+        metrics = INSTANCE_METRICS
+
+    queries = []
+    query_map = {}
+    for instance_index, instance_id in enumerate(instance_ids):
+        for metric_index, metric in enumerate(metrics):
+            # Ids must start with a lowercase letter and be unique within a request
+            query_id = '{}{}_{}'.format(id_prefix, instance_index, metric_index)
+            queries.append(build_metric_data_query(
+                query_id,
+                metric['namespace'],
+                metric['metric_name'],
+                get_metric_dimensions(metric, asg_name, instance_id),
+                period_sec,
+                unit=metric['unit']
+            ))
+            query_map[query_id] = (instance_id, metric['key'])
+    return queries, query_map
+
+
+def chunk_queries(queries, chunk_size=MAX_QUERIES_PER_REQUEST):
+    for i in range(0, len(queries), chunk_size):
+        yield queries[i:i + chunk_size]
+
+
+def get_metric_data_batched(cw_client, queries, start_time, end_time):
+    """
+    Run all queries through as few GetMetricData requests as possible, following NextToken pagination.
+
+    Returns a dict mapping query id -> {'Timestamps': [...], 'Values': [...]} in ascending time order,
+    and the number of API calls made.
+    """
+    results = {query['Id']: {'Timestamps': [], 'Values': []} for query in queries}
+    num_api_calls = 0
+
+    for chunk in chunk_queries(queries):
+        next_token = None
+        while True:
+            kwargs = {
+                'MetricDataQueries': chunk,
+                'StartTime': start_time,
+                'EndTime': end_time,
+                'ScanBy': 'TimestampAscending'
+            }
+            if next_token:
+                kwargs['NextToken'] = next_token
+
+            response = cw_client.get_metric_data(**kwargs)
+            num_api_calls = num_api_calls + 1
+
+            for result in response.get('MetricDataResults', []):
+                series = results.setdefault(result['Id'], {'Timestamps': [], 'Values': []})
+                series['Timestamps'].extend(result.get('Timestamps', []))
+                series['Values'].extend(result.get('Values', []))
+
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+
+    return results, num_api_calls
+
+
+def get_logs_by_instance_batched(cw_client, instances, asg_name: str, start_time, end_time, period_sec: int):
+    """
+    Fetch all instance metrics with batched GetMetricData calls.
+
+    `instances` is a list of (instance_id, launch_time) tuples. Returns the per-instance log dicts used by
+    timepoint_matrix.build_timepoint_matrix and a dict describing how many API calls were used.
+    """
+    instance_ids = [instance_id for instance_id, _ in instances]
+    queries, query_map = build_instance_queries(asg_name, instance_ids, period_sec)
+    results, num_api_calls = get_metric_data_batched(cw_client, queries, start_time, end_time)
+
+    logs_by_id = {}
+    for instance_id, launch_time in instances:
+        logs_by_id[instance_id] = {'instance_id': instance_id, 'launch_time': launch_time, 'timestamps': {}}
+
+    for query_id, (instance_id, key) in query_map.items():
+        logs_by_id[instance_id][key] = convert_metric_values(key, results[query_id]['Values'], period_sec)
+        logs_by_id[instance_id]['timestamps'][key] = [to_epoch_seconds(timestamp) for
+                                                      timestamp in results[query_id]['Timestamps']]
+
+    # exclude instances with no activity during the timespan of interest
+    logs_by_instance = [logs_by_id[instance_id] for instance_id in instance_ids
+                        if len(logs_by_id[instance_id]['cpu0_utils']) > 0]
+
+    per_instance_api_calls = len(instance_ids) * len(INSTANCE_METRICS)
+    api_stats = {
+        'api_calls': num_api_calls,
+        'per_instance_api_calls': per_instance_api_calls,
+        'api_calls_saved': per_instance_api_calls - num_api_calls
+    }
+    return logs_by_instance, api_stats
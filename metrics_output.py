@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+"""
+Writers for the aws_metrics_<...> files produced by get_logs.py.
+
+The csv is written row by row straight from the timepoint matrix. The optional
+columnar formats (parquet or arrow) hold the same columns plus the test
+parameters that are otherwise only packed into the csv filename, stored as
+typed columns and as schema metadata.
+"""
+import csv
+import json
+import math
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Boundaries passed to get_logs.py, in command line order
+TEST_PARAM_FIELDS = ['test_id',
+                     'test_start_time',
+                     'test_end_time',
+                     'sample_period',
+                     'asg_policy_type',
+                     'asg_cpu_max',
+                     'asg_disk_max',
+                     'asg_scaleup_duration',
+                     'image_size',
+                     'num_users_a',
+                     'num_users_b',
+                     'num_users_c']
+
+# The aws_metrics filename holds every test param except the sample period
+FILENAME_PARAM_FIELDS = [field for field in TEST_PARAM_FIELDS if field != 'sample_period']
+
+# csv field -> timepoint_matrix.matrix_to_columns column
+CSV_COLUMNS = {
+    'timepoint': 'timepoint',
+    'cpu0_util': 'cpu0_utils',
+    'cpu1_util': 'cpu1_utils',
+    'mem_util': 'mem_utils',
+    'disk_util': 'disk_utils',
+    'network_out': 'network_out_values',
+    'instance_id': 'instance_id',
+    'running_time_ms': 'running_time_ms',
+    # epoch seconds at the start of the timepoint's bucket
+    'timestamp': 'timestamp'
+}
+CSV_FIELDNAMES = list(CSV_COLUMNS.keys())
+
+# Optional per-timepoint columns appended after CSV_FIELDNAMES, e.g. get_logs.py --loadgen-monitor
+LOADGEN_SATURATED_FIELD = 'loadgen_saturated'
+
+COLUMNAR_FORMATS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow'
+}
+
+PARAMS_METADATA_KEY = b'aws_metrics_params'
+
+
+def get_metrics_filename(test_params, extension='.csv'):
+    return 'aws_metrics_{}_{}_{}_{}_{}_{}_{}_{}_{}_{}_{}{}'.format(
+        *[test_params[field] for field in FILENAME_PARAM_FIELDS], extension)
+
+
+def iter_metric_rows(instance_ids, launch_times, bucket_timestamps, matrix, end_time, extra_columns=None):
+    """
+    Yield csv rows (in CSV_FIELDNAMES order) one instance at a time, straight from the timepoint matrix.
+
+    Gaps (NaN) are written as empty fields. extra_columns ({field: one value per timepoint}) are appended in
+    their order.
+    """
+    timestamps = [int(timestamp) for timestamp in bucket_timestamps]
+    extra_values = list(zip(*extra_columns.values())) if extra_columns else [()] * len(timestamps)
+    for i, instance_id in enumerate(instance_ids):
+        running_time = end_time - launch_times[i]
+        # timepoint_matrix.METRIC_KEYS order
+        for timepoint, (cpu0, cpu1, disk, mem, network) in enumerate(matrix[i].tolist()):
+            yield (timepoint,
+                   '' if math.isnan(cpu0) else cpu0,
+                   '' if math.isnan(cpu1) else cpu1,
+                   '' if math.isnan(mem) else mem,
+                   '' if math.isnan(disk) else disk,
+                   '' if math.isnan(network) else network,
+                   instance_id,
+                   running_time,
+                   timestamps[timepoint]) + extra_values[timepoint]
+
+
+def write_metrics_csv(path, rows, extra_fieldnames=()):
+    with open(path, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+
+        writer.writerow(CSV_FIELDNAMES + list(extra_fieldnames))
+        writer.writerows(rows)
+
+
+def check_columnar_support():
+    if pa is None:
+        raise RuntimeError("Columnar output requires pyarrow (pip3 install pyarrow)")
+
+
+def build_metrics_table(columns, test_params, extra_columns=None):
+    """
+    Build an arrow table from timepoint_matrix.matrix_to_columns output, adding every test param as a typed
+    column and as json schema metadata, and extra_columns ({field: one value per timepoint}) after the csv
+    fields.
+    """
+    check_columnar_support()
+
+    num_rows = len(columns['timepoint'])
+    arrays = {}
+    for fieldname, column in CSV_COLUMNS.items():
+        if fieldname == 'instance_id':
+            arrays[fieldname] = pa.array(columns[column].tolist(), type=pa.string()).dictionary_encode()
+        elif fieldname == 'timestamp':
+            arrays[fieldname] = pa.array(columns[column], type=pa.int64())
+        else:
+            # from_pandas turns NaN gaps into nulls
+            arrays[fieldname] = pa.array(columns[column], from_pandas=True)
+    for fieldname, values in (extra_columns or {}).items():
+        arrays[fieldname] = pa.array([values[timepoint] for timepoint in columns['timepoint'].tolist()])
+    for field in TEST_PARAM_FIELDS:
+        arrays[field] = pa.array([int(test_params[field])] * num_rows, type=pa.int64())
+
+    table = pa.table(arrays)
+    metadata = {PARAMS_METADATA_KEY: json.dumps({field: int(test_params[field]) for field in TEST_PARAM_FIELDS})}
+    return table.replace_schema_metadata(metadata)
+
+
+def write_metrics_columnar(path, table, columnar_format):
+    check_columnar_support()
+
+    if columnar_format == 'parquet':
+        pq.write_table(table, path)
+    elif columnar_format == 'arrow':
+        feather.write_feather(table, path)
+    else:
+        raise ValueError("Unknown columnar format '{}', expected one of {}".format(
+            columnar_format, list(COLUMNAR_FORMATS.keys())))
+
+
+def read_metrics_table(path, columns=None):
+    """
+    Load an aws_metrics parquet or arrow file, reading only the requested columns.
+    """
+    check_columnar_support()
+
+    if path.endswith(COLUMNAR_FORMATS['parquet']):
+        return pq.read_table(path, columns=columns)
+    return feather.read_table(path, columns=columns, memory_map=True)
+
+
+def read_metrics_params(path):
+    """
+    Read the test params from the schema metadata of an aws_metrics parquet or arrow file.
+    """
+    check_columnar_support()
+
+    if path.endswith(COLUMNAR_FORMATS['parquet']):
+        schema = pq.read_schema(path)
+    else:
+        schema = feather.read_table(path, columns=[], memory_map=True).schema
+    return json.loads(schema.metadata[PARAMS_METADATA_KEY])
@@ -0,0 +1,456 @@
+#!/usr/bin/python3
+"""
+One scaling controller process for many auto scaling groups.
+
+asg_util_alarms.py controls a single group, so N groups take N processes
+and N times the API calls. Here a tick makes the same few calls whatever the
+number of groups:
+
+- one describe_instances for the running instances of every group,
+- one batched describe_instance_status for the instances not known to be
+  ready yet (a single ReadinessTracker covers all the groups),
+- every group's GetMetricData queries packed into the same requests (group
+  mode: two AVG(SEARCH) expressions per group; instance mode: one query per
+  ready instance and metric, 500 per request),
+- put_metric_data only for the groups whose Target changed, or that haven't
+  had it repeated for --target-refresh seconds.
+
+Each service has one client (and connection pool) for all the groups, and
+every call, retries included, takes a token from a shared ApiBudget of
+--api-budget calls per second. The Target rule is asg_util_alarms.decide_target,
+with the lower bounds at half the upper ones as there.
+
+Groups are NAME:CPU_UPPER:DISK_UPPER arguments and/or a --config JSON list of
+{"asg_name": ..., "cpu_upper": 70, "disk_upper": 70}, which is re-read when it
+changes; a group removed from it gets its Target reset to 0.5.
+
+    ./multi_group_alarms.py web-asg:70:70 batch-asg:80:60 --api-budget 5
+"""
+import asyncio
+import calendar
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+import boto3
+
+from asg_util_alarms import (LAUNCH_TIME_DELAY_SECONDS, PERIOD_SEC, TICK_SECONDS, WINDOW_MINUTES, decide_target,
+                             put_metric_data_target, run_notifier_loop, shutting_down)
+from aws_clients import DEFAULT_REGION, ApiBudget, BackoffClient, BudgetClient, create_client
+from controller_metrics import ControllerMetrics, InstrumentedClient, start_metrics_server, time_phase
+from group_metrics import GroupUtilizationQuery
+from instance_readiness import ReadinessTracker
+from metric_data import INSTANCE_METRICS, build_instance_queries, get_metric_data_batched, to_epoch_seconds
+
+logger = logging.getLogger('multi_group_alarms')
+
+GROUP_TAG = 'aws:autoscaling:groupName'
+DEFAULT_API_BUDGET = 5
+DEFAULT_API_BURST = 20
+# Below the 60 s period of the alarms on Target, so every period still gets a datapoint
+DEFAULT_TARGET_REFRESH_SECONDS = 45
+# Ticks start on a fixed schedule, but not to the millisecond
+REFRESH_SLACK_SECONDS = 1
+UTIL_METRICS = [metric for metric in INSTANCE_METRICS if metric['key'] in ('cpu0_utils', 'cpu1_utils', 'disk_utils')]
+
+
+def parse_group_spec(spec: str):
+    """
+    NAME:CPU_UPPER:DISK_UPPER (bounds 0-100) -> group config dict.
+    """
+    # group names may contain ':' themselves
+    parts = spec.rsplit(':', 2)
+    if len(parts) != 3:
+        raise ValueError("Expected NAME:CPU_UPPER:DISK_UPPER, got {!r}".format(spec))
+    return {'asg_name': parts[0], 'cpu_upper': float(parts[1]), 'disk_upper': float(parts[2])}
+
+
+def load_group_config(config_path: str):
+    with open(config_path) as config_file:
+        groups = json.load(config_file)
+    if not isinstance(groups, list) or not all(isinstance(group, dict) for group in groups):
+        raise ValueError("{}: expected a JSON list of groups".format(config_path))
+    for group in groups:
+        if 'asg_name' not in group or 'cpu_upper' not in group or 'disk_upper' not in group:
+            raise ValueError("{}: every group needs asg_name, cpu_upper and disk_upper".format(config_path))
+    return groups
+
+
+def get_group_name(instance):
+    for tag in instance.tags or []:
+        if tag['Key'] == GROUP_TAG:
+            return tag['Value']
+    return None
+
+
+def get_instance_mode_utils(results, query_map, period_sec: int):
+    """
+    Average cpu and disk utilization of one group from its build_instance_queries results, averaged the way
+    asg_util_alarms.get_average_utils does: the window mean of each instance and cpu, then the mean of those.
+    """
+    cpu_utils = []
+    disk_utils = []
+    timestamps = []
+    for query_id, (_, key) in query_map.items():
+        values = results[query_id]['Values']
+        timestamps.extend(results[query_id]['Timestamps'])
+        if not values:
+            continue
+        mean = sum(values) / len(values)
+        if key == 'disk_utils':
+            disk_utils.append(mean / 1000 / period_sec)
+        else:
+            cpu_utils.append((100 - mean) / 100)
+
+    # like get_average_utils, a zero utilization doesn't count towards the average
+    cpu_utils = [util for util in cpu_utils if util]
+    disk_utils = [util for util in disk_utils if util]
+    avg_cpu_util = sum(cpu_utils) / len(cpu_utils) if cpu_utils else None
+    avg_disk_util = sum(disk_utils) / len(disk_utils) if disk_utils else None
+    newest_timestamp = max(to_epoch_seconds(timestamp) for timestamp in timestamps) if timestamps else None
+    return avg_cpu_util, avg_disk_util, newest_timestamp
+
+
+class ControlledGroup:
+    """
+    A group's bounds and what has been published for it, kept across ticks.
+    """
+
+    def __init__(self, asg_name: str, cpu_upper: float, disk_upper: float, window_minutes: int):
+        self.asg_name = asg_name
+        self.group_query = GroupUtilizationQuery(window_minutes)
+        self.published_target = None
+        self.published_at = None
+        self.set_bounds(cpu_upper, disk_upper)
+
+    def set_bounds(self, cpu_upper: float, disk_upper: float):
+        """
+        Bounds in percent (0-100), as on the command line.
+        """
+        self.cpu_upper = float(cpu_upper / 100)
+        self.disk_upper = float(disk_upper / 100)
+        # Set lower bounds based on percentage of upper bounds
+        self.cpu_lower = self.cpu_upper * 0.5
+        self.disk_lower = self.disk_upper * 0.5
+
+    def needs_publish(self, target: float, now: float, refresh_seconds: float):
+        return self.published_target != target or self.published_at is None or \
+            now - self.published_at >= refresh_seconds - REFRESH_SLACK_SECONDS
+
+
+class MultiGroupController:
+    """
+    Controls every group in `groups` (a list of group config dicts) with shared clients.
+
+    Targets are published when they change, or every refresh_seconds. If `config_path` is given, the groups are
+    re-read from it whenever it changes.
+    """
+
+    def __init__(self, ec2, ec2_client, cw_client, groups, period_sec: int = PERIOD_SEC,
+                 window_minutes: int = WINDOW_MINUTES, query_mode: str = 'group',
+                 refresh_seconds: float = DEFAULT_TARGET_REFRESH_SECONDS, config_path: str = None,
+                 budget: ApiBudget = None, metrics: ControllerMetrics = None):
+        self.ec2 = ec2
+        self.ec2_client = ec2_client
+        self.cw_client = cw_client
+        self.period_sec = period_sec
+        self.window_minutes = window_minutes
+        self.query_mode = query_mode
+        self.refresh_seconds = refresh_seconds
+        self.config_path = config_path
+        self.config_mtime = None
+        self.budget = budget
+        self.metrics = metrics
+        self.readiness_tracker = ReadinessTracker(LAUNCH_TIME_DELAY_SECONDS)
+        self.api_calls = 0
+        self.groups = {}
+        self.static_groups = list(groups)
+        self.set_groups(self.static_groups)
+
+    def set_groups(self, group_configs):
+        """
+        Add new groups, update the bounds of known ones and reset the Target of the ones that are gone.
+        """
+        configs = {config['asg_name']: config for config in group_configs}
+        for asg_name in list(self.groups):
+            if asg_name not in configs:
+                group = self.groups.pop(asg_name)
+                logger.info("%s: no longer controlled", asg_name)
+                if group.published_target is not None and not shutting_down.is_set():
+                    put_metric_data_target(self.cw_client, 0.5, asg_name)
+        for asg_name, config in configs.items():
+            if asg_name in self.groups:
+                self.groups[asg_name].set_bounds(config['cpu_upper'], config['disk_upper'])
+            else:
+                logger.info("%s: controlled with cpu/disk upper bounds %s/%s", asg_name, str(config['cpu_upper']),
+                            str(config['disk_upper']))
+                self.groups[asg_name] = ControlledGroup(asg_name, config['cpu_upper'], config['disk_upper'],
+                                                        self.window_minutes)
+
+    def reload_config(self):
+        if self.config_path is None:
+            return
+        try:
+            mtime = os.stat(self.config_path).st_mtime
+        except FileNotFoundError:
+            logger.warning("Group config %s not found", self.config_path)
+            return
+        if mtime == self.config_mtime:
+            return
+        try:
+            configs = load_group_config(self.config_path)
+        except ValueError as error:
+            # a half-written or bad file: keep the current groups and try again next tick
+            logger.error("Ignoring group config %s: %s", self.config_path, error)
+            return
+        self.config_mtime = mtime
+        self.set_groups(self.static_groups + configs)
+
+    def list_instances(self):
+        """
+        The running instances of every group, in one describe_instances, by group name.
+        """
+        if self.budget is not None:
+            # the EC2 resource has its own client, so its call is paid for here
+            self.budget.acquire()
+        instances = list(self.ec2.instances.filter(
+            Filters=[
+                {'Name': 'instance-state-name', 'Values': ['running']},
+                {'Name': 'tag:' + GROUP_TAG, 'Values': sorted(self.groups)}
+            ]
+        ))
+        self.api_calls = self.api_calls + 1
+        if self.metrics is not None:
+            self.metrics.record_api_call('ec2', 'describe_instances')
+
+        instances_by_group = {asg_name: [] for asg_name in self.groups}
+        for instance in instances:
+            asg_name = get_group_name(instance)
+            if asg_name in instances_by_group:
+                instances_by_group[asg_name].append(instance)
+        return instances, instances_by_group
+
+    def get_utils(self, running_ids_by_group, ready_ids_by_group, start_time, end_time):
+        """
+        (avg cpu util, avg disk util, newest datapoint timestamp) of every group with ready instances, from
+        GetMetricData requests shared by all of them.
+        """
+        queries = []
+        query_maps = {}
+        for i, asg_name in enumerate(sorted(ready_ids_by_group)):
+            group = self.groups[asg_name]
+            if self.query_mode == 'group':
+                # Ids must start with a lowercase letter and be unique within a request
+                queries.extend(group.group_query.build_queries(asg_name, running_ids_by_group[asg_name],
+                                                               ready_ids_by_group[asg_name], end_time,
+                                                               self.period_sec, id_prefix='g{}_'.format(i)))
+                query_maps[asg_name] = 'g{}_'.format(i)
+            else:
+                group_queries, query_map = build_instance_queries(asg_name, ready_ids_by_group[asg_name],
+                                                                  self.period_sec, UTIL_METRICS,
+                                                                  id_prefix='g{}m'.format(i))
+                queries.extend(group_queries)
+                query_maps[asg_name] = query_map
+
+        results, api_calls = get_metric_data_batched(self.cw_client, queries, start_time, end_time)
+        self.api_calls = self.api_calls + api_calls
+
+        utils = {}
+        for asg_name, query_map in query_maps.items():
+            if self.query_mode == 'group':
+                group_query = self.groups[asg_name].group_query
+                avg_cpu_util, avg_disk_util = group_query.get_utils_from_results(results, self.period_sec, query_map)
+                utils[asg_name] = (avg_cpu_util, avg_disk_util, group_query.newest_timestamp)
+            else:
+                utils[asg_name] = get_instance_mode_utils(results, query_map, self.period_sec)
+        return utils
+
+    def run_tick(self, deadline: float = None):
+        """
+        Decide every group's Target and publish the ones that are due. Returns {asg_name: decision dict}.
+        """
+        metrics = self.metrics
+        tick_start = time.monotonic()
+        self.reload_config()
+        if not self.groups:
+            logger.warning("No groups to control")
+            return {}
+
+        start_time = datetime.utcnow() - timedelta(minutes=self.window_minutes)
+        end_time = datetime.utcnow()
+
+        with time_phase(metrics, 'ec2_list'):
+            instances, instances_by_group = self.list_instances()
+
+        # One readiness check for all the groups' instances
+        current_epoch_seconds = calendar.timegm(time.gmtime())
+        with time_phase(metrics, 'status_check'):
+            status_calls = self.readiness_tracker.status_calls
+            ready_ids, _ = self.readiness_tracker.update(self.ec2_client, instances, current_epoch_seconds)
+            self.api_calls = self.api_calls + self.readiness_tracker.status_calls - status_calls
+        ready_ids = set(ready_ids)
+
+        running_ids_by_group = {}
+        ready_ids_by_group = {}
+        waiting_by_group = {}
+        for asg_name, group_instances in instances_by_group.items():
+            running_ids_by_group[asg_name] = [instance.id for instance in group_instances]
+            group_ready_ids = [instance.id for instance in group_instances if instance.id in ready_ids]
+            waiting_by_group[asg_name] = len(group_instances) - len(group_ready_ids)
+            if group_ready_ids:
+                ready_ids_by_group[asg_name] = group_ready_ids
+            else:
+                logger.warning("%s: no ready instances found! (%s instance(s) warming up)", asg_name,
+                               str(waiting_by_group[asg_name]))
+
+        with time_phase(metrics, 'metric_fetch'):
+            utils = self.get_utils(running_ids_by_group, ready_ids_by_group, start_time, end_time) \
+                if ready_ids_by_group else {}
+
+        decisions = {}
+        for asg_name, (avg_cpu_util, avg_disk_util, newest_timestamp) in sorted(utils.items()):
+            group = self.groups[asg_name]
+            target, target_msg = decide_target(avg_cpu_util, avg_disk_util, group.cpu_upper, group.cpu_lower,
+                                               group.disk_upper, group.disk_lower,
+                                               len(ready_ids_by_group[asg_name]), waiting_by_group[asg_name])
+            logger.info("%s: %s ready (%s warming up), avg CPU/Disk Utilization %s/%s, Target: %s (%s)", asg_name,
+                        str(len(ready_ids_by_group[asg_name])), str(waiting_by_group[asg_name]), str(avg_cpu_util),
+                        str(avg_disk_util), str(target), str(target_msg))
+            decisions[asg_name] = {'target': target, 'ready_instances': len(ready_ids_by_group[asg_name]),
+                                   'waiting_instances': waiting_by_group[asg_name], 'avg_cpu_util': avg_cpu_util,
+                                   'avg_disk_util': avg_disk_util, 'newest_timestamp': newest_timestamp,
+                                   'published': False}
+
+        if deadline is not None and time.monotonic() > deadline:
+            logger.warning("Tick missed its deadline, not sending stale target values")
+            return decisions
+
+        # Send the target values that changed or are due to be repeated
+        with time_phase(metrics, 'put_target'):
+            for asg_name, decision in decisions.items():
+                # Don't overwrite the reset values sent by signal_handler
+                if shutting_down.is_set():
+                    return decisions
+                group = self.groups[asg_name]
+                if not group.needs_publish(decision['target'], tick_start, self.refresh_seconds):
+                    continue
+                put_metric_data_target(self.cw_client, decision['target'], asg_name)
+                self.api_calls = self.api_calls + 1
+                group.published_target = decision['target']
+                group.published_at = tick_start
+                decision['published'] = True
+
+        if metrics is not None and decisions:
+            newest_timestamps = [decision['newest_timestamp'] for decision in decisions.values()
+                                 if decision['newest_timestamp'] is not None]
+            # the decision latency of the group with the oldest data
+            metrics.record_decision(None, min(newest_timestamps) + self.period_sec if newest_timestamps else None,
+                                    groups=decisions)
+        return decisions
+
+    def reset_targets(self):
+        for asg_name in sorted(self.groups):
+            put_metric_data_target(self.cw_client, 0.5, asg_name)
+
+
+def signal_handler(controller: MultiGroupController):
+    shutting_down.set()
+
+    # Reset Target metrics
+    print("Multi group alarms script exiting, sending target value 0.5 to Cloudwatch for {} group(s) ...".format(
+        len(controller.groups)))
+    controller.reset_targets()
+    print("Multi group alarms script says \"Good bye.\"")
+    sys.exit(0)
+
+
+def main():
+    parser = ArgumentParser(description="Control the Target metric of several auto scaling groups from one process")
+    parser.add_argument('groups', nargs='*', metavar='NAME:CPU_UPPER:DISK_UPPER',
+                        help="A group and its 'cpu_upper' and 'disk_upper' bounds (0-100)")
+    parser.add_argument('--config',
+                        help="JSON list of {\"asg_name\", \"cpu_upper\", \"disk_upper\"} groups, re-read when it "
+                             "changes")
+    parser.add_argument('--query-mode', choices=['instance', 'group'], default='group',
+                        help="Have CloudWatch average each group with two expressions (default), or query each "
+                             "ready instance's metrics; either way all the groups share the requests")
+    parser.add_argument('--api-budget', type=float, default=DEFAULT_API_BUDGET,
+                        help="AWS API calls per second for all the groups together (default: %(default)s)")
+    parser.add_argument('--api-burst', type=float, default=DEFAULT_API_BURST,
+                        help="Calls that may be made at once before --api-budget applies (default: %(default)s)")
+    parser.add_argument('--target-refresh', type=float, default=DEFAULT_TARGET_REFRESH_SECONDS,
+                        help="Repeat an unchanged Target after this many seconds; keep it below the period of the "
+                             "alarms on Target (default: %(default)s)")
+    parser.add_argument('--tick-seconds', type=float, default=TICK_SECONDS,
+                        help="Time between the start of two ticks")
+    parser.add_argument('--tick-deadline', type=float,
+                        help="Don't publish Targets computed later than this many seconds after their tick "
+                             "started (default: --tick-seconds)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve controller metrics in Prometheus text format at http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--metrics-file',
+                        help="Append one JSON line per tick with phase timings and every group's decision")
+    args = parser.parse_args()
+    if not args.groups and not args.config:
+        parser.error("Give at least one NAME:CPU_UPPER:DISK_UPPER group or a --config file")
+    try:
+        groups = [parse_group_spec(spec) for spec in args.groups]
+    except ValueError as error:
+        parser.error(str(error))
+
+    # One client per service for all the groups
+    region = DEFAULT_REGION
+    ec2 = boto3.resource('ec2', region_name=region)
+    cw_client = create_client('cloudwatch', region)
+    ec2_client = create_client('ec2', region)
+
+    metrics = None
+    if args.metrics_port is not None or args.metrics_file:
+        metrics = ControllerMetrics(jsonl_path=args.metrics_file)
+        # Count every attempt, including throttled ones that get retried
+        cw_client = InstrumentedClient(cw_client, metrics, 'cloudwatch')
+        ec2_client = InstrumentedClient(ec2_client, metrics, 'ec2')
+        if args.metrics_port is not None:
+            start_metrics_server(metrics, args.metrics_port)
+
+    budget = ApiBudget(args.api_budget, args.api_burst)
+    cw_client = BackoffClient(BudgetClient(cw_client, budget))
+    ec2_client = BackoffClient(BudgetClient(ec2_client, budget))
+
+    controller = MultiGroupController(ec2, ec2_client, cw_client, groups, query_mode=args.query_mode,
+                                      refresh_seconds=args.target_refresh, config_path=args.config, budget=budget,
+                                      metrics=metrics)
+    controller.reload_config()
+
+    # Catch SIGINT & SIGTERM
+    def signal_handler_wrapper(_sig, _frame):
+        signal_handler(controller)
+
+    signal.signal(signal.SIGINT, signal_handler_wrapper)
+    signal.signal(signal.SIGTERM, signal_handler_wrapper)
+
+    def tick(deadline):
+        if metrics is not None:
+            metrics.start_tick()
+        try:
+            with time_phase(metrics, 'tick'):
+                controller.run_tick(deadline)
+        finally:
+            if metrics is not None:
+                metrics.finish_tick()
+
+    tick_deadline = args.tick_deadline if args.tick_deadline is not None else args.tick_seconds
+
+    # Run infinite-loop
+    logger.info("Starting multi group alarms script for %s group(s) ...", str(len(controller.groups)))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run_notifier_loop(tick, args.tick_seconds, tick_deadline, metrics=metrics))
+
+
+if __name__ == "__main__":
+    main()
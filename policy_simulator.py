@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+"""
+Offline replay of recorded tests through asg_util_alarms.py's scaling policy.
+
+Every aws_metrics file in the given results directories becomes a demand
+trace: per sample period, the cpu and disk utilization summed over the
+instances that were running, i.e. the work the group had to do. The trace is
+replayed tick by tick for a whole grid of policies at once (numpy arrays with
+one entry per policy) with
+
+- the load spread evenly over the instances that are serving, each instance
+  serving BOOT_SECONDS after launch and only counted by the controller
+  LAUNCH_TIME_DELAY_SECONDS after launch,
+- the controller's window average of metrics published PUBLISH_DELAY_SECONDS
+  late and run_scaling_notifier's Target rule,
+- an alarm that needs Target held for --alarm-seconds, the scale_up_size /
+  scale_down_size steps, a cooldown between scaling actions, and the
+  min_size / max_size capacity limits.
+
+A tick violates the SLO when the busiest resource of the serving instances is
+saturated, or when the p95 latency predicted for its utilization exceeds
+--slo-ms. The latency curve (p95 by utilization) is fitted from the test's
+testresults_<test_id>.jtl if there is one; without it --slo-utilization is
+the limit. Recorded demand can't exceed what the recorded instances could
+do, so where the recording was saturated the real demand may have been higher.
+
+Policies are ranked by SLO violation minutes, then instance-hours, summed
+over all traces. Traces and chunks of the policy grid are spread over
+processes.
+
+    ./policy_simulator.py results/2020_03_01_120000 --cpu-upper 30:95:5 --disk-upper 30:95:5 \\
+        --window-minutes 1 2 5 --scale-up-size 1 2 --output policy_ranking.csv
+"""
+import csv
+import glob
+import itertools
+import os
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from asg_util_alarms import LAUNCH_TIME_DELAY_SECONDS, TICK_SECONDS
+from capacity_join import METRICS_FILE_PATTERN, LatencyBuckets, aggregate_metrics, bucket_jtl, get_period, \
+    load_metrics
+from jtl_binary import get_jtl_path
+
+BOOT_SECONDS = 120
+PUBLISH_DELAY_SECONDS = 60
+DEFAULT_COOLDOWN_SECONDS = 300
+DEFAULT_ALARM_SECONDS = 60
+DEFAULT_MIN_SIZE = 1
+DEFAULT_MAX_SIZE = 5
+DEFAULT_SLO_MS = 1000
+DEFAULT_SLO_UTILIZATION = 0.9
+DEFAULT_CHUNK_POLICIES = 5000
+
+# Utilization bins the p95 latency curve is fitted on
+LATENCY_CURVE_BINS = 20
+
+POLICY_FIELDS = ['cpu_upper', 'disk_upper', 'window_minutes', 'scale_up_size', 'scale_down_size', 'min_size',
+                 'max_size']
+RANKING_FIELDNAMES = ['rank'] + POLICY_FIELDS + ['slo_violation_minutes', 'instance_hours', 'scale_ups',
+                                                 'scale_downs']
+
+
+def parse_values(values, value_type=float):
+    """
+    Expand a list of values, where START:STOP:STEP (inclusive) stands for a range.
+    """
+    expanded = []
+    for value in values:
+        if ':' in value:
+            start, stop, step = [value_type(part) for part in value.split(':')]
+            expanded.extend(value_type(v) for v in np.arange(start, stop + step / 2, step))
+        else:
+            expanded.append(value_type(value))
+    return expanded
+
+
+def build_policy_grid(cpu_upper, disk_upper, window_minutes, scale_up_size, scale_down_size, min_size, max_size):
+    """
+    Every combination of the given values, as one array per POLICY_FIELDS entry. Bounds are percentages.
+    """
+    combinations = np.array(list(itertools.product(cpu_upper, disk_upper, window_minutes, scale_up_size,
+                                                   scale_down_size, min_size, max_size)), dtype=np.float64)
+    policies = {field: combinations[:, i] for i, field in enumerate(POLICY_FIELDS)}
+    policies['cpu_upper'] = policies['cpu_upper'] / 100
+    policies['disk_upper'] = policies['disk_upper'] / 100
+    for field in ['scale_up_size', 'scale_down_size', 'min_size', 'max_size']:
+        policies[field] = policies[field].astype(np.int64)
+    return policies
+
+
+def fit_latency_curve(p95_ms, utilization, samples):
+    """
+    Median p95 latency per utilization bin, made non-decreasing. Returns (utilization, p95_ms) points.
+    """
+    valid = (samples > 0) & ~np.isnan(p95_ms) & ~np.isnan(utilization)
+    bins = np.minimum((utilization[valid] * LATENCY_CURVE_BINS).astype(np.int64), LATENCY_CURVE_BINS - 1)
+    points = []
+    for b in np.unique(bins):
+        points.append(((b + 0.5) / LATENCY_CURVE_BINS, float(np.median(p95_ms[valid][bins == b]))))
+    if not points:
+        return None
+    curve_utilization = np.array([point[0] for point in points])
+    curve_p95 = np.maximum.accumulate(np.array([point[1] for point in points]))
+    return curve_utilization, curve_p95
+
+
+def load_trace(metrics_path: str, jtl_path: str = None):
+    """
+    Get a test's demand per sample period and, if there is a jtl, its latency curve. None if the metrics file has
+    no rows (get_logs.py found no instance data).
+    """
+    metrics, file_period = load_metrics(metrics_path)
+    if len(metrics['timestamp']) == 0:
+        return None
+    period_sec = file_period or get_period(metrics['timestamp'])
+    grid_start = float(np.min(metrics['timestamp']))
+    num_buckets = int(round((np.max(metrics['timestamp']) - grid_start) / period_sec)) + 1
+    bucket_timestamps = grid_start + period_sec * np.arange(num_buckets, dtype=np.float64)
+
+    active_instances, mean_cpu, mean_disk, _ = aggregate_metrics(metrics, bucket_timestamps)
+    trace = {
+        'name': os.path.basename(metrics_path),
+        'period_sec': period_sec,
+        'cpu_demand': np.nan_to_num(active_instances * mean_cpu),
+        'disk_demand': np.nan_to_num(active_instances * mean_disk),
+        'initial_instances': int(active_instances[0]) if num_buckets else 1,
+        'latency_curve': None
+    }
+    if jtl_path is not None:
+        latency_buckets = LatencyBuckets()
+        samples, _, latency_counts, _ = bucket_jtl(jtl_path, grid_start, period_sec, num_buckets)
+        p95_ms = latency_buckets.percentiles(latency_counts, [95])[:, 0]
+        trace['latency_curve'] = fit_latency_curve(p95_ms, np.fmax(mean_cpu, mean_disk), samples)
+    return trace
+
+
+def find_traces(results_dirs):
+    """
+    (metrics_path, jtl_path or None) for every test in the results directories, preferring csv metrics files.
+    """
+    traces = []
+    for results_dir in results_dirs:
+        tests = {}
+        for path in sorted(glob.glob(os.path.join(results_dir, 'aws_metrics_*'))):
+            match = METRICS_FILE_PATTERN.match(os.path.basename(path))
+            if match is None or (match.group(1) in tests and not path.endswith('.csv')):
+                continue
+            tests[match.group(1)] = path
+        for test_id, metrics_path in sorted(tests.items(), key=lambda item: int(item[0])):
+            traces.append((metrics_path, get_jtl_path(results_dir, test_id)))
+    return traces
+
+
+def get_targets(avg_cpu_util, avg_disk_util, cpu_upper, cpu_lower, disk_upper, disk_lower, ready_instances,
+                waiting_instances):
+    """
+    run_scaling_notifier's Target rule for arrays of policies: 1 (scale up), 0.5 (no action) or 0 (scale down).
+    """
+    cpu_known = avg_cpu_util > 0
+    disk_known = avg_disk_util > 0
+    scale_up = cpu_known & (avg_cpu_util >= cpu_upper) | disk_known & (avg_disk_util >= disk_upper)
+    no_action = (ready_instances <= 1) & (waiting_instances == 0) | cpu_known & (avg_cpu_util > cpu_lower) | \
+        disk_known & (avg_disk_util > disk_lower)
+    return np.where(scale_up, 1.0, np.where(no_action, 0.5, 0.0))
+
+
+def simulate(trace, policies, slo_ms: float, slo_utilization: float, cooldown_seconds: float,
+             alarm_seconds: float, tick_seconds: float = TICK_SECONDS):
+    """
+    Replay one trace for every policy. Returns per-policy arrays of SLO violation seconds, instance seconds and
+    the number of scale up and scale down actions.
+    """
+    num_policies = len(policies['cpu_upper'])
+    policy_index = np.arange(num_policies)
+    period_sec = trace['period_sec']
+    cpu_demand = trace['cpu_demand']
+    disk_demand = trace['disk_demand']
+    num_ticks = int(len(cpu_demand) * period_sec // tick_seconds)
+
+    cpu_upper = policies['cpu_upper']
+    disk_upper = policies['disk_upper']
+    # lower bounds are set from the upper ones as asg_util_alarms.py does
+    cpu_lower = cpu_upper * 0.5
+    disk_lower = disk_upper * 0.5
+    window_ticks = np.maximum(np.rint(policies['window_minutes'] * 60 / tick_seconds).astype(np.int64), 1)
+    publish_delay_ticks = int(round(PUBLISH_DELAY_SECONDS / tick_seconds))
+    alarm_ticks = max(int(round(alarm_seconds / tick_seconds)), 1)
+
+    # one slot per possible instance, filled in launch order; NaN is an empty slot
+    slots = np.arange(int(np.max(policies['max_size'])))
+    desired = np.clip(trace['initial_instances'], policies['min_size'], policies['max_size'])
+    launch_times = np.where(slots[None, :] < desired[:, None], -np.inf, np.nan)
+
+    # running sums of the utilization the controller sees, per tick
+    cpu_sums = np.zeros((num_ticks + 1, num_policies))
+    disk_sums = np.zeros((num_ticks + 1, num_policies))
+    up_streak = np.zeros(num_policies, dtype=np.int64)
+    down_streak = np.zeros(num_policies, dtype=np.int64)
+    last_action = np.full(num_policies, -np.inf)
+
+    violation_seconds = np.zeros(num_policies)
+    instance_seconds = np.zeros(num_policies)
+    scale_ups = np.zeros(num_policies, dtype=np.int64)
+    scale_downs = np.zeros(num_policies, dtype=np.int64)
+
+    latency_curve = trace['latency_curve']
+    for k in range(num_ticks):
+        now = k * tick_seconds
+        bucket = min(int(now // period_sec), len(cpu_demand) - 1)
+
+        present = slots[None, :] < desired[:, None]
+        serving = np.count_nonzero(present & (launch_times <= now - BOOT_SECONDS), axis=1)
+        counted = np.count_nonzero(present & (launch_times <= now - LAUNCH_TIME_DELAY_SECONDS), axis=1)
+        waiting = np.count_nonzero(present, axis=1) - counted
+        instance_seconds = instance_seconds + np.count_nonzero(present, axis=1) * tick_seconds
+
+        # load per serving instance; above 1 the instances are saturated
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cpu_load = np.where(serving > 0, cpu_demand[bucket] / serving, np.inf)
+            disk_load = np.where(serving > 0, disk_demand[bucket] / serving, np.inf)
+        busiest = np.fmax(cpu_load, disk_load)
+        if latency_curve is not None:
+            predicted_p95 = np.interp(np.minimum(busiest, 1.0), latency_curve[0], latency_curve[1])
+            violation = (busiest >= 1.0) | (predicted_p95 > slo_ms)
+        else:
+            violation = busiest > slo_utilization
+        if cpu_demand[bucket] == 0 and disk_demand[bucket] == 0:
+            violation = np.zeros(num_policies, dtype=bool)
+        violation_seconds = violation_seconds + violation * tick_seconds
+
+        # measured utilization can't go above 100%
+        cpu_sums[k + 1] = cpu_sums[k] + np.where(serving > 0, np.minimum(cpu_load, 1.0), 0.0)
+        disk_sums[k + 1] = disk_sums[k] + np.where(serving > 0, np.minimum(disk_load, 1.0), 0.0)
+
+        # the controller's window only holds datapoints that have been published
+        published = k + 1 - publish_delay_ticks
+        if published < 1:
+            continue
+        window_start = np.maximum(published - window_ticks, 0)
+        window_length = published - window_start
+        avg_cpu_util = (cpu_sums[published] - cpu_sums[window_start, policy_index]) / window_length
+        avg_disk_util = (disk_sums[published] - disk_sums[window_start, policy_index]) / window_length
+
+        targets = get_targets(avg_cpu_util, avg_disk_util, cpu_upper, cpu_lower, disk_upper, disk_lower, counted,
+                              waiting)
+        # no Target is published without ready instances, which the alarm treats as not breaching
+        targets = np.where(counted > 0, targets, 0.5)
+        up_streak = np.where(targets == 1, up_streak + 1, 0)
+        down_streak = np.where(targets == 0, down_streak + 1, 0)
+
+        cooled_down = now - last_action >= cooldown_seconds
+        new_desired = desired
+        new_desired = np.where(cooled_down & (up_streak >= alarm_ticks),
+                               np.minimum(desired + policies['scale_up_size'], policies['max_size']), new_desired)
+        new_desired = np.where(cooled_down & (down_streak >= alarm_ticks),
+                               np.maximum(desired + policies['scale_down_size'], policies['min_size']),
+                               new_desired)
+        scaled_up = new_desired > desired
+        scaled_down = new_desired < desired
+        scale_ups = scale_ups + scaled_up
+        scale_downs = scale_downs + scaled_down
+        last_action = np.where(scaled_up | scaled_down, now, last_action)
+
+        # new instances take the next slots; scaling down removes the newest
+        launched = (slots[None, :] >= desired[:, None]) & (slots[None, :] < new_desired[:, None])
+        launch_times = np.where(launched, now, launch_times)
+        desired = new_desired
+
+    return violation_seconds, instance_seconds, scale_ups, scale_downs
+
+
+def simulate_chunk(trace, policies, start: int, end: int, settings):
+    chunk = {field: values[start:end] for field, values in policies.items()}
+    return start, end, simulate(trace, chunk, **settings)
+
+
+def rank_policies(violation_seconds, instance_seconds):
+    """
+    Policy indices from best to worst: fewest SLO violation seconds, then fewest instance seconds.
+    """
+    return np.lexsort((instance_seconds, violation_seconds))
+
+
+def main():
+    parser = ArgumentParser(description="Replay recorded tests through a grid of scaling policies and rank them")
+    parser.add_argument('results_dirs', nargs='+', help="Results directories written by run-tests.sh")
+    parser.add_argument('--cpu-upper', nargs='+', default=['50'],
+                        help="cpu_upper values in percent; START:STOP:STEP for a range")
+    parser.add_argument('--disk-upper', nargs='+', default=['50'], help="disk_upper values in percent")
+    parser.add_argument('--window-minutes', nargs='+', default=['2'])
+    parser.add_argument('--scale-up-size', nargs='+', default=['1'])
+    parser.add_argument('--scale-down-size', nargs='+', default=['-1'])
+    parser.add_argument('--min-size', nargs='+', default=[str(DEFAULT_MIN_SIZE)])
+    parser.add_argument('--max-size', nargs='+', default=[str(DEFAULT_MAX_SIZE)])
+    parser.add_argument('--slo-ms', type=float, default=DEFAULT_SLO_MS,
+                        help="p95 latency limit, used with the latency curve fitted from each test's jtl")
+    parser.add_argument('--slo-utilization', type=float, default=DEFAULT_SLO_UTILIZATION,
+                        help="Utilization limit for tests without a jtl")
+    parser.add_argument('--cooldown', type=float, default=DEFAULT_COOLDOWN_SECONDS,
+                        help="Seconds between scaling actions")
+    parser.add_argument('--alarm-seconds', type=float, default=DEFAULT_ALARM_SECONDS,
+                        help="How long Target must stay at 1 (or 0) before the alarm acts")
+    parser.add_argument('--workers', type=int, default=None, help="Processes (default: number of cpus)")
+    parser.add_argument('--chunk-policies', type=int, default=DEFAULT_CHUNK_POLICIES,
+                        help="Policies per simulation task")
+    parser.add_argument('--output', default='policy_ranking.csv')
+    parser.add_argument('--top', type=int, default=10, help="Print this many of the best policies")
+    args = parser.parse_args()
+
+    trace_paths = find_traces(args.results_dirs)
+    if not trace_paths:
+        print("No aws_metrics files found in {}".format(', '.join(args.results_dirs)))
+        return
+
+    policies = build_policy_grid(parse_values(args.cpu_upper), parse_values(args.disk_upper),
+                                 parse_values(args.window_minutes), parse_values(args.scale_up_size, int),
+                                 parse_values(args.scale_down_size, int), parse_values(args.min_size, int),
+                                 parse_values(args.max_size, int))
+    num_policies = len(policies['cpu_upper'])
+    settings = {'slo_ms': args.slo_ms, 'slo_utilization': args.slo_utilization, 'cooldown_seconds': args.cooldown,
+                'alarm_seconds': args.alarm_seconds}
+
+    violation_seconds = np.zeros(num_policies)
+    instance_seconds = np.zeros(num_policies)
+    scale_ups = np.zeros(num_policies, dtype=np.int64)
+    scale_downs = np.zeros(num_policies, dtype=np.int64)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        traces = []
+        for (metrics_path, _), trace in zip(trace_paths, executor.map(load_trace, *zip(*trace_paths))):
+            if trace is None:
+                print("No instance data in {}, skipping".format(metrics_path), file=sys.stderr)
+                continue
+            traces.append(trace)
+        if not traces:
+            print("No aws_metrics file in {} has instance data".format(', '.join(args.results_dirs)))
+            return
+        for trace in traces:
+            curve = 'fitted latency curve' if trace['latency_curve'] is not None else 'no jtl, utilization SLO'
+            print("Trace {}: {} period(s) of {}s, {} initial instance(s), {}".format(
+                trace['name'], len(trace['cpu_demand']), trace['period_sec'], trace['initial_instances'], curve))
+
+        futures = [executor.submit(simulate_chunk, trace, policies, start,
+                                   min(start + args.chunk_policies, num_policies), settings)
+                   for trace in traces for start in range(0, num_policies, args.chunk_policies)]
+        for future in futures:
+            start, end, (violations, instances, ups, downs) = future.result()
+            violation_seconds[start:end] = violation_seconds[start:end] + violations
+            instance_seconds[start:end] = instance_seconds[start:end] + instances
+            scale_ups[start:end] = scale_ups[start:end] + ups
+            scale_downs[start:end] = scale_downs[start:end] + downs
+
+    order = rank_policies(violation_seconds, instance_seconds)
+    rows = []
+    for rank, i in enumerate(order, 1):
+        rows.append([rank, round(policies['cpu_upper'][i] * 100, 6), round(policies['disk_upper'][i] * 100, 6),
+                     policies['window_minutes'][i], policies['scale_up_size'][i], policies['scale_down_size'][i],
+                     policies['min_size'][i], policies['max_size'][i], violation_seconds[i] / 60,
+                     instance_seconds[i] / 3600, scale_ups[i], scale_downs[i]])
+
+    with open(args.output, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(RANKING_FIELDNAMES)
+        writer.writerows(rows)
+
+    print("Simulated {} policies over {} trace(s), ranking written to {}".format(num_policies, len(traces),
+                                                                                  args.output))
+    for row in rows[:args.top]:
+        print(', '.join('{}={}'.format(field, '{:.4g}'.format(value) if isinstance(value, float) else value)
+                        for field, value in zip(RANKING_FIELDNAMES, row)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+#!/usr/bin/python3
+"""
+SQLite store of every campaign's results, for queries across runs.
+
+`ingest` loads the aws_metrics_<...> and testresults_<test_id>.jtl files of
+results directories (one campaign each) into a single database:
+
+- tests: one row per (campaign, test_id) with the test params as indexed
+  columns
+- metrics: the aws_metrics rows, indexed by test and timestamp
+- latency_summary: jtl_analysis.py's summary rows (with ALL roll-ups) and
+  the merged latency histogram as json
+- latency_buckets: samples, errors and latency percentiles per --period
+- test_latency: view of tests joined with their overall (ALL, ALL) summary
+
+Files are hashed and parsed in a process pool; the parent process is the
+only writer. A file is skipped if the store already has a file of the same
+name and content hash, wherever it was ingested from, so re-running ingest
+over the same directories (by any path) only loads new or changed files (a
+changed file replaces what its test had of that kind). A campaign is keyed
+by the real path of its directory.
+
+aws_metrics csv files written before get_logs.py recorded bucket timestamps
+get timestamps derived from test_start_time and the timepoint, assuming
+run-tests.sh's 30 s sample period.
+
+    ./results_store.py ingest results/* results_remote_lb/*
+    ./results_store.py query "SELECT asg_cpu_max, AVG(p99_ms) FROM test_latency
+                              WHERE image_size = 5 GROUP BY asg_cpu_max"
+"""
+import csv
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from capacity_join import DEFAULT_PERIOD_SEC, METRICS_FILE_PATTERN, LatencyBuckets, bucket_jtl, get_period
+from jtl_analysis import ALL_LABEL, PERCENTILES, SUMMARY_FIELDNAMES, add_rollups, analyze_jtl, iter_summary_rows
+from metrics_output import COLUMNAR_FORMATS, FILENAME_PARAM_FIELDS, TEST_PARAM_FIELDS, read_metrics_params, \
+    read_metrics_table
+
+DEFAULT_DB_PATH = os.path.join('results', 'results.sqlite')
+DEFAULT_RESULTS_DIRS = ['results/*/', 'results_remote_lb/*/']
+HASH_CHUNK_BYTES = 1024 * 1024
+
+JTL_FILE_PATTERN = re.compile(r'^testresults_(\d+)\.jtlb?$')
+
+METRICS_COLUMNS = ['timestamp', 'timepoint', 'instance_id', 'cpu0_util', 'cpu1_util', 'mem_util', 'disk_util',
+                   'network_out', 'running_time_ms']
+# 'p99.9_ms' isn't a valid column name
+SUMMARY_COLUMNS = [field.replace('.', '_') for field in SUMMARY_FIELDNAMES if field != 'file']
+SUMMARY_COLUMN_TYPES = {'thread_group': 'TEXT', 'label': 'TEXT', 'samples': 'INTEGER', 'errors': 'INTEGER'}
+BUCKET_PERCENTILE_COLUMNS = ['p{}_ms'.format(percentile).replace('.', '_') for percentile in PERCENTILES]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    test_rowid INTEGER,
+    ingested_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+CREATE TABLE IF NOT EXISTS tests (
+    rowid INTEGER PRIMARY KEY,
+    campaign TEXT NOT NULL,
+    test_id INTEGER NOT NULL,
+    {params},
+    metrics_path TEXT,
+    jtl_path TEXT,
+    UNIQUE (campaign, test_id)
+);
+CREATE INDEX IF NOT EXISTS tests_params ON tests (image_size, asg_policy_type, asg_cpu_max, asg_disk_max);
+CREATE INDEX IF NOT EXISTS tests_users ON tests (num_users_a, num_users_b, num_users_c);
+CREATE INDEX IF NOT EXISTS tests_start_time ON tests (test_start_time);
+CREATE TABLE IF NOT EXISTS metrics (
+    test_rowid INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    timepoint INTEGER,
+    instance_id TEXT,
+    cpu0_util REAL,
+    cpu1_util REAL,
+    mem_util REAL,
+    disk_util REAL,
+    network_out REAL,
+    running_time_ms REAL
+);
+CREATE INDEX IF NOT EXISTS metrics_test_time ON metrics (test_rowid, timestamp);
+CREATE TABLE IF NOT EXISTS latency_summary (
+    test_rowid INTEGER NOT NULL,
+    {summary},
+    histogram TEXT
+);
+CREATE INDEX IF NOT EXISTS latency_summary_test ON latency_summary (test_rowid, thread_group, label);
+CREATE TABLE IF NOT EXISTS latency_buckets (
+    test_rowid INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    period_sec INTEGER NOT NULL,
+    samples INTEGER,
+    errors INTEGER,
+    {percentiles}
+);
+CREATE INDEX IF NOT EXISTS latency_buckets_test_time ON latency_buckets (test_rowid, timestamp);
+CREATE VIEW IF NOT EXISTS test_latency AS
+    SELECT tests.*, {summary_names}
+    FROM tests JOIN latency_summary ON latency_summary.test_rowid = tests.rowid
+    WHERE latency_summary.thread_group = '{all_label}' AND latency_summary.label = '{all_label}';
+""".format(params=',\n    '.join('{} INTEGER'.format(field) for field in TEST_PARAM_FIELDS if field != 'test_id'),
+           summary=',\n    '.join('{} {}'.format(column, SUMMARY_COLUMN_TYPES.get(column, 'REAL'))
+                                  for column in SUMMARY_COLUMNS),
+           percentiles=',\n    '.join('{} REAL'.format(column) for column in BUCKET_PERCENTILE_COLUMNS),
+           summary_names=', '.join('latency_summary.' + column for column in SUMMARY_COLUMNS
+                                   if column not in ('thread_group', 'label')),
+           all_label=ALL_LABEL)
+
+
+def connect(db_path: str):
+    connection = sqlite3.connect(db_path)
+    # readers (query) don't block the ingest writer
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def hash_file(path: str):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as data_file:
+        for chunk in iter(lambda: data_file.read(HASH_CHUNK_BYTES), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def find_files(campaign_dir: str):
+    """
+    List the (kind, test_id, path) of every aws_metrics and jtl file of a results directory; a metrics csv is
+    preferred over its columnar copies, and a csv jtl over its .jtlb.
+    """
+    metrics_paths = {}
+    jtl_paths = {}
+    for path in sorted(glob.glob(os.path.join(campaign_dir, '*'))):
+        name = os.path.basename(path)
+        match = METRICS_FILE_PATTERN.match(name)
+        if match is not None:
+            test_id = int(match.group(1))
+            if test_id not in metrics_paths or path.endswith('.csv'):
+                metrics_paths[test_id] = path
+            continue
+        match = JTL_FILE_PATTERN.match(name)
+        if match is not None:
+            test_id = int(match.group(1))
+            if test_id not in jtl_paths or path.endswith('.jtl'):
+                jtl_paths[test_id] = path
+    files = [('metrics', test_id, path) for test_id, path in metrics_paths.items()] + \
+        [('jtl', test_id, path) for test_id, path in jtl_paths.items()]
+    return sorted(files, key=lambda item: (item[1], item[0]))
+
+
+def parse_metrics_filename(path: str):
+    """
+    Test params packed into an aws_metrics filename, see metrics_output.get_metrics_filename.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    values = name[len('aws_metrics_'):].split('_')
+    if len(values) != len(FILENAME_PARAM_FIELDS):
+        raise ValueError("Can't parse the test params of {}".format(path))
+    return {field: int(value) for field, value in zip(FILENAME_PARAM_FIELDS, values)}
+
+
+def to_float(value):
+    return float(value) if value != '' else None
+
+
+def parse_metrics(path: str):
+    """
+    Read an aws_metrics file into its test params and rows in METRICS_COLUMNS order.
+    """
+    if path.endswith(COLUMNAR_FORMATS['parquet']) or path.endswith(COLUMNAR_FORMATS['arrow']):
+        params = read_metrics_params(path)
+        table = read_metrics_table(path, columns=METRICS_COLUMNS)
+        columns = [table.column(column).to_pylist() for column in METRICS_COLUMNS]
+        rows = list(zip(*columns))
+    else:
+        params = parse_metrics_filename(path)
+        with open(path, newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader)
+            indices = [header.index(column) for column in METRICS_COLUMNS[1:]]
+            timestamp_index = header.index('timestamp') if 'timestamp' in header else None
+            rows = []
+            for row in reader:
+                values = [row[index] for index in indices]
+                timepoint = int(values[0])
+                if timestamp_index is not None:
+                    timestamp = int(row[timestamp_index])
+                else:
+                    # written before the timestamp column existed, with run-tests.sh's sample period
+                    timestamp = params['test_start_time'] + timepoint * DEFAULT_PERIOD_SEC
+                rows.append((timestamp, timepoint, values[1]) + tuple(to_float(value) for value in values[2:]))
+        if timestamp_index is None:
+            params['sample_period'] = DEFAULT_PERIOD_SEC
+        elif rows:
+            params['sample_period'] = get_period(np.array([row[0] for row in rows]))
+    return {'params': params, 'rows': rows}
+
+
+def parse_jtl(path: str, period_sec: int):
+    """
+    Summarize a jtl into latency_summary rows and latency_buckets rows on a period_sec grid.
+    """
+    stats = add_rollups(analyze_jtl(path))
+    summary_rows = [row[1:] + [json.dumps(stats[(row[1], row[2])].elapsed.to_dict())]
+                    for row in iter_summary_rows(None, stats)]
+
+    bucket_rows = []
+    overall = stats.get((ALL_LABEL, ALL_LABEL))
+    if overall is not None and overall.samples > 0:
+        grid_start = overall.first_start_ms // 1000 // period_sec * period_sec
+        num_buckets = int((overall.last_end_ms / 1000 - grid_start) // period_sec) + 1
+        samples, errors, latency_counts, _ = bucket_jtl(path, grid_start, period_sec, num_buckets)
+        percentiles = LatencyBuckets().percentiles(latency_counts, PERCENTILES)
+        for b in np.flatnonzero(samples):
+            bucket_rows.append((int(grid_start + b * period_sec), period_sec, int(samples[b]), int(errors[b])) +
+                               tuple(float(value) for value in percentiles[b]))
+    return {'summary_rows': summary_rows, 'bucket_rows': bucket_rows}
+
+
+def parse_file(kind: str, path: str, period_sec: int):
+    if kind == 'metrics':
+        return parse_metrics(path)
+    return parse_jtl(path, period_sec)
+
+
+def get_test_rowid(connection, campaign: str, test_id: int):
+    connection.execute('INSERT OR IGNORE INTO tests (campaign, test_id) VALUES (?, ?)', (campaign, test_id))
+    return connection.execute('SELECT rowid FROM tests WHERE campaign = ? AND test_id = ?',
+                              (campaign, test_id)).fetchone()[0]
+
+
+def store_metrics(connection, test_rowid: int, path: str, parsed):
+    params = {field: value for field, value in parsed['params'].items() if field != 'test_id'}
+    assignments = ', '.join('{} = ?'.format(field) for field in params)
+    connection.execute('UPDATE tests SET {}, metrics_path = ? WHERE rowid = ?'.format(assignments),
+                       list(params.values()) + [path, test_rowid])
+    connection.execute('DELETE FROM metrics WHERE test_rowid = ?', (test_rowid,))
+    connection.executemany('INSERT INTO metrics (test_rowid, {}) VALUES (?, {})'.format(
+        ', '.join(METRICS_COLUMNS), ', '.join('?' * len(METRICS_COLUMNS))),
+        ((test_rowid,) + tuple(row) for row in parsed['rows']))
+
+
+def store_jtl(connection, test_rowid: int, path: str, parsed):
+    connection.execute('UPDATE tests SET jtl_path = ? WHERE rowid = ?', (path, test_rowid))
+    connection.execute('DELETE FROM latency_summary WHERE test_rowid = ?', (test_rowid,))
+    connection.execute('DELETE FROM latency_buckets WHERE test_rowid = ?', (test_rowid,))
+    columns = SUMMARY_COLUMNS + ['histogram']
+    connection.executemany('INSERT INTO latency_summary (test_rowid, {}) VALUES (?, {})'.format(
+        ', '.join(columns), ', '.join('?' * len(columns))),
+        ([test_rowid] + row for row in parsed['summary_rows']))
+    columns = ['timestamp', 'period_sec', 'samples', 'errors'] + BUCKET_PERCENTILE_COLUMNS
+    connection.executemany('INSERT INTO latency_buckets (test_rowid, {}) VALUES (?, {})'.format(
+        ', '.join(columns), ', '.join('?' * len(columns))),
+        ((test_rowid,) + row for row in parsed['bucket_rows']))
+
+
+def ingest(db_path: str, results_dirs, workers: int = None, period_sec: int = DEFAULT_PERIOD_SEC):
+    """
+    Load new or changed files of results_dirs into the store. Returns (ingested, skipped, failed) file counts.
+    """
+    files = []
+    for results_dir in results_dirs:
+        # the same directory is the same campaign however it is named on the command line
+        campaign = os.path.realpath(results_dir)
+        files.extend((campaign, kind, test_id, os.path.join(campaign, os.path.basename(path)))
+                     for kind, test_id, path in find_files(results_dir))
+
+    connection = connect(db_path)
+    ingested = skipped = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(hash_file, [path for _, _, _, path in files], chunksize=8))
+
+        new_files = []
+        seen = set()
+        for file_info, sha256 in zip(files, hashes):
+            # aws_metrics and jtl names hold the test id (and params), so a file with the same name and content is
+            # the same result, even if it was copied or moved
+            name = os.path.basename(file_info[3])
+            known_paths = [path for path, in connection.execute('SELECT path FROM files WHERE sha256 = ?',
+                                                                 (sha256,))]
+            if (name, sha256) in seen or any(os.path.basename(path) == name for path in known_paths):
+                skipped = skipped + 1
+            else:
+                seen.add((name, sha256))
+                new_files.append(file_info + (sha256,))
+
+        futures = [executor.submit(parse_file, kind, path, period_sec) for _, kind, _, path, _ in new_files]
+        for (campaign, kind, test_id, path, sha256), future in zip(new_files, futures):
+            try:
+                parsed = future.result()
+            except Exception as error:
+                print("Failed to ingest {}: {}".format(path, error), file=sys.stderr)
+                failed = failed + 1
+                continue
+            # one transaction per file, so an interrupted ingest never leaves a file half loaded
+            with connection:
+                test_rowid = get_test_rowid(connection, campaign, test_id)
+                if kind == 'metrics':
+                    store_metrics(connection, test_rowid, path, parsed)
+                else:
+                    store_jtl(connection, test_rowid, path, parsed)
+                connection.execute('INSERT OR REPLACE INTO files (path, sha256, kind, test_rowid, ingested_at) '
+                                   'VALUES (?, ?, ?, ?, ?)', (path, sha256, kind, test_rowid, time.time()))
+            ingested = ingested + 1
+            print("Ingested {}".format(path))
+    connection.close()
+    return ingested, skipped, failed
+
+
+def query(db_path: str, sql: str, params=()):
+    """
+    Run a query against the store. Returns (column names, rows, elapsed seconds).
+    """
+    connection = sqlite3.connect('file:{}?mode=ro'.format(db_path), uri=True)
+    try:
+        start = time.perf_counter()
+        cursor = connection.execute(sql, params)
+        rows = cursor.fetchall()
+        elapsed = time.perf_counter() - start
+        columns = [description[0] for description in cursor.description or []]
+    finally:
+        connection.close()
+    return columns, rows, elapsed
+
+
+def main():
+    parser = ArgumentParser(description="Store the results of every campaign in one SQLite database")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="Database file (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    ingest_parser = subparsers.add_parser('ingest', help="Load new or changed result files")
+    ingest_parser.add_argument('results_dirs', nargs='*',
+                               help="Results directories, one per campaign (default: {})".format(
+                                   ' '.join(DEFAULT_RESULTS_DIRS)))
+    ingest_parser.add_argument('--workers', type=int, default=None,
+                               help="Processes used to hash and parse files (default: number of cpus)")
+    ingest_parser.add_argument('--period', type=int, default=DEFAULT_PERIOD_SEC,
+                               help="Bucket size in seconds of latency_buckets (default: %(default)s)")
+
+    query_parser = subparsers.add_parser('query', help="Run an SQL query and print the rows as csv")
+    query_parser.add_argument('sql')
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        results_dirs = args.results_dirs or sorted(path for pattern in DEFAULT_RESULTS_DIRS
+                                                   for path in glob.glob(pattern))
+        ingested, skipped, failed = ingest(args.db, results_dirs, args.workers, args.period)
+        print("{} file(s) ingested, {} already in {}, {} failed".format(ingested, skipped, args.db, failed))
+    else:
+        columns, rows, elapsed = query(args.db, args.sql)
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        writer.writerows(rows)
+        print("{} row(s) in {:.1f} ms".format(len(rows), elapsed * 1000), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
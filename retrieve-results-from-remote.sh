@@ -1,12 +1,13 @@
 #!/bin/bash
 
 # Parse flags
-while getopts i:r: option
+while getopts i:r:b option
 do
 case "${option}"
 in
 i) ssh_public_key=${OPTARG};;
 r) local_results_dir=${OPTARG};;
+b) binary_jtl=true;;
 esac
 done
 
@@ -41,10 +42,20 @@ then
     exit 1
 fi
 
-# Expected results directory path on load generator
-remote_results_dir=/home/ubuntu/load-generator-scripts-seng533/results
+# Expected scripts and results directory paths on load generator
+remote_scripts_dir=/home/ubuntu/load-generator-scripts-seng533
+remote_results_dir=${remote_scripts_dir}/results
+
+rsync_options=()
+if [[ "${binary_jtl}" = "true" ]]
+then
+    # Convert the jtl files to .jtlb on the load generator and only copy those
+    ssh -i ${ssh_public_key} ubuntu@${load_generator_dns} \
+        "cd ${remote_scripts_dir} && find results -name 'testresults_*.jtl' -exec python3 jtl_binary.py encode --skip-existing {} +"
+    rsync_options=(--exclude 'testresults_*.jtl')
+fi
 
 # Retrieve remote results
-rsync -av --progress -e "ssh -i ${ssh_public_key}" \
+rsync -av --progress -e "ssh -i ${ssh_public_key}" "${rsync_options[@]}" \
        ubuntu@${load_generator_dns}:${remote_results_dir}/* \
        ${local_results_dir}
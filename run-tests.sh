@@ -6,8 +6,12 @@ asg_suffix=${2}
 
 asg_name="PicSiteASG${asg_suffix}"
 
-# Capture "ctrl + c" interruptions and kill the alarm monitor script if it is running
+# Optional: the UDP port instance_sidecar.py on the instances sends its samples to
+sidecar_port=${SIDECAR_PORT:-}
+
+# Capture "ctrl + c" interruptions and kill the alarm and load generator monitor scripts if they are running
 alarm_monitor_script_pid=
+loadgen_monitor_pid=
 
 exit_fn () {
     trap SIGINT             # Restore signal handling for SIGINT
@@ -15,6 +19,10 @@ exit_fn () {
     then
         kill ${alarm_monitor_script_pid}
     fi
+    if ! [[ "${loadgen_monitor_pid}" = "" ]]
+    then
+        kill ${loadgen_monitor_pid}
+    fi
     echo "Script interrupted while running tests ..."
     echo "Please run 'shutdown_load_balancing.sh' and 'shutdown_auto_scaling_group.sh' if you would like to stop testing."
     exit                    # Then exit script.
@@ -103,6 +111,8 @@ for i in $(seq 0 $(expr ${num_tests} - 1)) ; do
     num_instances=$(cat ${config_file} | jq ".[$i].num_instances")
     scale_down_size=$(cat ${config_file} | jq ".[$i].scale_down_size")
     scale_up_size=$(cat ${config_file} | jq ".[$i].scale_up_size")
+    latency_slo_p95_ms=$(cat ${config_file} | jq ".[$i].latency_slo_p95_ms")
+    latency_slo_p99_ms=$(cat ${config_file} | jq ".[$i].latency_slo_p99_ms")
     test_id=${i}
 
     # Set defaults
@@ -135,11 +145,38 @@ for i in $(seq 0 $(expr ${num_tests} - 1)) ; do
     echo "Waiting for desired starting instances (${num_instances}) for test ..."
     wait_for_desired_instances ${num_instances}
 
+    # optional latency SLO: asg_util_alarms.py follows the jtl, so JMeter has to flush every sample to it
+    alarm_monitor_args=()
+    jmeter_args=()
+    if [[ "${latency_slo_p95_ms}" != "null" ]]; then alarm_monitor_args+=(--slo-p95-ms "${latency_slo_p95_ms}"); fi
+    if [[ "${latency_slo_p99_ms}" != "null" ]]; then alarm_monitor_args+=(--slo-p99-ms "${latency_slo_p99_ms}"); fi
+    if [[ ${#alarm_monitor_args[@]} -gt 0 ]]
+    then
+        alarm_monitor_args+=(--latency-jtl "${results_dir}/testresults_${test_id}.jtl")
+        jmeter_args+=(-Jjmeter.save.saveservice.autoflush=true)
+    fi
+
+    # optional sidecar: asg_util_alarms.py collects and records the 1 s samples, get_logs.py reads them back
+    get_logs_args=()
+    if [[ -n "${sidecar_port}" ]]
+    then
+        sidecar_file="${results_dir}/sidecar_${test_id}.csv"
+        alarm_monitor_args+=(--sidecar-port "${sidecar_port}" --sidecar-record "${sidecar_file}")
+        get_logs_args+=(--source sidecar --sidecar-file "${sidecar_file}")
+    fi
+
     # setup auto-scaling monitor script and track pid to kill it later
     trap 'exit_fn' SIGINT
-    python3 asg_util_alarms.py "${asg_name}" "${cpu_max}" "${disk_max}" &
+    python3 asg_util_alarms.py "${asg_name}" "${cpu_max}" "${disk_max}" "${alarm_monitor_args[@]}" &
     alarm_monitor_script_pid=$!
 
+    # watch this host and the JMeter process for saturation while the test runs
+    loadgen_file="${results_dir}/loadgen_${test_id}.csv"
+    python3 loadgen_monitor.py record "${loadgen_file}" \
+        --match ApacheJMeter.jar --match "testresults_${test_id}.jtl" &
+    loadgen_monitor_pid=$!
+    get_logs_args+=(--loadgen-monitor "${loadgen_file}")
+
     # setup jmeter thread stop script and track pid to kill it later
     stop_delay=$((${duration} + 60))
     ./stop_jmeter_threads_after_delay.sh ${stop_delay} &
@@ -158,6 +195,7 @@ for i in $(seq 0 $(expr ${num_tests} - 1)) ; do
         -JImageSize="${image_size}" \
         -JTestID="${test_id}" \
         -JResultsDir="${results_dir}" \
+        "${jmeter_args[@]}" \
         -l ${results_dir}/testresults_${test_id}.jtl
     end_time=$(date +%s) # ms since epoch utc
     echo "Finished running JMeter test."
@@ -169,6 +207,12 @@ for i in $(seq 0 $(expr ${num_tests} - 1)) ; do
     trap SIGINT
     kill -s SIGINT ${alarm_monitor_script_pid} # seems to be global
 
+    # stop the load generator monitor and flag the samples JMeter took while saturated
+    kill ${loadgen_monitor_pid}
+    wait ${loadgen_monitor_pid}
+    loadgen_monitor_pid=
+    python3 loadgen_monitor.py flag "${loadgen_file}" --jtl "${results_dir}/testresults_${test_id}.jtl"
+
     # get our logs
     python3 get_logs.py "${results_dir}" "${asg_name}" \
         "${test_id}"  \
@@ -182,7 +226,8 @@ for i in $(seq 0 $(expr ${num_tests} - 1)) ; do
         "${image_size}" \
         "${num_users_a}" \
         "${num_users_b}" \
-        "${num_users_c}"
+        "${num_users_c}" \
+        "${get_logs_args[@]}"
 
     # clean-up remaining instances
     echo "Cleaning up instances after test ..."
@@ -0,0 +1,61 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+# The scripts are flat modules at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loadgen import handle_stub_client  # noqa: E402
+
+
+class SlowReader:
+    """
+    Holds every request `delay` seconds before the stub server answers it.
+    """
+
+    def __init__(self, reader, delay: float):
+        self.reader = reader
+        self.delay = delay
+
+    async def readuntil(self, separator):
+        head = await self.reader.readuntil(separator)
+        await asyncio.sleep(self.delay)
+        return head
+
+    async def readexactly(self, n):
+        return await self.reader.readexactly(n)
+
+
+@pytest.fixture
+def stub_server():
+    """
+    stub_server(image_bytes, delay) starts loadgen.py's stub server on an ephemeral port in a background thread
+    and returns the port.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    servers = []
+
+    def start(image_bytes: int = 1024, delay: float = 0.0):
+        def handle(reader, writer):
+            return handle_stub_client(SlowReader(reader, delay) if delay else reader, writer, image_bytes)
+        servers.append(loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', 0)))
+        thread.start()
+        return servers[0].sockets[0].getsockname()[1]
+
+    yield start
+
+    if thread.is_alive():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+    for server in servers:
+        server.close()
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(asyncio.wait(tasks))
+    loop.close()
@@ -0,0 +1,59 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import campaign
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST = {'autoscaling_value': 1, 'cpu_utilization_param': 70, 'disk_utilization_param': 70, 'test_duration': 600,
+        'image_size': 5, 'num_users_a': 1, 'num_users_b': 1, 'num_users_c': 1}
+
+
+def write_test_list(tmp_path, num_tests):
+    path = str(tmp_path / 'test_list.json')
+    with open(path, 'w') as test_list:
+        json.dump([TEST] * num_tests, test_list)
+    return path
+
+
+def test_failed_test_is_cleaned_up_and_every_slot_torn_down(tmp_path):
+    tests = campaign.load_tests(write_test_list(tmp_path, 4))
+    backend = campaign.FakeAwsBackend(time_scale=0.0001)
+    jmeter = campaign.FakeJMeterRunner(time_scale=0.0001, fail_test_ids=[1])
+
+    results = campaign.run_campaign(backend, jmeter, tests, ['1', '2'], str(tmp_path))
+
+    assert isinstance(results.pop(1), RuntimeError)
+    assert results == {0: None, 2: None, 3: None}
+    calls = backend.calls
+    # every test scaled its group back down, the failed one too, and its alarm monitor was stopped
+    assert sum(call[0] == 'shutdown_group' for call in calls) == 4
+    assert sum(call[0] == 'start_alarm_monitor' for call in calls) == \
+        sum(call[0] == 'stop_alarm_monitor' for call in calls) == 4
+    assert sorted(call[2] for call in calls if call[0] == 'collect_logs') == [0, 2, 3]
+    assert [call for call in calls if call[0] == 'teardown'] == [('teardown', '1'), ('teardown', '2')]
+    assert calls[-2:] == [('teardown', '1'), ('teardown', '2')]
+
+
+def test_sigint_stops_the_campaign_and_tears_down(tmp_path):
+    # at this time scale a test takes about 12 s
+    process = subprocess.Popen([sys.executable, 'campaign.py', write_test_list(tmp_path, 4), '--dry-run',
+                                '--time-scale', '0.01', '--asg-suffixes', '1', '2',
+                                '--results-dir', str(tmp_path / 'results')],
+                               cwd=REPO_DIR, stderr=subprocess.PIPE, universal_newlines=True)
+    time.sleep(5)
+    interrupted = time.monotonic()
+    process.send_signal(signal.SIGINT)
+    _, output = process.communicate(timeout=60)
+
+    assert process.returncode == 1
+    # the waits give up at once instead of running the remaining tests
+    assert time.monotonic() - interrupted < 5
+    assert "Campaign interrupted" in output
+    assert "('teardown', '1')" in output and "('teardown', '2')" in output
+    assert output.count("'start_alarm_monitor'") == output.count("'stop_alarm_monitor'") > 0
+    assert output.count("'shutdown_group'") == output.count("'prepare_group'")
+    assert "'collect_logs'" not in output
@@ -0,0 +1,35 @@
+import numpy as np
+
+from capacity_join import bucket_jtl
+from results_store import parse_jtl
+
+HEADER = 'timeStamp,elapsed,label,responseCode,threadName,success\n'
+
+
+def write_jtl(tmp_path):
+    jtl_path = tmp_path / 'testresults_1.jtl'
+    jtl_path.write_text(HEADER +
+                        '1000000,120,login,200,Users A 1-1,true\n'
+                        'bad,130,login,200,Users A 1-1,true\n'
+                        '1031000,oops,login,200,Users A 1-2,true\n'
+                        '1032000,140,login,500,Users A 1-2,false\n'
+                        '1999000,150,login,200,Users A 1-2,true\n'
+                        '1033000,150,login\n')
+    return str(jtl_path)
+
+
+def test_bucket_jtl_drops_rows_with_non_integer_fields(tmp_path):
+    samples, errors, latency_counts, dropped = bucket_jtl(write_jtl(tmp_path), 1000, 30, 3, 0.01)
+
+    assert samples.tolist() == [1, 1, 0]
+    assert errors.tolist() == [0, 1, 0]
+    assert latency_counts.sum() == 2
+    # two unparsable rows and one outside the grid; the truncated last row isn't a sample
+    assert dropped == 3
+
+
+def test_parse_jtl_ingests_around_non_integer_fields(tmp_path):
+    parsed = parse_jtl(write_jtl(tmp_path), 30)
+
+    assert sum(row[2] for row in parsed['bucket_rows']) == 3
+    assert np.isfinite([row[4] for row in parsed['bucket_rows']]).all()
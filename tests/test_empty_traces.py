@@ -0,0 +1,47 @@
+import csv
+import os
+import subprocess
+import sys
+
+import capacity_join
+import policy_simulator
+from metrics_output import CSV_FIELDNAMES
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_metrics(results_dir, test_id, rows):
+    path = os.path.join(str(results_dir), 'aws_metrics_{}_1000_1600_1_70_70_600_5_1_1_1.csv'.format(test_id))
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(CSV_FIELDNAMES)
+        writer.writerows(rows)
+    return path
+
+
+def write_jtl(results_dir, test_id):
+    path = os.path.join(str(results_dir), 'testresults_{}.jtl'.format(test_id))
+    with open(path, 'w', newline='') as jtl_file:
+        writer = csv.writer(jtl_file)
+        writer.writerow(['timeStamp', 'elapsed', 'label', 'responseCode', 'threadName', 'success'])
+        writer.writerow([1000000, 120, 'home', 200, 'User A 1-1', 'true'])
+    return path
+
+
+def test_empty_metrics_file_is_skipped(tmp_path):
+    empty_path = write_metrics(tmp_path, 0, [])
+    write_metrics(tmp_path, 1, [[timepoint, 0.5, 0.5, 0.3, 0.2, 100, 'i-1', 5000, 1000 + timepoint * 30]
+                                for timepoint in range(20)])
+
+    assert policy_simulator.load_trace(empty_path) is None
+    assert capacity_join.join_test(empty_path, write_jtl(tmp_path, 0), str(tmp_path / 'capacity_0.csv')) is None
+    assert not os.path.exists(str(tmp_path / 'capacity_0.csv'))
+
+    # the sweep goes on with the other trace
+    output_path = str(tmp_path / 'ranking.csv')
+    result = subprocess.run([sys.executable, 'policy_simulator.py', str(tmp_path), '--workers', '1',
+                             '--output', output_path], cwd=REPO_DIR, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    assert 'No instance data in {}'.format(empty_path) in result.stderr
+    assert 'over 1 trace(s)' in result.stdout
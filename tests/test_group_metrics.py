@@ -0,0 +1,44 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import asg_util_alarms
+from fake_aws import FakeAws
+from group_metrics import GroupUtilizationQuery
+
+ASG_NAME = 'PicSiteASG'
+PERIOD_SEC = 60
+WINDOW_MINUTES = 10
+
+
+def test_group_query_matches_per_instance_path():
+    aws = FakeAws(6, ASG_NAME, time.time() - 3600)
+    # one instance in another group, which the group query must not pick up either
+    aws.add_group('OtherASG', 1)
+    running_ids = [instance.id for instance in aws.instances if instance.asg_name == ASG_NAME]
+    # two still waiting to be ready, and one that stopped running but still has datapoints in the window
+    ready_ids = running_ids[:3]
+    stopped_ids = running_ids[5:]
+    running_ids = running_ids[:5]
+    end_time = datetime.now(timezone.utc)
+    start_time = end_time - timedelta(minutes=WINDOW_MINUTES)
+
+    expected_cpu, expected_disk = asg_util_alarms.get_average_utils(
+        aws.cw_client, ready_ids, start_time, end_time, PERIOD_SEC, WINDOW_MINUTES, ASG_NAME)
+
+    query = GroupUtilizationQuery(WINDOW_MINUTES)
+    # the stopped instance was seen running on an earlier tick
+    query.get_excluded_instance_ids(running_ids + stopped_ids, ready_ids, end_time.timestamp() - 60)
+    cpu, disk = query.get_utils(aws.cw_client, ASG_NAME, running_ids, ready_ids, start_time, end_time, PERIOD_SEC)
+
+    assert expected_cpu is not None and expected_disk is not None
+    assert cpu == pytest.approx(expected_cpu, abs=1e-6)
+    assert disk == pytest.approx(expected_disk, abs=1e-6)
+    assert query.api_calls == 1
+
+    # with every instance included, the average moves
+    all_cpu, _ = GroupUtilizationQuery(WINDOW_MINUTES).get_utils(
+        aws.cw_client, ASG_NAME, running_ids + stopped_ids, running_ids + stopped_ids, start_time, end_time,
+        PERIOD_SEC)
+    assert all_cpu != pytest.approx(expected_cpu, abs=1e-3)
@@ -0,0 +1,49 @@
+import time
+
+from asg_util_alarms import LAUNCH_TIME_DELAY_SECONDS, get_ready_instances
+from fake_aws import FakeAws
+from instance_readiness import ReadinessTracker
+
+ASG_NAME = 'PicSiteASG'
+TICK_SECONDS = 60
+TICKS = 60
+
+
+def get_status_calls(aws):
+    return aws.calls.get('describe_instance_status', 0)
+
+
+def test_tracker_matches_per_instance_checks_with_fewer_calls():
+    start = time.time() // TICK_SECONDS * TICK_SECONDS
+    # 10 instances up since before the run, 10 more launched one every 5 ticks
+    aws = FakeAws(10, ASG_NAME, start - 3600)
+    for i in range(10):
+        aws.add_group(ASG_NAME, 1, start + i * 5 * TICK_SECONDS)
+    tracker = ReadinessTracker(LAUNCH_TIME_DELAY_SECONDS)
+
+    per_instance_calls = 0
+    tracker_calls = 0
+    expected_per_instance_calls = 0
+    for tick in range(TICKS):
+        now = start + tick * TICK_SECONDS
+        # instances launch when their time comes; three of the first ones are terminated halfway through
+        running = [instance for instance in aws.instances if instance.launch_epoch <= now]
+        if tick >= TICKS // 2:
+            running = running[3:]
+
+        calls = get_status_calls(aws)
+        expected = get_ready_instances(aws.ec2_client, running, now)
+        per_instance_calls = per_instance_calls + get_status_calls(aws) - calls
+
+        calls = get_status_calls(aws)
+        ready_ids, waiting = tracker.update(aws.ec2_client, running, now)
+        tracker_calls = tracker_calls + get_status_calls(aws) - calls
+
+        assert (ready_ids, waiting) == expected, tick
+        expected_per_instance_calls = expected_per_instance_calls + len(
+            [instance for instance in running if now - instance.launch_epoch >= LAUNCH_TIME_DELAY_SECONDS])
+
+    assert per_instance_calls == expected_per_instance_calls
+    # one batched call on the first tick and one per instance that finishes its launch delay
+    assert tracker_calls == tracker.status_calls == 1 + 10
+    assert tracker_calls * 20 < per_instance_calls
@@ -0,0 +1,112 @@
+import csv
+import math
+import threading
+import time
+
+import pytest
+
+from instance_sidecar import (HEADER, MAGIC, RECORD_COLUMNS, SidecarCollector, decode_datagram,
+                              encode_datagram, read_sidecar_logs, run_sidecar)
+
+SAMPLES = [(1000.0, 1.0, 80.0, 60.0, 250.0, 40.0, 1e6),
+           (1001.0, 1.0, 70.0, math.nan, 500.0, 41.0, 2e6)]
+
+
+def test_datagram_round_trip():
+    instance_id, samples = decode_datagram(encode_datagram('i-0123456789abcdef0', SAMPLES))
+
+    assert instance_id == 'i-0123456789abcdef0'
+    assert len(samples) == 2
+    for sample, expected in zip(samples, SAMPLES):
+        # the metrics are sent as 32 bit floats
+        assert sample[:2] == expected[:2]
+        assert math.isnan(sample[3]) == math.isnan(expected[3])
+        assert [value for value in sample[2:] if not math.isnan(value)] == \
+            pytest.approx([value for value in expected[2:] if not math.isnan(value)])
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'SCR',
+    b'XXXX' + encode_datagram('i-1', SAMPLES)[4:],
+    encode_datagram('i-1', SAMPLES)[:-1],
+    HEADER.pack(MAGIC, 200) + b'i-1',
+])
+def test_decode_rejects_bad_datagrams(data):
+    with pytest.raises(ValueError):
+        decode_datagram(data)
+
+
+def test_collector_ignores_bad_datagrams():
+    collector = SidecarCollector(window_seconds=1)
+
+    assert collector.add_datagram(b'not a datagram', 1000.0) is None
+    assert collector.bad_datagrams == 1
+    assert collector.get_window_samples('i-1', 1000.0) is None
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_sidecar_to_collector_over_loopback(tmp_path):
+    record_path = str(tmp_path / 'sidecar.csv')
+    collector = SidecarCollector(port=0, host='127.0.0.1', window_seconds=0.5, stale_seconds=5,
+                                 record_path=record_path).start()
+    stop_event = threading.Event()
+    sender = threading.Thread(target=run_sidecar, args=(('127.0.0.1', collector.get_port()), 'i-loopback'),
+                              kwargs={'interval': 0.05, 'batch': 2, 'stop_event': stop_event})
+    sender.start()
+    try:
+        assert wait_for(lambda: 'i-loopback' in collector.get_reporting_ids(time.time()))
+        now = time.time()
+        assert collector.covers(['i-loopback'], now)
+        assert not collector.covers(['i-loopback', 'i-silent'], now)
+
+        cpu_utils, disk_util = collector.get_instance_utils('i-loopback', now)
+        assert 0 <= cpu_utils[0] <= 1
+        assert collector.get_newest_timestamp(['i-loopback']) <= now
+        # nothing counts once the instance has gone quiet for stale_seconds
+        assert collector.get_instance_utils('i-loopback', now + 60) is None
+        assert collector.get_reporting_ids(now + 60) == set()
+    finally:
+        stop_event.set()
+        sender.join()
+        collector.stop()
+
+    with open(record_path, newline='') as record_file:
+        rows = list(csv.DictReader(record_file))
+    assert rows and rows[0].keys() == set(RECORD_COLUMNS)
+    assert {row['instance_id'] for row in rows} == {'i-loopback'}
+
+
+def test_read_sidecar_logs_buckets_samples(tmp_path):
+    record_path = str(tmp_path / 'sidecar.csv')
+    with open(record_path, 'w', newline='') as record_file:
+        writer = csv.writer(record_file)
+        writer.writerow(RECORD_COLUMNS)
+        for second in range(1001, 1021):
+            # cpu0 30% busy in the first 10 s bucket, 50% in the second; the disk 10% busy
+            cpu0_idle = 70 if second <= 1010 else 50
+            writer.writerow(['i-1', second, 1.0, cpu0_idle, 'nan', 100.0, 40.0, 1000.0])
+        # another group's instance, and a sample starting before the test
+        writer.writerow(['i-other', 1005, 1.0, 0, 0, 0, 0, 0])
+        writer.writerow(['i-1', 1000, 1.0, 0, 0, 0, 0, 0])
+
+    logs = read_sidecar_logs([record_path], [('i-1', 500.0), ('i-2', 500.0)], 1000, 1020, 10)
+
+    assert len(logs) == 1
+    log = logs[0]
+    assert (log['instance_id'], log['launch_time']) == ('i-1', 500.0)
+    assert log['timestamps']['cpu0_utils'] == [1000.0, 1010.0]
+    assert log['cpu0_utils'] == pytest.approx([0.3, 0.5])
+    assert log['cpu1_utils'] == []
+    assert log['disk_utils'] == pytest.approx([0.1, 0.1])
+    assert log['mem_utils'] == pytest.approx([40.0, 40.0])
+    # bytes per second scaled to CloudWatch's 60 s NetworkOut datapoints
+    assert log['network_out_values'] == pytest.approx([60000.0, 60000.0])
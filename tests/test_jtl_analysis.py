@@ -0,0 +1,20 @@
+from jtl_analysis import analyze_jtl
+
+HEADER = 'timeStamp,elapsed,label,responseCode,threadName,success\n'
+
+
+def test_rows_with_non_integer_fields_are_skipped(tmp_path):
+    jtl_path = tmp_path / 'testresults_1.jtl'
+    jtl_path.write_text(HEADER +
+                        '1000,120,login,200,Users A 1-1,true\n'
+                        'bad,130,login,200,Users A 1-1,true\n'
+                        '2000,oops,login,200,Users A 1-2,true\n'
+                        '3000,140,login,500,Users A 1-2,false\n'
+                        '4000,150,login\n')
+
+    stats = analyze_jtl(str(jtl_path))
+
+    assert list(stats) == [('Users A', 'login')]
+    sampler_stats = stats[('Users A', 'login')]
+    assert (sampler_stats.samples, sampler_stats.errors) == (2, 1)
+    assert (sampler_stats.first_start_ms, sampler_stats.last_end_ms) == (1000, 3140)
@@ -0,0 +1,81 @@
+import csv
+import io
+
+import numpy as np
+import pytest
+
+from jtl_binary import JtlBinaryReader, decode_jtl, encode_jtl
+
+HEADER = ['timeStamp', 'elapsed', 'label', 'responseCode', 'threadName', 'success', 'failureMessage', 'bytes',
+          'URL']
+
+
+def get_rows():
+    rows = []
+    for i in range(11):
+        rows.append([1554000000000 + i * 1000, 100 + i, 'Get Image', 200, 'User A 1-{}'.format(i % 3 + 1), 'true',
+                     '', 5000 + i, 'http://lb/static/images/random_image_5mb_{}.bmp'.format(i)])
+    # quoted fields with commas, quotes and a line break
+    rows[1][2] = 'Login, then redirect'
+    rows[2][6] = 'Assertion failed: "ok"\nexpected 200'
+    rows[3][8] = 'http://lb/search?q=a,b'
+    # empty fields, and leading zeros that must not come back as plain integers
+    rows[4][1] = ''
+    rows[5][3] = '007'
+    # wider than int64
+    rows[7][7] = '123456789012345678901234567890'
+    rows[8][7] = '-9223372036854775809'
+    return rows
+
+
+def write_csv(path, rows, lineterminator):
+    with open(str(path), 'w', newline='') as jtl_file:
+        writer = csv.writer(jtl_file, lineterminator=lineterminator)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+
+@pytest.mark.parametrize('lineterminator', ['\r\n', '\n'])
+def test_round_trip_is_byte_identical(tmp_path, lineterminator):
+    rows = get_rows()
+    # a row cut short, as an interrupted test leaves it, is the only thing dropped
+    write_csv(tmp_path / 'in.jtl', rows[:6] + [rows[6][:4]] + rows[6:], lineterminator)
+    write_csv(tmp_path / 'expected.jtl', rows, lineterminator)
+
+    # several blocks, some with integer columns that have to fall back to strings
+    assert encode_jtl(str(tmp_path / 'in.jtl'), str(tmp_path / 'in.jtlb'), block_rows=3) == 1
+    decode_jtl(str(tmp_path / 'in.jtlb'), str(tmp_path / 'out.jtl'))
+
+    assert (tmp_path / 'out.jtl').read_bytes() == (tmp_path / 'expected.jtl').read_bytes()
+    with JtlBinaryReader(str(tmp_path / 'in.jtlb')) as reader:
+        assert len(reader.index) == 4
+        assert reader.num_rows == len(rows)
+
+
+def test_time_range_reads_only_rows_in_range(tmp_path):
+    rows = get_rows()
+    # a garbled timeStamp makes its whole block's column strings; that row has no time and is never in range
+    rows[10][0] = 'bad'
+    write_csv(tmp_path / 'in.jtl', rows, '\r\n')
+    encode_jtl(str(tmp_path / 'in.jtl'), str(tmp_path / 'in.jtlb'), block_rows=3)
+    start_ms = 1554000000000 + 2000
+    end_ms = 1554000000000 + 9500
+    expected = [row for row in rows if row[0] != 'bad' and start_ms <= row[0] < end_ms]
+
+    with JtlBinaryReader(str(tmp_path / 'in.jtlb')) as reader:
+        values = reader.read(['timeStamp', 'bytes'], start_ms=start_ms, end_ms=end_ms)
+        # a block whose rows are all earlier isn't read; the block with the garbled row always is
+        assert reader.get_blocks(start_ms + 1000, end_ms).tolist() == [1, 2, 3]
+        in_range = list(reader.iter_rows(start_ms, end_ms))
+
+    assert [int(value) for value in values['timeStamp']] == [row[0] for row in expected]
+    assert [str(value) for value in values['bytes']] == [str(row[7]) for row in expected]
+    assert values['timeStamp'].dtype == object
+    assert np.array_equal(np.array([int(row[0]) for row in in_range]), np.array([row[0] for row in expected]))
+
+    decode_jtl(str(tmp_path / 'in.jtlb'), str(tmp_path / 'out.jtl'), start_ms, end_ms)
+    expected_csv = io.StringIO(newline='')
+    writer = csv.writer(expected_csv)
+    writer.writerow(HEADER)
+    writer.writerows(expected)
+    assert (tmp_path / 'out.jtl').read_bytes() == expected_csv.getvalue().encode()
@@ -0,0 +1,25 @@
+from latency_slo import LatencySloMonitor
+
+
+def test_poll_skips_rows_with_bad_fields(tmp_path):
+    jtl_path = tmp_path / 'testresults_0.jtl'
+    lines = ['timeStamp,elapsed,label,success']
+    for i in range(30):
+        lines.append('{},{},home,true'.format(1000000 + i * 10, 100 if i != 5 else 'oops'))
+    lines.append('not-a-time,100,home,true')
+    jtl_path.write_text('\n'.join(lines) + '\n')
+    monitor = LatencySloMonitor(str(jtl_path), p95_ms=500, min_samples=1)
+
+    monitor.poll()
+
+    p95_ms, p99_ms, samples, errors = monitor.get_latency(now=1001)
+    assert samples == 29
+    assert errors == 0
+    assert not monitor.is_breached(p95_ms, p99_ms)
+
+    # later rows are still read
+    with open(str(jtl_path), 'a') as jtl_file:
+        jtl_file.write('1000500,900,home,false\n')
+    monitor.poll()
+    assert monitor.get_latency(now=1001)[2:] == (30, 1)
+    monitor.close()
@@ -0,0 +1,127 @@
+import asyncio
+import csv
+import re
+
+import pytest
+
+from loadgen import IMAGE_PATH, JTL_FIELDNAMES, ArrivalSchedule, parse_properties, run_load
+
+IMAGE_URL = re.compile(r'^http://127\.0\.0\.1:\d+' + re.escape(IMAGE_PATH).replace(r'\{\}', r'\d+') + '$')
+
+
+@pytest.fixture
+def current_loop():
+    # run_load runs on the current event loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def read_jtl(jtl_path):
+    with open(str(jtl_path), newline='') as jtl_file:
+        rows = list(csv.reader(jtl_file))
+    return rows[0], [dict(zip(rows[0], row)) for row in rows[1:]]
+
+
+def test_closed_loop_run_against_the_stub(tmp_path, stub_server, current_loop):
+    port = stub_server()
+    params = parse_properties(['usersA=2', 'usersB=2', 'usersC=2', 'duration=3', 'ImageSize=1',
+                               'LoadBalancerDNS=127.0.0.1:{}'.format(port)])
+    jtl_path = tmp_path / 'testresults_1.jtl'
+
+    generator = run_load(params, str(jtl_path))
+
+    header, samples = read_jtl(jtl_path)
+    assert header == JTL_FIELDNAMES
+    assert len(samples) == generator.samples > 0
+    assert all(len(sample) == len(JTL_FIELDNAMES) and None not in sample for sample in samples)
+    assert generator.errors == 0 and all(sample['success'] == 'true' for sample in samples)
+
+    threads = {}
+    for sample in samples:
+        threads.setdefault(sample['threadName'], []).append(sample)
+    assert {name.rsplit(' ', 1)[0] for name in threads} == {'User A', 'User B', 'User C'}
+    for thread_name, thread_samples in threads.items():
+        thread_samples.sort(key=lambda sample: int(sample['timeStamp']))
+        images = thread_samples
+        if not thread_name.startswith('User A'):
+            # B and C log in (redirected to /) before fetching images
+            assert thread_samples[0]['label'] == 'Login'
+            assert thread_samples[0]['URL'].endswith(':{}/login'.format(port))
+            images = thread_samples[1:]
+        assert all(sample['label'] == 'Get Image' and sample['responseCode'] == '200' and
+                   IMAGE_URL.match(sample['URL']) for sample in images)
+
+    # each group's second user starts half the duration after its first
+    for group, group_number in [('User A', 1), ('User B', 2), ('User C', 3)]:
+        first = int(threads['{} {}-1'.format(group, group_number)][0]['timeStamp'])
+        second = int(threads['{} {}-2'.format(group, group_number)][0]['timeStamp'])
+        assert second - first >= 1400
+
+
+def get_offsets(schedule, share=1.0):
+    offsets = [0.0]
+    while True:
+        offset = schedule.next_offset(offsets[-1], share)
+        if offset >= schedule.duration - 1e-9:
+            return offsets
+        offsets.append(offset)
+
+
+def test_constant_schedule():
+    offsets = get_offsets(ArrivalSchedule('constant:10', 2))
+
+    assert offsets == pytest.approx([i * 0.1 for i in range(20)])
+    # a generator with half the rate sends every other arrival
+    assert get_offsets(ArrivalSchedule('constant:10', 2), share=0.5) == pytest.approx(offsets[::2])
+
+
+def test_step_schedule():
+    offsets = get_offsets(ArrivalSchedule('step:4,10:1', 3))
+
+    # 4/s for the first second, then the last rate until the end
+    assert offsets == pytest.approx([0, 0.25, 0.5, 0.75] + [1 + i * 0.1 for i in range(20)])
+
+
+def test_ramp_schedule():
+    schedule = ArrivalSchedule('ramp:10:30', 10)
+    offsets = get_offsets(schedule)
+
+    assert [schedule.rate_at(t) for t in (0, 5, 10, 20)] == [10, 20, 30, 30]
+    gaps = [b - a for a, b in zip(offsets, offsets[1:])]
+    assert all(gap == pytest.approx(1 / schedule.rate_at(offset)) for offset, gap in zip(offsets, gaps))
+    # the mean rate of a linear ramp from 10/s to 30/s
+    assert len(offsets) == pytest.approx(200, abs=2)
+
+
+def test_bad_schedule():
+    for profile in ['constant', 'constant:x', 'step:1,2', 'ramp:1', 'burst:5']:
+        with pytest.raises(ValueError):
+            ArrivalSchedule(profile, 10)
+
+
+def test_open_loop_latency_includes_queueing(tmp_path, stub_server, current_loop):
+    delay = 0.05
+    rate = 50
+    port = stub_server(delay=delay)
+    params = parse_properties(['duration=1', 'ImageSize=1', 'LoadBalancerDNS=127.0.0.1:{}'.format(port)])
+    jtl_path = tmp_path / 'testresults_1.jtl'
+
+    # one request at a time, each taking at least 50 ms, scheduled every 20 ms
+    generator = run_load(params, str(jtl_path), ArrivalSchedule('constant:{}'.format(rate), 1), max_in_flight=1)
+
+    _, samples = read_jtl(jtl_path)
+    assert len(samples) == generator.samples == rate
+    assert generator.errors == 0
+
+    # timeStamp is the scheduled send time, not when the request got through
+    timestamps = sorted(int(sample['timeStamp']) for sample in samples)
+    assert all(abs(b - a - 1000 / rate) <= 1 for a, b in zip(timestamps, timestamps[1:]))
+    assert generator.max_start_delay > 1.0
+
+    # served one after the other, so the i-th response can't be done before (i + 1) * delay
+    ends = sorted(int(sample['timeStamp']) + int(sample['elapsed']) - timestamps[0] for sample in samples)
+    assert all(end >= (i + 1) * delay * 1000 - 2 for i, end in enumerate(ends))
+    assert max(int(sample['elapsed']) for sample in samples) >= rate * delay * 1000 - (rate - 1) * 1000 / rate - 2
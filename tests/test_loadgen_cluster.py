@@ -0,0 +1,140 @@
+import asyncio
+import csv
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import loadgen_cluster
+from loadgen import parse_properties
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class RecordingController(loadgen_cluster.Controller):
+    """
+    Also keeps the number of samples each worker reported.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reported = {}
+
+    def merge_interval(self, name, index, stats):
+        self.reported[name] = self.reported.get(name, 0) + sum(sampler_stats.samples
+                                                               for sampler_stats in stats.values())
+        super().merge_interval(name, index, stats)
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_controller(params, num_workers, port):
+    """
+    Run a RecordingController in a background thread; returns (thread, [controller]).
+    """
+    started = []
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        controller = RecordingController(params, num_workers, 1)
+        started.append(controller)
+        try:
+            loop.run_until_complete(controller.run('127.0.0.1', port))
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while not started:
+        time.sleep(0.01)
+    return thread, started[0]
+
+
+def start_worker(port, name, jtl_path):
+    return subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'loadgen_cluster.py'), 'worker',
+                             '--controller', '127.0.0.1:{}'.format(port), '--name', name, '-l', str(jtl_path)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_workers(controller, port, count, jtl_dir):
+    """
+    Start the workers one at a time, so worker wi runs shard i.
+    """
+    workers = {}
+    for i in range(count):
+        name = 'w{}'.format(i)
+        workers[name] = start_worker(port, name, jtl_dir / (name + '.jtl'))
+        while len(controller.workers) <= i:
+            time.sleep(0.05)
+    return workers
+
+
+def read_jtl(jtl_path):
+    with open(str(jtl_path), newline='') as jtl_file:
+        return list(csv.DictReader(jtl_file))
+
+
+def get_merged_samples(controller):
+    return sum(sampler_stats.samples for sampler_stats in loadgen_cluster.merge_stats(
+        controller.intervals.values()).values())
+
+
+def test_merged_samples_add_up_over_workers(tmp_path, stub_server):
+    port = get_free_port()
+    params = parse_properties(['usersA=4', 'usersB=2', 'usersC=2', 'duration=3', 'ImageSize=1',
+                               'LoadBalancerDNS=127.0.0.1:{}'.format(stub_server())])
+    thread, controller = start_controller(params, 2, port)
+    workers = start_workers(controller, port, 2, tmp_path)
+    for process in workers.values():
+        assert process.wait(timeout=60) == 0
+    thread.join(timeout=60)
+
+    worker_samples = {name: len(read_jtl(tmp_path / '{}.jtl'.format(name))) for name in workers}
+    assert all(samples > 0 for samples in worker_samples.values())
+    assert controller.reported == worker_samples
+    assert get_merged_samples(controller) == sum(worker_samples.values())
+    assert controller.disconnected == []
+    # shard k runs users k, k + 2, ... of every group
+    for i, name in enumerate(sorted(workers)):
+        thread_numbers = {int(row['threadName'].rsplit('-', 1)[1]) for row in read_jtl(tmp_path / (name + '.jtl'))}
+        assert all((number - 1) % 2 == i for number in thread_numbers)
+
+
+def test_killed_worker_shards_are_reassigned(tmp_path, stub_server):
+    port = get_free_port()
+    params = parse_properties(['usersA=6', 'usersB=3', 'usersC=3', 'duration=4', 'ImageSize=1',
+                               'LoadBalancerDNS=127.0.0.1:{}'.format(stub_server())])
+    thread, controller = start_controller(params, 3, port)
+    workers = start_workers(controller, port, 3, tmp_path)
+
+    # kill w2 mid-test, after it has reported the 1-2 s interval
+    time.sleep(controller.start_at + 2.5 - time.time())
+    workers['w2'].kill()
+    killed_at_ms = time.time() * 1000
+    for name in ['w0', 'w1']:
+        assert workers[name].wait(timeout=60) == 0
+    thread.join(timeout=60)
+
+    assert controller.disconnected == ['w2']
+    assert sorted(controller.workers['w0']['shards'] + controller.workers['w1']['shards']) == [0, 1, 2]
+
+    # the survivors' reports match their jtls, and w2's finished intervals are counted once, on top
+    rows = {name: read_jtl(tmp_path / (name + '.jtl')) for name in ['w0', 'w1']}
+    assert {name: controller.reported[name] for name in rows} == {name: len(rows[name]) for name in rows}
+    assert 0 < controller.reported['w2']
+    # the interval w2 was killed in is dropped, not half-counted
+    assert {index for index, names in controller.interval_workers.items() if 'w2' in names} == {0, 1}
+    assert get_merged_samples(controller) == sum(controller.reported.values())
+
+    # shard 2's users ran on whichever worker adopted it, only after w2 was gone
+    adopter = 'w0' if 2 in controller.workers['w0']['shards'] else 'w1'
+    adopted = [row for row in rows[adopter] if (int(row['threadName'].rsplit('-', 1)[1]) - 1) % 3 == 2]
+    assert adopted
+    assert min(int(row['timeStamp']) for row in adopted) >= killed_at_ms - 1000
@@ -0,0 +1,89 @@
+import csv
+
+import loadgen_monitor
+from jtl_binary import JtlBinaryReader, encode_jtl
+
+
+def write_monitor(path, saturated):
+    """
+    A monitor csv with one row per (end epoch seconds, interval) in `saturated`.
+    """
+    with open(path, 'w', newline='') as monitor_file:
+        writer = csv.writer(monitor_file)
+        writer.writerow(loadgen_monitor.MONITOR_COLUMNS)
+        for end, interval in saturated:
+            writer.writerow([end, interval] + [''] * (len(loadgen_monitor.MONITOR_COLUMNS) - 4) + [1, 'cpu'])
+
+
+def write_jtl(path, rows):
+    with open(path, 'w', newline='') as jtl_file:
+        writer = csv.writer(jtl_file, lineterminator='\n')
+        writer.writerow(['timeStamp', 'elapsed', 'label', 'success'])
+        writer.writerows(rows)
+
+
+def read_jtl(path):
+    with open(path, newline='') as jtl_file:
+        return list(csv.reader(jtl_file))
+
+
+def test_flag_compares_sample_times_with_the_intervals(tmp_path):
+    monitor_path = str(tmp_path / 'loadgen_0.csv')
+    jtl_path = str(tmp_path / 'testresults_0.jtl')
+    # saturated from 999.5 to 1000.5 s
+    write_monitor(monitor_path, [(1000.5, 1.0)])
+    write_jtl(jtl_path, [[999000, 100, 'before', 'true'],
+                         [999400, 200, 'overlapping start', 'true'],
+                         [1000000, 0, 'inside', 'true'],
+                         [1000400, 200, 'overlapping end', 'true'],
+                         [1000600, 100, 'after', 'true']])
+
+    samples, flagged = loadgen_monitor.flag_jtl(jtl_path, loadgen_monitor.load_saturated_intervals(monitor_path))
+
+    rows = read_jtl(jtl_path)
+    assert rows[0][-1] == loadgen_monitor.JTL_FLAG_COLUMN
+    assert [row[-1] for row in rows[1:]] == ['false', 'true', 'true', 'true', 'false']
+    assert (samples, flagged) == (5, 3)
+
+
+def test_flag_keeps_rows_it_cannot_parse(tmp_path):
+    monitor_path = str(tmp_path / 'loadgen_0.csv')
+    jtl_path = str(tmp_path / 'testresults_0.jtl')
+    write_monitor(monitor_path, [(1000, 1.0)])
+    write_jtl(jtl_path, [[999500, 10, 'a', 'true'],
+                         [999600, 'oops', 'b', 'true'],
+                         [999700]])
+
+    samples, flagged = loadgen_monitor.flag_jtl(jtl_path, loadgen_monitor.load_saturated_intervals(monitor_path))
+
+    rows = read_jtl(jtl_path)
+    assert rows[1:] == [['999500', '10', 'a', 'true', 'true'],
+                        ['999600', 'oops', 'b', 'true', ''],
+                        ['999700', '']]
+    assert (samples, flagged) == (1, 1)
+
+    # flagging again replaces the column instead of adding one
+    loadgen_monitor.flag_jtl(jtl_path, loadgen_monitor.load_saturated_intervals(monitor_path))
+    assert read_jtl(jtl_path)[0] == ['timeStamp', 'elapsed', 'label', 'success', loadgen_monitor.JTL_FLAG_COLUMN]
+
+
+def test_flag_binary_jtl(tmp_path):
+    monitor_path = str(tmp_path / 'loadgen_0.csv')
+    jtl_path = str(tmp_path / 'testresults_0.jtl')
+    write_monitor(monitor_path, [(1000, 1.0)])
+    write_jtl(jtl_path, [[998000, 10, 'a', 'true'], [999500, 10, 'b', 'true']])
+    encode_jtl(jtl_path, jtl_path + 'b')
+
+    assert loadgen_monitor.flag_jtl(jtl_path + 'b', loadgen_monitor.load_saturated_intervals(monitor_path)) == (2, 1)
+
+    with JtlBinaryReader(jtl_path + 'b') as reader:
+        assert reader.header[-1] == loadgen_monitor.JTL_FLAG_COLUMN
+        assert [row[-1] for row in reader.iter_rows()] == ['false', 'true']
+
+
+def test_bucket_flags(tmp_path):
+    monitor_path = str(tmp_path / 'loadgen_0.csv')
+    # saturated from 1004 to 1006 s
+    write_monitor(monitor_path, [(1005, 1.0), (1006, 1.0)])
+
+    assert loadgen_monitor.get_bucket_flags(monitor_path, [995, 1000, 1005, 1010], 5) == [0, 1, 1, 0]
@@ -0,0 +1,34 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from fake_aws import FakeAws
+from metric_cache import CachingClient, MetricCache
+
+ASG_NAME = 'PicSiteASG'
+PERIOD_SEC = 60
+
+
+def test_counters_are_exact_across_threads(tmp_path):
+    # old enough to be settled, so the second round is served from the cache
+    end = (time.time() - 3600) // PERIOD_SEC * PERIOD_SEC
+    aws = FakeAws(8, ASG_NAME, end - 7200)
+    cache = MetricCache(str(tmp_path))
+    client = CachingClient(aws.cw_client, cache)
+
+    def fetch(instance_id):
+        return client.get_metric_statistics(
+            Namespace='AWS/EC2', MetricName='CPUUtilization',
+            Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
+            StartTime=datetime.fromtimestamp(end - 1800, timezone.utc),
+            EndTime=datetime.fromtimestamp(end, timezone.utc), Period=PERIOD_SEC, Statistics=['Average'])
+
+    instance_ids = [instance.id for instance in aws.instances] * 50
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(fetch, instance_ids))
+        misses = cache.misses
+        list(executor.map(fetch, instance_ids))
+
+    assert cache.hits + cache.misses == 2 * len(instance_ids)
+    assert cache.misses == misses
+    assert client.api_calls == aws.calls['get_metric_statistics'] == misses
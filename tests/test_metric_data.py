@@ -0,0 +1,79 @@
+from metric_data import (INSTANCE_METRICS, MAX_QUERIES_PER_REQUEST, build_instance_queries, chunk_queries,
+                         get_logs_by_instance_batched, get_metric_data_batched)
+
+PERIOD_SEC = 60
+NUM_DATAPOINTS = 5
+
+
+class PagingClient:
+    """
+    A GetMetricData stub that returns NUM_DATAPOINTS ascending datapoints per query, `page_size` per response.
+    """
+
+    def __init__(self, page_size: int):
+        self.page_size = page_size
+        self.requests = []
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, ScanBy, NextToken=None):
+        self.requests.append({'ids': [query['Id'] for query in MetricDataQueries], 'scan_by': ScanBy,
+                              'next_token': NextToken})
+        page = int(NextToken) if NextToken else 0
+        first = page * self.page_size
+        last = min(first + self.page_size, NUM_DATAPOINTS)
+        results = []
+        for query in MetricDataQueries:
+            # a distinct value per query and datapoint; cpu idle stays a percentage
+            base = sum(ord(char) for char in query['Id']) % 50
+            results.append({'Id': query['Id'],
+                            'Timestamps': [StartTime + (i + 1) * PERIOD_SEC for i in range(first, last)],
+                            'Values': [float(base + i) for i in range(first, last)]})
+        response = {'MetricDataResults': results}
+        if last < NUM_DATAPOINTS:
+            response['NextToken'] = str(page + 1)
+        return response
+
+
+def test_chunk_queries():
+    chunks = list(chunk_queries(list(range(1201))))
+
+    assert [len(chunk) for chunk in chunks] == [500, 500, 201]
+    assert [item for chunk in chunks for item in chunk] == list(range(1201))
+
+
+def test_batched_fetch_chunks_pages_and_merges():
+    # 250 instances x 5 metrics = 1250 queries: 3 requests, each paged 3 times
+    instance_ids = ['i-{:05d}'.format(i) for i in range(250)]
+    queries, query_map = build_instance_queries('PicSiteASG', instance_ids, PERIOD_SEC)
+    client = PagingClient(page_size=2)
+
+    results, api_calls = get_metric_data_batched(client, queries, 0, 1000)
+
+    assert api_calls == 3 * 3 == len(client.requests)
+    assert all(len(request['ids']) <= MAX_QUERIES_PER_REQUEST for request in client.requests)
+    assert all(request['scan_by'] == 'TimestampAscending' for request in client.requests)
+    # every page of a chunk repeats the same queries
+    assert [request['next_token'] for request in client.requests] == [None, '1', '2'] * 3
+    assert client.requests[0]['ids'] == client.requests[2]['ids'] != client.requests[3]['ids']
+
+    assert set(results) == set(query_map)
+    for query_id, series in results.items():
+        assert series['Timestamps'] == [(i + 1) * PERIOD_SEC for i in range(NUM_DATAPOINTS)]
+        assert series['Values'] == sorted(series['Values'])
+        assert len(series['Values']) == NUM_DATAPOINTS
+
+
+def test_logs_by_instance_batched():
+    instances = [('i-a', 100.0), ('i-b', 200.0)]
+    client = PagingClient(page_size=NUM_DATAPOINTS)
+
+    logs, api_stats = get_logs_by_instance_batched(client, instances, 'PicSiteASG', 0, 1000, PERIOD_SEC)
+
+    assert api_stats == {'api_calls': 1, 'per_instance_api_calls': 2 * len(INSTANCE_METRICS),
+                         'api_calls_saved': 2 * len(INSTANCE_METRICS) - 1}
+    assert [(log['instance_id'], log['launch_time']) for log in logs] == instances
+    for log in logs:
+        for metric in INSTANCE_METRICS:
+            assert len(log[metric['key']]) == NUM_DATAPOINTS
+            assert log['timestamps'][metric['key']] == [(i + 1) * PERIOD_SEC for i in range(NUM_DATAPOINTS)]
+        # 'Idle Percent' -> 'Utilization'
+        assert all(0 < value <= 1 for value in log['cpu0_utils'])
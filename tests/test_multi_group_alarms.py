@@ -0,0 +1,110 @@
+import json
+import time
+
+import pytest
+
+import asg_util_alarms
+from aws_clients import ApiBudget, BudgetClient
+from fake_aws import FakeAws
+from group_metrics import GroupUtilizationQuery
+from instance_readiness import ReadinessTracker
+from multi_group_alarms import MultiGroupController, load_group_config
+
+PERIOD_SEC = 60
+WINDOW_MINUTES = 10
+TICKS = 3
+# bounds far enough from the fake data that each rule fires: scale up, scale down, no action
+CPU_UPPERS = [25, 70, 80, 70, 80, 90, 70, 70, 70, 80]
+
+
+def create_aws(num_groups):
+    aws = FakeAws(3, 'g0', time.time() - 3600)
+    for i in range(1, num_groups):
+        aws.add_group('g{}'.format(i), 1 + i % 4)
+    return aws
+
+
+def get_groups(num_groups):
+    return [{'asg_name': 'g{}'.format(i), 'cpu_upper': CPU_UPPERS[i], 'disk_upper': 70} for i in range(num_groups)]
+
+
+def wait_for_stable_minute():
+    # the fake data moves on at minute boundaries; keep the runs being compared within one minute
+    if time.time() % 60 > 50:
+        time.sleep(61 - time.time() % 60)
+
+
+def run_ticks(num_groups, query_mode):
+    """
+    Returns the last tick's decisions, the API calls of each tick, the fake account and the budget.
+    """
+    aws = create_aws(num_groups)
+    budget = ApiBudget(1000, 1000)
+    controller = MultiGroupController(aws.resource, BudgetClient(aws.ec2_client, budget),
+                                      BudgetClient(aws.cw_client, budget), get_groups(num_groups),
+                                      period_sec=PERIOD_SEC, window_minutes=WINDOW_MINUTES, query_mode=query_mode,
+                                      budget=budget)
+    tick_calls = []
+    for _ in range(TICKS):
+        calls = dict(aws.calls)
+        decisions = controller.run_tick()
+        tick_calls.append({operation: count - calls.get(operation, 0) for operation, count in aws.calls.items()
+                           if count > calls.get(operation, 0)})
+    return decisions, tick_calls, aws, budget
+
+
+@pytest.mark.parametrize('query_mode', ['group', 'instance'])
+def test_ten_groups_cost_the_same_steady_tick_calls_as_one(query_mode):
+    wait_for_stable_minute()
+    one_decisions, one_calls, _, _ = run_ticks(1, query_mode)
+    decisions, tick_calls, aws, budget = run_ticks(10, query_mode)
+
+    assert len(one_decisions) == 1 and len(decisions) == 10
+    # after the first tick nothing is pending readiness and no Target has changed
+    assert one_calls[1:] == tick_calls[1:] == [{'describe_instances': 1, 'get_metric_data': 1}] * (TICKS - 1)
+    assert tick_calls[0] == {'describe_instances': 1, 'describe_instance_status': 1, 'get_metric_data': 1,
+                             'put_metric_data': 10}
+    # every call, the resource's describe_instances included, took a token from the shared budget
+    assert budget.calls == sum(aws.calls.values())
+
+
+@pytest.mark.parametrize('query_mode', ['group', 'instance'])
+def test_decisions_match_run_scaling_notifier(query_mode):
+    wait_for_stable_minute()
+    decisions, _, aws, _ = run_ticks(10, query_mode)
+
+    for group in get_groups(10):
+        asg_name = group['asg_name']
+        cpu_upper = group['cpu_upper'] / 100
+        disk_upper = group['disk_upper'] / 100
+        group_query = GroupUtilizationQuery(WINDOW_MINUTES) if query_mode == 'group' else None
+        asg_util_alarms.run_scaling_notifier(aws.resource, aws.ec2_client, aws.cw_client, cpu_upper, cpu_upper * 0.5,
+                                             disk_upper, disk_upper * 0.5, PERIOD_SEC, WINDOW_MINUTES, asg_name,
+                                             readiness_tracker=ReadinessTracker(
+                                                 asg_util_alarms.LAUNCH_TIME_DELAY_SECONDS),
+                                             group_query=group_query)
+        published = [value for namespace, _, value in aws.put_values if namespace == asg_name]
+
+        decision = decisions[asg_name]
+        assert published[-1] == decision['target'], asg_name
+        expected = asg_util_alarms.decide_target(decision['avg_cpu_util'], decision['avg_disk_util'], cpu_upper,
+                                                 cpu_upper * 0.5, disk_upper, disk_upper * 0.5,
+                                                 decision['ready_instances'], decision['waiting_instances'])
+        assert expected[0] == decision['target']
+
+    assert {decision['target'] for decision in decisions.values()} == {0, 0.5, 1}
+
+
+def test_config_must_be_a_list_of_groups(tmp_path):
+    config_path = tmp_path / 'groups.json'
+    for config in [{'asg_name': 'g0', 'cpu_upper': 70, 'disk_upper': 70}, ['g0'], [None], 7, [70]]:
+        config_path.write_text(json.dumps(config))
+        with pytest.raises(ValueError):
+            load_group_config(str(config_path))
+
+    # a bad config is ignored and the controller keeps its groups
+    aws = create_aws(1)
+    controller = MultiGroupController(aws.resource, aws.ec2_client, aws.cw_client, get_groups(1),
+                                      config_path=str(config_path))
+    decisions = controller.run_tick()
+    assert list(decisions) == ['g0']
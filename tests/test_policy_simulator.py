@@ -0,0 +1,35 @@
+import itertools
+
+import numpy as np
+
+from asg_util_alarms import decide_target
+from policy_simulator import get_targets
+
+
+def to_array(values):
+    # no data is None for the controller and NaN for the simulator
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+def test_get_targets_matches_decide_target():
+    # zero, and either side of and on every bound
+    utils = [None, 0.0, 0.1, 0.24, 0.25, 0.26, 0.29, 0.3, 0.31, 0.34, 0.35, 0.36, 0.44, 0.45, 0.46, 0.5, 0.59,
+             0.6, 0.61, 0.69, 0.7, 0.71, 0.89, 0.9, 0.91, 1.0, 1.5]
+    # (cpu upper, disk upper), with the lower bounds at half, as in both
+    bounds = [(0.7, 0.6), (0.5, 0.9)]
+    grid = list(itertools.product(utils, utils, [0, 1, 2, 5], [0, 1, 3], bounds))
+
+    cpu, disk, ready, waiting, grid_bounds = zip(*grid)
+    cpu_upper = np.array([upper for upper, _ in grid_bounds])
+    disk_upper = np.array([upper for _, upper in grid_bounds])
+    # policies are arrays in the simulator, so the bounds vary per element too
+    targets = get_targets(to_array(cpu), to_array(disk), cpu_upper, cpu_upper * 0.5, disk_upper, disk_upper * 0.5,
+                          np.array(ready), np.array(waiting))
+
+    expected = [decide_target(cpu_util, disk_util, cpu_bound, cpu_bound * 0.5, disk_bound, disk_bound * 0.5,
+                              ready_instances, waiting_instances)[0]
+                for cpu_util, disk_util, ready_instances, waiting_instances, (cpu_bound, disk_bound) in grid]
+    mismatches = [(point, target, expected_target) for point, target, expected_target
+                  in zip(grid, targets.tolist(), expected) if target != expected_target]
+    assert mismatches == []
+    assert set(expected) == {0, 0.5, 1}
@@ -0,0 +1,64 @@
+import csv
+import os
+
+import results_store
+from metrics_output import CSV_FIELDNAMES
+
+# test_id, test_start_time, test_end_time, asg_policy_type, asg_cpu_max, asg_disk_max, asg_scaleup_duration,
+# image_size, num_users_a, num_users_b, num_users_c
+PARAMS = [3, 1000, 1600, 1, 70, 70, 600, 5, 1, 2, 3]
+
+
+def write_metrics(campaign_dir, fieldnames, rows):
+    path = os.path.join(str(campaign_dir), 'aws_metrics_{}.csv'.format('_'.join(str(value) for value in PARAMS)))
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(fieldnames)
+        writer.writerows(rows)
+
+
+def write_jtl(campaign_dir):
+    with open(os.path.join(str(campaign_dir), 'testresults_3.jtl'), 'w', newline='') as jtl_file:
+        writer = csv.writer(jtl_file)
+        writer.writerow(['timeStamp', 'elapsed', 'label', 'responseCode', 'threadName', 'success'])
+        for i in range(10):
+            writer.writerow([1000000 + i * 1000, 100 + i, 'home', 200, 'User A 1-1', 'true'])
+
+
+def count(db_path, table):
+    return results_store.query(db_path, 'SELECT COUNT(*) FROM {}'.format(table))[1][0][0]
+
+
+def test_ingest_skips_files_already_stored_under_another_path(tmp_path, monkeypatch):
+    campaign_dir = tmp_path / 'res' / 'c1'
+    campaign_dir.mkdir(parents=True)
+    write_metrics(campaign_dir, CSV_FIELDNAMES, [[0, 0.5, 0.4, 0.3, 0.2, 100, 'i-1', 5000, 1000],
+                                                 [1, 0.6, 0.5, 0.3, 0.2, 100, 'i-1', 5000, 1030]])
+    write_jtl(campaign_dir)
+    db_path = str(tmp_path / 'results.sqlite')
+    monkeypatch.chdir(str(tmp_path))
+
+    assert results_store.ingest(db_path, ['res/c1'], workers=1) == (2, 0, 0)
+    assert results_store.ingest(db_path, [str(campaign_dir)], workers=1) == (0, 2, 0)
+    assert results_store.ingest(db_path, ['res/../res/c1/'], workers=1) == (0, 2, 0)
+
+    assert count(db_path, 'tests') == 1
+    assert count(db_path, 'metrics') == 2
+    assert count(db_path, 'test_latency') == 1
+    campaign, sample_period = results_store.query(db_path, 'SELECT campaign, sample_period FROM tests')[1][0]
+    assert campaign == os.path.realpath(str(campaign_dir))
+    assert sample_period == 30
+
+
+def test_ingest_metrics_without_timestamps(tmp_path):
+    campaign_dir = tmp_path / 'c1'
+    campaign_dir.mkdir()
+    legacy_fieldnames = [field for field in CSV_FIELDNAMES if field != 'timestamp']
+    write_metrics(campaign_dir, legacy_fieldnames, [[0, 0.5, 0.4, 0.3, 0.2, 100, 'i-1', 5000],
+                                                    [1, 0.6, '', 0.3, 0.2, 100, 'i-1', 5000]])
+    db_path = str(tmp_path / 'results.sqlite')
+
+    assert results_store.ingest(db_path, [str(campaign_dir)], workers=1) == (1, 0, 0)
+
+    rows = results_store.query(db_path, 'SELECT timestamp, timepoint, cpu1_util FROM metrics ORDER BY timepoint')[1]
+    assert rows == [(1000, 0, 0.4), (1000 + results_store.DEFAULT_PERIOD_SEC, 1, None)]
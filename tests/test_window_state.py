@@ -0,0 +1,86 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import asg_util_alarms
+from fake_aws import FakeAws
+
+ASG_NAME = 'PicSiteASG'
+PERIOD_SEC = 60
+WINDOW_MINUTES = 10
+TICKS = 60
+
+
+class CountingClient:
+    """
+    Counts the datapoints each get_metric_statistics call returns.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = 0
+        self.datapoints = 0
+
+    def get_metric_statistics(self, **kwargs):
+        response = self.client.get_metric_statistics(**kwargs)
+        self.calls = self.calls + 1
+        self.datapoints = self.datapoints + len(response['Datapoints'])
+        return response
+
+
+class NoDataClient:
+    """
+    A CloudWatch client for instances whose agent hasn't reported anything yet.
+    """
+
+    def get_metric_statistics(self, **kwargs):
+        return {'Label': kwargs['MetricName'], 'Datapoints': []}
+
+
+def test_incremental_windows_match_full_window_queries():
+    # ticks a minute apart, well in the past so every datapoint has been published
+    first_tick = (time.time() - 3 * 3600) // PERIOD_SEC * PERIOD_SEC
+    aws = FakeAws(4, ASG_NAME, first_tick - 3600)
+    # two instances join at tick 20, and two of the first ones are gone from tick 40
+    aws.add_group(ASG_NAME, 2, first_tick + 20 * PERIOD_SEC)
+    # one more is ready from tick 10 but has no datapoints until tick 50
+    aws.add_group(ASG_NAME, 1, first_tick + 50 * PERIOD_SEC)
+    instance_ids = [instance.id for instance in aws.instances]
+    silent_id = instance_ids.pop()
+    full_client = CountingClient(aws.cw_client)
+    incremental_client = CountingClient(aws.cw_client)
+    window_states = {}
+
+    for tick in range(TICKS):
+        ready_ids = instance_ids[:4] if tick < 20 else instance_ids if tick < 40 else instance_ids[2:]
+        if tick >= 10:
+            ready_ids = ready_ids + [silent_id]
+        end_time = datetime.fromtimestamp(first_tick + tick * PERIOD_SEC + 5, timezone.utc)
+        start_time = end_time - timedelta(minutes=WINDOW_MINUTES)
+
+        expected = asg_util_alarms.get_average_utils(full_client, ready_ids, start_time, end_time, PERIOD_SEC,
+                                                     WINDOW_MINUTES, ASG_NAME)
+        utils = asg_util_alarms.get_average_utils(incremental_client, ready_ids, start_time, end_time, PERIOD_SEC,
+                                                  WINDOW_MINUTES, ASG_NAME, window_states=window_states)
+
+        assert utils == pytest.approx(expected, abs=1e-9), tick
+        assert set(window_states) == set(ready_ids)
+
+    # as many calls, but after the first tick only the newest datapoints come back
+    assert incremental_client.calls == full_client.calls
+    assert incremental_client.datapoints < full_client.datapoints / 2
+
+
+def test_empty_windows_have_no_utilization():
+    end_time = datetime.now(timezone.utc)
+    start_time = end_time - timedelta(minutes=WINDOW_MINUTES)
+    instance_ids = ['i-0000000000000000{}'.format(i) for i in range(2)]
+
+    expected = asg_util_alarms.get_average_utils(NoDataClient(), instance_ids, start_time, end_time, PERIOD_SEC,
+                                                 WINDOW_MINUTES, ASG_NAME)
+    utils = asg_util_alarms.get_average_utils(NoDataClient(), instance_ids, start_time, end_time, PERIOD_SEC,
+                                              WINDOW_MINUTES, ASG_NAME, window_states={})
+
+    assert utils == expected == (None, None)
+    assert asg_util_alarms.decide_target(*utils, 0.7, 0.3, 0.7, 0.3, 2, 0) == (0, "Scale down")
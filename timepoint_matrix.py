@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+"""
+Timestamp-aligned instances x timepoints x metrics array for get_logs.py.
+
+Every series is placed on a shared grid of `period_sec` buckets using the real
+CloudWatch timestamps, so instances that launched late, stopped reporting early
+or skipped a sample line up correctly. Missing samples start out as NaN and are
+then handled by an explicit fill policy.
+"""
+import numpy as np
+
+from metric_data import to_epoch_seconds
+
+# Order of the metric axis of the matrix
+METRIC_KEYS = ['cpu0_utils', 'cpu1_utils', 'disk_utils', 'mem_utils', 'network_out_values']
+
+# How gaps are filled:
+# - 'nan': leave gaps as NaN (written as empty CSV fields)
+# - 'zero': fill every gap with 0
+# - 'pad': carry the previous sample forward
+# - 'interpolate': linearly interpolate between the surrounding samples, carrying the last one forward
+# With every policy except 'nan', timepoints before an instance's first sample are 0, since the tests only scale
+# up and the instance simply did not exist yet.
+FILL_POLICIES = ['nan', 'zero', 'pad', 'interpolate']
+DEFAULT_FILL_POLICY = 'zero'
+
+
+def get_grid_start(logs_by_instance, start_time=None):
+    """
+    Get the timestamp of the first bucket: start_time if given, otherwise the earliest sample of any series.
+    """
+    if start_time is not None:
+        return to_epoch_seconds(start_time)
+
+    earliest = [min(timestamps) for log in logs_by_instance for timestamps in log['timestamps'].values()
+                if len(timestamps) > 0]
+    return min(earliest) if len(earliest) > 0 else 0.0
+
+
+def build_timepoint_matrix(logs_by_instance, period_sec: int, start_time=None, num_timepoints=None):
+    """
+    Place every metric series of every instance on a shared timestamp grid.
+
+    Expects each per-instance log to hold the value lists under METRIC_KEYS and the matching epoch-second
+    timestamps under log['timestamps'][key].
+
+    Returns (bucket_timestamps, matrix) where bucket_timestamps has shape (timepoints,) and matrix has shape
+    (instances, timepoints, metrics) with NaN wherever no sample was reported.
+    """
+    grid_start = get_grid_start(logs_by_instance, start_time)
+
+    # Convert every series to (bucket index, value) arrays up front
+    series = []
+    max_index = -1
+    for log in logs_by_instance:
+        instance_series = []
+        for key in METRIC_KEYS:
+            values = np.asarray(log.get(key) or [], dtype=np.float64)
+            timestamps = np.asarray(log['timestamps'].get(key) or [], dtype=np.float64)
+            indices = np.rint((timestamps - grid_start) / period_sec).astype(np.int64)
+            keep = indices >= 0
+            indices = indices[keep]
+            values = values[keep]
+            if len(indices) > 0:
+                max_index = max(max_index, int(indices.max()))
+            instance_series.append((indices, values))
+        series.append(instance_series)
+
+    if num_timepoints is None:
+        num_timepoints = max_index + 1
+
+    matrix = np.full((len(logs_by_instance), num_timepoints, len(METRIC_KEYS)), np.nan)
+    for i, instance_series in enumerate(series):
+        for m, (indices, values) in enumerate(instance_series):
+            keep = indices < num_timepoints
+            matrix[i, indices[keep], m] = values[keep]
+
+    bucket_timestamps = grid_start + period_sec * np.arange(num_timepoints, dtype=np.float64)
+    return bucket_timestamps, matrix
+
+
+def forward_fill(matrix):
+    """
+    Carry the last non-NaN value forward along the timepoint axis.
+    """
+    num_timepoints = matrix.shape[1]
+    index = np.where(np.isnan(matrix), 0, np.arange(num_timepoints)[None, :, None])
+    np.maximum.accumulate(index, axis=1, out=index)
+    filled = np.take_along_axis(matrix, index, axis=1)
+    return filled
+
+
+def interpolate(matrix):
+    """
+    Linearly interpolate interior gaps along the timepoint axis, leaving leading and trailing gaps untouched.
+    """
+    num_timepoints = matrix.shape[1]
+    positions = np.arange(num_timepoints, dtype=np.float64)
+    known = ~np.isnan(matrix)
+
+    # previous and next known position for every cell
+    previous_index = np.where(known, np.arange(num_timepoints)[None, :, None], 0)
+    np.maximum.accumulate(previous_index, axis=1, out=previous_index)
+    next_index = np.where(known, np.arange(num_timepoints)[None, :, None], num_timepoints - 1)
+    next_index = np.flip(np.minimum.accumulate(np.flip(next_index, axis=1), axis=1), axis=1)
+
+    previous_values = np.take_along_axis(matrix, previous_index, axis=1)
+    next_values = np.take_along_axis(matrix, next_index, axis=1)
+
+    span = (next_index - previous_index).astype(np.float64)
+    weight = np.divide(positions[None, :, None] - previous_index, span, out=np.zeros_like(span), where=span > 0)
+    interpolated = previous_values + weight * (next_values - previous_values)
+
+    return np.where(known, matrix, interpolated)
+
+
+def fill_gaps(matrix, fill_policy: str = DEFAULT_FILL_POLICY):
+    if fill_policy not in FILL_POLICIES:
+        raise ValueError("Unknown fill policy '{}', expected one of {}".format(fill_policy, FILL_POLICIES))
+
+    if fill_policy == 'nan':
+        return matrix
+    if fill_policy == 'zero':
+        return np.nan_to_num(matrix, nan=0.0)
+
+    if fill_policy == 'interpolate':
+        matrix = interpolate(matrix)
+    # trailing gaps after interpolation, or every gap for 'pad'
+    matrix = forward_fill(matrix)
+    # leading gaps: the instance had not launched yet
+    return np.nan_to_num(matrix, nan=0.0)
+
+
+def matrix_to_columns(instance_ids, launch_times, bucket_timestamps, matrix, end_time):
+    """
+    Flatten the matrix into per-column arrays in instance-major, timepoint-minor order, matching the rows of
+    the aws_metrics csv files.
+    """
+    num_instances, num_timepoints, _ = matrix.shape
+    values = matrix.reshape(num_instances * num_timepoints, len(METRIC_KEYS))
+
+    columns = {
+        'timepoint': np.tile(np.arange(num_timepoints), num_instances),
+        'instance_id': np.repeat(np.asarray(instance_ids, dtype=object), num_timepoints),
+        'running_time_ms': np.repeat(end_time - np.asarray(launch_times, dtype=np.float64), num_timepoints),
+        'timestamp': np.tile(np.asarray(bucket_timestamps, dtype=np.int64), num_instances),
+    }
+    for m, key in enumerate(METRIC_KEYS):
+        columns[key] = values[:, m]
+    return columns
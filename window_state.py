@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+"""
+Incremental sliding-window state for asg_util_alarms.py.
+
+Instead of re-querying the whole window for every instance on every tick, each
+instance keeps the datapoints still inside the window in a ring buffer with a
+running sum, and only the interval since the newest datapoint it has seen is
+fetched again.
+"""
+from collections import deque
+from datetime import timedelta
+
+from metric_data import to_epoch_seconds
+
+# Metrics tracked for every ready instance
+WINDOW_METRICS = ['cpu0', 'cpu1', 'disk']
+
+
+class MetricWindow:
+    """
+    Datapoints of a single metric from the last window_seconds, oldest first, with a running sum for the mean.
+    """
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self.points = deque()
+        self.total = 0.0
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def last_timestamp(self):
+        return self.points[-1][0] if self.points else None
+
+    def add(self, timestamp: float, value: float):
+        """
+        Add a datapoint. A datapoint for the newest timestamp replaces it, since CloudWatch keeps updating the
+        current period while it is still in progress. Older datapoints are ignored.
+        """
+        last_timestamp = self.last_timestamp
+        if last_timestamp is not None:
+            if timestamp < last_timestamp:
+                return
+            if timestamp == last_timestamp:
+                _, old_value = self.points.pop()
+                self.total = self.total - old_value
+
+        self.points.append((timestamp, value))
+        self.total = self.total + value
+
+    def expire(self, now: float):
+        cutoff = now - self.window_seconds
+        while self.points and self.points[0][0] < cutoff:
+            _, value = self.points.popleft()
+            self.total = self.total - value
+
+    def mean(self):
+        if len(self.points) == 0:
+            return None
+        return self.total / len(self.points)
+
+
+class InstanceWindowState:
+    """
+    Sliding windows for every metric of one instance.
+    """
+
+    def __init__(self, instance_id: str, window_minutes: int, period_sec: int):
+        self.instance_id = instance_id
+        self.period_sec = period_sec
+        self.window = timedelta(minutes=window_minutes)
+        self.windows = {metric: MetricWindow(self.window.total_seconds()) for metric in WINDOW_METRICS}
+
+    def get_fetch_start(self, metric: str, now):
+        """
+        Fetch from the newest datapoint seen (so an in-progress period gets refreshed), or the whole window the
+        first time.
+        """
+        last_timestamp = self.windows[metric].last_timestamp
+        window_start = now - self.window
+        if last_timestamp is None:
+            return window_start
+        # last_timestamp as a datetime of the same kind as now (asg_util_alarms uses naive UTC datetimes)
+        last_seen = now - timedelta(seconds=to_epoch_seconds(now) - last_timestamp)
+        return max(window_start, last_seen)
+
+    def add_datapoints(self, metric: str, datapoints):
+        """
+        Add CloudWatch datapoints (dicts with 'Timestamp' and 'Average') in time order.
+        """
+        window = self.windows[metric]
+        for timestamp, value in sorted((to_epoch_seconds(data_point['Timestamp']), data_point['Average'])
+                                       for data_point in datapoints):
+            window.add(timestamp, value)
+
+    def expire(self, now):
+        now_seconds = to_epoch_seconds(now)
+        for window in self.windows.values():
+            window.expire(now_seconds)
+
+    def mean(self, metric: str):
+        return self.windows[metric].mean()
+
+
+def get_newest_timestamp(window_states):
+    """
+    Get the timestamp of the newest datapoint held by any instance, or None.
+    """
+    timestamps = [window.last_timestamp for state in window_states.values() for window in state.windows.values()
+                  if window.last_timestamp is not None]
+    return max(timestamps) if timestamps else None